@@ -1,71 +1,180 @@
-import operator
 import random
+import numpy
 import util
 import EtfLot
+from EtfLot import DAYS_PER_YEAR
+from LotGroup import LotGroup, SAME_BASIS_PER_SHARE_TOLERANCE
+
+HARVEST_LOTS_WITH_LOSSES = False
+"""The list-of-EtfLots version of tax_loss_harvest compared (tax rate, "longterm")
+tuples from EtfLot.capital_gains_tax_rate against 0, which in Python 2 is never
+true, so it never actually harvested any lots; it only sorted them. Setting this
+to True harvests the lots with losses. Note that doing so makes the regular
+account pay trading fees that margin_leverage's simple approximations don't
+account for."""
+COMPACT_LOTS = True
+"""Merge lots bought the same day, and long-term lots with the same basis per
+share, where that can't change any results; see lots_can_be_compacted. With
+EtfLot.PARTIAL_SALES_REDUCE_BASIS off, as it is by default, that's nowhere."""
+LONG_TERM_BASIS_BUCKET_WIDTH = 0
+"""If > 0 and lots are compacted, long-term lots whose bases per share are
+within this fraction of each other get merged, which bounds the number of
+long-term lots at the cost of purchase prices being off by up to this
+fraction. If 0, lots are only merged when it can't change any results; see
+LotGroup."""
+CHECK_RUNNING_TOTALS = False
+"""If True, check the running totals of shares and cost basis against sums
+over all the lots after every change. This is slow and only for debugging."""
+RUNNING_TOTAL_TOLERANCE = 1e-9
+
+def lots_can_be_compacted(sells_best_for_taxes_first_only):
+    """Whether an account's lots can be merged without changing its results.
+    A partial sale's gain only doesn't depend on the size of the lot if
+    EtfLot.PARTIAL_SALES_REDUCE_BASIS, and selling in random order picks a lot
+    number out of however many lots there are, so the account has to always
+    sell the lots best for taxes first."""
+    return COMPACT_LOTS and EtfLot.PARTIAL_SALES_REDUCE_BASIS and sells_best_for_taxes_first_only
 
 class Assets(object):
-    """Stores the collection of ETF lots that the investor holds"""
+    """Stores the collection of ETF lots that the investor holds.
+
+    Every lot gets the same daily return, so instead of updating each lot's
+    value, the account keeps one price index (the value of a share), and a
+    lot's current value is its shares times the index. A day's price update is
+    then one multiply, and with a running total of shares, so is the total
+    value, however many lots there are. The total cost basis is likewise kept
+    as a running total that each buy, sale and harvest updates.
+
+    The lots are split into short-term and long-term LotGroups, each sorted by
+    basis per share, so the lots that are cheapest to sell tax-wise are at the
+    front of one of the groups, and lots with capital losses are a prefix of
+    each. Short-term lots move to the long-term group once they've been held a
+    year. Selling or harvesting thus costs about the number of lots touched
+    rather than a sort of all the lots.
+
+    A lot's basis per share is the price index it was bought at, so lots
+    bought at the same price, like two lots bought the same day, have exactly
+    the same tax rate and are sold in the order they were bought, as the list
+    of EtfLots that this replaced sorted them. That list compounded each lot's
+    value separately, and the rounding errors decided the order of such lots;
+    since a partial sale's gain depends on the size of the lot (see
+    EtfLot.PARTIAL_SALES_REDUCE_BASIS), results can differ from it slightly.
+
+    If compact_lots (see lots_can_be_compacted), lots bought the same day,
+    and long-term lots with the same basis per share, are merged into one lot
+    (see LotGroup). num_lots is the number of lots held after merging and
+    num_lots_without_compaction the number there would be without it."""
+
+    def __init__(self, randgenerator=None, compact_lots=False):
+        self.__short_term_lots = LotGroup(merge_same_day=compact_lots)
+        self.__long_term_lots = LotGroup(merge_same_day=compact_lots, merge_same_basis_per_share=compact_lots,
+            basis_per_share_tolerance=LONG_TERM_BASIS_BUCKET_WIDTH if LONG_TERM_BASIS_BUCKET_WIDTH > 0 \
+                else SAME_BASIS_PER_SHARE_TOLERANCE)
+        self.__price_index = 1.0
+        self.__total_shares = 0.0
+        self.__total_purchase_price = 0.0
+        self.__randgenerator = randgenerator
+        """Used to pick the order of lots to sell when not selling in tax-favored
+        order. It should be the path's lot-ordering stream from random_streams;
+        if it's None, the global random generator is used."""
 
-    def __init__(self):
-        self.__lots_list = []
+    @property
+    def num_lots(self):
+        return self.__short_term_lots.num_lots + self.__long_term_lots.num_lots
+
+    @property
+    def num_lots_without_compaction(self):
+        return self.__short_term_lots.num_purchases + self.__long_term_lots.num_purchases
 
     def buy_new_lot(self, purchase_amount, fee_per_dollar_traded, day):
-        self.__lots_list.append(EtfLot.EtfLot(purchase_amount, fee_per_dollar_traded, day))
+        purchase_price = purchase_amount * (1-fee_per_dollar_traded)
+        shares = purchase_price / self.__price_index
+        self.__short_term_lots.insert(purchase_price, day, shares, basis_per_share=self.__price_index)
+        self.__total_shares += shares
+        self.__total_purchase_price += purchase_price
+        self.__check_running_totals()
 
     def total_assets(self):
-        total = 0
-        for lot in self.__lots_list:
-            total += lot.current_price
-        return total
+        return self.__total_shares * self.__price_index
+
+    def total_cost_basis(self):
+        return self.__total_purchase_price
+
+    def __check_running_totals(self):
+        if not CHECK_RUNNING_TOTALS:
+            return
+        lot_groups = [self.__short_term_lots, self.__long_term_lots]
+        total_shares = sum(float(numpy.sum(lots.shares)) for lots in lot_groups)
+        total_purchase_price = sum(float(numpy.sum(lots.purchase_prices)) for lots in lot_groups)
+        for (name, running_total, total) in [("shares", self.__total_shares, total_shares),
+                ("cost basis", self.__total_purchase_price, total_purchase_price)]:
+            assert abs(running_total - total) <= RUNNING_TOTAL_TOLERANCE * max(abs(total), 1), \
+                "Running total of %s is %f but the lots add up to %f" % (name, running_total, total)
 
     def update_prices(self, rate_of_return):
-        lots_to_delete_because_lost_all_value = []
-        for lot in self.__lots_list:
-            if lot.update_price(rate_of_return):
-                lots_to_delete_because_lost_all_value.append(lot)
-        for lot_to_delete in lots_to_delete_because_lost_all_value:
-            self.__lots_list.remove(lot_to_delete)
-
-    def __get_sorted_tax_rates_and_lots(self, day, taxes):
-        """Sort lots by most-tax-advantaged-to-sell first"""
-        list_to_sort = [(lot.capital_gains_tax_rate(day, taxes.tax_rates), lot) for lot in self.__lots_list]
-        list_to_sort.sort(key=operator.itemgetter(0))
-        return list_to_sort
-
-    def sell(self, amount_of_net_cash_to_get_back, fee_per_dollar_traded, day, taxes, 
+        """Same as util.update_price for each lot. If the price would go below 0,
+        every lot has lost all its value and is removed."""
+        (self.__price_index, price_fell_to_zero) = util.update_price(self.__price_index, rate_of_return)
+        if price_fell_to_zero:
+            self.__remove_all_lots()
+        self.__check_running_totals()
+
+    def total_assets_after_price_updates(self, growth_factors):
+        """What total_assets would be after each of a run of update_prices calls,
+        for rates of return growth_factors - 1, which must all be > -1, as a
+        numpy array. Doesn't change anything."""
+        return self.__total_shares * util.running_products(self.__price_index, growth_factors)[1:]
+
+    def update_prices_over_days(self, growth_factors):
+        """Same as update_prices for each rate of return growth_factors - 1, all
+        of which must be > -1."""
+        if len(growth_factors) > 0:
+            self.__price_index = float(util.running_products(self.__price_index, growth_factors)[-1])
+        self.__check_running_totals()
+
+    def __remove_all_lots(self):
+        self.__short_term_lots.clear()
+        self.__long_term_lots.clear()
+        self.__total_shares = 0.0 # don't leave rounding errors behind
+        self.__total_purchase_price = 0.0
+        self.__price_index = 1.0 # any later purchases start from a fresh index
+
+    def __move_lots_that_became_long_term(self, day):
+        """Lots are inserted in the order they were in, so that lots with the
+        same basis per share stay in the order they were bought."""
+        lot_indices = self.__short_term_lots.indices_of_lots_purchased_on_or_before(day - DAYS_PER_YEAR)
+        lots_to_move = [self.__short_term_lots.remove(lot_index) for lot_index in reversed(lot_indices)]
+        for lot in reversed(lots_to_move):
+            self.__long_term_lots.insert(*lot)
+
+    def __tax_rate(self, lots, lot_index, is_long_term, tax_rates):
+        """What's the fraction of capital-gains tax paid per dollar of the lot
+        that's sold? Same as EtfLot.capital_gains_tax_rate."""
+        current_price = lots.shares[lot_index] * self.__price_index
+        rate = tax_rates.long_term_cap_gains_rate_plus_state() if is_long_term else \
+            tax_rates.short_term_cap_gains_rate_plus_state()
+        return (current_price - lots.purchase_prices[lot_index]) * rate / current_price
+
+    def sell(self, amount_of_net_cash_to_get_back, fee_per_dollar_traded, day, taxes,
              sell_best_for_taxes_first):
-        """If sell_best_for_taxes_first is True, sort lots according to which ones, 
-        if sold, incur least capital-gains tax. Otherwise sort randomly.
-        Since we're paying taxes, in order to get C dollars of after-tax cash back, we need 
+        """If sell_best_for_taxes_first is True, sell the lots which incur the least
+        capital-gains tax first, long-term lots first among equals. Otherwise
+        sell lots in random order.
+        Since we're paying taxes, in order to get C dollars of after-tax cash back, we need
         to sell more than C of actual ETFs.
         """
-        deficit_still_not_paid = 0
+        self.__move_lots_that_became_long_term(day)
         if sell_best_for_taxes_first:
-            # Sort to put ETFs that would incur lowest capital-gains taxes first.
-            # Use decorate-sort-undecorate pattern because too complicated to use
-            # the capital_gains_tax function as a sort key.
-            self.__lots_list = [lot for tax, lot in self.__get_sorted_tax_rates_and_lots(day, taxes)]
+            deficit_still_not_paid = self.__sell_best_for_taxes_first(
+                amount_of_net_cash_to_get_back, fee_per_dollar_traded, taxes)
         else:
-            random.shuffle(self.__lots_list)
-            """We're not using the seeded random generator here because this function is called
-            different numbers of times by different variants and different random rounds. So there's
-            some extra randomness introduced by this across variants of the simulation, but hopefully
-            the effect isn't huge."""
-
-        # get cash
-        cash_still_need_to_get = amount_of_net_cash_to_get_back
-        while cash_still_need_to_get > 0:
-            if self.__lots_list:
-                (cash_still_need_to_get, lot_emptied) = self.__lots_list[0].sell(
-                    cash_still_need_to_get, fee_per_dollar_traded, day, taxes)
-                if lot_emptied:
-                    self.__lots_list.pop(0)
-            else: # list is empty; we have no more securities, but we need cash!
-                deficit_still_not_paid = cash_still_need_to_get
-                print "Account wiped out with %s still needing to be repaid." % util.format_as_dollar_string(cash_still_need_to_get)
-                assert self.total_assets() == 0, "Total assets aren't 0 despite wiping out all assets."
-                break
-        
+            deficit_still_not_paid = self.__sell_in_random_order(
+                amount_of_net_cash_to_get_back, fee_per_dollar_traded, taxes)
+
+        if deficit_still_not_paid > 0: # we have no more securities, but we need cash!
+            print "Account wiped out with %s still needing to be repaid." % util.format_as_dollar_string(deficit_still_not_paid)
+            self.__remove_all_lots()
+
         """If you have a deficit that isn't yet paid, you tap into other savings
         you may have in order to pay for it. 
         I assume the other savings have long-term maturity. 
@@ -77,10 +186,127 @@ class Assets(object):
         So the increase in your long-term capital gains is half of the amount
         you sell."""
         taxes.add_long_term_cap_gains(deficit_still_not_paid/2)
+        self.__check_running_totals()
         return deficit_still_not_paid
 
+    def __sell_best_for_taxes_first(self, cash_still_need_to_get, fee_per_dollar_traded, taxes):
+        """Merge the fronts of the long-term and short-term groups, like a merge
+        sort, until we have enough cash. Emptied lots are removed at the end."""
+        num_long_term_lots_emptied = 0
+        num_short_term_lots_emptied = 0
+        partly_sold_lots = None
+        partly_sold_shares = 0
+        while cash_still_need_to_get > 0:
+            have_long_term_lot = num_long_term_lots_emptied < self.__long_term_lots.num_lots
+            have_short_term_lot = num_short_term_lots_emptied < self.__short_term_lots.num_lots
+            if not (have_long_term_lot or have_short_term_lot):
+                break
+            sell_long_term_lot = have_long_term_lot and (not have_short_term_lot or \
+                self.__tax_rate(self.__long_term_lots, num_long_term_lots_emptied, True, taxes.tax_rates) <= \
+                self.__tax_rate(self.__short_term_lots, num_short_term_lots_emptied, False, taxes.tax_rates))
+            if sell_long_term_lot:
+                (lots, lot_index) = (self.__long_term_lots, num_long_term_lots_emptied)
+            else:
+                (lots, lot_index) = (self.__short_term_lots, num_short_term_lots_emptied)
+            (cash_still_need_to_get, shares_sold, lot_emptied) = self.__sell_from_lot(
+                lots, lot_index, sell_long_term_lot, cash_still_need_to_get, fee_per_dollar_traded, taxes)
+            if not lot_emptied:
+                (partly_sold_lots, partly_sold_shares) = (lots, shares_sold)
+            elif sell_long_term_lot:
+                num_long_term_lots_emptied += 1
+            else:
+                num_short_term_lots_emptied += 1
+        self.__long_term_lots.remove_first(num_long_term_lots_emptied)
+        self.__short_term_lots.remove_first(num_short_term_lots_emptied)
+        if partly_sold_lots is not None and not EtfLot.PARTIAL_SALES_REDUCE_BASIS:
+            partly_sold_lots.sell_shares(0, partly_sold_shares)
+        return cash_still_need_to_get
+
+    def __sell_in_random_order(self, cash_still_need_to_get, fee_per_dollar_traded, taxes):
+        """Picking a random remaining lot each time gives the same order as
+        shuffling all the lots and selling from the front, but only draws as
+        many random numbers as lots get sold."""
+        while cash_still_need_to_get > 0 and self.num_lots > 0:
+            """This function is called different numbers of times by different variants and
+            different random rounds, so the generator used here has to be separate from the
+            one for market returns and employment. Otherwise shuffling would change those."""
+            if self.__randgenerator:
+                lot_number = self.__randgenerator.randrange(self.num_lots)
+            else:
+                lot_number = random.randrange(self.num_lots)
+            is_long_term = lot_number < self.__long_term_lots.num_lots
+            if is_long_term:
+                (lots, lot_index) = (self.__long_term_lots, lot_number)
+            else:
+                (lots, lot_index) = (self.__short_term_lots, lot_number - self.__long_term_lots.num_lots)
+            (cash_still_need_to_get, shares_sold, lot_emptied) = self.__sell_from_lot(
+                lots, lot_index, is_long_term, cash_still_need_to_get, fee_per_dollar_traded, taxes)
+            if lot_emptied:
+                lots.remove(lot_index)
+            elif not EtfLot.PARTIAL_SALES_REDUCE_BASIS:
+                lots.sell_shares(lot_index, shares_sold)
+        return cash_still_need_to_get
+
+    def __sell_from_lot(self, lots, lot_index, is_long_term, cash_still_need_to_get,
+                        fee_per_dollar_traded, taxes):
+        """Sell some or all of a lot to get needed $. Same as EtfLot.sell, except
+        that if the whole lot is sold, it's up to the caller to remove it, and if
+        part of it is sold and PARTIAL_SALES_REDUCE_BASIS isn't set, it's up to
+        the caller to take the shares sold off the lot (see LotGroup.sell_shares).
+        Returns (how much more cash is needed, shares sold, whether the whole lot
+        was sold)."""
+        purchase_price = lots.purchase_prices[lot_index]
+        shares = lots.shares[lot_index]
+        current_price = shares * self.__price_index
+        after_fee_value_of_lot = current_price * (1-fee_per_dollar_traded)
+
+        if after_fee_value_of_lot > cash_still_need_to_get:
+            amount_to_sell = cash_still_need_to_get / (1-fee_per_dollar_traded) # selling this amount leaves us with an after-fee amount of cash_still_need_to_get
+            if EtfLot.PARTIAL_SALES_REDUCE_BASIS:
+                fraction_sold = amount_to_sell / current_price
+                self.__record_cap_gains(taxes, is_long_term, (current_price - purchase_price) * fraction_sold)
+                self.__total_shares -= shares * fraction_sold
+                self.__total_purchase_price -= purchase_price * fraction_sold
+                lots.sell_fraction(lot_index, fraction_sold)
+                return (0, shares * fraction_sold, False)
+            shares_to_sell = amount_to_sell / self.__price_index
+            fraction_of_total_cap_gain_incurred = (current_price - amount_to_sell - purchase_price) * \
+                amount_to_sell / current_price
+            self.__record_cap_gains(taxes, is_long_term, fraction_of_total_cap_gain_incurred)
+            self.__total_shares -= shares_to_sell
+            return (0, shares_to_sell, False)
+        else: # sell the whole security
+            self.__record_cap_gains(taxes, is_long_term, current_price - purchase_price)
+            self.__total_shares -= shares
+            self.__total_purchase_price -= purchase_price
+            return (cash_still_need_to_get - after_fee_value_of_lot, shares, True)
+
+    def __record_cap_gains(self, taxes, is_long_term, amount_to_add):
+        if is_long_term:
+            taxes.add_long_term_cap_gains(amount_to_add)
+        else:
+            taxes.add_short_term_cap_gains(amount_to_add)
+
     def tax_loss_harvest(self, fee_per_dollar_traded, day, taxes):
-        lots_to_harvest = [lot for tax, lot in self.__get_sorted_tax_rates_and_lots(day, taxes) if tax < 0]
-        self.__lots_list = [lot for tax, lot in self.__get_sorted_tax_rates_and_lots(day, taxes) if tax >= 0] # only keep the remainder that aren't harvested
-        return sum([lot.harvest(fee_per_dollar_traded, day, taxes) for lot in lots_to_harvest]) # total earnings from selling the securities
-            
\ No newline at end of file
+        """Sell all lots with capital losses if HARVEST_LOTS_WITH_LOSSES. Returns
+        the total earnings from selling them."""
+        if not HARVEST_LOTS_WITH_LOSSES:
+            return 0
+        self.__move_lots_that_became_long_term(day)
+        earnings = 0
+        for (lots, is_long_term) in [(self.__long_term_lots, True), (self.__short_term_lots, False)]:
+            num_lots_to_harvest = lots.num_lots_with_basis_per_share_above(self.__price_index)
+            if num_lots_to_harvest > 0:
+                harvested_shares = lots.shares[:num_lots_to_harvest]
+                harvested_values = harvested_shares * self.__price_index
+                self.__record_cap_gains(taxes, is_long_term, float(numpy.sum(
+                    harvested_values - lots.purchase_prices[:num_lots_to_harvest])))
+                earnings += float(numpy.sum(harvested_values)) * (1-fee_per_dollar_traded)
+                self.__total_shares -= float(numpy.sum(harvested_shares))
+                self.__total_purchase_price -= float(numpy.sum(lots.purchase_prices[:num_lots_to_harvest]))
+                lots.remove_first(num_lots_to_harvest)
+        if self.num_lots == 0:
+            self.__total_shares = 0.0
+            self.__total_purchase_price = 0.0
+        self.__check_running_totals()
+        return earnings
@@ -0,0 +1,359 @@
+import random
+import numpy
+import util
+import BrokerageAccount
+from BrokerageAccount import EPSILON, FEE_PER_DOLLAR_TRADED, MIN_ADDITIONAL_PURCHASE_AMOUNT
+from EtfLot import DAYS_PER_YEAR
+
+AGGREGATE_LONG_TERM_LOTS = False
+"""Without this, an account that keeps lots has a column of lots per purchase
+(or per purchase day), so its memory grows as the number of paths times the
+number of purchases: e.g., 3 arrays of 8 bytes for each of 360 monthly
+purchases over 30 years come to about 8.6 KB per path, or 86 MB for a batch
+of 10,000 paths, plus the copies that selling makes, so a batch of a million
+paths wouldn't fit in memory. Setting this to True merges each path's lots
+into one lot, whose purchase price is their total purchase price (an
+average-cost basis), as soon as they become long-term. Then only the lots
+bought in the past year have columns of their own, and memory doesn't grow
+with the horizon. But results differ from one_run's: the long-term lots are
+no longer sold highest basis first, and selling in random order draws from
+fewer lots. (It's the batched version of Assets.LONG_TERM_BASIS_BUCKET_WIDTH
+with buckets wide enough to hold every basis.)"""
+
+class BatchedAccounts(object):
+    """One BrokerageAccount for each of num_paths sample paths, for
+    margin_leverage.batched_runs. Margin, shares and lots are numpy arrays
+    with an element per path, and every method acts on all paths at once.
+    Methods that take a boolean array paths only change the paths where it's
+    True; arrays they return have 0 for the other paths.
+
+    As in Assets, each path has a price index, and a holding's value is its
+    shares times that index. The paths advance in lockstep, so they all buy on
+    the same days. So the lots are stored as columns, with each path's lot in
+    the path's element (0 shares if it bought nothing): one column per
+    purchase day if compact_lots, since Assets then merges lots bought the
+    same day, and otherwise one per purchase. Selling goes
+    through the same lots in the same order as Assets.sell: in tax-favored
+    order, the selling paths' lots are sorted by a vectorized version of
+    Assets' merge of its long-term and short-term groups, and in random order,
+    each selling path draws from its own lot-ordering generator, as in one_run.
+    Results are the same as with BrokerageAccount up to rounding. Partial
+    sales reduce purchase prices in proportion, so this needs
+    EtfLot.PARTIAL_SALES_REDUCE_BASIS.
+
+    Accounts that never sell (keeps_lots False) keep only their total shares.
+    Accounts that do keep a column per purchase unless
+    AGGREGATE_LONG_TERM_LOTS, which bounds their memory at the cost of
+    results that only approximate one_run's."""
+
+    def __init__(self, num_paths, broker_max_margin_to_assets_ratio,
+                 taper_off_leverage_toward_end, taper_off_leverage_a_lot_toward_end,
+                 initial_personal_max_margin_to_assets_relative_to_broker_max,
+                 lot_ordering_randgenerators=None, keeps_lots=True, compact_lots=False):
+        """lot_ordering_randgenerators has each path's generator for the order
+        in which lots are sold when not selling in tax-favored order, or is
+        None to use the random module."""
+        self.__margin = numpy.zeros(num_paths)
+        self.__price_index = numpy.ones(num_paths)
+        self.__total_shares = numpy.zeros(num_paths)
+        self.__keeps_lots = keeps_lots
+        self.__compact_lots = compact_lots
+        self.__lot_purchase_days = [] # one for each column of lots, in order
+        self.__lot_purchase_prices = []
+        self.__lot_shares = []
+        self.__lot_bases_per_share = [] # the price index each lot was bought at, as in Assets
+        self.__aggregates_long_term_lots = keeps_lots and AGGREGATE_LONG_TERM_LOTS
+        self.__has_long_term_aggregate = False # whether the first column holds the merged long-term lots
+        self.__lot_ordering_randgenerators = lot_ordering_randgenerators
+        self.__uses_margin = numpy.ones(num_paths, dtype=bool)
+        self.__broker_max_margin_to_assets_ratio = broker_max_margin_to_assets_ratio
+        self.__account_for_leverage_caps = BrokerageAccount.BrokerageAccount(0, 0,
+            broker_max_margin_to_assets_ratio, taper_off_leverage_toward_end,
+            taper_off_leverage_a_lot_toward_end,
+            initial_personal_max_margin_to_assets_relative_to_broker_max)
+        """BrokerageAccount's leverage caps depend only on its parameters and
+        years_remaining, so one account computes them for all paths."""
+
+    @property
+    def num_lot_columns(self):
+        return len(self.__lot_purchase_days)
+
+    @property
+    def margin(self):
+        return self.__margin
+
+    @margin.setter
+    def margin(self, vals):
+        self.__margin = vals
+
+    def assets(self):
+        return self.__total_shares * self.__price_index
+
+    def assets_minus_margin(self):
+        assets_minus_margin = self.assets() - self.__margin
+        assert numpy.all(assets_minus_margin >= 0), "More margin loans than total assets!"
+        return assets_minus_margin
+
+    def personal_max_margin_to_assets_ratios(self, years_remaining):
+        return numpy.where(self.__uses_margin,
+            self.__account_for_leverage_caps.personal_max_margin_to_assets_ratio(years_remaining), 0.0)
+
+    def __broker_max_margin_to_assets_ratios(self):
+        return numpy.where(self.__uses_margin, self.__broker_max_margin_to_assets_ratio, 0.0)
+
+    def stop_using_margin(self, paths):
+        """Replace the accounts of paths with new ones whose max margin-to-assets
+        ratios are 0, as when the margin strategy goes bankrupt"""
+        self.__uses_margin[paths] = False
+        self.__margin = numpy.where(paths, 0.0, self.__margin)
+        self.__remove_all_lots(paths)
+
+    def margin_to_assets_ratios(self):
+        """BrokerageAccount.margin_to_assets for each path"""
+        assets = self.assets()
+        no_assets = assets == 0
+        ratios = self.__margin / numpy.where(no_assets, 1.0, assets)
+        ratios[abs(self.__margin-0) < EPSILON] = 0
+        ratios[no_assets] = numpy.where(self.__margin[no_assets] == 0, 0, float("inf"))
+        return ratios
+
+    def update_asset_prices(self, growth_factors, paths=None):
+        """BrokerageAccount.update_asset_prices with rates of return
+        growth_factors - 1"""
+        if paths is None:
+            self.__price_index = self.__price_index * growth_factors
+        else:
+            self.__price_index = numpy.where(paths, self.__price_index * growth_factors, self.__price_index)
+        price_fell_to_zero = self.__price_index < 0
+        if numpy.any(price_fell_to_zero):
+            self.__remove_all_lots(price_fell_to_zero)
+
+    def __remove_all_lots(self, paths):
+        for column in [self.__total_shares] + self.__lot_shares + self.__lot_purchase_prices:
+            column[paths] = 0.0
+        self.__price_index[paths] = 1.0 # any later purchases start from a fresh index
+
+    def __buy_new_lots(self, purchase_amounts, day):
+        """Assets.buy_new_lot for each path with a nonzero purchase amount"""
+        purchase_prices = purchase_amounts * (1-FEE_PER_DOLLAR_TRADED)
+        shares = purchase_prices / self.__price_index
+        self.__total_shares += shares
+        if self.__aggregates_long_term_lots:
+            self.__aggregate_long_term_lots(day)
+        if self.__keeps_lots:
+            if not (self.__compact_lots and self.__lot_purchase_days and self.__lot_purchase_days[-1] == day):
+                self.__lot_purchase_days.append(day)
+                self.__lot_purchase_prices.append(numpy.zeros(len(shares)))
+                self.__lot_shares.append(numpy.zeros(len(shares)))
+                self.__lot_bases_per_share.append(numpy.ones(len(shares)))
+            self.__lot_purchase_prices[-1] += purchase_prices
+            self.__lot_shares[-1] += shares
+            self.__lot_bases_per_share[-1][purchase_amounts > 0] = self.__price_index[purchase_amounts > 0]
+
+    def __aggregate_long_term_lots(self, day):
+        """Merge the columns of lots that are long-term on day into the first
+        column; see AGGREGATE_LONG_TERM_LOTS. Columns are in order of
+        purchase, so the long-term ones come first."""
+        num_long_term_columns = 0
+        while num_long_term_columns < len(self.__lot_purchase_days) and \
+                self.__lot_purchase_days[num_long_term_columns] <= day - DAYS_PER_YEAR:
+            num_long_term_columns += 1
+        if num_long_term_columns == 0:
+            return
+        if num_long_term_columns > 1 or not self.__has_long_term_aggregate:
+            purchase_prices = numpy.sum(self.__lot_purchase_prices[:num_long_term_columns], axis=0)
+            shares = numpy.sum(self.__lot_shares[:num_long_term_columns], axis=0)
+            bases_per_share = numpy.where(shares > 0, purchase_prices / numpy.where(shares > 0, shares, 1.0), 1.0)
+            purchase_day = self.__lot_purchase_days[num_long_term_columns-1]
+            for columns in [self.__lot_purchase_days, self.__lot_purchase_prices, self.__lot_shares,
+                            self.__lot_bases_per_share]:
+                del columns[:num_long_term_columns]
+            self.__lot_purchase_days.insert(0, purchase_day)
+            self.__lot_purchase_prices.insert(0, purchase_prices)
+            self.__lot_shares.insert(0, shares)
+            self.__lot_bases_per_share.insert(0, bases_per_share)
+            self.__has_long_term_aggregate = True
+
+    def __sell(self, amounts_of_net_cash_to_get_back, paths, day, taxes, sell_best_for_taxes_first):
+        """Assets.sell for each of paths. Returns the deficits still not paid."""
+        assert self.__keeps_lots, "Can't sell from an account that doesn't keep lots."
+        if self.__aggregates_long_term_lots:
+            self.__aggregate_long_term_lots(day)
+        selling_paths = numpy.flatnonzero(paths)
+        deficits_still_not_paid = numpy.zeros(len(paths))
+        if len(selling_paths) == 0 or not self.__lot_purchase_days:
+            deficits_still_not_paid[selling_paths] = amounts_of_net_cash_to_get_back[selling_paths]
+        else:
+            purchase_prices = numpy.column_stack([column[selling_paths] for column in self.__lot_purchase_prices])
+            shares = numpy.column_stack([column[selling_paths] for column in self.__lot_shares])
+            bases_per_share = numpy.column_stack([column[selling_paths] for column in self.__lot_bases_per_share])
+            is_long_term = numpy.array(self.__lot_purchase_days) <= day - DAYS_PER_YEAR
+            cash_needed = amounts_of_net_cash_to_get_back[selling_paths]
+            if sell_best_for_taxes_first:
+                (fractions_sold, deficits) = self.__fractions_sold_best_for_taxes_first(
+                    purchase_prices, shares, bases_per_share, is_long_term, self.__price_index[selling_paths],
+                    cash_needed, taxes.tax_rates)
+            else:
+                (fractions_sold, deficits) = self.__fractions_sold_in_random_order(
+                    shares, bases_per_share, is_long_term, selling_paths, cash_needed)
+            cap_gains = (shares * self.__price_index[selling_paths,numpy.newaxis] - purchase_prices) * fractions_sold
+            long_term_cap_gains = numpy.zeros(len(paths))
+            long_term_cap_gains[selling_paths] = numpy.sum(cap_gains[:,is_long_term], axis=1)
+            short_term_cap_gains = numpy.zeros(len(paths))
+            short_term_cap_gains[selling_paths] = numpy.sum(cap_gains[:,~is_long_term], axis=1)
+            taxes.add_long_term_cap_gains(long_term_cap_gains)
+            taxes.add_short_term_cap_gains(short_term_cap_gains)
+            shares *= (1-fractions_sold)
+            purchase_prices *= (1-fractions_sold)
+            for (column_num, (purchase_price_column, shares_column)) in \
+                    enumerate(zip(self.__lot_purchase_prices, self.__lot_shares)):
+                purchase_price_column[selling_paths] = purchase_prices[:,column_num]
+                shares_column[selling_paths] = shares[:,column_num]
+            self.__total_shares[selling_paths] = numpy.sum(shares, axis=1)
+            deficits_still_not_paid[selling_paths] = deficits
+
+        for deficit_still_not_paid in deficits_still_not_paid[deficits_still_not_paid > 0]:
+            print "Account wiped out with %s still needing to be repaid." % \
+                util.format_as_dollar_string(deficit_still_not_paid)
+        self.__remove_all_lots(deficits_still_not_paid > 0)
+        taxes.add_long_term_cap_gains(deficits_still_not_paid/2) # see Assets.sell
+        return deficits_still_not_paid
+
+    def __fractions_sold_best_for_taxes_first(self, purchase_prices, shares, bases_per_share, is_long_term,
+                                              price_index, cash_needed, tax_rates):
+        """Sort each row's lots the way Assets.__sell_best_for_taxes_first
+        merges its groups, then sell lots in that order until each row has its
+        cash. Returns the fraction of each lot sold and each row's deficit.
+        The merge only compares the fronts of the groups, so a lot can't be
+        sold before one ahead of it in its group, even if rounding gives it a
+        lower tax rate or they tie. Merging that way gives the same order as
+        sorting by the highest tax rate up to each lot in its group, with
+        long-term lots first among equals and otherwise in group order."""
+        (num_rows, num_columns) = shares.shape
+        current_prices = shares * price_index[:,numpy.newaxis]
+        has_shares = shares > 0
+        safe_current_prices = numpy.where(has_shares, current_prices, 1.0)
+        tax_rates_per_dollar = numpy.where(is_long_term, tax_rates.long_term_cap_gains_rate_plus_state(),
+                                           tax_rates.short_term_cap_gains_rate_plus_state()) * \
+            (current_prices - purchase_prices) / safe_current_prices
+        rows = numpy.arange(num_rows)[:,numpy.newaxis]
+        group_order = self.__group_order(shares, bases_per_share, is_long_term)
+        is_long_term_in_group_order = numpy.broadcast_to(is_long_term, shares.shape)[rows,group_order]
+        highest_tax_rates_so_far = numpy.where(is_long_term_in_group_order,
+            numpy.maximum.accumulate(numpy.where(is_long_term_in_group_order,
+                tax_rates_per_dollar[rows,group_order], -numpy.inf), axis=1),
+            numpy.maximum.accumulate(numpy.where(is_long_term_in_group_order,
+                -numpy.inf, tax_rates_per_dollar[rows,group_order]), axis=1))
+        sort_keys = [numpy.broadcast_to(numpy.arange(num_columns), shares.shape), ~is_long_term_in_group_order,
+                     highest_tax_rates_so_far, ~has_shares[rows,group_order]]
+        order = group_order[rows,numpy.lexsort(sort_keys, axis=-1)]
+
+        after_fee_values = (current_prices * (1-FEE_PER_DOLLAR_TRADED))[rows,order]
+        cash_after_selling = cash_needed[:,numpy.newaxis] - numpy.cumsum(after_fee_values, axis=1)
+        cash_before_selling = cash_after_selling + after_fee_values
+        is_sold = has_shares[rows,order] & (cash_before_selling > 0)
+        is_sold_in_full = is_sold & (cash_after_selling >= 0)
+        sorted_fractions_sold = numpy.where(is_sold_in_full, 1.0, numpy.where(is_sold,
+            cash_before_selling / (1-FEE_PER_DOLLAR_TRADED) / safe_current_prices[rows,order], 0.0))
+        fractions_sold = numpy.zeros(shares.shape)
+        fractions_sold[rows,order] = sorted_fractions_sold
+        deficits = numpy.maximum(cash_after_selling[:,-1], 0)
+        return (fractions_sold, deficits)
+
+    def __group_order(self, shares, bases_per_share, is_long_term):
+        """The columns of each row in the order of Assets' lots: the long-term
+        group and then the short-term group, each by highest basis per share
+        and then in order of purchase, and then the columns without shares."""
+        return numpy.lexsort([numpy.broadcast_to(numpy.arange(shares.shape[1]), shares.shape), -bases_per_share,
+                              numpy.broadcast_to(~is_long_term, shares.shape), ~(shares > 0)], axis=-1)
+
+    def __fractions_sold_in_random_order(self, shares, bases_per_share, is_long_term, selling_paths,
+                                         cash_needed):
+        """Assets.__sell_in_random_order for each row, drawing lots from the
+        row's path's lot-ordering generator. Lot numbers count through the
+        long-term group and then the short-term group, each in group order."""
+        num_rows = shares.shape[0]
+        current_prices = shares * self.__price_index[selling_paths,numpy.newaxis]
+        order = self.__group_order(shares, bases_per_share, is_long_term)
+        nums_lots = numpy.sum(shares > 0, axis=1)
+        fractions_sold = numpy.zeros(shares.shape)
+        deficits = numpy.zeros(num_rows)
+        for (row, path_index) in enumerate(selling_paths):
+            randgenerator = self.__lot_ordering_randgenerators[path_index] \
+                if self.__lot_ordering_randgenerators else random
+            lot_columns = order[row,:nums_lots[row]].tolist()
+            row_current_prices = current_prices[row].tolist()
+            cash_still_need_to_get = float(cash_needed[row])
+            while cash_still_need_to_get > 0 and lot_columns:
+                lot_number = randgenerator.randrange(len(lot_columns))
+                current_price = row_current_prices[lot_columns[lot_number]]
+                after_fee_value_of_lot = current_price * (1-FEE_PER_DOLLAR_TRADED)
+                if after_fee_value_of_lot > cash_still_need_to_get:
+                    fractions_sold[row,lot_columns[lot_number]] = \
+                        cash_still_need_to_get / (1-FEE_PER_DOLLAR_TRADED) / current_price
+                    cash_still_need_to_get = 0
+                else:
+                    fractions_sold[row,lot_columns[lot_number]] = 1.0
+                    cash_still_need_to_get -= after_fee_value_of_lot
+                    del lot_columns[lot_number]
+            deficits[row] = cash_still_need_to_get
+        return (fractions_sold, deficits)
+
+    def debt_to_pay_off_to_restore_voluntary_max_margin_to_assets_ratio(self, years_remaining):
+        margin_to_assets = self.margin_to_assets_ratios()
+        max_margin_to_assets = self.personal_max_margin_to_assets_ratios(years_remaining)
+        return numpy.where(margin_to_assets <= (1+EPSILON) * max_margin_to_assets, 0.0,
+            numpy.where(margin_to_assets == float("inf"), self.__margin,
+                        self.__margin - self.assets() * max_margin_to_assets))
+
+    def voluntary_rebalance(self, day, taxes, years_remaining, paths):
+        return self.__rebalance(day, taxes, self.personal_max_margin_to_assets_ratios(years_remaining),
+                                True, paths)
+
+    def mandatory_rebalance(self, day, taxes, does_broker_liquidation_sell_tax_favored_first, paths):
+        return self.__rebalance(day, taxes, self.__broker_max_margin_to_assets_ratios(),
+                                does_broker_liquidation_sell_tax_favored_first, paths)
+
+    def __rebalance(self, day, taxes, max_margin_to_assets_ratios, sell_best_for_taxes_first, paths):
+        """BrokerageAccount.rebalance for each of paths"""
+        paths = paths & (self.margin_to_assets_ratios() > (1+EPSILON) * max_margin_to_assets_ratios)
+        if not numpy.any(paths):
+            return numpy.zeros(len(paths))
+        amounts_of_cash_needed = (self.__margin - self.assets() * max_margin_to_assets_ratios) / \
+            (1 - max_margin_to_assets_ratios - FEE_PER_DOLLAR_TRADED * max_margin_to_assets_ratios)
+        deficits_still_not_paid = self.__sell(amounts_of_cash_needed, paths, day, taxes,
+                                              sell_best_for_taxes_first)
+        self.__margin = numpy.where(deficits_still_not_paid > 0, 0.0,
+            numpy.where(paths, self.__margin - amounts_of_cash_needed, self.__margin))
+        return deficits_still_not_paid
+
+    def buy_ETF_at_fixed_ratio(self, money_on_hand, day, years_remaining):
+        buys = money_on_hand > 0
+        if numpy.any(buys):
+            max_margin_to_assets = self.personal_max_margin_to_assets_ratios(years_remaining)
+            loans = numpy.where(buys, money_on_hand * max_margin_to_assets / (1.0 - max_margin_to_assets), 0.0)
+            self.__margin = self.__margin + loans
+            self.__buy_new_lots(numpy.where(buys, money_on_hand + loans, 0.0), day)
+
+    def buy_ETF_without_margin(self, money_on_hand, day):
+        if numpy.any(money_on_hand > 0):
+            self.__buy_new_lots(numpy.where(money_on_hand > 0, money_on_hand, 0.0), day)
+
+    def compute_interest(self, annual_interest_rate, fraction_of_year_elapsed):
+        return self.__margin * ((1+annual_interest_rate)**fraction_of_year_elapsed - 1)
+
+    def voluntary_rebalance_to_increase_leverage(self, day, years_remaining):
+        assets = self.assets()
+        max_margin_to_assets = self.personal_max_margin_to_assets_ratios(years_remaining)
+        additional_debts = (assets * max_margin_to_assets - self.__margin) / (1-max_margin_to_assets)
+        buys = (assets > 0) & (self.margin_to_assets_ratios() < (1-EPSILON) * max_margin_to_assets) & \
+            (additional_debts >= MIN_ADDITIONAL_PURCHASE_AMOUNT)
+        if numpy.any(buys):
+            self.__margin = numpy.where(buys, self.__margin + additional_debts, self.__margin)
+            self.__buy_new_lots(numpy.where(buys, additional_debts, 0.0), day)
+
+    def pay_off_all_margin(self, day, taxes, paths):
+        assert numpy.all(self.assets()[paths] >= self.__margin[paths]), "More debt than equity!"
+        deficits_still_not_paid = self.__sell(self.__margin, paths & (self.__margin > 0), day, taxes, True)
+        self.__margin = numpy.where(paths, 0.0, self.__margin)
+        return deficits_still_not_paid
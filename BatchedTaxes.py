@@ -0,0 +1,62 @@
+import numpy
+from Taxes import MAX_CAPITAL_LOSS_DEDUCTION_PER_YEAR
+
+class BatchedTaxes(object):
+    """Taxes for each of num_paths investors at once, for
+    margin_leverage.batched_runs. The short- and long-term capital gains
+    accumulated so far are numpy arrays with an element per path, and
+    process_taxes follows the same rules as Taxes.process_taxes, path by path."""
+
+    def __init__(self, tax_rates, num_paths):
+        self.__tax_rates = tax_rates
+        self.__accumulated_short_term_cap_gains = numpy.zeros(num_paths)
+        self.__accumulated_long_term_cap_gains = numpy.zeros(num_paths)
+
+    @property
+    def tax_rates(self):
+        return self.__tax_rates
+
+    def add_short_term_cap_gains(self, amounts_to_add):
+        self.__accumulated_short_term_cap_gains += amounts_to_add
+
+    def add_long_term_cap_gains(self, amounts_to_add):
+        self.__accumulated_long_term_cap_gains += amounts_to_add
+
+    def total_gain_or_loss(self):
+        return self.__accumulated_short_term_cap_gains + self.__accumulated_long_term_cap_gains
+
+    def process_taxes(self, paths=None):
+        """Taxes.process_taxes for the paths where the boolean array paths is
+        True (or all paths if it's None). Returns the bill (positive) or
+        refund (negative) for each path, which is 0 for paths not processed."""
+        short_term = self.__accumulated_short_term_cap_gains
+        long_term = self.__accumulated_long_term_cap_gains
+        total = short_term + long_term
+
+        """Net gain: see Taxes.__get_tax_bill_or_refund_and_carryover"""
+        short_term_rate = self.__tax_rates.short_term_cap_gains_rate_plus_state()
+        long_term_rate = self.__tax_rates.long_term_cap_gains_rate_plus_state()
+        bills = numpy.where(long_term < 0, short_term_rate * total,
+                            numpy.where(short_term < 0, long_term_rate * total,
+                                        short_term_rate * short_term + long_term_rate * long_term))
+
+        """Net loss: deduct up to the max and carry over the rest, as in Taxes.__get_tax_carryovers"""
+        amounts_to_deduct = numpy.maximum(total, MAX_CAPITAL_LOSS_DEDUCTION_PER_YEAR)
+        refunds = self.__tax_rates.income_tax_rate_plus_state() * amounts_to_deduct
+        short_term_below_deduction = short_term < amounts_to_deduct
+        combined_carryovers = numpy.minimum(0, short_term + long_term - amounts_to_deduct)
+        short_term_carryover_losses = numpy.where(short_term_below_deduction,
+            numpy.where(long_term < 0, short_term - amounts_to_deduct, combined_carryovers), 0.0)
+        long_term_carryover_losses = numpy.where(long_term < 0,
+            numpy.where(short_term_below_deduction, long_term, combined_carryovers), 0.0)
+
+        have_loss = total < 0
+        bills_or_refunds = numpy.where(total > 0, bills, numpy.where(have_loss, refunds, 0.0))
+        short_term_carryover_losses[~have_loss] = 0
+        long_term_carryover_losses[~have_loss] = 0
+        if paths is None:
+            paths = numpy.ones(len(total), dtype=bool)
+        bills_or_refunds[~paths] = 0
+        self.__accumulated_short_term_cap_gains = numpy.where(paths, short_term_carryover_losses, short_term)
+        self.__accumulated_long_term_cap_gains = numpy.where(paths, long_term_carryover_losses, long_term)
+        return bills_or_refunds
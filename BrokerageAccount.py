@@ -1,5 +1,6 @@
 import Assets
 import util
+import numpy
 
 EPSILON = .001
 # give some wiggle room for inexact calculations, such as might result
@@ -37,15 +38,26 @@ class BrokerageAccount(object):
 
     def __init__(self, margin, assets, broker_max_margin_to_assets_ratio, 
                  taper_off_leverage_toward_end, taper_off_leverage_a_lot_toward_end, 
-                 initial_personal_max_margin_to_assets_relative_to_broker_max):
+                 initial_personal_max_margin_to_assets_relative_to_broker_max,
+                 randgenerator=None, compact_lots=False):
         self.__margin = margin # amount of debt
-        self.__assets = Assets.Assets() # list of the ETFs you own
+        self.__assets = Assets.Assets(randgenerator, compact_lots) # list of the ETFs you own
+        self.__randgenerator = randgenerator
         self.__broker_max_margin_to_assets_ratio = broker_max_margin_to_assets_ratio
         self.__taper_off_leverage_toward_end = taper_off_leverage_toward_end
         self.__taper_off_leverage_a_lot_toward_end = taper_off_leverage_a_lot_toward_end
         self.__initial_personal_max_margin_to_assets_relative_to_broker_max = initial_personal_max_margin_to_assets_relative_to_broker_max
+        self.__personal_max_margin_to_assets_ratios = dict() # by years_remaining
 
     def personal_max_margin_to_assets_ratio(self, years_remaining):
+        """This gets called several times a day but only changes once a year,
+        so compute it once for each years_remaining."""
+        if years_remaining not in self.__personal_max_margin_to_assets_ratios:
+            self.__personal_max_margin_to_assets_ratios[years_remaining] = \
+                self.__compute_personal_max_margin_to_assets_ratio(years_remaining)
+        return self.__personal_max_margin_to_assets_ratios[years_remaining]
+
+    def __compute_personal_max_margin_to_assets_ratio(self, years_remaining):
         """Keep a personal max margin-to-assets ratio below the broker ratio so that
         you can rebalance on your own terms rather than having the broker constantly
         force you to rebalance.
@@ -79,11 +91,37 @@ class BrokerageAccount(object):
 
     @property
     def assets(self):
+        """Running total kept by Assets, so this doesn't look at the lots"""
         return self.__assets.total_assets()
 
+    @property
+    def cost_basis(self):
+        return self.__assets.total_cost_basis()
+
+    @property
+    def num_lots(self):
+        return self.__assets.num_lots
+
+    @property
+    def num_lots_without_compaction(self):
+        return self.__assets.num_lots_without_compaction
+
+    @property
+    def randgenerator(self):
+        """Random generator for the order of lots sold when not selling in tax-favored order"""
+        return self.__randgenerator
+
     def update_asset_prices(self, rate_of_return):
         self.__assets.update_prices(rate_of_return)
 
+    def assets_after_price_updates(self, growth_factors):
+        """self.assets after each of a run of update_asset_prices calls, where
+        growth_factors are 1 + the rates of return. Doesn't change the account."""
+        return self.__assets.total_assets_after_price_updates(growth_factors)
+
+    def update_asset_prices_over_days(self, growth_factors):
+        self.__assets.update_prices_over_days(growth_factors)
+
     """
     NOT USING ANYMORE
 
@@ -92,13 +130,15 @@ class BrokerageAccount(object):
     """
 
     def assets_minus_margin(self):
-        assets_minus_margin = self.assets - self.margin
+        assets = self.assets
+        assets_minus_margin = assets - self.margin
         assert assets_minus_margin >= 0, "More margin loans (%s) than total assets (%s)!" % \
-            (util.format_as_dollar_string(self.margin), util.format_as_dollar_string(self.assets))
+            (util.format_as_dollar_string(self.margin), util.format_as_dollar_string(assets))
         return assets_minus_margin
 
     def margin_to_assets(self):
-        if self.assets == 0:
+        assets = self.assets
+        if assets == 0:
             if self.margin == 0:
                 return 0
             else:
@@ -108,7 +148,22 @@ class BrokerageAccount(object):
             if abs(self.margin-0) < EPSILON:
                 return 0
             else:
-                return float(self.margin)/self.assets
+                return float(self.margin)/assets
+
+    def margin_to_assets_ratios(self, asset_values):
+        """margin_to_assets for each of a numpy array of asset values, with the
+        current margin"""
+        if abs(self.margin-0) < EPSILON:
+            ratios = numpy.zeros(len(asset_values))
+        else:
+            ratios = float(self.margin)/numpy.where(asset_values == 0, 1.0, asset_values)
+        ratios[asset_values == 0] = 0 if self.margin == 0 else float("inf")
+        return ratios
+
+    def would_need_mandatory_rebalance(self, margin_to_assets_ratios):
+        """Whether mandatory_rebalance would sell anything at each of a numpy
+        array of margin-to-assets ratios"""
+        return margin_to_assets_ratios > (1+EPSILON) * self.__broker_max_margin_to_assets_ratio
     
     """
     NOT USING THIS ANYMORE. TOO CONFUSING AND NOT REALLY NEEDED 99.99% OF THE TIME
@@ -135,13 +190,15 @@ class BrokerageAccount(object):
         get us back to having a margin-to-assets ratio within the limit R?
         Let A be assets. If we're currently over the limit, we want to set
         C such that (D-C)/A = R  ==>  D-C = AR  ==>  C = D-AR"""
-        if self.margin_to_assets() <= (1+EPSILON) * self.personal_max_margin_to_assets_ratio(years_remaining):
+        margin_to_assets = self.margin_to_assets()
+        max_margin_to_assets = self.personal_max_margin_to_assets_ratio(years_remaining)
+        if margin_to_assets <= (1+EPSILON) * max_margin_to_assets:
             return 0
         else:
-            if self.margin_to_assets() == float("inf"):
+            if margin_to_assets == float("inf"):
                 return self.margin # if we have no assets, need to pay off all margin
             else:
-                return self.margin - self.assets * self.personal_max_margin_to_assets_ratio(years_remaining)
+                return self.margin - self.assets * max_margin_to_assets
 
     def voluntary_rebalance(self, day, taxes, years_remaining):
         """Restore our voluntarily self-imposed max margin-to-assets ratio."""
@@ -0,0 +1,53 @@
+import cPickle
+import hashlib
+import os
+from os import path
+
+def key(*parts):
+    """Hash of parts (which should have a repr that doesn't change from run to
+    run, like util.object_parameters) to name a unit of work by"""
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+class Checkpoints(object):
+    """Results of finished units of a long computation, each saved to its own
+    file in checkpoint_dir as soon as it's done, so that if the computation
+    is stopped (a crash, a reboot, Ctrl-C) and run again with the same
+    arguments, the units that already finished are loaded instead of being
+    run again. Units are named by a key (see key) of everything their
+    results depend on, so a unit whose arguments changed is run again."""
+
+    def __init__(self, checkpoint_dir):
+        self.__checkpoint_dir = checkpoint_dir
+        if not path.isdir(checkpoint_dir):
+            try:
+                os.makedirs(checkpoint_dir)
+            except OSError:
+                assert path.isdir(checkpoint_dir), "Couldn't create %s" % checkpoint_dir # another process may have made it
+
+    def has(self, key):
+        return path.exists(self.__file_name(key))
+
+    def load(self, key):
+        with open(self.__file_name(key), "rb") as infile:
+            return cPickle.load(infile)
+
+    def save(self, key, value):
+        """Write to a temporary file and then rename it so that a unit is
+        never half saved, even if the computation is stopped while saving it."""
+        file_name = self.__file_name(key)
+        temp_file_name = "%s.%i.tmp" % (file_name, os.getpid())
+        with open(temp_file_name, "wb") as outfile:
+            cPickle.dump(value, outfile, cPickle.HIGHEST_PROTOCOL)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        if os.name == "nt" and path.exists(file_name):
+            os.remove(file_name) # Windows won't rename over an existing file
+        os.rename(temp_file_name, file_name)
+
+    def remove(self, key):
+        """Remove a unit once it's no longer needed, if it was saved"""
+        if self.has(key):
+            os.remove(self.__file_name(key))
+
+    def __file_name(self, key):
+        return path.join(self.__checkpoint_dir, "%s.pkl" % key)
@@ -1,6 +1,14 @@
 import math
 import util
 DAYS_PER_YEAR = 365
+PARTIAL_SALES_REDUCE_BASIS = False
+"""When EtfLot.sell sells an amount A of a lot worth V with purchase price P,
+it takes A off the lot's value but leaves P alone, and counts
+(V - A - P) * A / V as the realized gain. That isn't A/V of the lot's gain
+V - P, and it leaves all of P with the part of the lot that's still held.
+Setting this to True sells A/V of the lot's shares and of its purchase price,
+realizing A/V of its gain, which is how a sale of some of a lot's shares is
+taxed. Assets and path_kernel follow this setting too."""
 
 class EtfLot(object):
     """Store characteristics about an ETF (or stock, etc.) purchase 
@@ -12,6 +20,10 @@ class EtfLot(object):
         self.__purchase_day = purchase_day
         self.__current_price = self.__purchase_price
 
+    @property
+    def purchase_price(self):
+        return self.__purchase_price
+
     @property
     def current_price(self):
         return self.__current_price
@@ -39,13 +51,18 @@ class EtfLot(object):
 
         if after_fee_value_of_lot > cash_still_need_to_get:
             amount_to_sell = cash_still_need_to_get / (1-fee_per_dollar_traded) # selling this amount leaves us with an after-fee amount of cash_still_need_to_get
+            if PARTIAL_SALES_REDUCE_BASIS:
+                fraction_sold = amount_to_sell / cur_price_before_sell_any_portion
+                fraction_of_total_cap_gain_incurred = self.__capital_gain() * fraction_sold
+                self.__purchase_price *= (1-fraction_sold)
             self.__current_price -= amount_to_sell
             if self.__current_price < .1:
                 pass
                 # following can be uncommented, but it makes the output more verbose
                 #print "WARNING! Stock price is only", self.__current_price ,
-            fraction_of_total_cap_gain_incurred = self.__capital_gain() * amount_to_sell / cur_price_before_sell_any_portion
-            assert abs(fraction_of_total_cap_gain_incurred) <= abs(self.__capital_gain()), "Fractional capital gain is too big!"
+            if not PARTIAL_SALES_REDUCE_BASIS:
+                fraction_of_total_cap_gain_incurred = self.__capital_gain() * amount_to_sell / cur_price_before_sell_any_portion
+                assert abs(fraction_of_total_cap_gain_incurred) <= abs(self.__capital_gain()), "Fractional capital gain is too big!"
             self.__record_cap_gains(taxes, long_or_short, fraction_of_total_cap_gain_incurred)
             
             """
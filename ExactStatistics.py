@@ -0,0 +1,104 @@
+import math
+import numpy
+import util
+
+class ExactStatistics(object):
+    """Statistics of the ending values of one account type over sample paths
+    0, 1, ..., in order, computed from the values themselves, which are all
+    kept. It has the same methods as StreamingStatistics, which gives
+    estimates of them in constant memory instead."""
+
+    def __init__(self):
+        self.__values = []
+        self.__control_values = []
+        self.__array = None
+        self.__sorted_values = None
+
+    @property
+    def num_values(self):
+        return len(self.__values)
+
+    def add(self, value, control_value=0):
+        self.__values.append(value)
+        self.__control_values.append(control_value)
+        self.__array = None
+        self.__sorted_values = None
+
+    def add_values(self, values, control_values=None):
+        if control_values is None:
+            control_values = numpy.zeros(len(values))
+        self.__values.extend(values)
+        self.__control_values.extend(control_values)
+        self.__array = None
+        self.__sorted_values = None
+
+    def merge(self, other):
+        """Add the values of the samples right after these"""
+        self.add_values(other.__values, other.__control_values)
+
+    def mean(self):
+        return numpy.mean(self.__values_array())
+
+    def stderr(self, sampling_mode=util.INDEPENDENT_SAMPLING):
+        return util.stderr(self.__values_array(), sampling_mode)
+
+    def sqrt_mean(self):
+        return numpy.mean(self.__sqrt_values())
+
+    def sqrt_stderr(self, sampling_mode=util.INDEPENDENT_SAMPLING):
+        return util.stderr(self.__sqrt_values(), sampling_mode)
+
+    def sqrt_difference_stderr(self, other, sampling_mode=util.INDEPENDENT_SAMPLING):
+        """Standard error of sqrt_mean() - other.sqrt_mean(), for other's
+        values from the same sample paths (e.g., at another leverage
+        amount), compared path by path so that what's common to both cancels"""
+        return util.stderr(numpy.array(self.__sqrt_values()) - numpy.array(other.__sqrt_values()),
+                           sampling_mode)
+
+    def log_std(self):
+        """Standard deviation of log(value+1)"""
+        return numpy.std(map(math.log, self.__values_array()+1)) # The +1 here is so that the log() value will be at least 0
+
+    def min(self):
+        return min(self.__values_array())
+
+    def max(self):
+        return max(self.__values_array())
+
+    def median(self):
+        return numpy.median(self.__values_array())
+
+    def percentile(self, percentile_as_fraction):
+        return util.percentile(self.__sorted(), percentile_as_fraction)
+
+    def value_at_sorted_index(self, index):
+        return self.__sorted()[index]
+
+    def expected_value_of(self, function):
+        return numpy.mean(map(function, self.__values_array()))
+
+    def histogram_data(self, bins):
+        """(x, weights) to give pyplot.hist for a histogram of the values"""
+        return (self.__values_array(), None)
+
+    def fraction_greater_than(self, other):
+        """Fraction of ranks at which this sorted value is greater than other's"""
+        return util.probability_x_better_than_y(self.__sorted(), other.__sorted())
+
+    def control_variate_mean_and_stderr(self, expected_control_value,
+                                        sampling_mode=util.INDEPENDENT_SAMPLING):
+        return util.control_variate_mean_and_stderr(self.__values, self.__control_values,
+                                                    expected_control_value, sampling_mode)
+
+    def __values_array(self):
+        if self.__array is None:
+            self.__array = numpy.array(self.__values)
+        return self.__array
+
+    def __sqrt_values(self):
+        return map(math.sqrt, self.__values_array())
+
+    def __sorted(self):
+        if self.__sorted_values is None:
+            self.__sorted_values = sorted(self.__values)
+        return self.__sorted_values
@@ -0,0 +1,94 @@
+import numpy
+import util
+import BrokerageAccount
+
+class HorizonSchedule(object):
+    """Values that margin_leverage.one_run needs each day or pay day but that
+    depend only on the day, not on the sample path: the years elapsed and
+    remaining, the leverage that a margin account rebalancing monthly targets,
+    the pay before any employment-dependent penalty, the fraction of margin
+    principal to repay, and the present-value discount. Build it once per
+    investor, market and horizon, and have the loops read it by index instead
+    of recomputing the same powers each day.
+
+    Lists indexed by day have one entry per day of the calendar. Lists indexed
+    by pay period have one entry per pay day of the calendar, in order.
+    margin_leverage_multiples is indexed by years_remaining. Pay on a pay period is
+    annual_incomes_before_layoff_penalty[pay_period] times
+    Investor.current_income_multiplier() times pay_fraction_of_year.
+    (BrokerageAccount remembers its own leverage caps by years_remaining.)"""
+
+    def __init__(self, investor, market, calendar, days_per_year, pay_every_num_days):
+        num_days = calendar.num_days
+        self.__years_elapsed = [day/days_per_year for day in xrange(num_days)] # intentional int division
+        self.__years_remaining = [(num_days-day)/days_per_year for day in xrange(num_days)]
+
+        is_event_day = calendar.is_pay_day | calendar.is_tax_day | calendar.is_tax_loss_harvest_day
+        is_event_day[1:] |= numpy.diff(self.__years_remaining) != 0
+        is_event_day[-1] = True
+        event_days = numpy.flatnonzero(is_event_day)
+        self.__next_event_days = event_days[numpy.searchsorted(event_days, numpy.arange(num_days))].tolist()
+
+        margin_account = BrokerageAccount.BrokerageAccount(0,0,investor.broker_max_margin_to_assets_ratio,\
+            investor.taper_off_leverage_toward_end,\
+            investor.taper_off_leverage_a_lot_toward_end,\
+            investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+        self.__margin_leverage_multiples = [util.max_margin_to_assets_ratio_to_N_to_1_leverage(
+            margin_account.personal_max_margin_to_assets_ratio(years_remaining))
+            for years_remaining in xrange(int(investor.years_until_donate)+1)]
+
+        pay_days = calendar.pay_days
+        self.__pay_fraction_of_year = float(pay_every_num_days) / days_per_year
+        self.__annual_incomes_before_layoff_penalty = investor.annual_incomes_before_layoff_penalty(
+            pay_days, days_per_year, market.inflation_rate)
+        self.__principal_repayment_fractions = [util.per_period_annuity_fraction_of_principal(
+            (num_days - day) / pay_every_num_days, market.annual_margin_interest_rate,
+            investor.pay_principal_throughout) for day in pay_days]
+
+        self.__present_value_factor = market.present_value(1.0, investor.years_until_donate)
+
+    @property
+    def years_elapsed(self):
+        """Indexed by day"""
+        return self.__years_elapsed
+
+    @property
+    def years_remaining(self):
+        """Indexed by day"""
+        return self.__years_remaining
+
+    @property
+    def next_event_days(self):
+        """Indexed by day: the first day on or after it that's a pay, tax or
+        tax-loss-harvest day, the last day, or a day when years_remaining
+        changes. Between events, only market returns change anything."""
+        return self.__next_event_days
+
+    @property
+    def margin_leverage_multiples(self):
+        """The leverage multiple that a margin account rebalancing monthly would
+        target, indexed by years_remaining"""
+        return self.__margin_leverage_multiples
+
+    @property
+    def pay_fraction_of_year(self):
+        return self.__pay_fraction_of_year
+
+    @property
+    def annual_incomes_before_layoff_penalty(self):
+        """Indexed by pay period"""
+        return self.__annual_incomes_before_layoff_penalty
+
+    @property
+    def principal_repayment_fractions(self):
+        """Fraction of the margin loan to repay, indexed by pay period. Same as
+        util.per_period_annuity_payment_of_principal for a principal of 1."""
+        return self.__principal_repayment_fractions
+
+    @property
+    def present_value_factor(self):
+        """Market.present_value of $1 on the donation date"""
+        return self.__present_value_factor
+
+    def present_value(self, amount):
+        return amount * self.__present_value_factor
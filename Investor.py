@@ -1,9 +1,18 @@
 import random
+import numpy
 import TaxRates
 
+INCOME_PENALTY_PER_PAST_LAYOFF = .05
+MIN_INCOME_FRACTION_AFTER_LAYOFFS = .7
+
 class Investor(object):
     """Store parameters about how an investor behaves"""
 
+    STATE_PROPERTIES = ["laid_off"]
+    """Properties that change as a sample path runs (see
+    randomly_update_employment_status_this_month), which aren't parameters,
+    so util.object_parameters leaves them out"""
+
     def __init__(self, years_until_donate=15, initial_annual_income_for_investing=30000, 
                  annual_real_income_growth_percent=2, match_percent_from_401k=50,
                  taper_off_leverage_toward_end=True, taper_off_leverage_a_lot_toward_end=False,
@@ -105,6 +114,10 @@ class Investor(object):
     def do_tax_loss_harvesting(self):
         return self.__do_tax_loss_harvesting
 
+    @property
+    def only_paid_in_first_month_of_sim(self):
+        return self.__only_paid_in_first_month_of_sim
+
     @property
     def initial_personal_max_margin_to_assets_relative_to_broker_max(self):
         return self.__initial_personal_max_margin_to_assets_relative_to_broker_max
@@ -113,15 +126,63 @@ class Investor(object):
         if self.__laid_off or (self.__only_paid_in_first_month_of_sim and day > 0):
             return 0
         else:
-            penalty_for_past_layoffs = max(.7, 1 - .05 * self.__num_times_laid_off)
-            return self.__initial_annual_income_for_investing * \
-                (1+self.__annual_real_income_growth_percent/100.0)**years_elapsed * \
-                (1+inflation_rate)**years_elapsed * penalty_for_past_layoffs
+            return self.__annual_income_before_layoff_penalty(years_elapsed, inflation_rate) * \
+                self.current_income_multiplier()
 
-    def randomly_update_employment_status_this_month(self, randgenerator, num_times_randgenerator_was_called):
+    def current_income_multiplier(self):
+        """The part of current_annual_income that depends on employment history"""
+        if self.__laid_off:
+            return 0
+        else:
+            return income_penalty_for_past_layoffs(self.__num_times_laid_off)
+
+    def annual_incomes_before_layoff_penalty(self, pay_days, days_per_year, inflation_rate):
+        """current_annual_income on each of pay_days for an investor who's never
+        been laid off"""
+        return [0 if (self.__only_paid_in_first_month_of_sim and day > 0) else
+                self.__annual_income_before_layoff_penalty(day/days_per_year, inflation_rate) # intentional int division
+                for day in pay_days]
+
+    def __annual_income_before_layoff_penalty(self, years_elapsed, inflation_rate):
+        return self.__initial_annual_income_for_investing * \
+            (1+self.__annual_real_income_growth_percent/100.0)**years_elapsed * \
+            (1+inflation_rate)**years_elapsed
+
+    def expected_annual_incomes(self, pay_days, days_per_year, inflation_rate):
+        """Expected value of current_annual_income on each of pay_days, averaged
+        over employment histories starting from reset_employment_for_next_round.
+        As in margin_leverage.one_run, employment gets updated once after each
+        pay day. The number of past layoffs is tracked only up to the point
+        where the income penalty stops growing, so this is exact."""
+        num_layoffs_where_penalty_stops_growing = int(round(
+            (1-MIN_INCOME_FRACTION_AFTER_LAYOFFS)/INCOME_PENALTY_PER_PAST_LAYOFF))
+        probabilities = {(False, 0): 1.0} # (laid off, number of past layoffs) -> probability
+        expected_incomes = []
+        for day in pay_days:
+            if self.__only_paid_in_first_month_of_sim and day > 0:
+                expected_incomes.append(0)
+            else:
+                years_elapsed = day/days_per_year # intentional int division
+                expected_penalty = sum(probability * income_penalty_for_past_layoffs(num_times_laid_off)
+                    for ((laid_off, num_times_laid_off), probability) in probabilities.items() if not laid_off)
+                expected_incomes.append(self.__annual_income_before_layoff_penalty(
+                    years_elapsed, inflation_rate) * expected_penalty)
+            next_probabilities = dict()
+            for ((laid_off, num_times_laid_off), probability) in probabilities.items():
+                if not laid_off:
+                    transitions = [((True, min(num_times_laid_off+1, num_layoffs_where_penalty_stops_growing)),
+                                    self.__monthly_probability_of_layoff),
+                                   ((False, num_times_laid_off), 1-self.__monthly_probability_of_layoff)]
+                else:
+                    transitions = [((False, num_times_laid_off), self.__monthly_probability_find_work_after_laid_off),
+                                   ((True, num_times_laid_off), 1-self.__monthly_probability_find_work_after_laid_off)]
+                for (state, transition_probability) in transitions:
+                    next_probabilities[state] = next_probabilities.get(state, 0) + probability * transition_probability
+            probabilities = next_probabilities
+        return expected_incomes
+
+    def randomly_update_employment_status_this_month(self, randgenerator):
         rand_num = randgenerator.random() if randgenerator else random.random()
-        if randgenerator:
-            num_times_randgenerator_was_called += 1
         if not self.__laid_off:
             if rand_num < self.__monthly_probability_of_layoff:
                 self.__laid_off = True
@@ -129,10 +190,25 @@ class Investor(object):
         else:
             if rand_num < self.__monthly_probability_find_work_after_laid_off:
                 self.__laid_off = False
-        return num_times_randgenerator_was_called
+
+    def randomly_update_employment_statuses(self, laid_off, num_times_laid_off, rand_nums):
+        """randomly_update_employment_status_this_month for many paths at once,
+        given numpy arrays of each path's employment status and the random
+        number it would draw. Returns the new (laid_off, num_times_laid_off)."""
+        newly_laid_off = ~laid_off & (rand_nums < self.__monthly_probability_of_layoff)
+        found_work = laid_off & (rand_nums < self.__monthly_probability_find_work_after_laid_off)
+        return ((laid_off | newly_laid_off) & ~found_work, num_times_laid_off + newly_laid_off)
 
     def reset_employment_for_next_round(self):
         """Since we're using the same investor object over multiple runs, we need to reset the
         state that may change during a given run."""
         self.__laid_off = False
-        self.__num_times_laid_off = 0
\ No newline at end of file
+        self.__num_times_laid_off = 0
+
+def income_penalty_for_past_layoffs(num_times_laid_off):
+    return max(MIN_INCOME_FRACTION_AFTER_LAYOFFS, 1 - INCOME_PENALTY_PER_PAST_LAYOFF * num_times_laid_off)
+
+def income_multipliers(laid_off, num_times_laid_off):
+    """Investor.current_income_multiplier for numpy arrays of employment statuses"""
+    return numpy.where(laid_off, 0.0, numpy.maximum(MIN_INCOME_FRACTION_AFTER_LAYOFFS, 
+        1 - INCOME_PENALTY_PER_PAST_LAYOFF * num_times_laid_off))
@@ -0,0 +1,169 @@
+import numpy
+
+INITIAL_LOT_CAPACITY = 16
+SAME_BASIS_PER_SHARE_TOLERANCE = 1e-12
+"""Relative difference in basis per share that's just rounding error, e.g.,
+for two lots bought at the same share price."""
+
+class LotGroup(object):
+    """Lots of one holding-period class (short term or long term), stored as
+    a structure of arrays sorted by basis per share, highest first. Lot i has
+    purchase price (cost basis) purchase_prices[i], purchase day
+    purchase_days[i] and shares[i] shares. The arrays have spare capacity at
+    the end that doubles whenever it runs out.
+
+    Within one holding-period class, the capital-gains tax rate per dollar
+    sold is rate * (1 - basis per share / share price), so the lot with the
+    highest basis per share is the cheapest to sell, and the lots with
+    capital losses (basis per share above the share price) are a prefix.
+    Lots with equal basis per share keep the order they were inserted in.
+    A lot's basis per share can be given when it's inserted, e.g., as the
+    share price it was bought at, so that lots bought at the same price tie
+    exactly instead of being ordered by the rounding error in their purchase
+    prices divided by their shares.
+
+    An inserted lot is merged into a neighboring lot (in basis-per-share order)
+    instead of being added if
+    - merge_same_day is set and it was bought the same day, or
+    - merge_same_basis_per_share is set (for long-term lots, whose holding
+      period can't change anymore) and the two bases per share are within
+      basis_per_share_tolerance of each other, relative to the basis per share.
+    If partial sales reduce a lot's shares and purchase price in proportion
+    (sell_fraction), then with the default tolerance, selling a merged lot
+    gives the same taxes as selling the lots it's made of. If they leave the
+    purchase price alone, as EtfLot.sell does (sell_shares), a partial sale's
+    gain depends on the size of the lot, so lots shouldn't be merged. A
+    larger tolerance buckets lots by basis; each merged lot's purchase price
+    is then off by at most that fraction.
+    purchase_counts[i] is how many purchases went into lot i."""
+
+    def __init__(self, merge_same_day=False, merge_same_basis_per_share=False,
+                 basis_per_share_tolerance=SAME_BASIS_PER_SHARE_TOLERANCE):
+        self.__merge_same_day = merge_same_day
+        self.__merge_same_basis_per_share = merge_same_basis_per_share
+        self.__basis_per_share_tolerance = basis_per_share_tolerance
+        self.__negative_basis_per_share = numpy.zeros(INITIAL_LOT_CAPACITY) # ascending, for searchsorted
+        self.__purchase_prices = numpy.zeros(INITIAL_LOT_CAPACITY)
+        self.__purchase_days = numpy.zeros(INITIAL_LOT_CAPACITY, dtype=int)
+        self.__shares = numpy.zeros(INITIAL_LOT_CAPACITY)
+        self.__purchase_counts = numpy.zeros(INITIAL_LOT_CAPACITY, dtype=int)
+        self.__num_lots = 0
+        self.__num_purchases = 0
+
+    @property
+    def num_lots(self):
+        return self.__num_lots
+
+    @property
+    def num_purchases(self):
+        """Number of lots there would be without merging"""
+        return self.__num_purchases
+
+    @property
+    def purchase_prices(self):
+        return self.__purchase_prices[:self.__num_lots]
+
+    @property
+    def purchase_days(self):
+        return self.__purchase_days[:self.__num_lots]
+
+    @property
+    def shares(self):
+        return self.__shares[:self.__num_lots]
+
+    @property
+    def purchase_counts(self):
+        return self.__purchase_counts[:self.__num_lots]
+
+    def __arrays(self):
+        return [self.__negative_basis_per_share, self.__purchase_prices, self.__purchase_days, 
+                self.__shares, self.__purchase_counts]
+
+    def insert(self, purchase_price, purchase_day, shares, purchase_count=1, basis_per_share=None):
+        if basis_per_share is None:
+            basis_per_share = purchase_price / shares
+        negative_basis_per_share = -basis_per_share
+        position = int(numpy.searchsorted(self.__negative_basis_per_share[:self.__num_lots],
+                                          negative_basis_per_share, side="right"))
+        self.__num_purchases += purchase_count
+        for neighbor in [position-1, position]:
+            if self.__can_merge(neighbor, negative_basis_per_share, purchase_day):
+                self.__purchase_prices[neighbor] += purchase_price
+                self.__shares[neighbor] += shares
+                self.__purchase_days[neighbor] = min(self.__purchase_days[neighbor], purchase_day)
+                self.__purchase_counts[neighbor] += purchase_count
+                self.__negative_basis_per_share[neighbor] = -self.__purchase_prices[neighbor] / self.__shares[neighbor]
+                return
+        if self.__num_lots == len(self.__shares):
+            self.__grow()
+        for (array, value) in zip(self.__arrays(), [negative_basis_per_share, purchase_price,
+                                                     purchase_day, shares, purchase_count]):
+            array[position+1:self.__num_lots+1] = array[position:self.__num_lots]
+            array[position] = value
+        self.__num_lots += 1
+
+    def __can_merge(self, lot_index, negative_basis_per_share, purchase_day):
+        if lot_index < 0 or lot_index >= self.__num_lots:
+            return False
+        same_basis_per_share = abs(self.__negative_basis_per_share[lot_index] - negative_basis_per_share) <= \
+            -negative_basis_per_share * SAME_BASIS_PER_SHARE_TOLERANCE
+        if self.__merge_same_day and self.__purchase_days[lot_index] == purchase_day and same_basis_per_share:
+            return True
+        return self.__merge_same_basis_per_share and \
+            abs(self.__negative_basis_per_share[lot_index] - negative_basis_per_share) <= \
+            -negative_basis_per_share * self.__basis_per_share_tolerance
+
+    def __grow(self):
+        new_capacity = 2 * len(self.__shares)
+        (self.__negative_basis_per_share, self.__purchase_prices, self.__purchase_days, self.__shares,
+         self.__purchase_counts) = \
+            [self.__with_capacity(array, new_capacity) for array in self.__arrays()]
+
+    def __with_capacity(self, array, capacity):
+        bigger_array = numpy.zeros(capacity, dtype=array.dtype)
+        bigger_array[:self.__num_lots] = array[:self.__num_lots]
+        return bigger_array
+
+    def remove(self, lot_index):
+        """Remove a lot and return its (purchase price, purchase day, shares,
+        purchase count, basis per share)."""
+        removed_lot = (self.__purchase_prices[lot_index], self.__purchase_days[lot_index],
+                       self.__shares[lot_index], self.__purchase_counts[lot_index],
+                       -self.__negative_basis_per_share[lot_index])
+        for array in self.__arrays():
+            array[lot_index:self.__num_lots-1] = array[lot_index+1:self.__num_lots]
+        self.__num_lots -= 1
+        self.__num_purchases -= removed_lot[3]
+        return removed_lot
+
+    def remove_first(self, num_lots_to_remove):
+        if num_lots_to_remove > 0:
+            self.__num_purchases -= int(numpy.sum(self.__purchase_counts[:num_lots_to_remove]))
+            num_lots_left = self.__num_lots - num_lots_to_remove
+            for array in self.__arrays():
+                array[:num_lots_left] = array[num_lots_to_remove:self.__num_lots]
+            self.__num_lots = num_lots_left
+
+    def clear(self):
+        self.__num_lots = 0
+        self.__num_purchases = 0
+
+    def sell_fraction(self, lot_index, fraction_sold):
+        """Sell part of a lot. Its purchase price goes down in proportion, so its
+        basis per share and hence its place in the order stay the same."""
+        self.__purchase_prices[lot_index] *= (1-fraction_sold)
+        self.__shares[lot_index] *= (1-fraction_sold)
+
+    def sell_shares(self, lot_index, shares_to_sell):
+        """Sell part of a lot. The lot keeps its whole purchase price, as in
+        EtfLot.sell without PARTIAL_SALES_REDUCE_BASIS, so its basis per share
+        goes up and it may have to move."""
+        (purchase_price, purchase_day, shares, purchase_count, basis_per_share) = self.remove(lot_index)
+        self.insert(purchase_price, purchase_day, shares - shares_to_sell, purchase_count)
+
+    def num_lots_with_basis_per_share_above(self, share_price):
+        return int(numpy.searchsorted(self.__negative_basis_per_share[:self.__num_lots],
+                                      -share_price, side="left"))
+
+    def indices_of_lots_purchased_on_or_before(self, day):
+        return numpy.flatnonzero(self.purchase_days <= day)
@@ -1,5 +1,45 @@
 import random
 import math
+import hashlib
+import numpy
+import os
+from os import path
+from scipy.stats import norm
+from util import INDEPENDENT_SAMPLING, ANTITHETIC_SAMPLING, STRATIFIED_SAMPLING
+
+VIX_DATA_FILE = "vix_close_2Jan2004_to_10Apr2015.txt"
+VOLATILITY_SERIES_BY_FILE = dict()
+
+def volatility_series_cache_file_name(text_file_name):
+    return path.splitext(text_file_name)[0] + ".npy"
+
+def load_volatility_series(text_file_name=VIX_DATA_FILE):
+    """Return a read-only array of annual sigmas from a text file that has one
+    percentage per line (e.g., 18.22 for a VIX close of 18.22). Relative file
+    names are looked up next to this module.
+
+    The text is parsed only the first time; after that the values come from a
+    binary .npy copy next to the text file, which is memory-mapped rather than
+    read in. Since every process maps the same file, the operating system
+    shares one copy of the series across all the worker processes, and each
+    process maps it only once because the array is kept in
+    VOLATILITY_SERIES_BY_FILE. The cache is rebuilt if the text file is newer."""
+    if not path.isabs(text_file_name):
+        text_file_name = path.join(path.dirname(path.abspath(__file__)), text_file_name)
+    if text_file_name not in VOLATILITY_SERIES_BY_FILE:
+        cache_file_name = volatility_series_cache_file_name(text_file_name)
+        if not path.exists(cache_file_name) or \
+            path.getmtime(cache_file_name) < path.getmtime(text_file_name):
+            with open(text_file_name, "r") as data:
+                sigmas = numpy.array([float(price.strip())/100 for price in data.readlines() if price.strip()])
+            temp_file_name = "%s.%i.tmp" % (cache_file_name, os.getpid())
+            with open(temp_file_name, "wb") as temp_file:
+                numpy.save(temp_file, sigmas)
+            if os.name == "nt" and path.exists(cache_file_name):
+                os.remove(cache_file_name) # Windows won't rename over an existing file
+            os.rename(temp_file_name, cache_file_name) # so other processes never see a half-written cache
+        VOLATILITY_SERIES_BY_FILE[text_file_name] = numpy.load(cache_file_name, mmap_mode="r")
+    return VOLATILITY_SERIES_BY_FILE[text_file_name]
 
 class Market(object):
     """Parameters about the behavior of the stock market and interest rates"""
@@ -9,7 +49,7 @@ class Market(object):
                  medium_black_swan_prob=.004, annual_sigma_for_medium_black_swan=1.1,
                  large_black_swan_prob=.0001, 
                  annual_sigma_for_large_black_swan=4.1,
-                 trading_days_per_year=252):
+                 trading_days_per_year=252, volatility_data_file=VIX_DATA_FILE):
         self.annual_mu = annual_mu
         self.annual_sigma = annual_sigma
         self.annual_margin_interest_rate = annual_margin_interest_rate
@@ -23,6 +63,9 @@ class Market(object):
 
         self.__inflation_rate = inflation_rate
         self.__use_VIX_data_for_volatility = use_VIX_data_for_volatility
+        self.__volatility_data_file = volatility_data_file
+        """When use_VIX_data_for_volatility is True, sigmas come from this file.
+        It can be any longer or alternative series in the same format as the VIX file."""
         self.__VIX_data = None
         self.__num_days_VIX_data = 0
         self.__medium_black_swan_prob = medium_black_swan_prob
@@ -34,7 +77,18 @@ class Market(object):
         # Get VIX data if needed
         if self.__use_VIX_data_for_volatility:
             self.read_VIX_data()
-            self.__num_days_VIX_data = len(self.__VIX_data)
+
+    def __getstate__(self):
+        """Don't copy the volatility series when a Market is pickled to send to
+        another process; that process maps the shared cache file itself."""
+        state = self.__dict__.copy()
+        state["_Market__VIX_data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.__use_VIX_data_for_volatility:
+            self.read_VIX_data()
 
     @property
     def annual_mu(self):
@@ -88,15 +142,29 @@ class Market(object):
     def trading_days_per_year(self):
         return self.__trading_days_per_year
 
+    @property
+    def volatility_data_file(self):
+        return self.__volatility_data_file
+
+    @property
+    def volatility_data_hash(self):
+        """Hash of the sigmas read from volatility_data_file, or None if they
+        aren't used, so that util.object_parameters tells apart markets whose
+        series differ even if the file name is the same (e.g., after the file
+        is edited or replaced by a longer series)"""
+        if not self.__use_VIX_data_for_volatility:
+            return None
+        return hashlib.sha1(numpy.ascontiguousarray(self.__VIX_data)).hexdigest()
+
     def read_VIX_data(self):
         """Read in daily VIX prices, which I took from 
         http://www.cboe.com/publish/scheduledtask/mktdata/datahouse/vixcurrent.csv ,
         which is linked from http://www.cboe.com/micro/vix/historical.aspx , 
-        on 12 Apr 2015"""
-        with open("vix_close_2Jan2004_to_10Apr2015.txt", "r") as data:
-            self.__VIX_data = [float(price.strip())/100 for price in data.readlines()]
+        on 12 Apr 2015. See load_volatility_series for how it's shared across processes."""
+        self.__VIX_data = load_volatility_series(self.__volatility_data_file)
+        self.__num_days_VIX_data = len(self.__VIX_data)
 
-    def random_daily_return(self, day, randgenerator, num_times_randgenerator_was_called):
+    def random_daily_return(self, day, randgenerator):
         delta_t = 1.0/self.__trading_days_per_year
         if self.__use_VIX_data_for_volatility:
             sigma_to_use = self.__VIX_data[day % self.__num_days_VIX_data]
@@ -107,8 +175,6 @@ class Market(object):
 
         # See if we have black swans
         rand_float = randgenerator.random() if randgenerator else random.random()
-        if randgenerator:
-            num_times_randgenerator_was_called += 1
         if rand_float < self.__large_black_swan_prob:
             sigma_to_use = self.__annual_sigma_for_large_black_swan
             mu_to_use = 0
@@ -117,10 +183,7 @@ class Market(object):
             mu_to_use = 0
 
         randgauss = randgenerator.gauss(0,1) if randgenerator else random.gauss(0,1)
-        if randgenerator:
-            num_times_randgenerator_was_called += 1
-        return (sigma_to_use * randgauss * math.sqrt(delta_t) + mu_to_use * delta_t, \
-            num_times_randgenerator_was_called)
+        return sigma_to_use * randgauss * math.sqrt(delta_t) + mu_to_use * delta_t
         """
         The above is a GBM for stock; for an example of this equation, see the first equation 
         in section 7.1 of 'Path-dependence of Leveraged ETF returns', 
@@ -129,6 +192,91 @@ class Market(object):
         delta_t = 1/252, then daily_sigma = yearly_sigma * sqrt(delta_t)
         """
 
+    def random_daily_returns(self, num_paths, trading_days, randgenerator=None,
+                             sampling_mode=INDEPENDENT_SAMPLING, strata=None, num_strata=None):
+        """Batch version of random_daily_return. Returns a
+        (num_paths x len(trading_days)) numpy array whose row i holds the daily
+        returns of sample path i on the given trading days, in order.
+        trading_days holds the day numbers (counted from the start of the
+        simulation) on which the market is open; they're only needed to
+        look up the VIX sigma for each day. randgenerator should be either a
+        numpy.random.RandomState used for all paths or a list with one
+        RandomState per path (see random_streams); in the latter case, each row
+        is the same as if its path had been generated alone. If randgenerator
+        is None, numpy's global generator is used.
+
+        sampling_mode can be
+        - INDEPENDENT_SAMPLING: every path gets its own draws.
+        - ANTITHETIC_SAMPLING: rows 2k and 2k+1 are a pair. Row 2k+1 has the same
+          black-swan days as row 2k but the opposite normal shock on every
+          day, so only even rows' generators are used. Pairing the shocks
+          rather than the returns keeps the pairs valid with black swans and
+          VIX sigma.
+        - STRATIFIED_SAMPLING: the sum of a path's normal shocks is stratified.
+          Row i's total shock is drawn from stratum strata[i] out of num_strata
+          equally likely strata of the normal distribution, and its daily
+          shocks are drawn from their conditional distribution given that sum.
+          Each day's shock is still a standard normal, so black swans and VIX
+          sigma are applied to it as usual.
+        util.stderr gives standard errors for samples from each mode."""
+        if randgenerator is None:
+            randgenerator = numpy.random
+        trading_days = numpy.asarray(trading_days, dtype=int)
+        num_trading_days = len(trading_days)
+        delta_t = 1.0/self.__trading_days_per_year
+        if self.__use_VIX_data_for_volatility:
+            sigma_for_each_day = self.__VIX_data[trading_days % self.__num_days_VIX_data]
+        else:
+            sigma_for_each_day = numpy.repeat(float(self.annual_sigma), num_trading_days)
+        sigmas = numpy.tile(sigma_for_each_day, (num_paths, 1))
+        mus = numpy.repeat(float(self.annual_mu), num_paths * num_trading_days).reshape(
+            (num_paths, num_trading_days))
+
+        if isinstance(randgenerator, list):
+            assert len(randgenerator) == num_paths, "Need one random generator per path"
+        if sampling_mode == ANTITHETIC_SAMPLING:
+            num_rows_to_draw = (num_paths+1)/2
+            if isinstance(randgenerator, list):
+                randgenerator = randgenerator[::2]
+        else:
+            num_rows_to_draw = num_paths
+        rand_floats = self.__draws(randgenerator, "random_sample", num_rows_to_draw, num_trading_days)
+        randgauss = self.__draws(randgenerator, "standard_normal", num_rows_to_draw, num_trading_days)
+        if sampling_mode == ANTITHETIC_SAMPLING:
+            rand_floats = numpy.repeat(rand_floats, 2, axis=0)[:num_paths]
+            randgauss = numpy.repeat(randgauss, 2, axis=0)[:num_paths]
+            randgauss[1::2] *= -1
+        elif sampling_mode == STRATIFIED_SAMPLING:
+            assert strata is not None and num_strata, "Stratified sampling needs strata and num_strata"
+            fractions_within_strata = self.__draws(randgenerator, "random_sample", num_paths, 1)[:,0]
+            total_shocks = norm.ppf((numpy.asarray(strata) + fractions_within_strata) / float(num_strata))
+            """Given iid standard normals g_1..g_n, g_j - mean(g) is independent of
+            sum(g), so shifting every g_j by the same amount gives the conditional
+            distribution of the daily shocks given that their sum is sqrt(n) * total_shock."""
+            randgauss += ((total_shocks * math.sqrt(num_trading_days) - randgauss.sum(axis=1)) / \
+                num_trading_days)[:,numpy.newaxis]
+        else:
+            assert sampling_mode == INDEPENDENT_SAMPLING, "Unknown sampling mode %s" % sampling_mode
+
+        # See if we have black swans; same mixture as in random_daily_return
+        large_black_swans = rand_floats < self.__large_black_swan_prob
+        medium_black_swans = numpy.logical_and(numpy.logical_not(large_black_swans), 
+            rand_floats < (self.__large_black_swan_prob + self.__medium_black_swan_prob))
+        sigmas[medium_black_swans] = self.__annual_sigma_for_medium_black_swan
+        sigmas[large_black_swans] = self.__annual_sigma_for_large_black_swan
+        mus[numpy.logical_or(medium_black_swans, large_black_swans)] = 0
+
+        return sigmas * randgauss * math.sqrt(delta_t) + mus * delta_t
+
+    def __draws(self, randgenerator, method_name, num_rows, num_columns):
+        """num_rows x num_columns draws, either all from one generator or
+        row i from the ith generator in a list."""
+        if isinstance(randgenerator, list):
+            return numpy.array([getattr(path_generator, method_name)(num_columns) 
+                                for path_generator in randgenerator])
+        else:
+            return getattr(randgenerator, method_name)((num_rows, num_columns))
+
     def present_value(self, amount, years_in_future):
         #return amount / (1+self.annual_mu)**years_in_future
         #return amount * math.exp(- self.annual_mu * years_in_future) / (1+self.__inflation_rate)**years_in_future # use continuous interest for discounting like GBM model does
@@ -0,0 +1,156 @@
+import hashlib
+import os
+from os import path
+import numpy
+import util
+import random_streams
+
+NUM_PATHS_TO_GENERATE_AT_ONCE = 100
+
+class RecordedDraws(object):
+    """Replays a row of recorded uniform draws through the random() method
+    that random.Random has, so it can stand in for a path's employment
+    generator."""
+
+    def __init__(self, draws):
+        self.__draws = iter(draws)
+
+    def random(self):
+        return float(next(self.__draws))
+
+class PathTape(object):
+    """Daily market returns and monthly employment draws for sample paths
+    0, 1, ..., num_paths-1, generated once and saved to .npy files in tape_dir.
+    Every process that opens the same tape memory-maps those files read-only
+    instead of regenerating the paths, so the draws are only computed once per
+    market configuration and horizon, and every leverage level and scenario
+    that uses the tape sees exactly the same random numbers.
+
+    The draws come from the per-path streams in random_streams, so a run that
+    reads from a tape gives the same results as one that doesn't. The file
+    names include a hash of everything the draws depend on (the Market's
+    parameters, the trading days, the number of pay days, the seed, the
+    sampling mode and, with stratified sampling, where the strata depend on
+    it, the number of paths), so tapes for different configurations don't
+    collide and an existing tape is reused whenever it matches. Otherwise a
+    path's draws don't depend on how many paths there are, so a tape with
+    more paths than asked for is reused as is, and one with fewer is
+    extended (see with_at_least)."""
+
+    def __init__(self, tape_dir, market, calendar, num_paths, scenario_seed,
+                 sampling_mode=util.INDEPENDENT_SAMPLING):
+        """With stratified sampling, each of the num_paths paths is its own stratum."""
+        self.__tape_dir = tape_dir
+        self.__market = market
+        self.__calendar = calendar
+        self.__scenario_seed = scenario_seed
+        self.__sampling_mode = sampling_mode
+        key = hashlib.sha1(repr((util.object_parameters(market), calendar.trading_days.tolist(),
+                                 len(calendar.pay_days),
+                                 num_paths if sampling_mode == util.STRATIFIED_SAMPLING else None,
+                                 scenario_seed, sampling_mode))).hexdigest()
+        self.__returns_file = path.join(tape_dir, "returns_%s.npy" % key)
+        self.__employment_draws_file = path.join(tape_dir, "employment_%s.npy" % key)
+        if not path.isdir(tape_dir):
+            try:
+                os.makedirs(tape_dir)
+            except OSError:
+                assert path.isdir(tape_dir), "Couldn't create %s" % tape_dir # another process may have made it
+        if num_paths_in(self.__returns_file) < num_paths:
+            self.__write_returns(num_paths)
+        if num_paths_in(self.__employment_draws_file) < num_paths:
+            self.__write_employment_draws(num_paths)
+        self.__open()
+
+    def __open(self):
+        self.__returns = numpy.load(self.__returns_file, mmap_mode="r")
+        self.__employment_draws = numpy.load(self.__employment_draws_file, mmap_mode="r")
+        self.__num_paths = min(len(self.__returns), len(self.__employment_draws))
+
+    def __write_atomically(self, file_name, shape, fill_rows):
+        """Write to a temporary file and then rename it so that other processes
+        never see a half-written tape. The paths already in the file, if
+        any, are copied rather than generated again."""
+        temp_file_name = "%s.%i.tmp" % (file_name, os.getpid())
+        tape = numpy.lib.format.open_memmap(temp_file_name, mode="w+", dtype=numpy.float64,
+                                            shape=shape)
+        num_paths_already_there = min(num_paths_in(file_name), shape[0])
+        if num_paths_already_there:
+            existing_tape = numpy.load(file_name, mmap_mode="r")
+            tape[:num_paths_already_there] = existing_tape[:num_paths_already_there]
+            del existing_tape
+        for first_path in xrange(num_paths_already_there, shape[0], NUM_PATHS_TO_GENERATE_AT_ONCE):
+            last_path = min(first_path + NUM_PATHS_TO_GENERATE_AT_ONCE, shape[0])
+            tape[first_path:last_path] = fill_rows(first_path, last_path-first_path)
+        tape.flush()
+        del tape
+        if os.name == "nt" and path.exists(file_name):
+            os.remove(file_name) # Windows won't rename over an existing file
+        os.rename(temp_file_name, file_name)
+
+    def __write_returns(self, num_tape_paths):
+        self.__write_atomically(self.__returns_file, (num_tape_paths, self.__calendar.num_trading_days),
+            lambda first_path, num_paths: random_streams.daily_returns_for_paths(
+                self.__market, self.__calendar.trading_days, self.__scenario_seed, first_path, num_paths,
+                self.__sampling_mode, num_tape_paths))
+
+    def __write_employment_draws(self, num_tape_paths):
+        num_pay_days = len(self.__calendar.pay_days)
+        self.__write_atomically(self.__employment_draws_file, (num_tape_paths, num_pay_days),
+            lambda first_path, num_paths: random_streams.employment_draws_for_paths(
+                self.__scenario_seed, first_path, num_paths, num_pay_days))
+
+    def with_at_least(self, num_paths):
+        """This tape if it has at least num_paths paths, or else the same
+        tape extended to num_paths (see the class's comment)"""
+        if num_paths <= self.__num_paths:
+            return self
+        assert self.__sampling_mode != util.STRATIFIED_SAMPLING, "Stratified path tapes can't be extended"
+        return PathTape(self.__tape_dir, self.__market, self.__calendar, num_paths, self.__scenario_seed,
+                        self.__sampling_mode)
+
+    def __getstate__(self):
+        """When a tape is sent to another process, send only the file names;
+        the other process maps the files itself."""
+        state = self.__dict__.copy()
+        state["_PathTape__returns"] = None
+        state["_PathTape__employment_draws"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+    @property
+    def num_paths(self):
+        return self.__num_paths
+
+    @property
+    def sampling_mode(self):
+        return self.__sampling_mode
+
+    @property
+    def scenario_seed(self):
+        return self.__scenario_seed
+
+    def daily_returns(self, path_index):
+        """Row to pass as one_run's daily_returns."""
+        return self.__returns[path_index]
+
+    def daily_returns_for_paths(self, first_path_index, num_paths):
+        """Rows to pass as margin_leverage.batched_runs's daily_returns"""
+        return self.__returns[first_path_index:first_path_index+num_paths]
+
+    def employment_randgenerator(self, path_index):
+        """Stand-in for the path's employment generator."""
+        return RecordedDraws(self.__employment_draws[path_index])
+
+    def employment_draws(self, first_path_index, num_paths):
+        """Rows of employment draws, one per pay day, for margin_leverage.batched_runs"""
+        return self.__employment_draws[first_path_index:first_path_index+num_paths]
+
+def num_paths_in(file_name):
+    """Number of paths in a tape file, or 0 if there isn't one"""
+    if not path.exists(file_name):
+        return 0
+    return numpy.load(file_name, mmap_mode="r").shape[0]
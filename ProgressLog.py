@@ -0,0 +1,160 @@
+import json
+import os
+from os import path
+import sys
+import time
+
+EVENT_INTERVAL_SECONDS = 10 # see ShardProgress
+
+class ProgressLog(object):
+    """Append-only file of progress events from every process of a
+    computation (the main one and the workers running its sample shards),
+    one JSON object per line, so that their progress can be followed in one
+    place (see summary) rather than in their interleaved printouts. Each
+    event is appended in a single write to the file opened for appending, so
+    events from different processes never interleave within a line.
+
+    The main process writes a "scheduled" event with the number of samples
+    and shards before it runs them, and each shard writes "start",
+    "progress" and "done" events (see ShardProgress)."""
+
+    def __init__(self, file_name):
+        self.__file_name = file_name
+
+    @property
+    def file_name(self):
+        return self.__file_name
+
+    def write(self, event, **fields):
+        fields.update(event=event, time=time.time(), pid=os.getpid())
+        line = json.dumps(fields, sort_keys=True) + "\n"
+        fd = os.open(self.__file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def scheduled(self, num_samples, num_shards):
+        self.write("scheduled", num_samples=num_samples, num_shards=num_shards)
+
+    def shard_progress(self, run_name, N_to_1_leverage, first_sample, end_sample):
+        return ShardProgress(self, run_name, N_to_1_leverage, first_sample, end_sample)
+
+    def events(self):
+        """The events in the order they were written, less a last line that
+        may still be being written"""
+        events = []
+        if path.exists(self.__file_name):
+            with open(self.__file_name) as infile:
+                for line in infile:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass
+        return events
+
+class ShardProgress(object):
+    """Progress of a process's run of samples first_sample through
+    end_sample-1 of run_name (e.g., its outfilepath) at N_to_1_leverage,
+    written to a ProgressLog when it starts, as samples finish (at most every
+    EVENT_INTERVAL_SECONDS) and when it's done. Each event has the number
+    of samples done, the samples per second so far and the estimated
+    seconds left."""
+
+    def __init__(self, log, run_name, N_to_1_leverage, first_sample, end_sample):
+        self.__log = log
+        self.__run_name = run_name
+        self.__N_to_1_leverage = N_to_1_leverage
+        self.__first_sample = first_sample
+        self.__end_sample = end_sample
+        self.__start_time = time.time()
+        self.__last_event_time = self.__start_time
+        self.__write("start", 0, self.__start_time)
+
+    def update(self, num_samples_done):
+        now = time.time()
+        if now - self.__last_event_time >= EVENT_INTERVAL_SECONDS:
+            self.__write("progress", num_samples_done, now)
+
+    def finish(self):
+        self.__write("done", self.__end_sample - self.__first_sample, time.time())
+
+    def __write(self, event, num_samples_done, now):
+        elapsed_seconds = now - self.__start_time
+        samples_per_second = num_samples_done / elapsed_seconds if num_samples_done and elapsed_seconds > 0 else None
+        num_samples_left = self.__end_sample - self.__first_sample - num_samples_done
+        self.__log.write(event, run=self.__run_name, leverage=self.__N_to_1_leverage,
+                         first_sample=self.__first_sample, end_sample=self.__end_sample,
+                         samples_done=num_samples_done, samples_per_second=samples_per_second,
+                         eta_seconds=num_samples_left / samples_per_second if samples_per_second else None)
+        self.__last_event_time = now
+
+def summary(events, now=None):
+    """Lines of a consolidated view of the events of a ProgressLog since its
+    last "scheduled" event: the overall progress of the shards scheduled
+    there, and each worker process's throughput and current shard"""
+    if now is None:
+        now = time.time()
+    scheduled_indices = [index for (index, event) in enumerate(events) if event["event"] == "scheduled"]
+    if scheduled_indices:
+        scheduled = events[scheduled_indices[-1]]
+        events = events[scheduled_indices[-1]+1:]
+    else:
+        scheduled = None
+    last_event_by_shard = dict()
+    events_by_pid = dict()
+    for event in events:
+        if event["event"] != "scheduled":
+            last_event_by_shard[(event["run"], event["first_sample"], event["end_sample"])] = event
+            events_by_pid.setdefault(event["pid"], []).append(event)
+    if scheduled is None and not last_event_by_shard:
+        return ["No progress events"]
+
+    num_samples_done = sum(event["samples_done"] for event in last_event_by_shard.values())
+    if scheduled:
+        num_samples = scheduled["num_samples"]
+        num_shards = scheduled["num_shards"]
+        start_time = scheduled["time"]
+    else:
+        num_samples = sum(end_sample - first_sample for (run, first_sample, end_sample) in last_event_by_shard)
+        num_shards = len(last_event_by_shard)
+        start_time = min(event["time"] for event in events)
+    num_shards_done = len([event for event in last_event_by_shard.values() if event["event"] == "done"])
+    end_time = events[-1]["time"] if events and num_samples_done >= num_samples else now
+    elapsed_seconds = end_time - start_time
+    samples_per_second = num_samples_done / elapsed_seconds if elapsed_seconds > 0 else 0
+    lines = ["{:,} of {:,} samples ({:.0f}%) and {} of {} shards done in {}, {:.2f} samples/second{}".format(
+        num_samples_done, num_samples, 100.0 * num_samples_done / max(1, num_samples), num_shards_done,
+        num_shards, format_seconds(elapsed_seconds), samples_per_second,
+        ", about {} left".format(format_seconds((num_samples - num_samples_done) / samples_per_second))
+        if samples_per_second > 0 and num_samples_done < num_samples else "")]
+
+    for pid in sorted(events_by_pid.keys()):
+        pid_events = events_by_pid[pid]
+        last_event_by_pid_shard = dict(((event["run"], event["first_sample"], event["end_sample"]), event)
+                                       for event in pid_events)
+        pid_samples_done = sum(event["samples_done"] for event in last_event_by_pid_shard.values())
+        pid_elapsed_seconds = pid_events[-1]["time"] - pid_events[0]["time"]
+        line = "Worker {}: {:,} samples in {} shards, {}".format(pid, pid_samples_done,
+            len(last_event_by_pid_shard), "{:.2f} samples/second".format(pid_samples_done / pid_elapsed_seconds)
+            if pid_elapsed_seconds > 0 else "no throughput yet")
+        last_event = pid_events[-1]
+        if last_event["event"] != "done":
+            line += "; on {} at {:.2f}:1 leverage, samples {}-{}: {:,} done{}".format(last_event["run"],
+                last_event["leverage"], last_event["first_sample"], last_event["end_sample"]-1,
+                last_event["samples_done"], ", about {} left".format(format_seconds(last_event["eta_seconds"]))
+                if last_event["eta_seconds"] is not None else "")
+        lines.append(line)
+    return lines
+
+def format_seconds(seconds):
+    return time.strftime("%H:%M:%S", time.gmtime(seconds)) if seconds < 24*60*60 \
+        else "{:.1f} days".format(seconds / (24*60*60))
+
+if __name__ == "__main__":
+    """python ProgressLog.py <log file> prints the summary of a ProgressLog"""
+    if len(sys.argv) != 2:
+        print "Usage: python ProgressLog.py <log file, e.g., progress_log.jsonl>"
+    else:
+        for line in summary(ProgressLog(sys.argv[1]).events()):
+            print line
@@ -0,0 +1,81 @@
+import fnmatch
+import glob
+import hashlib
+from os import path
+import Checkpoints
+
+MODULES_THAT_DONT_CHANGE_RESULTS = ["write_essay.py", "write_results.py", "test_*.py", "oldversion_*.py"]
+"""Names or glob patterns of modules whose edits shouldn't make results be
+computed again: write_essay only reads results, write_results only formats
+the files that are made from cached results each time they're loaded, and
+the tests and old versions of the programs aren't imported by any run"""
+
+CODE_VERSION = None
+
+def can_change_results(module_file_name):
+    return not any(fnmatch.fnmatch(path.basename(module_file_name), pattern)
+                   for pattern in MODULES_THAT_DONT_CHANGE_RESULTS)
+
+def code_version():
+    """Hash of the source of every module in this directory that can change
+    a result, so that results computed with older code aren't reused"""
+    global CODE_VERSION
+    if CODE_VERSION is None:
+        code_hash = hashlib.sha1()
+        for file_name in sorted(glob.glob(path.join(path.dirname(path.abspath(__file__)), "*.py"))):
+            if can_change_results(file_name):
+                with open(file_name, "rb") as source:
+                    code_hash.update(path.basename(file_name))
+                    code_hash.update(source.read())
+        CODE_VERSION = code_hash.hexdigest()
+    return CODE_VERSION
+
+class ResultCache(object):
+    """Results of whole simulation runs (e.g., a run_samples run's merged
+    SampleResults), saved in cache_dir under a key of everything they depend
+    on: the run's parameters (a tuple with a repr that doesn't change from
+    run to run, like util.object_parameters), its number of samples and the
+    code that computed them. A run whose key is in the cache can load its
+    results instead of being run again, so rebuilding the results after
+    changing one scenario only reruns that scenario, and results computed
+    with other settings or other code are never reused by mistake. The
+    numbers of samples stored for each set of parameters are kept too, so a
+    run of more samples can start from the results of a run of fewer.
+
+    The figures of individual sample paths that a run saves while it runs
+    (the other figures and files are made from the results) are saved along
+    with the results and copied to the new run's outfilepath on loading."""
+
+    def __init__(self, cache_dir):
+        self.__entries = Checkpoints.Checkpoints(cache_dir)
+
+    def has(self, parameters, num_samples):
+        return self.__entries.has(self.__key(parameters, num_samples))
+
+    def load(self, parameters, num_samples, outfilepath):
+        (results, figures) = self.__entries.load(self.__key(parameters, num_samples))
+        if outfilepath:
+            for (suffix, contents) in figures.iteritems():
+                with open(outfilepath + suffix, "wb") as figure:
+                    figure.write(contents)
+        return results
+
+    def save(self, parameters, num_samples, results, outfilepath, figure_suffix_pattern):
+        """Save results, along with the figures named outfilepath followed by
+        figure_suffix_pattern (a glob pattern)"""
+        figures = dict()
+        if outfilepath:
+            for file_name in glob.glob(outfilepath + figure_suffix_pattern):
+                with open(file_name, "rb") as figure:
+                    figures[file_name[len(outfilepath):]] = figure.read()
+        self.__entries.save(self.__key(parameters, num_samples), (results, figures))
+        self.__entries.save(self.__key(parameters, None),
+                            sorted(set(self.num_samples_stored(parameters) + [num_samples])))
+
+    def num_samples_stored(self, parameters):
+        """Numbers of samples of the runs with these parameters in the cache"""
+        key = self.__key(parameters, None)
+        return self.__entries.load(key) if self.__entries.has(key) else []
+
+    def __key(self, parameters, num_samples):
+        return Checkpoints.key(code_version(), parameters, num_samples)
@@ -0,0 +1,154 @@
+import copy
+import numpy
+import ExactStatistics
+import StreamingStatistics
+
+class SampleResults(object):
+    """What margin_leverage.run_samples keeps from a run of consecutive
+    samples: the statistics of each account type's ending values (and their
+    control variates), which are ExactStatistics if exact_statistics and
+    StreamingStatistics otherwise; the counts of emergency-savings gaps and
+    bankruptcies; running sums of the simple-calculation ending balances and
+    of the daily margin-to-assets ratios; and the histories of the first few
+    samples for plotting.
+
+    A shard of samples fills one in with add_sample or add_batch, and
+    merge appends the results of the shard that comes next, so merging the
+    shards of a run in order gives the same values as running it unsharded
+    (up to the rounding of the running sums). Only the histories of samples
+    before max_num_histories (or max_num_percent_differences) are kept; a shard
+    that starts at first_sample should keep max(0, max_num_histories -
+    first_sample) of them."""
+
+    def __init__(self, account_types, exact_statistics, max_num_histories, max_num_percent_differences):
+        self.__account_types = account_types
+        statistics_class = ExactStatistics.ExactStatistics if exact_statistics else \
+            StreamingStatistics.StreamingStatistics
+        self.__account_statistics = dict((type, statistics_class()) for type in account_types)
+        self.__max_num_histories = max_num_histories
+        self.__max_num_percent_differences = max_num_percent_differences
+        self.__margin_to_assets_ratio_histories = []
+        self.__wealth_histories = []
+        self.__carried_cap_gains_histories = []
+        self.__margin_percent_differences_from_simple_calc_list = []
+        self.__sum_of_margin_to_assets_ratios = None
+        self.__num_times_margin_ended_with_emergency_savings_gap = 0
+        self.__num_times_margin_strategy_went_bankrupt = 0
+        self.__sum_of_simple_calc_ending_balances = 0
+
+    @property
+    def num_samples(self):
+        return self.__account_statistics[self.__account_types[0]].num_values
+
+    @property
+    def account_statistics(self):
+        return self.__account_statistics
+
+    @property
+    def margin_to_assets_ratio_histories(self):
+        return self.__margin_to_assets_ratio_histories
+
+    @property
+    def wealth_histories(self):
+        return self.__wealth_histories
+
+    @property
+    def carried_cap_gains_histories(self):
+        return self.__carried_cap_gains_histories
+
+    @property
+    def margin_percent_differences_from_simple_calc_list(self):
+        return self.__margin_percent_differences_from_simple_calc_list
+
+    @property
+    def sum_of_margin_to_assets_ratios(self):
+        """Indexed by day"""
+        return self.__sum_of_margin_to_assets_ratios
+
+    @property
+    def num_times_margin_ended_with_emergency_savings_gap(self):
+        return self.__num_times_margin_ended_with_emergency_savings_gap
+
+    @property
+    def num_times_margin_strategy_went_bankrupt(self):
+        return self.__num_times_margin_strategy_went_bankrupt
+
+    @property
+    def sum_of_simple_calc_ending_balances(self):
+        return self.__sum_of_simple_calc_ending_balances
+
+    def add_sample(self, account_values, control_variates, margin_to_assets_ratios,
+                   margin_wealth, carried_cap_gains, margin_percent_differences_from_simple_calc,
+                   margin_account_has_emergency_savings_gap, margin_strategy_went_bankrupt,
+                   simple_calc_ending_balance):
+        """Add the results of one_run (or kernel_run) for the next sample.
+        account_values and control_variates are in the order of account_types."""
+        for (type, value, control_variate) in zip(self.__account_types, account_values, control_variates):
+            self.__account_statistics[type].add(value, control_variate)
+
+        if len(self.__margin_to_assets_ratio_histories) < self.__max_num_histories:
+            self.__margin_to_assets_ratio_histories.append(margin_to_assets_ratios)
+        if len(self.__wealth_histories) < self.__max_num_histories:
+            self.__wealth_histories.append(margin_wealth)
+        if len(self.__carried_cap_gains_histories) < self.__max_num_histories:
+            self.__carried_cap_gains_histories.append(carried_cap_gains)
+        if len(self.__margin_percent_differences_from_simple_calc_list) < self.__max_num_percent_differences:
+            self.__margin_percent_differences_from_simple_calc_list.append(margin_percent_differences_from_simple_calc)
+        self.__sum_of_simple_calc_ending_balances += simple_calc_ending_balance
+        self.__add_to_sum_of_margin_to_assets_ratios(margin_to_assets_ratios)
+        if margin_account_has_emergency_savings_gap:
+            self.__num_times_margin_ended_with_emergency_savings_gap += 1
+        if margin_strategy_went_bankrupt:
+            self.__num_times_margin_strategy_went_bankrupt += 1
+
+    def add_batch(self, account_values, control_variates, sum_of_margin_to_assets_ratios,
+                  margin_to_assets_ratios_list, margin_wealth_list, carried_cap_gains_list,
+                  margin_percent_differences_from_simple_calc_list,
+                  margin_account_has_emergency_savings_gap, margin_strategy_went_bankrupt,
+                  simple_calc_ending_balances):
+        """Add the results of batched_runs for the next batch of samples.
+        account_values is a list of arrays with a value per sample, and
+        control_variates is an array with a row per sample, both with the
+        types in the order of account_types."""
+        for (type_num, (type, batch_values)) in enumerate(zip(self.__account_types, account_values)):
+            self.__account_statistics[type].add_values(batch_values, control_variates[:,type_num])
+
+        self.__extend_histories(margin_to_assets_ratios_list, margin_wealth_list, carried_cap_gains_list,
+                                margin_percent_differences_from_simple_calc_list)
+        self.__sum_of_simple_calc_ending_balances += numpy.sum(simple_calc_ending_balances)
+        self.__add_to_sum_of_margin_to_assets_ratios(sum_of_margin_to_assets_ratios)
+        self.__num_times_margin_ended_with_emergency_savings_gap += int(numpy.sum(margin_account_has_emergency_savings_gap))
+        self.__num_times_margin_strategy_went_bankrupt += int(numpy.sum(margin_strategy_went_bankrupt))
+
+    def merge(self, next_results):
+        """Append the results of the shard of samples right after this one"""
+        for (type, statistics) in self.__account_statistics.items():
+            statistics.merge(next_results.account_statistics[type])
+
+        self.__extend_histories(next_results.margin_to_assets_ratio_histories,
+                                next_results.wealth_histories,
+                                next_results.carried_cap_gains_histories,
+                                next_results.margin_percent_differences_from_simple_calc_list)
+        self.__sum_of_simple_calc_ending_balances += next_results.sum_of_simple_calc_ending_balances
+        if next_results.sum_of_margin_to_assets_ratios is not None:
+            self.__add_to_sum_of_margin_to_assets_ratios(next_results.sum_of_margin_to_assets_ratios)
+        self.__num_times_margin_ended_with_emergency_savings_gap += \
+            next_results.num_times_margin_ended_with_emergency_savings_gap
+        self.__num_times_margin_strategy_went_bankrupt += next_results.num_times_margin_strategy_went_bankrupt
+
+    def __extend_histories(self, margin_to_assets_ratios_list, margin_wealth_list, carried_cap_gains_list,
+                           margin_percent_differences_from_simple_calc_list):
+        self.__margin_to_assets_ratio_histories.extend(margin_to_assets_ratios_list[
+            :self.__max_num_histories-len(self.__margin_to_assets_ratio_histories)])
+        self.__wealth_histories.extend(margin_wealth_list[
+            :self.__max_num_histories-len(self.__wealth_histories)])
+        self.__carried_cap_gains_histories.extend(carried_cap_gains_list[
+            :self.__max_num_histories-len(self.__carried_cap_gains_histories)])
+        self.__margin_percent_differences_from_simple_calc_list.extend(margin_percent_differences_from_simple_calc_list[
+            :self.__max_num_percent_differences-len(self.__margin_percent_differences_from_simple_calc_list)])
+
+    def __add_to_sum_of_margin_to_assets_ratios(self, margin_to_assets_ratios):
+        if self.__sum_of_margin_to_assets_ratios is None:
+            self.__sum_of_margin_to_assets_ratios = copy.copy(margin_to_assets_ratios)
+        else:
+            self.__sum_of_margin_to_assets_ratios += margin_to_assets_ratios
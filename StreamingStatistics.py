@@ -0,0 +1,263 @@
+import math
+import numpy
+import util
+import TDigest
+
+class StreamingStatistics(object):
+    """Statistics of the ending values of one account type over sample paths
+    0, 1, ..., in order, kept in constant memory so that runs of millions of
+    samples don't have to keep every value; see ExactStatistics for the
+    version that keeps them, which has the same methods.
+
+    Kept online and mergeable: the count, means and co-moments of each value,
+    its square root, log(value+1) and its control variate (see
+    margin_leverage.control_variate_growth_factor), which give the means,
+    standard errors and control-variate estimates; the same for the means and
+    differences of neighboring pairs of samples, which util.stderr uses for
+    antithetic and stratified sampling; the min and max; and a TDigest of the
+    values for quantiles, histograms and expectations of other functions.
+    Shards merged in order must start at even sample numbers so that pairs
+    aren't split."""
+
+    BUFFER_SIZE = 1000
+    VALUE = 0
+    SQRT_VALUE = 1
+    LOG_VALUE = 2
+    CONTROL_VALUE = 3
+    PAIRED_VALUE = 0
+    PAIRED_SQRT_VALUE = 1
+    PAIRED_CONTROL_VALUE = 2
+    NUM_RANKS_TO_COMPARE = 1000
+
+    def __init__(self):
+        self.__buffer = []
+        self.__moments = Moments(4)
+        self.__pair_mean_moments = Moments(3)
+        self.__pair_difference_products = numpy.zeros((3,3))
+        self.__num_pairs = 0
+        self.__unpaired_values = None
+        self.__digest = TDigest.TDigest()
+
+    @property
+    def num_values(self):
+        self.__flush()
+        return self.__moments.count
+
+    def add(self, value, control_value=0):
+        self.__buffer.append( (value, control_value) )
+        if len(self.__buffer) >= self.BUFFER_SIZE:
+            self.__flush()
+
+    def add_values(self, values, control_values=None):
+        self.__flush()
+        values = numpy.asarray(values, dtype=float)
+        if control_values is None:
+            control_values = numpy.zeros(len(values))
+        self.__add_array(values, numpy.asarray(control_values, dtype=float))
+
+    def merge(self, other):
+        """Add the statistics of the samples right after these. These have to
+        be an even number of samples, or other's pairs would be the wrong ones."""
+        self.__flush()
+        other.__flush()
+        assert self.__unpaired_values is None or other.num_values == 0, \
+            "Can't merge samples after an odd number of samples without splitting pairs"
+        self.__moments.merge(other.__moments)
+        self.__pair_mean_moments.merge(other.__pair_mean_moments)
+        self.__pair_difference_products += other.__pair_difference_products
+        self.__num_pairs += other.__num_pairs
+        if other.num_values > 0:
+            self.__unpaired_values = other.__unpaired_values
+        self.__digest.merge(other.__digest)
+
+    def mean(self):
+        self.__flush()
+        return self.__moments.means[self.VALUE]
+
+    def stderr(self, sampling_mode=util.INDEPENDENT_SAMPLING):
+        return self.__stderr(self.VALUE, self.PAIRED_VALUE, sampling_mode)
+
+    def sqrt_mean(self):
+        self.__flush()
+        return self.__moments.means[self.SQRT_VALUE]
+
+    def sqrt_stderr(self, sampling_mode=util.INDEPENDENT_SAMPLING):
+        return self.__stderr(self.SQRT_VALUE, self.PAIRED_SQRT_VALUE, sampling_mode)
+
+    def sqrt_difference_stderr(self, other, sampling_mode=util.INDEPENDENT_SAMPLING):
+        """As in ExactStatistics, but without the values to compare path by
+        path, the errors are combined as if independent, which overstates
+        the difference's error if the paths are the same"""
+        return math.sqrt(self.sqrt_stderr(sampling_mode)**2 + other.sqrt_stderr(sampling_mode)**2)
+
+    def log_std(self):
+        """Standard deviation of log(value+1)"""
+        self.__flush()
+        return math.sqrt(self.__moments.variance(self.LOG_VALUE))
+
+    def min(self):
+        self.__flush()
+        return self.__digest.min
+
+    def max(self):
+        self.__flush()
+        return self.__digest.max
+
+    def median(self):
+        return self.__digest_values_at_ranks(self.num_values / 2.0)
+
+    def percentile(self, percentile_as_fraction):
+        """As in util.percentile"""
+        num_values = self.num_values
+        return self.value_at_sorted_index(min(int(round(num_values * percentile_as_fraction,0)), num_values-1))
+
+    def value_at_sorted_index(self, index):
+        if index == 0:
+            return self.min()
+        elif index == self.num_values-1:
+            return self.max()
+        return self.__digest_values_at_ranks(index + .5)
+
+    def expected_value_of(self, function):
+        """Estimated mean of function(value), from the TDigest's centroids"""
+        (means, weights) = self.__centroids()
+        return numpy.sum(weights * numpy.array(map(function, means))) / numpy.sum(weights)
+
+    def histogram_data(self, bins):
+        """(x, weights) to give pyplot.hist for a histogram of the values with
+        these bins: the bin centers, weighted by the estimated number of
+        values in each bin"""
+        self.__flush()
+        bins = numpy.asarray(bins, dtype=float)
+        counts = numpy.diff(self.__digest.fractions_below(bins)) * self.num_values
+        return ((bins[:-1] + bins[1:]) / 2, counts)
+
+    def fraction_greater_than(self, other):
+        """Fraction of ranks at which this sorted value is greater than
+        other's, estimated at up to NUM_RANKS_TO_COMPARE ranks"""
+        num_ranks = min(self.NUM_RANKS_TO_COMPARE, self.num_values)
+        ranks = (numpy.arange(num_ranks) + .5) / num_ranks
+        return numpy.mean(self.__digest_values_at_ranks(ranks * self.num_values) >
+                          other.__digest_values_at_ranks(ranks * other.num_values))
+
+    def control_variate_mean_and_stderr(self, expected_control_value,
+                                        sampling_mode=util.INDEPENDENT_SAMPLING):
+        """As in util.control_variate_mean_and_stderr"""
+        self.__flush()
+        control_variance = self.__moments.variance(self.CONTROL_VALUE)
+        if control_variance > 0:
+            coefficient = self.__moments.covariance(self.VALUE, self.CONTROL_VALUE) / control_variance
+        else:
+            coefficient = 0
+        adjusted_mean = self.__moments.means[self.VALUE] - \
+            coefficient * (self.__moments.means[self.CONTROL_VALUE] - expected_control_value)
+        return (adjusted_mean, self.__stderr(self.VALUE, self.PAIRED_VALUE, sampling_mode,
+                                             self.CONTROL_VALUE, self.PAIRED_CONTROL_VALUE, coefficient))
+
+    def __stderr(self, index, paired_index, sampling_mode, control_index=None,
+                 paired_control_index=None, coefficient=0):
+        """util.stderr of the values at index, minus coefficient times the
+        values at control_index if given"""
+        self.__flush()
+        num_values = self.__moments.count
+        if sampling_mode == util.ANTITHETIC_SAMPLING:
+            assert num_values % 2 == 0, "Antithetic samples come in pairs"
+            variance = self.__pair_mean_moments.variance(paired_index, paired_control_index, coefficient)
+            return math.sqrt(max(0, variance)) / math.sqrt(self.__num_pairs)
+        elif sampling_mode == util.STRATIFIED_SAMPLING:
+            sum_of_squared_differences = self.__pair_difference_products[paired_index, paired_index]
+            if paired_control_index is not None:
+                sum_of_squared_differences += \
+                    - 2 * coefficient * self.__pair_difference_products[paired_index, paired_control_index] \
+                    + coefficient**2 * self.__pair_difference_products[paired_control_index, paired_control_index]
+            sum_of_variances = max(0, sum_of_squared_differences) * num_values / (2.0*self.__num_pairs)
+            return math.sqrt(sum_of_variances) / num_values
+        else:
+            assert sampling_mode == util.INDEPENDENT_SAMPLING, "Unknown sampling mode %s" % sampling_mode
+            variance = self.__moments.variance(index, control_index, coefficient)
+            return math.sqrt(max(0, variance)) / math.sqrt(num_values)
+
+    def __digest_values_at_ranks(self, ranks):
+        self.__flush()
+        return self.__digest.values_at_ranks(ranks)
+
+    def __centroids(self):
+        self.__flush()
+        return self.__digest.centroids()
+
+    def __flush(self):
+        if self.__buffer:
+            buffer = numpy.array(self.__buffer, dtype=float)
+            self.__buffer = []
+            self.__add_array(buffer[:,0], buffer[:,1])
+
+    def __add_array(self, values, control_values):
+        if len(values) == 0:
+            return
+        self.__moments.add(numpy.column_stack((values, numpy.sqrt(values), numpy.log(values+1),
+                                               control_values)))
+        self.__digest.add_values(values)
+
+        paired_values = numpy.column_stack((values, numpy.sqrt(values), control_values))
+        if self.__unpaired_values is not None:
+            paired_values = numpy.vstack((self.__unpaired_values, paired_values))
+        num_pairs = len(paired_values) / 2
+        self.__unpaired_values = paired_values[-1] if len(paired_values) % 2 == 1 else None
+        if num_pairs > 0:
+            firsts = paired_values[0:2*num_pairs:2]
+            seconds = paired_values[1:2*num_pairs:2]
+            self.__pair_mean_moments.add((firsts + seconds) / 2)
+            self.__pair_difference_products += numpy.dot((firsts - seconds).T, firsts - seconds)
+            self.__num_pairs += num_pairs
+
+class Moments(object):
+    """Count, means and co-moments (sums of products of deviations from the
+    means) of a few variables, updated a batch at a time and merged with the
+    formulas of Chan, Golub and LeVeque."""
+
+    def __init__(self, num_variables):
+        self.__count = 0
+        self.__means = numpy.zeros(num_variables)
+        self.__comoments = numpy.zeros((num_variables, num_variables))
+
+    @property
+    def count(self):
+        return self.__count
+
+    @property
+    def means(self):
+        return self.__means
+
+    @property
+    def comoments(self):
+        return self.__comoments
+
+    def add(self, rows):
+        """rows has a row per observation and a column per variable"""
+        means = numpy.mean(rows, axis=0)
+        deviations = rows - means
+        self.__combine(len(rows), means, numpy.dot(deviations.T, deviations))
+
+    def merge(self, other):
+        if other.count > 0:
+            self.__combine(other.count, other.means, other.comoments)
+
+    def covariance(self, index1, index2):
+        return self.__comoments[index1, index2] / self.__count
+
+    def variance(self, index, control_index=None, coefficient=0):
+        """Population variance of the variable at index, minus coefficient
+        times the variable at control_index if given"""
+        variance = self.covariance(index, index)
+        if control_index is not None:
+            variance += - 2 * coefficient * self.covariance(index, control_index) \
+                + coefficient**2 * self.covariance(control_index, control_index)
+        return variance
+
+    def __combine(self, count, means, comoments):
+        total_count = self.__count + count
+        differences = means - self.__means
+        self.__comoments = self.__comoments + comoments + \
+            numpy.outer(differences, differences) * self.__count * count / float(total_count)
+        self.__means = self.__means + differences * count / float(total_count)
+        self.__count = total_count
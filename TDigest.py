@@ -0,0 +1,99 @@
+import math
+import numpy
+
+class TDigest(object):
+    """Sketch of a distribution of values for estimating its quantiles in
+    constant memory: a merging t-digest (Dunning and Ertl, "Computing
+    extremely accurate quantiles using t-digests"). Values are summarized by
+    at most about compression/2 centroids (mean, weight), which are small
+    near the tails and larger in the middle, so quantiles near 0 and 1 stay
+    accurate. Digests of different values can be merged."""
+
+    BUFFER_SIZE = 5000
+
+    def __init__(self, compression=1000):
+        self.__compression = compression
+        self.__means = numpy.zeros(0)
+        self.__weights = numpy.zeros(0)
+        self.__buffer = []
+        self.__min = float("inf")
+        self.__max = float("-inf")
+
+    @property
+    def num_values(self):
+        return numpy.sum(self.__weights) + len(self.__buffer)
+
+    @property
+    def min(self):
+        return self.__min
+
+    @property
+    def max(self):
+        return self.__max
+
+    def add(self, value):
+        self.__buffer.append(value)
+        if len(self.__buffer) >= self.BUFFER_SIZE:
+            self.__compress()
+
+    def add_values(self, values):
+        values = numpy.asarray(values, dtype=float)
+        if len(values) > 0:
+            self.__compress(values, numpy.ones(len(values)))
+
+    def merge(self, other):
+        (means, weights) = other.centroids()
+        self.__compress(means, weights)
+        self.__min = min(self.__min, other.min)
+        self.__max = max(self.__max, other.max)
+
+    def centroids(self):
+        """(means, weights) of the centroids, in order of their means"""
+        self.__compress()
+        return (self.__means, self.__weights)
+
+    def values_at_ranks(self, ranks):
+        """Estimated values at the given ranks, from 0 (the min) to
+        num_values (the max). The value of the ith smallest (starting from 0)
+        is at rank i + .5."""
+        (means, weights) = self.centroids()
+        centers = numpy.cumsum(weights) - weights/2.0
+        return numpy.interp(ranks, numpy.concatenate(([0], centers, [numpy.sum(weights)])),
+                            numpy.concatenate(([self.__min], means, [self.__max])))
+
+    def fractions_below(self, values):
+        """Estimated fraction of the values that are below each of values
+        (0 at or below the min and 1 at or above the max)"""
+        (means, weights) = self.centroids()
+        total_weight = numpy.sum(weights)
+        centers = numpy.cumsum(weights) - weights/2.0
+        values = numpy.asarray(values, dtype=float)
+        fractions = numpy.interp(values, numpy.concatenate(([self.__min], means, [self.__max])),
+                                 numpy.concatenate(([0], centers, [total_weight]))) / total_weight
+        return numpy.where(values <= self.__min, 0, numpy.where(values >= self.__max, 1, fractions))
+
+    def __compress(self, new_means=None, new_weights=None):
+        """Sort the centroids, the buffer and any new centroids together, and
+        merge neighbors that fall in the same unit of the scale function
+        k(q) = compression/(2 pi) * asin(2q - 1)."""
+        means = [self.__means, numpy.asarray(self.__buffer, dtype=float)]
+        weights = [self.__weights, numpy.ones(len(self.__buffer))]
+        if new_means is not None:
+            means.append(new_means)
+            weights.append(new_weights)
+        means = numpy.concatenate(means)
+        weights = numpy.concatenate(weights)
+        self.__buffer = []
+        if len(means) == 0:
+            return
+        self.__min = min(self.__min, numpy.min(means))
+        self.__max = max(self.__max, numpy.max(means))
+        order = numpy.argsort(means, kind="mergesort")
+        means = means[order]
+        weights = weights[order]
+        quantiles_at_centers = (numpy.cumsum(weights) - weights/2.0) / numpy.sum(weights)
+        units = numpy.floor(self.__compression / (2*math.pi) *
+                            numpy.arcsin(2*numpy.clip(quantiles_at_centers, 0, 1) - 1))
+        first_of_each_unit = numpy.flatnonzero(numpy.concatenate(([True], numpy.diff(units) != 0)))
+        self.__weights = numpy.add.reduceat(weights, first_of_each_unit)
+        self.__means = numpy.add.reduceat(means * weights, first_of_each_unit) / self.__weights
@@ -0,0 +1,109 @@
+from datetime import date, timedelta
+import numpy
+import util
+
+YEAR_TO_REPEAT_IF_NO_START_YEAR = 2015
+
+class TradingCalendar(object):
+    """Which days of a simulation horizon the stock market is open, and on
+    which days the periodic events (pay, taxes, tax-loss harvesting) happen.
+    Build it once per horizon instead of checking each day as it comes up.
+
+    Days are numbered from 0 at the start of the simulation. If start_year is
+    None, every simulated year is treated as a copy of 2015, which matches
+    util.day_is_weekend and util.day_is_holiday. Otherwise day 0 is Jan 1 of
+    start_year and each year gets its real weekends and NYSE holidays, so the
+    number of trading days varies a bit from year to year. Either way, the pay,
+    tax and harvest days are counted in simulation days (day % days_per_year),
+    like the rest of the simulation does."""
+
+    def __init__(self, num_days, days_per_year, pay_every_num_days, tax_day,
+                 tax_loss_harvest_day, start_year=None):
+        self.__num_days = num_days
+        self.__start_year = start_year
+
+        holidays_by_year = dict()
+        is_trading_day = numpy.zeros(num_days, dtype=bool)
+        if start_year is None:
+            first_day = date(YEAR_TO_REPEAT_IF_NO_START_YEAR,1,1)
+        else:
+            first_day = date(start_year,1,1)
+        for day in xrange(num_days):
+            if start_year is None:
+                cur_date = first_day + timedelta(days=day % days_per_year)
+            else:
+                cur_date = first_day + timedelta(days=day)
+            if cur_date.year not in holidays_by_year:
+                holidays_by_year[cur_date.year] = set(util.trading_holidays(cur_date.year))
+            is_trading_day[day] = cur_date.weekday() not in [util.SATURDAY, util.SUNDAY] and \
+                cur_date not in holidays_by_year[cur_date.year]
+        self.__is_trading_day = is_trading_day
+        self.__trading_days = numpy.flatnonzero(is_trading_day)
+        self.__num_trading_days_before = numpy.concatenate(([0], numpy.cumsum(is_trading_day)))
+
+        all_days = numpy.arange(num_days)
+        self.__is_pay_day = all_days % pay_every_num_days == 0
+        self.__is_tax_day = all_days % days_per_year == tax_day
+        self.__is_tax_loss_harvest_day = all_days % days_per_year == tax_loss_harvest_day
+
+    @property
+    def num_days(self):
+        return self.__num_days
+
+    @property
+    def start_year(self):
+        return self.__start_year
+
+    @property
+    def is_trading_day(self):
+        """Boolean mask over all days of the horizon."""
+        return self.__is_trading_day
+
+    @property
+    def trading_days(self):
+        """Day numbers on which the market is open, in order. Row i of
+        Market.random_daily_returns corresponds to day trading_days[i]."""
+        return self.__trading_days
+
+    @property
+    def num_trading_days_before(self):
+        """Element d is the number of trading days before day d, i.e., the index
+        in trading_days of day d or of the first trading day after it. It has
+        num_days+1 elements, the last being num_trading_days."""
+        return self.__num_trading_days_before
+
+    @property
+    def num_trading_days(self):
+        return len(self.__trading_days)
+
+    @property
+    def is_pay_day(self):
+        return self.__is_pay_day
+
+    @property
+    def pay_days(self):
+        return numpy.flatnonzero(self.__is_pay_day)
+
+    @property
+    def is_tax_day(self):
+        return self.__is_tax_day
+
+    @property
+    def tax_days(self):
+        return numpy.flatnonzero(self.__is_tax_day)
+
+    @property
+    def is_tax_loss_harvest_day(self):
+        return self.__is_tax_loss_harvest_day
+
+    @property
+    def tax_loss_harvest_days(self):
+        return numpy.flatnonzero(self.__is_tax_loss_harvest_day)
+
+    def event_days(self):
+        """Yield (day, is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day)
+        for every day of the horizon, using plain Python bools so that the
+        simulation loops don't pay for indexing into numpy arrays each day."""
+        return zip(xrange(self.__num_days), self.__is_trading_day.tolist(),
+                   self.__is_pay_day.tolist(), self.__is_tax_day.tolist(),
+                   self.__is_tax_loss_harvest_day.tolist())
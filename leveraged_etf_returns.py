@@ -12,12 +12,16 @@ from os import path
 import copy
 import write_results
 import margin_leverage
-from random import Random
+import random_streams
+import worker_pool
+import ExactStatistics
+import StreamingStatistics
 
 FUNDS_AND_EXPENSE_RATIOS = {"regular":.001, "lev":.01}
 MODERATE_ANNUAL_FRACTION_OF_SHORT_TERM_CAP_GAINS = .1
 HIGH_ANNUAL_FRACTION_OF_SHORT_TERM_CAP_GAINS = .5
 MONTHS_PER_YEAR = 12
+SAMPLE_PATH_FIGURE_SUFFIX_PATTERN = "_regularvslev_iter*.png" # see plots.graph_lev_ETF_and_underlying_trajectories
 
 QUICK = False
 if QUICK:
@@ -34,8 +38,15 @@ else:
 
 def one_run_daily_rebalancing(funds_and_expense_ratios, tax_rate, 
                               leverage_ratio, investor, market, iter_num,
-                              outfilepath, randgenerator, num_trajectories_to_save_as_figures):
+                              outfilepath, randgenerator, num_trajectories_to_save_as_figures,
+                              daily_returns=None):
+    """randgenerator is used for employment. If daily_returns is given, it
+    should be a row of the array returned by Market.random_daily_returns, and
+    each day's market return is read from it instead of being drawn from
+    randgenerator."""
     investor.reset_employment_for_next_round()
+    if daily_returns is not None:
+        daily_returns = numpy.asarray(daily_returns).tolist() # plain floats are faster in the daily loop
 
     emergency_savings = dict()
     for type in funds_and_expense_ratios.keys():
@@ -52,15 +63,20 @@ def one_run_daily_rebalancing(funds_and_expense_ratios, tax_rate,
 
     historical_regular_values = []
     historical_lev_values = []
-    num_times_randgenerator_was_called = 0
+    trading_day_num = 0
 
     PRINT_DEBUG_STUFF = False
 
-    for day in xrange(num_days):
-        if not util.day_is_weekend(day % margin_leverage.DAYS_PER_YEAR) and not util.day_is_holiday(day % margin_leverage.DAYS_PER_YEAR):
+    calendar = margin_leverage.trading_calendar(num_days)
+
+    for (day, is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day) in calendar.event_days():
+        if is_trading_day:
             # Update accounts to new daily return
-            (today_return, num_times_randgenerator_was_called) = market.random_daily_return(
-                day, randgenerator, num_times_randgenerator_was_called)
+            if daily_returns is not None:
+                today_return = daily_returns[trading_day_num]
+            else:
+                today_return = market.random_daily_return(day, randgenerator)
+            trading_day_num += 1
             if PRINT_DEBUG_STUFF and iter_num == 1:
                 print "today return = %f" % today_return
             after_tax_today_return_for_lev_ETF_only = today_return * (1-tax_rate)
@@ -81,14 +97,13 @@ def one_run_daily_rebalancing(funds_and_expense_ratios, tax_rate,
             for type in funds_and_expense_ratios.keys():
                 emergency_savings[type] = max(0, emergency_savings[type] * (1+today_return))
 
-        if day % margin_leverage.INTEREST_AND_SALARY_EVERY_NUM_DAYS == 0:
+        if is_pay_day:
             years_elapsed = day/margin_leverage.DAYS_PER_YEAR # intentional int division
             pay = investor.current_annual_income(years_elapsed, day, market.inflation_rate) * \
                 (float(margin_leverage.INTEREST_AND_SALARY_EVERY_NUM_DAYS) / margin_leverage.DAYS_PER_YEAR)
             regular_val += pay * (1-BrokerageAccount.FEE_PER_DOLLAR_TRADED)
             lev_fund_val += pay * (1-leverage_ratio*BrokerageAccount.FEE_PER_DOLLAR_TRADED)
-            num_times_randgenerator_was_called = investor.randomly_update_employment_status_this_month(
-                randgenerator, num_times_randgenerator_was_called)
+            investor.randomly_update_employment_status_this_month(randgenerator)
 
         if PRINT_DEBUG_STUFF and iter_num == 1:
             print "Day %i, regular = %s, lev = %s, emerg_lev = %s" % (day, \
@@ -112,73 +127,159 @@ def one_run_daily_rebalancing(funds_and_expense_ratios, tax_rate,
     return (market.present_value(regular_val+emergency_savings["regular"],
                                       investor.years_until_donate), 
             market.present_value(lev_fund_val+emergency_savings["lev"],
-                                      investor.years_until_donate),
-            num_times_randgenerator_was_called)
+                                      investor.years_until_donate))
 
 def many_runs(funds_and_expense_ratios, tax_rate, leverage_ratio, num_samples,
               investor, market, outfilepath, num_trajectories_to_save_as_figures,
-              use_seed_for_randomness=True):
-    if use_seed_for_randomness:
-        randgenerator = Random("seedy character")
-    else:
-        randgenerator = None
+              use_seed_for_randomness=True, num_paths_per_return_batch=None,
+              scenario_seed=random_streams.DEFAULT_SCENARIO_SEED,
+              sampling_mode=util.INDEPENDENT_SAMPLING, num_workers=None, exact_statistics=True):
+    """If use_seed_for_randomness, sample number i draws from its own random
+    streams keyed by (scenario_seed, i), so its results don't depend on
+    the other samples. If num_paths_per_return_batch is set, the daily market
+    returns for that many samples at a time are drawn in one call to 
+    Market.random_daily_returns; this doesn't change seeded results.
+    sampling_mode is as in margin_leverage.run_samples.
+    As in run_samples, seeded samples are split into shards that run on a
+    pool of num_workers processes (one per available core if None), and the
+    shards' results are put back together in order, and exact_statistics
+    chooses between keeping every ending value and streaming statistics.
+    Also as in run_samples, seeded results are saved to and loaded from the
+    margin_leverage.result_cache, and a run of more samples than a cached run
+    only runs the new samples."""
+    if num_workers is None:
+        num_workers = worker_pool.num_available_cores()
+    args = (funds_and_expense_ratios, tax_rate, leverage_ratio, num_samples,
+            investor, market, outfilepath, num_trajectories_to_save_as_figures)
+    shard_kwargs = {"use_seed_for_randomness": use_seed_for_randomness,
+                    "num_paths_per_return_batch": num_paths_per_return_batch,
+                    "scenario_seed": scenario_seed, "sampling_mode": sampling_mode,
+                    "exact_statistics": exact_statistics}
+    cache = margin_leverage.result_cache() if use_seed_for_randomness else None
+    cache_parameters = ("many_runs", sorted(funds_and_expense_ratios.items()), tax_rate, leverage_ratio,
+                        util.object_parameters(investor), util.object_parameters(market),
+                        num_trajectories_to_save_as_figures, scenario_seed, sampling_mode, exact_statistics)
 
     fund_types = funds_and_expense_ratios.keys()
-    fund_arrays = dict()
-    for type in fund_types:
-        fund_arrays[type] = numpy.array([])
-    prev_num_times_randgenerator_was_called = -9999 # junk
+    if cache and cache.has(cache_parameters, num_samples):
+        print "Loading cached results for {}".format(outfilepath)
+        (fund_statistics, num_lev_bankruptcies) = cache.load(cache_parameters, num_samples, outfilepath)
+    else:
+        alignment = margin_leverage.shard_alignment(num_samples, **shard_kwargs)
+        (num_stored_samples, stored_results) = margin_leverage.stored_results_to_top_up(cache,
+            cache_parameters, num_samples, alignment, sampling_mode, outfilepath) if cache else (0, None)
+        shards = margin_leverage.sample_shards(num_samples, num_workers, alignment, num_stored_samples)
+        log = margin_leverage.progress_log()
+        if log and shards:
+            log.scheduled(sum(end_sample - first_sample for (first_sample, end_sample) in shards), len(shards))
+        shard_results = worker_pool.run_tasks(many_runs_shard_task, 
+            [(args, shard_kwargs, first_sample, end_sample) for (first_sample, end_sample) in shards],
+            num_workers)
+        if stored_results:
+            shard_results.insert(0, stored_results)
 
-    # Get results
-    num_lev_bankruptcies = 0
-    for i in xrange(num_samples):
-        output_values = one_run_daily_rebalancing(funds_and_expense_ratios, 
-                                                  tax_rate, leverage_ratio, 
-                                                  investor, market, i,
-                                                  outfilepath, randgenerator,
-                                                  num_trajectories_to_save_as_figures)
-        assert len(output_values) == len(fund_types)+1, "output_values is wrong size"
-        num_times_randgenerator_was_called = output_values[-1]
-        if i > 0:
-            assert num_times_randgenerator_was_called == prev_num_times_randgenerator_was_called, \
-                "randgenerator was called different numbers of times across runs :("
-        prev_num_times_randgenerator_was_called = num_times_randgenerator_was_called
-        for j in xrange(len(fund_types)):
-            fund_arrays[fund_types[j]] = numpy.append(fund_arrays[fund_types[j]], 
-                                                      output_values[j])
-            num_lev_bankruptcies += 1 if output_values[1]==0 else 0
-        if i % 1000 == 0:
-            print "Done with run %i." % i
+        (fund_statistics, num_lev_bankruptcies) = shard_results[0]
+        for (shard_fund_statistics, shard_num_lev_bankruptcies) in shard_results[1:]:
+            for type in fund_types:
+                fund_statistics[type].merge(shard_fund_statistics[type])
+            num_lev_bankruptcies += shard_num_lev_bankruptcies
+        if cache:
+            cache.save(cache_parameters, num_samples, (fund_statistics, num_lev_bankruptcies), outfilepath,
+                       SAMPLE_PATH_FIGURE_SUFFIX_PATTERN)
 
     # Plot results
     if outfilepath:
-        plots.graph_expected_utility_vs_alpha(numpy.array(fund_arrays[fund_types[0]]), \
-            numpy.array(fund_arrays[fund_types[1]]), outfilepath)
-        plots.graph_expected_utility_vs_wealth_saturation_cutoff(numpy.array(fund_arrays[fund_types[0]]), \
-            numpy.array(fund_arrays[fund_types[1]]), outfilepath, 4, 7)
+        plots.graph_expected_utility_vs_alpha(fund_statistics[fund_types[0]], \
+            fund_statistics[fund_types[1]], outfilepath)
+        plots.graph_expected_utility_vs_wealth_saturation_cutoff(fund_statistics[fund_types[0]], \
+            fund_statistics[fund_types[1]], outfilepath, 4, 7)
 
     # Write results
     with open(write_results.results_table_file_name(outfilepath), "w") as outfile:
-            write_results.write_file_table(fund_arrays, fund_types, 
-                                           float(num_lev_bankruptcies)/num_samples, outfile)
+            write_results.write_file_table(fund_statistics, fund_types, 
+                                           float(num_lev_bankruptcies)/num_samples, outfile,
+                                           sampling_mode=sampling_mode)
 
     # Print results
     for type in fund_types:
         lev_ratio_for_this_type = 1 if type == fund_types[0] else leverage_ratio
         print "Type: %s" % type
-        print "mean = %s" % util.format_as_dollar_string(numpy.mean(fund_arrays[type]))
-        print "median = %s" % util.format_as_dollar_string(numpy.median(fund_arrays[type]))
-        print "25th percentile = %s" % util.format_as_dollar_string(util.percentile(fund_arrays[type],.25))
-        print "min = %s" % util.format_as_dollar_string(numpy.min(fund_arrays[type]))
+        print "mean = %s" % util.format_as_dollar_string(fund_statistics[type].mean())
+        print "median = %s" % util.format_as_dollar_string(fund_statistics[type].median())
+        print "25th percentile = %s" % util.format_as_dollar_string(fund_statistics[type].percentile(.25))
+        print "min = %s" % util.format_as_dollar_string(fund_statistics[type].min())
         print ""
     """
     NOT NEEDED ANYMORE
     print "alpha where expected utilities are equal = %s" % \
         find_alpha_where_expected_utilities_are_equal(
-            fund_arrays[fund_types[0]],fund_arrays[fund_types[1]])
+            fund_statistics[fund_types[0]],fund_statistics[fund_types[1]])
     """
-    print "randgenerator called %i times. Check that this is equal across variants!" % \
-        num_times_randgenerator_was_called
+
+def many_runs_shard_task((args, shard_kwargs, first_sample, end_sample)):
+    return many_runs_shard(*args, first_sample=first_sample, end_sample=end_sample, **shard_kwargs)
+
+def many_runs_shard(funds_and_expense_ratios, tax_rate, leverage_ratio, num_samples,
+                    investor, market, outfilepath, num_trajectories_to_save_as_figures,
+                    first_sample, end_sample, use_seed_for_randomness=True, 
+                    num_paths_per_return_batch=None,
+                    scenario_seed=random_streams.DEFAULT_SCENARIO_SEED,
+                    sampling_mode=util.INDEPENDENT_SAMPLING, exact_statistics=True):
+    """Run samples first_sample through end_sample-1 of a many_runs run, with
+    the same arguments. Returns the ExactStatistics or StreamingStatistics of
+    each fund type's values and the number of leveraged-fund bankruptcies."""
+    num_paths_per_return_batch = margin_leverage.return_batch_size(
+        num_paths_per_return_batch, use_seed_for_randomness, sampling_mode, num_samples)
+    randgenerator = None
+
+    fund_types = funds_and_expense_ratios.keys()
+    fund_statistics = dict()
+    for type in fund_types:
+        fund_statistics[type] = ExactStatistics.ExactStatistics() if exact_statistics else \
+            StreamingStatistics.StreamingStatistics()
+
+    days_in_each_batch = margin_leverage.trading_calendar(
+        int(round(margin_leverage.DAYS_PER_YEAR * investor.years_until_donate,0))).trading_days
+    daily_returns = None
+
+    log = margin_leverage.progress_log()
+    shard_progress = log.shard_progress(outfilepath, leverage_ratio, first_sample, end_sample) if log else None
+
+    # Get results
+    num_lev_bankruptcies = 0
+    for i in xrange(first_sample, end_sample):
+        if num_paths_per_return_batch:
+            index_in_batch = i % num_paths_per_return_batch
+            if index_in_batch == 0:
+                num_paths_in_batch = min(num_paths_per_return_batch, end_sample-i)
+                if use_seed_for_randomness:
+                    daily_returns_batch = random_streams.daily_returns_for_paths(
+                        market, days_in_each_batch, scenario_seed, i, num_paths_in_batch,
+                        sampling_mode, num_samples)
+                else:
+                    daily_returns_batch = market.random_daily_returns(num_paths_in_batch, 
+                        days_in_each_batch, None, sampling_mode, 
+                        range(i, i+num_paths_in_batch), num_samples)
+            daily_returns = daily_returns_batch[index_in_batch]
+        if use_seed_for_randomness:
+            randgenerator = random_streams.employment_generator(scenario_seed, i)
+        output_values = one_run_daily_rebalancing(funds_and_expense_ratios, 
+                                                  tax_rate, leverage_ratio, 
+                                                  investor, market, i,
+                                                  outfilepath, randgenerator,
+                                                  num_trajectories_to_save_as_figures,
+                                                  daily_returns)
+        assert len(output_values) == len(fund_types), "output_values is wrong size"
+        for j in xrange(len(fund_types)):
+            fund_statistics[fund_types[j]].add(output_values[j])
+            num_lev_bankruptcies += 1 if output_values[1]==0 else 0
+        if shard_progress:
+            shard_progress.update(i+1-first_sample)
+        if i % 1000 == 0:
+            print "Done with run %i." % i
+    if shard_progress:
+        shard_progress.finish()
+    return (fund_statistics, num_lev_bankruptcies)
 
 """
 NOT USED ANYMORE
@@ -203,7 +304,7 @@ def expected_utility(numpy_array_of_wealth_values, alpha):
 """
 
 def sweep_variations(funds_and_expense_ratios, leverage_ratio, num_samples, 
-                     num_trajectories_to_save_as_figures, outfilepath):
+                     num_trajectories_to_save_as_figures, outfilepath, num_workers=None):
     for scenario in LEV_ETF_SCENARIOS.keys():
         dir = path.join(outfilepath, LEV_ETF_SCENARIOS[scenario])
         if not os.path.isdir(dir):
@@ -235,7 +336,8 @@ def sweep_variations(funds_and_expense_ratios, leverage_ratio, num_samples,
                 tax_rate = HIGH_ANNUAL_FRACTION_OF_SHORT_TERM_CAP_GAINS * tax_rates.short_term_cap_gains_rate_plus_state()
         print "\n==Scenario: %s==" % scenario
         many_runs(funds_and_expense_ratios_to_use, tax_rate, leverage_ratio_to_use, num_samples,
-                  investor, market, path.join(dir,""), num_trajectories_to_save_as_figures)
+                  investor, market, path.join(dir,""), num_trajectories_to_save_as_figures,
+                  num_workers=num_workers)
 
 if __name__ == "__main__":
     leverage_ratio = 2.0
@@ -3,17 +3,31 @@ import plots
 import write_results
 import Investor
 import Market
+import EtfLot
+import Assets
 import BrokerageAccount
+import BatchedAccounts
 import TaxRates
 import Taxes
+import BatchedTaxes
+import TradingCalendar
+import HorizonSchedule
+import LotGroup
+import PathTape
+import path_kernel
+import random_streams
+import worker_pool
+import SampleResults
+import Checkpoints
+import ResultCache
+import ProgressLog
 import numpy
-import copy
+import fractions
 import math
 import os
 from os import path
-from multiprocessing import Process, Queue
+import Queue
 import time
-from random import Random
 
 USE_SMALL_SCENARIO_SET_FOR_QUICK_TEST = False
 if USE_SMALL_SCENARIO_SET_FOR_QUICK_TEST:
@@ -65,26 +79,129 @@ THRESHOLD_FOR_TAX_CONVERGENCE = 50
 DIFFERENCE_THRESHOLD_FOR_WARNING_ABOUT_DIFF_FROM_SIMPLE_COMPUTATION_PER_YEAR = .05
 TYPES = ["regular", "margin", "matched401k"]
 NUM_PERCENT_DIFFS_TO_PLOT = 10
+NUM_HISTORIES_TO_PLOT = 20
 INTEREST_AND_SALARY_EVERY_NUM_DAYS = 30
+CALENDAR_START_YEAR = None # None means every year repeats 2015's weekends and holidays
+CALENDARS_BY_NUM_DAYS = dict()
+USE_PATH_TAPES = True
+PATH_TAPE_DIR_NAME = "path_tapes"
+SAMPLING_MODE = util.INDEPENDENT_SAMPLING # see Market.random_daily_returns
+USE_CONTROL_VARIATES = False # see run_samples
+SKIP_DAYS_WITHOUT_EVENTS = True # see simulate_days_without_events
+SCENARIOS_FOR_BATCHED_ENGINE = [] # prefixes (values of SCENARIOS) of scenarios to run with batched_runs, which only some can be (see run_samples)
+BATCHED_ENGINE_PATHS_PER_BATCH = 10000
+USE_COMPILED_KERNEL = path_kernel.HAVE_NUMBA # see run_samples; without numba, kernel_run is slower than one_run
+KERNEL_PARITY_TOLERANCE = 1e-9 # see compare_kernel_runs_with_one_run
+BATCHED_PARITY_TOLERANCE = 1e-9 # see compare_batched_runs_with_one_run
+SAMPLES_PER_SHARD = 100 # see sample_shards
+EXACT_STATISTICS = True # see run_samples
+USE_CHECKPOINTS = True # see run_leverage_sweeps
+CHECKPOINT_DIR_NAME = "checkpoints"
+USE_RESULT_CACHE = True # see run_sharded_samples
+RESULT_CACHE_DIR_NAME = "result_cache" # under the directory the program is run from
+SAMPLE_PATH_FIGURE_SUFFIX_PATTERN = "_regularvsmar_iter*.png" # see plots.graph_margin_vs_regular_trajectories
+SAMPLING_MODES_THAT_CAN_BE_TOPPED_UP = [util.INDEPENDENT_SAMPLING, util.ANTITHETIC_SAMPLING] # see stored_results_to_top_up
+TARGET_RATIO_STDERR = None # for sweeps; see run_samples
+MAX_NUM_SAMPLES_PER_STARTING_SAMPLE = 16 # default max_num_samples / num_samples when there's a TARGET_RATIO_STDERR
+EXP_UTIL_OBJECTIVE = "E[sqrt(wealth)] ratio" # objectives for search_for_optimal_leverage
+MEDIAN_OBJECTIVE = "median ratio"
+LEVERAGE_SEARCH_CONFIDENCE_Z = 2 # standard errors; see leverage_could_be_optimal
+LEVERAGE_SEARCH_FILE_NAME = "leverage_search.txt"
+SEARCH_FOR_OPTIMAL_LEVERAGE = False # by default, in optimal_leverage_for_all_scenarios; see there
+LEVERAGE_SEARCH_NUM_AMOUNTS = 7 # 1:1 to 4:1 in steps of .5, so the default 2:1 is one of them
+USE_PROGRESS_LOG = True # see progress_log
+PROGRESS_LOG_FILE_NAME = "progress_log.jsonl" # under the directory the program is run from
+
+def trading_calendar(num_days):
+    """Build the calendar for a horizon only once per process."""
+    if num_days not in CALENDARS_BY_NUM_DAYS:
+        CALENDARS_BY_NUM_DAYS[num_days] = TradingCalendar.TradingCalendar(num_days, 
+            DAYS_PER_YEAR, INTEREST_AND_SALARY_EVERY_NUM_DAYS, TAX_DAY, TAX_LOSS_HARVEST_DAY,
+            start_year=CALENDAR_START_YEAR)
+    return CALENDARS_BY_NUM_DAYS[num_days]
+
+def horizon_schedule(investor, market):
+    return HorizonSchedule.HorizonSchedule(investor, market, 
+        trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate)), DAYS_PER_YEAR,
+        INTEREST_AND_SALARY_EVERY_NUM_DAYS)
+
+def path_tape_for(investor, market, num_samples, cur_working_dir):
+    """Path tape shared by every run under cur_working_dir that has this
+    market and horizon, or None if USE_PATH_TAPES is False."""
+    if not USE_PATH_TAPES:
+        return None
+    return PathTape.PathTape(path.join(cur_working_dir, PATH_TAPE_DIR_NAME), market,
+        trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate)), num_samples,
+        random_streams.DEFAULT_SCENARIO_SEED, SAMPLING_MODE)
+
+def checkpoints_for(cur_working_dir):
+    """Checkpoints shared by every sweep under cur_working_dir, or None if
+    USE_CHECKPOINTS is False."""
+    if not USE_CHECKPOINTS:
+        return None
+    return Checkpoints.Checkpoints(path.join(cur_working_dir, CHECKPOINT_DIR_NAME))
+
+def progress_log():
+    """ProgressLog that the sample shards of everything run from the current
+    directory write their progress to, or None if USE_PROGRESS_LOG is False.
+    Run "python ProgressLog.py progress_log.jsonl" there to see how far
+    along they are."""
+    if not USE_PROGRESS_LOG:
+        return None
+    return ProgressLog.ProgressLog(path.join(os.getcwd(), PROGRESS_LOG_FILE_NAME))
+
+def result_cache():
+    """ResultCache shared by everything run from the current directory, or
+    None if USE_RESULT_CACHE is False."""
+    if not USE_RESULT_CACHE:
+        return None
+    return ResultCache.ResultCache(path.join(os.getcwd(), RESULT_CACHE_DIR_NAME))
 
 def one_run(investor,market,verbosity,outfilepath,iter_num,
-            num_margin_trajectories_to_save_as_figures, randgenerator):
+            num_margin_trajectories_to_save_as_figures, randgenerator,
+            daily_returns=None, lot_ordering_randgenerator=None, schedule=None):
+    """randgenerator is used for employment. If daily_returns is given, it
+    should be a row of the array returned by Market.random_daily_returns, and
+    the day's market return is read from it instead of being drawn from
+    randgenerator. lot_ordering_randgenerator picks which lots get sold when
+    not selling in tax-favored order. See random_streams for how run_samples
+    gives each path its own generators. schedule is the HorizonSchedule for
+    investor and market; pass it in to avoid rebuilding it for every path.
+    The last element of the returned tuple has the present values of the
+    control variates for each of TYPES; see control_variate_growth_factor.
+
+    path_kernel.simulate_path redoes this function's accounting for
+    kernel_run, so any change here must be made there too; test_path_kernel
+    checks that they still agree (see compare_kernel_runs_with_one_run)."""
     investor.reset_employment_for_next_round()
     days_from_start_to_donation_date = int(DAYS_PER_YEAR * investor.years_until_donate)
+    calendar = trading_calendar(days_from_start_to_donation_date)
+    if schedule is None:
+        schedule = horizon_schedule(investor, market)
+    if daily_returns is not None:
+        daily_returns_array = numpy.array(daily_returns, dtype=float)
+        daily_returns = daily_returns_array.tolist() # plain floats are faster in the daily loop
     accounts = dict()
+    """The regular and 401k accounts never sell in random order, but the
+    margin account does in margin calls unless the broker sells tax-favored
+    lots first."""
     accounts["regular"] = BrokerageAccount.BrokerageAccount(0,0,0,\
         investor.taper_off_leverage_toward_end,\
         investor.taper_off_leverage_a_lot_toward_end,\
-        investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+        investor.initial_personal_max_margin_to_assets_relative_to_broker_max,\
+        lot_ordering_randgenerator, Assets.lots_can_be_compacted(True))
     accounts["margin"] = BrokerageAccount.BrokerageAccount(0,0,\
         investor.broker_max_margin_to_assets_ratio,\
         investor.taper_off_leverage_toward_end,\
         investor.taper_off_leverage_a_lot_toward_end,\
-        investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+        investor.initial_personal_max_margin_to_assets_relative_to_broker_max,\
+        lot_ordering_randgenerator,\
+        Assets.lots_can_be_compacted(investor.does_broker_liquidation_sell_tax_favored_first))
     accounts["matched401k"] = BrokerageAccount.BrokerageAccount(0,0,0,\
         investor.taper_off_leverage_toward_end,\
         investor.taper_off_leverage_a_lot_toward_end,\
-        investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+        investor.initial_personal_max_margin_to_assets_relative_to_broker_max,\
+        lot_ordering_randgenerator, Assets.lots_can_be_compacted(True))
     debt_to_yourself_after_margin_account_lost_all_value = 0
     """Non-margin investors can't get into debt, so we need only track debt to yourself
     for the margin-investing case. This variable assumes that if you go into the hole with
@@ -93,18 +210,30 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
     not getting to invest them in the market. Hence, this is like a debt you borrow from yourself
     that you need to pay off over time by replenishing your emergency fund."""
     margin_strategy_went_bankrupt = False
-    num_times_randgenerator_was_called = 0
+    trading_day_num = 0
+    pay_period_num = 0
     PRINT_DEBUG_STUFF = False
     already_gave_warning_about_account_deviating = False
 
     taxes = dict()
     emergency_savings = dict()
     simple_approx_account_values = dict()
+    control_variate_account_values = dict()
     for type in TYPES:
         taxes[type] = Taxes.Taxes(investor.tax_rates)
         emergency_savings[type] = investor.initial_emergency_savings
         simple_approx_account_values[type] = 0
-    interest_and_salary_every_fraction_of_year = float(INTEREST_AND_SALARY_EVERY_NUM_DAYS) / DAYS_PER_YEAR
+        control_variate_account_values[type] = 0
+    control_variate_emergency_savings = investor.initial_emergency_savings
+    scheduled_leverage = schedule.margin_leverage_multiples
+    interest_and_salary_every_fraction_of_year = schedule.pay_fraction_of_year
+    years_elapsed_by_day = schedule.years_elapsed
+    years_remaining_by_day = schedule.years_remaining
+    annual_incomes_before_layoff_penalty = schedule.annual_incomes_before_layoff_penalty
+    principal_repayment_fractions = schedule.principal_repayment_fractions
+    next_event_days = schedule.next_event_days
+    skip_days_without_events = SKIP_DAYS_WITHOUT_EVENTS and daily_returns is not None and not PRINT_DEBUG_STUFF
+    first_day_not_yet_simulated = 0
 
     # Record history over lifetime of investment
     historical_margin_to_assets_ratios = numpy.zeros(days_from_start_to_donation_date)
@@ -113,9 +242,24 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
     historical_carried_cap_gains = numpy.zeros(days_from_start_to_donation_date)
     historical_margin_percent_differences_from_simple_calc = numpy.zeros(days_from_start_to_donation_date)
 
-    for day in xrange(days_from_start_to_donation_date):
-        years_elapsed = day/DAYS_PER_YEAR # intentional int division
-        years_remaining = (days_from_start_to_donation_date-day)/DAYS_PER_YEAR
+    for (day, is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day) in calendar.event_days():
+        if day < first_day_not_yet_simulated:
+            continue
+        if skip_days_without_events and next_event_days[day] > day:
+            (first_day_not_yet_simulated, trading_day_num, control_variate_emergency_savings,
+             margin_strategy_went_bankrupt, already_gave_warning_about_account_deviating) = \
+                simulate_days_without_events(day, next_event_days[day], daily_returns_array,
+                    trading_day_num, investor, market, calendar, schedule, accounts, taxes,
+                    emergency_savings, simple_approx_account_values, control_variate_account_values,
+                    control_variate_emergency_savings, margin_strategy_went_bankrupt,
+                    already_gave_warning_about_account_deviating,
+                    (historical_margin_to_assets_ratios, historical_regular_wealth,
+                     historical_margin_wealth, historical_carried_cap_gains,
+                     historical_margin_percent_differences_from_simple_calc))
+            if first_day_not_yet_simulated > day:
+                continue
+        years_elapsed = years_elapsed_by_day[day]
+        years_remaining = years_remaining_by_day[day]
 
         # Record historical info for future reference
         cur_margin_to_assets = accounts["margin"].margin_to_assets()
@@ -135,25 +279,22 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
                     100*difference if difference is not float("inf") else 100 # just turn infinity into 100% difference
                 if abs(difference) > DIFFERENCE_THRESHOLD_FOR_WARNING_ABOUT_DIFF_FROM_SIMPLE_COMPUTATION_PER_YEAR * \
                     investor.years_until_donate and not already_gave_warning_about_account_deviating:
-                    if difference == float("inf"):
-                        percent_diff_string = "infinity"
-                    else:
-                        percent_diff_string = str(int(round(100*difference,0)))
-                    print "WARNING: Actual account value (%s) differs by %s percent from simple approximate value (%s)." % \
-                        (util.format_as_dollar_string(actual_value), percent_diff_string, \
-                        util.format_as_dollar_string(simple_approx_account_values[type]))
+                    warn_about_account_deviating(actual_value, difference, simple_approx_account_values[type])
                     already_gave_warning_about_account_deviating = True
 
         """ Stock market changes on non-holiday weekdays.
-        The functions to check if it's a weekend and a holiday are based on the year
-        2015, when all holidays should have been non-weekends. This means there are
+        By default the calendar is based on the year 2015, when all holidays
+        should have been non-weekends. This means there are
         9 non-weekend holidays. Thus, the number of trading days in the year is
         365 * 5/7 - 9 = 252, which is what we wanted. Probably it's not actually important
         that I'm keeping track of what exact day of the year it is here, but 
         oh well. :)"""
-        if not util.day_is_weekend(day % DAYS_PER_YEAR) and not util.day_is_holiday(day % DAYS_PER_YEAR):
-            (random_daily_return, num_times_randgenerator_was_called) = \
-                market.random_daily_return(day, randgenerator, num_times_randgenerator_was_called)
+        if is_trading_day:
+            if daily_returns is not None:
+                random_daily_return = daily_returns[trading_day_num]
+            else:
+                random_daily_return = market.random_daily_return(day, randgenerator)
+            trading_day_num += 1
             if PRINT_DEBUG_STUFF and iter_num == 1:
                 print "today return = %f" % random_daily_return
 
@@ -181,6 +322,13 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
                 if simple_approx_account_values[type] < 0:
                     simple_approx_account_values[type] = 0
 
+            # Update control variates
+            control_variate_emergency_savings *= (1+random_daily_return)
+            for type in TYPES:
+                control_variate_account_values[type] *= control_variate_growth_factor(
+                    scheduled_leverage_multiple(type, years_remaining, scheduled_leverage),
+                    random_daily_return, market)
+
             # Update regular account
             accounts["regular"].update_asset_prices(random_daily_return)
 
@@ -207,9 +355,9 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
             accounts["matched401k"].update_asset_prices(random_daily_return)
 
         # check if we should get paid and defray interest
-        if day % INTEREST_AND_SALARY_EVERY_NUM_DAYS == 0:
-            pay = investor.current_annual_income(years_elapsed, day, market.inflation_rate) * \
-                (float(INTEREST_AND_SALARY_EVERY_NUM_DAYS) / DAYS_PER_YEAR)
+        if is_pay_day:
+            pay = annual_incomes_before_layoff_penalty[pay_period_num] * \
+                investor.current_income_multiplier() * interest_and_salary_every_fraction_of_year
             
             if verbosity > 1:
                 if day % 1000 == 0:
@@ -229,6 +377,9 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
                 BrokerageAccount.FEE_PER_DOLLAR_TRADED)
             """A 2X margin account pays double the brokerage fees because it buys double the
             amount of assets."""
+            for type in TYPES:
+                control_variate_account_values[type] += control_variate_contribution(type, pay, 
+                    scheduled_leverage_multiple(type, years_remaining, scheduled_leverage), investor)
 
             if margin_strategy_gap_in_emergency_funds(emergency_savings) > pay:
                 # restore emergency savings with pay
@@ -265,8 +416,7 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
                     # if this happens, no money left to 2. pay principal, 3. pay down margin if it's over limit, or 4. buy ETF
                 else:
                     # 2. pay some principal, if we're dong that
-                    number_of_pay_periods_until_donation_date = (days_from_start_to_donation_date - day) / INTEREST_AND_SALARY_EVERY_NUM_DAYS
-                    amount_of_principal_to_repay = util.per_period_annuity_payment_of_principal(accounts["margin"].margin, number_of_pay_periods_until_donation_date,market.annual_margin_interest_rate, investor.pay_principal_throughout)
+                    amount_of_principal_to_repay = accounts["margin"].margin * principal_repayment_fractions[pay_period_num] # see util.per_period_annuity_payment_of_principal
                     if amount_of_principal_to_repay > pay_after_interest:
                         accounts["margin"].margin -= pay_after_interest
                         deficit_still_not_paid = accounts["margin"].voluntary_rebalance(
@@ -302,10 +452,10 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
                 accounts["margin"].voluntary_rebalance_to_increase_leverage(day, years_remaining)
 
             # Possibly get laid off or return to work
-            num_times_randgenerator_was_called = investor.randomly_update_employment_status_this_month(
-                randgenerator, num_times_randgenerator_was_called)
+            investor.randomly_update_employment_status_this_month(randgenerator)
+            pay_period_num += 1
         
-        if day % DAYS_PER_YEAR == TAX_DAY:
+        if is_tax_day:
             for type in ["regular", "margin"]: # No "matched401k" because 401k accounts don't pay taxes!
                 bill_or_refund = taxes[type].process_taxes()
                 if type is "regular":
@@ -353,7 +503,7 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
                 else:
                     pass
 
-        if investor.do_tax_loss_harvesting and day % DAYS_PER_YEAR == TAX_LOSS_HARVEST_DAY:
+        if investor.do_tax_loss_harvesting and is_tax_loss_harvest_day:
             for type in ["regular", "margin"]: # No "matched401k" because its gains/losses aren't taxed!
                 accounts[type].tax_loss_harvest(day, taxes[type])
 
@@ -370,6 +520,10 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
             util.format_as_dollar_string(simple_approx_account_values["margin"]), \
             util.format_as_dollar_string(emergency_savings["margin"]))
 
+    if verbosity > 1:
+        print "Margin account holds %i lots (%i without compaction)." % \
+            (accounts["margin"].num_lots, accounts["margin"].num_lots_without_compaction)
+
     # Make sure our variables are in order.
     have_assets_and_no_savings_gap = accounts["margin"].assets > 0 and margin_strategy_gap_in_emergency_funds(emergency_savings) == 0
     have_savings_gap_and_no_assets = accounts["margin"].assets == 0 and margin_strategy_gap_in_emergency_funds(emergency_savings) > 0
@@ -415,21 +569,176 @@ def one_run(investor,market,verbosity,outfilepath,iter_num,
             historical_margin_wealth, outfilepath, iter_num)
 
     # Return present values of the account balances
-    present_value_function = lambda wealth: market.present_value(wealth,investor.years_until_donate)
+    present_value_function = schedule.present_value
     historical_margin_wealth = map(present_value_function, historical_margin_wealth)
 
     # Ending balances
     ending_balances = [accounts[type].assets_minus_margin() + emergency_savings[type] for type in TYPES]
     present_value_of_ending_balances = map(present_value_function,ending_balances)
     present_value_of_simple_calc_ending_margin_balance = \
-        market.present_value(simple_approx_account_values["margin"] + \
-        emergency_savings["margin"],investor.years_until_donate)
+        present_value_function(simple_approx_account_values["margin"] + emergency_savings["margin"])
+    present_values_of_control_variates = [present_value_function(control_variate_account_values[type] + 
+        control_variate_emergency_savings) for type in TYPES]
 
     return tuple(present_value_of_ending_balances) + (historical_margin_to_assets_ratios, \
         historical_margin_wealth, historical_carried_cap_gains, \
         historical_margin_percent_differences_from_simple_calc, have_savings_gap_and_no_assets, \
-        margin_strategy_went_bankrupt, num_times_randgenerator_was_called, \
-        present_value_of_simple_calc_ending_margin_balance, )
+        margin_strategy_went_bankrupt, present_value_of_simple_calc_ending_margin_balance, 
+        present_values_of_control_variates, )
+
+def warn_about_account_deviating(actual_value, difference, simple_approx_account_value):
+    if difference == float("inf"):
+        percent_diff_string = "infinity"
+    else:
+        percent_diff_string = str(int(round(100*difference,0)))
+    print "WARNING: Actual account value (%s) differs by %s percent from simple approximate value (%s)." % \
+        (util.format_as_dollar_string(actual_value), percent_diff_string, \
+        util.format_as_dollar_string(simple_approx_account_value))
+
+def simulate_days_without_events(first_day, end_day, daily_returns, trading_day_num, investor, market,
+                                 calendar, schedule, accounts, taxes, emergency_savings,
+                                 simple_approx_account_values, control_variate_account_values,
+                                 control_variate_emergency_savings, margin_strategy_went_bankrupt,
+                                 already_gave_warning_about_account_deviating, histories):
+    """Do what one_run's daily loop does on days first_day, ..., end_day-1, none
+    of which can be an event day (see HorizonSchedule.next_event_days), all at
+    once. On those days, only the market return changes anything, unless the
+    broker forces a sale. So the emergency savings, simple approximations,
+    control variates and accounts' price indices after each trading day are
+    running products of daily factors, and numpy.cumprod computes them in the
+    same order as the loop, giving exactly the same numbers.
+
+    The days are cut short before the first one where something else would
+    happen: mandatory_rebalance would sell, a return is -100% or worse, the
+    margin strategy starts or stops using emergency savings, a simple
+    approximation would go below 0, or one of the loop's assertions would
+    fail. The loop then handles that day itself.
+
+    daily_returns is the numpy array of the path's returns, and trading_day_num
+    is the index in it of the next trading day's return. histories is
+    (historical_margin_to_assets_ratios, historical_regular_wealth,
+    historical_margin_wealth, historical_carried_cap_gains,
+    historical_margin_percent_differences_from_simple_calc). The dicts and
+    arrays passed in are updated in place. Returns (first day not simulated,
+    trading_day_num, control_variate_emergency_savings,
+    margin_strategy_went_bankrupt, already_gave_warning_about_account_deviating)."""
+    num_days = end_day - first_day
+    num_trading_days = calendar.num_trading_days_before[end_day] - trading_day_num
+    trading_day_offsets = calendar.trading_days[trading_day_num:trading_day_num+num_trading_days] - first_day
+    num_trading_days_before = calendar.num_trading_days_before[first_day:end_day] - trading_day_num
+    returns = daily_returns[trading_day_num:trading_day_num+num_trading_days]
+    growth_factors = 1.0 + returns
+    years_remaining = schedule.years_remaining[first_day]
+    (regular_row, margin_row) = (TYPES.index("regular"), TYPES.index("margin"))
+
+    """Rows 0-2 are the emergency savings of TYPES, row 3 the control variates'
+    emergency savings, rows 4-6 the control variates of TYPES and rows 7-9 the
+    simple approximations of TYPES. Column j is after j trading days."""
+    values = numpy.empty((10, num_trading_days+1))
+    values[:,0] = [emergency_savings[type] for type in TYPES] + [control_variate_emergency_savings] + \
+        [control_variate_account_values[type] for type in TYPES] + \
+        [simple_approx_account_values[type] for type in TYPES]
+    values[:4,1:] = growth_factors
+    for (row, type) in enumerate(TYPES, 4):
+        values[row,1:] = daily_growth_factors(scheduled_leverage_multiple(
+            type, years_remaining, schedule.margin_leverage_multiples), returns, growth_factors, market)
+    numpy.cumprod(values[:7], axis=1, out=values[:7])
+    trading_day_problems = growth_factors <= 0
+
+    # Whether the margin account sits out because the margin strategy is using emergency savings
+    using_emergency_savings = values[margin_row,1:] < values[regular_row,1:]
+    margin_account_sits_out = num_trading_days > 0 and bool(using_emergency_savings[0])
+    trading_day_problems |= using_emergency_savings != margin_account_sits_out
+    if margin_account_sits_out and (accounts["margin"].assets != 0 or accounts["margin"].margin != 0):
+        trading_day_problems[0] = True
+
+    assets = numpy.empty((3, num_trading_days+1))
+    for (row, type) in enumerate(TYPES):
+        assets[row,0] = accounts[type].assets
+        if type == "margin" and margin_account_sits_out:
+            assets[row,1:] = assets[row,0]
+        else:
+            assets[row,1:] = accounts[type].assets_after_price_updates(growth_factors)
+    margin_to_assets_ratios = accounts["margin"].margin_to_assets_ratios(assets[margin_row])
+    if not margin_account_sits_out:
+        trading_day_problems |= accounts["margin"].would_need_mandatory_rebalance(margin_to_assets_ratios[1:])
+
+    for (row, type) in enumerate(TYPES, 7):
+        if investor.rebalance_monthly_to_increase_leverage:
+            leverage_multiples = leverage_multiple(accounts[type], years_remaining, investor)
+            if type is not "margin" and leverage_multiples != 1.0:
+                trading_day_problems[:] = True
+            if margin_strategy_went_bankrupt and leverage_multiples != 1.0:
+                leverage_multiples = numpy.repeat(leverage_multiples, num_trading_days)
+        else:
+            ratios = accounts[type].margin_to_assets_ratios(assets[row-7,:-1])
+            trading_day_problems |= ratios == 1 # the loop would divide by 0
+            ratios[ratios == 1] = 0
+            leverage_multiples = util.max_margin_to_assets_ratio_to_N_to_1_leverage(ratios)
+            if type is not "margin":
+                trading_day_problems |= leverage_multiples != 1.0
+        if margin_strategy_went_bankrupt and isinstance(leverage_multiples, numpy.ndarray):
+            leverage_multiples[:num_trading_days if margin_account_sits_out else 1] = 1.0 # it's reset after the first day unless the account sits out
+        values[row,1:] = daily_growth_factors(leverage_multiples, returns, growth_factors, market)
+    numpy.cumprod(values[7:], axis=1, out=values[7:])
+    trading_day_problems |= (values[7:,1:] < 0).any(axis=0)
+
+    # The checks that the loop does at the start of each day
+    actual_values = assets[:,num_trading_days_before] - \
+        numpy.array([[accounts[type].margin] for type in TYPES])
+    differences = util.fractional_differences(actual_values, values[7:,num_trading_days_before])
+    non_margin_rows = [row for row in xrange(3) if row != margin_row]
+    day_problems = (actual_values < 0).any(axis=0) | \
+        ~(numpy.abs(differences[non_margin_rows]) < TINY_NUMBER).all(axis=0)
+
+    first_problem_days = numpy.concatenate((trading_day_offsets[trading_day_problems], 
+                                            numpy.flatnonzero(day_problems)))
+    if len(first_problem_days) > 0:
+        num_days = int(first_problem_days.min())
+    if num_days == 0:
+        return (first_day, trading_day_num, control_variate_emergency_savings, 
+                margin_strategy_went_bankrupt, already_gave_warning_about_account_deviating)
+    num_trading_days = calendar.num_trading_days_before[first_day+num_days] - trading_day_num
+    states = num_trading_days_before[:num_days]
+    days = slice(first_day, first_day+num_days)
+
+    (historical_margin_to_assets_ratios, historical_regular_wealth, historical_margin_wealth,
+     historical_carried_cap_gains, historical_margin_percent_differences_from_simple_calc) = histories
+    historical_margin_to_assets_ratios[days] = margin_to_assets_ratios[states]
+    historical_regular_wealth[days] = actual_values[regular_row,:num_days] + \
+        values[regular_row,states]
+    historical_margin_wealth[days] = actual_values[margin_row,:num_days] + values[margin_row,states]
+    historical_carried_cap_gains[days] = taxes["margin"].total_gain_or_loss()
+    historical_margin_percent_differences_from_simple_calc[days] = 100*differences[margin_row,:num_days]
+    if not already_gave_warning_about_account_deviating:
+        days_to_warn = numpy.flatnonzero(numpy.abs(differences[margin_row,:num_days]) > 
+            DIFFERENCE_THRESHOLD_FOR_WARNING_ABOUT_DIFF_FROM_SIMPLE_COMPUTATION_PER_YEAR * investor.years_until_donate)
+        if len(days_to_warn) > 0:
+            day_to_warn = days_to_warn[0]
+            warn_about_account_deviating(float(actual_values[margin_row,day_to_warn]), 
+                float(differences[margin_row,day_to_warn]), float(values[7+margin_row,states[day_to_warn]]))
+            already_gave_warning_about_account_deviating = True
+
+    if num_trading_days > 0:
+        for (row, type) in enumerate(TYPES):
+            emergency_savings[type] = float(values[row,num_trading_days])
+            control_variate_account_values[type] = float(values[4+row,num_trading_days])
+            simple_approx_account_values[type] = float(values[7+row,num_trading_days])
+            if not (type == "margin" and margin_account_sits_out):
+                accounts[type].update_asset_prices_over_days(growth_factors[:num_trading_days])
+        control_variate_emergency_savings = float(values[3,num_trading_days])
+        if not margin_account_sits_out:
+            margin_strategy_went_bankrupt = False # see check_if_margin_strategy_should_use_emergency_funds_and_maybe_go_bankrupt
+    return (first_day+num_days, trading_day_num+num_trading_days, control_variate_emergency_savings,
+            margin_strategy_went_bankrupt, already_gave_warning_about_account_deviating)
+
+def daily_growth_factors(leverage_multiples, daily_returns, growth_factors, market):
+    """control_variate_growth_factor for numpy arrays of daily returns and
+    their growth factors 1 + daily_returns. With leverage 1.0, it gives exactly
+    the growth factors, so don't bother computing it."""
+    if not isinstance(leverage_multiples, numpy.ndarray) and leverage_multiples == 1.0:
+        return growth_factors
+    return control_variate_growth_factor(leverage_multiples, daily_returns, market)
 
 def leverage_multiple(account, years_remaining, investor):
     return util.max_margin_to_assets_ratio_to_N_to_1_leverage( \
@@ -438,6 +747,59 @@ def leverage_multiple(account, years_remaining, investor):
             util.max_margin_to_assets_ratio_to_N_to_1_leverage( \
             account.margin_to_assets())
 
+def scheduled_leverage_multiple(type, years_remaining, scheduled_leverage):
+    return scheduled_leverage[years_remaining] if type == "margin" else 1.0
+
+def control_variate_growth_factor(cur_leverage_multiple, daily_return, market):
+    """The control variates are like the simple approximations to account
+    values, except that the margin one always uses the scheduled leverage
+    (even if the real account goes bankrupt or doesn't rebalance monthly) and
+    is never clamped at 0. Each is the sum over pay days of a contribution that
+    depends only on employment times a product of daily growth factors that
+    are linear in the daily returns. Since returns are independent of each other
+    and of employment, expected_control_variate_values can compute their
+    expectations exactly, while they stay highly correlated with the real
+    ending balances. The emergency savings, which are part of the ending
+    balances, are included too."""
+    return 1+cur_leverage_multiple*daily_return \
+        - (cur_leverage_multiple-1.0)*market.annual_margin_interest_rate/market.trading_days_per_year
+
+def control_variate_contribution(type, pay, cur_leverage_multiple, investor):
+    if type == "matched401k":
+        return pay * (1+investor.match_percent_from_401k/100.0) * (1-BrokerageAccount.FEE_PER_DOLLAR_TRADED)
+    else:
+        return pay * (1-cur_leverage_multiple*BrokerageAccount.FEE_PER_DOLLAR_TRADED)
+
+def expected_control_variate_values(investor, market, schedule=None):
+    """Exact expectations of the control variates that one_run returns, in
+    the same order."""
+    calendar = trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate))
+    if schedule is None:
+        schedule = horizon_schedule(investor, market)
+    scheduled_leverage = schedule.margin_leverage_multiples
+    """Black-swan days have mu set to 0, and the normal shocks have mean 0."""
+    expected_daily_return = market.annual_mu / market.trading_days_per_year * \
+        (1 - market.medium_black_swan_prob - market.large_black_swan_prob)
+    expected_annual_incomes = iter(investor.expected_annual_incomes(calendar.pay_days, DAYS_PER_YEAR,
+                                                                    market.inflation_rate))
+    expected_account_values = dict((type, 0.0) for type in TYPES)
+    expected_emergency_savings = float(investor.initial_emergency_savings)
+    for (day, is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day) in calendar.event_days():
+        years_remaining = schedule.years_remaining[day]
+        if is_trading_day:
+            expected_emergency_savings *= (1+expected_daily_return)
+            for type in TYPES:
+                expected_account_values[type] *= control_variate_growth_factor(
+                    scheduled_leverage_multiple(type, years_remaining, scheduled_leverage),
+                    expected_daily_return, market)
+        if is_pay_day:
+            expected_pay = next(expected_annual_incomes) * schedule.pay_fraction_of_year
+            for type in TYPES:
+                expected_account_values[type] += control_variate_contribution(type, expected_pay, 
+                    scheduled_leverage_multiple(type, years_remaining, scheduled_leverage), investor)
+    return [schedule.present_value(expected_account_values[type] + expected_emergency_savings)
+            for type in TYPES]
+
 def margin_strategy_gap_in_emergency_funds(emergency_savings):
     return emergency_savings["regular"] - emergency_savings["margin"]
 
@@ -459,130 +821,1143 @@ def check_if_margin_strategy_should_use_emergency_funds_and_maybe_go_bankrupt(
             accounts["margin"] = BrokerageAccount.BrokerageAccount(0,0,0, \
                 investor.taper_off_leverage_toward_end, \
                 investor.taper_off_leverage_a_lot_toward_end,\
-                investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+                investor.initial_personal_max_margin_to_assets_relative_to_broker_max,\
+                accounts["margin"].randgenerator,\
+                Assets.lots_can_be_compacted(investor.does_broker_liquidation_sell_tax_favored_first))
     return (emergency_savings, accounts, margin_strategy_went_bankrupt)
 
+def batched_runs(investor, market, verbosity, outfilepath, first_iter_num,
+                 num_margin_trajectories_to_save_as_figures, daily_returns, employment_draws,
+                 num_histories_to_keep, lot_ordering_randgenerators=None, schedule=None):
+    """one_run for many sample paths at once. The paths advance day by day in
+    lockstep, with each path's accounts, taxes, emergency savings and
+    employment status held as elements of numpy arrays, and margin calls,
+    bankruptcies and layoffs applied to the paths they happen to by boolean
+    masks. Path i has iter_num first_iter_num+i, daily returns
+    daily_returns[i] and employment draws employment_draws[i], one per pay day
+    (see random_streams.employment_draws_for_paths) and lot-ordering generator
+    lot_ordering_randgenerators[i], so it sees the same market and employment
+    history and sells the same lots as one_run would with that path's
+    generators. Results are the same as one_run's up to rounding (see
+    BatchedAccounts), except that tax-loss harvesting isn't supported, and
+    it needs EtfLot.PARTIAL_SALES_REDUCE_BASIS. The margin account keeps a
+    column of lots per purchase, so memory grows as the number of paths times
+    the number of purchases, unless BatchedAccounts.AGGREGATE_LONG_TERM_LOTS,
+    which bounds it but makes results only approximate one_run's.
+
+    Returns a tuple like one_run's, except that each element has an entry per
+    path, the histories are kept only for the first num_histories_to_keep
+    paths, and there's an extra element after the ending balances: the sum
+    over all paths of the margin-to-assets ratio history. The control variates
+    are an array with a row per path."""
+    if investor.do_tax_loss_harvesting and Assets.HARVEST_LOTS_WITH_LOSSES:
+        raise Exception("batched_runs doesn't harvest tax losses. Use one_run instead.")
+    if not EtfLot.PARTIAL_SALES_REDUCE_BASIS:
+        raise Exception("batched_runs reduces the basis of partly sold lots. Use one_run instead.")
+    investor.reset_employment_for_next_round()
+    days_from_start_to_donation_date = int(DAYS_PER_YEAR * investor.years_until_donate)
+    calendar = trading_calendar(days_from_start_to_donation_date)
+    if schedule is None:
+        schedule = horizon_schedule(investor, market)
+    daily_returns = numpy.array(daily_returns, dtype=float).T.copy() # a row per trading day
+    employment_draws = numpy.array(employment_draws, dtype=float).T.copy() # a row per pay day
+    num_paths = daily_returns.shape[1]
+    num_histories_to_keep = min(num_histories_to_keep, num_paths)
+    accounts = dict()
+    for type in TYPES:
+        accounts[type] = BatchedAccounts.BatchedAccounts(num_paths,
+            investor.broker_max_margin_to_assets_ratio if type == "margin" else 0,
+            investor.taper_off_leverage_toward_end,
+            investor.taper_off_leverage_a_lot_toward_end,
+            investor.initial_personal_max_margin_to_assets_relative_to_broker_max,
+            lot_ordering_randgenerators, keeps_lots=(type == "margin"),
+            compact_lots=Assets.lots_can_be_compacted(investor.does_broker_liquidation_sell_tax_favored_first))
+    taxes = BatchedTaxes.BatchedTaxes(investor.tax_rates, num_paths)
+    """Only the margin account pays capital-gains taxes: the regular account
+    never sells, and the 401k's gains aren't taxed."""
+    laid_off = numpy.zeros(num_paths, dtype=bool)
+    num_times_laid_off = numpy.zeros(num_paths, dtype=int)
+    deficits_still_not_paid = numpy.zeros(num_paths)
+    """The last deficit each path's one_run would have gotten back from a
+    rebalance, which it checks once more at the end"""
+    margin_strategy_went_bankrupt = numpy.zeros(num_paths, dtype=bool)
+    already_gave_warning_about_account_deviating = numpy.zeros(num_paths, dtype=bool)
+    trading_day_num = 0
+    pay_period_num = 0
+
+    emergency_savings = dict()
+    simple_approx_account_values = dict()
+    control_variate_account_values = dict()
+    for type in TYPES:
+        emergency_savings[type] = numpy.ones(num_paths) * investor.initial_emergency_savings
+        simple_approx_account_values[type] = numpy.zeros(num_paths)
+        control_variate_account_values[type] = numpy.zeros(num_paths)
+    control_variate_emergency_savings = numpy.ones(num_paths) * investor.initial_emergency_savings
+    scheduled_leverage = schedule.margin_leverage_multiples
+    interest_and_salary_every_fraction_of_year = schedule.pay_fraction_of_year
+    years_remaining_by_day = schedule.years_remaining
+    annual_incomes_before_layoff_penalty = schedule.annual_incomes_before_layoff_penalty
+    principal_repayment_fractions = schedule.principal_repayment_fractions
+    warning_threshold = DIFFERENCE_THRESHOLD_FOR_WARNING_ABOUT_DIFF_FROM_SIMPLE_COMPUTATION_PER_YEAR * \
+        investor.years_until_donate
+
+    # Record history over lifetime of investment
+    sum_of_margin_to_assets_ratios = numpy.zeros(days_from_start_to_donation_date)
+    history_shape = (num_histories_to_keep, days_from_start_to_donation_date)
+    historical_margin_to_assets_ratios = numpy.zeros(history_shape)
+    historical_regular_wealth = numpy.zeros(history_shape)
+    historical_margin_wealth = numpy.zeros(history_shape)
+    historical_carried_cap_gains = numpy.zeros(history_shape)
+    historical_margin_percent_differences_from_simple_calc = numpy.zeros(history_shape)
+
+    for (day, is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day) in calendar.event_days():
+        years_remaining = years_remaining_by_day[day]
+        margin_account = accounts["margin"]
+
+        # Record historical info for future reference
+        cur_margin_to_assets = margin_account.margin_to_assets_ratios()
+        sum_of_margin_to_assets_ratios[day] = numpy.sum(cur_margin_to_assets)
+        historical_margin_to_assets_ratios[:,day] = cur_margin_to_assets[:num_histories_to_keep]
+        actual_values = dict((type, accounts[type].assets_minus_margin()) for type in TYPES)
+        historical_regular_wealth[:,day] = (actual_values["regular"] + emergency_savings["regular"])[:num_histories_to_keep]
+        historical_margin_wealth[:,day] = (actual_values["margin"] + emergency_savings["margin"])[:num_histories_to_keep]
+        historical_carried_cap_gains[:,day] = taxes.total_gain_or_loss()[:num_histories_to_keep]
+
+        # Check deviations from simple approximate estimates of account values
+        for type in TYPES:
+            differences = util.fractional_differences(actual_values[type], simple_approx_account_values[type])
+            if type is not "margin":
+                assert numpy.all(abs(differences) < TINY_NUMBER), "Non-margin simple calculations should match the real things."
+            else:
+                historical_margin_percent_differences_from_simple_calc[:,day] = 100*differences[:num_histories_to_keep]
+                paths_to_warn = (abs(differences) > warning_threshold) & ~already_gave_warning_about_account_deviating
+                for path_index in numpy.flatnonzero(paths_to_warn):
+                    warn_about_account_deviating(actual_values[type][path_index], differences[path_index],
+                                                 simple_approx_account_values[type][path_index])
+                already_gave_warning_about_account_deviating |= paths_to_warn
+
+        if is_trading_day:
+            random_daily_returns = daily_returns[trading_day_num]
+            trading_day_num += 1
+            growth_factors = 1.0+random_daily_returns
+
+            for type in TYPES:
+                # Update emergency savings
+                emergency_savings[type] = numpy.maximum(emergency_savings[type] * growth_factors, 0) # see util.update_price
+                # Update simple approximations to account values
+                if type is "margin":
+                    cur_leverage_multiples = leverage_multiples(margin_account, years_remaining, investor)
+                    cur_leverage_multiples[margin_strategy_went_bankrupt] = 1.0
+                else:
+                    cur_leverage_multiples = 1.0 # non-margin accounts have max margin-to-assets ratios of 0
+                simple_approx_account_values[type] = numpy.maximum(0, simple_approx_account_values[type] * \
+                    (1+cur_leverage_multiples*random_daily_returns \
+                    - (cur_leverage_multiples-1.0)*market.annual_margin_interest_rate/market.trading_days_per_year))
+
+            # Update control variates
+            control_variate_emergency_savings *= growth_factors
+            for type in TYPES:
+                control_variate_account_values[type] *= control_variate_growth_factor(
+                    scheduled_leverage_multiple(type, years_remaining, scheduled_leverage),
+                    random_daily_returns, market)
+
+            accounts["regular"].update_asset_prices(growth_factors)
+            accounts["matched401k"].update_asset_prices(growth_factors)
+
+            """Paths whose margin strategy is using emergency savings have no
+            margin assets, so they sit out the margin account's update."""
+            paths_updating_margin_account = emergency_savings["margin"] >= emergency_savings["regular"]
+            margin_account.update_asset_prices(growth_factors, paths_updating_margin_account)
+            deficits = margin_account.mandatory_rebalance(day, taxes,
+                investor.does_broker_liquidation_sell_tax_favored_first, paths_updating_margin_account)
+            margin_strategy_went_bankrupt = use_emergency_funds_for_deficits_and_maybe_go_bankrupt(
+                deficits, paths_updating_margin_account, deficits_still_not_paid, emergency_savings,
+                margin_account, margin_strategy_went_bankrupt)
+
+        # check if we should get paid and defray interest
+        if is_pay_day:
+            pay = annual_incomes_before_layoff_penalty[pay_period_num] * \
+                Investor.income_multipliers(laid_off, num_times_laid_off) * interest_and_salary_every_fraction_of_year
+
+            if verbosity > 1:
+                if day % 1000 == 0:
+                    print "Day " + str(day) + ", year " + str(schedule.years_elapsed[day])
+
+            accounts["regular"].buy_ETF_at_fixed_ratio(pay, day, years_remaining)
+            simple_approx_account_values["regular"] += pay * (1-BrokerageAccount.FEE_PER_DOLLAR_TRADED)
+            matched_pay_amount = pay * (1+investor.match_percent_from_401k/100.0)
+            accounts["matched401k"].buy_ETF_at_fixed_ratio(matched_pay_amount, day, years_remaining)
+            simple_approx_account_values["matched401k"] += matched_pay_amount * (1-BrokerageAccount.FEE_PER_DOLLAR_TRADED)
+            simple_approx_account_values["margin"] += pay * (1-leverage_multiples( \
+                margin_account, years_remaining, investor) * BrokerageAccount.FEE_PER_DOLLAR_TRADED)
+            for type in TYPES:
+                control_variate_account_values[type] += control_variate_contribution(type, pay, 
+                    scheduled_leverage_multiple(type, years_remaining, scheduled_leverage), investor)
+
+            # The same steps as in one_run, each on the paths whose branch it's in
+            gaps = emergency_savings["regular"] - emergency_savings["margin"]
+            restoring_savings_with_all_pay = gaps > pay
+            emergency_savings["margin"][restoring_savings_with_all_pay] += pay[restoring_savings_with_all_pay]
+            paying_margin_account = ~restoring_savings_with_all_pay
+            # 0. restore any needed emergency savings
+            restoring_some_savings = paying_margin_account & (gaps > 0)
+            pay = numpy.where(restoring_some_savings, pay - gaps, pay)
+            emergency_savings["margin"][restoring_some_savings] += gaps[restoring_some_savings]
+            # 1. pay interest
+            interest = margin_account.compute_interest(market.annual_margin_interest_rate,
+                                                       interest_and_salary_every_fraction_of_year)
+            pay_after_interest = pay - interest
+            paying_interest_with_equity = paying_margin_account & (pay_after_interest <= 0)
+            margin_account.margin = numpy.where(paying_interest_with_equity, 
+                margin_account.margin + (interest - pay), margin_account.margin)
+            # 2. pay some principal, if we're dong that
+            paying_principal = paying_margin_account & ~paying_interest_with_equity
+            amount_of_principal_to_repay = margin_account.margin * principal_repayment_fractions[pay_period_num]
+            paying_principal_with_equity = paying_principal & (amount_of_principal_to_repay > pay_after_interest)
+            margin_account.margin = numpy.where(paying_principal_with_equity,
+                margin_account.margin - pay_after_interest, margin_account.margin)
+            paying_principal_with_pay = paying_principal & ~paying_principal_with_equity
+            margin_account.margin = numpy.where(paying_principal_with_pay,
+                margin_account.margin - amount_of_principal_to_repay, margin_account.margin)
+            pay_after_interest_and_principal = pay_after_interest - amount_of_principal_to_repay
+            # 3. pay down margin if it's over limit
+            amount_to_pay_for_voluntary_margin_call = \
+                margin_account.debt_to_pay_off_to_restore_voluntary_max_margin_to_assets_ratio(years_remaining)
+            paying_margin_call_with_equity = paying_principal_with_pay & \
+                (amount_to_pay_for_voluntary_margin_call > pay_after_interest_and_principal)
+            margin_account.margin = numpy.where(paying_margin_call_with_equity,
+                margin_account.margin - pay_after_interest_and_principal, margin_account.margin)
+            buying_ETF = paying_principal_with_pay & ~paying_margin_call_with_equity
+            margin_account.margin = numpy.where(buying_ETF,
+                margin_account.margin - amount_to_pay_for_voluntary_margin_call, margin_account.margin)
+            rebalancing = paying_interest_with_equity | paying_principal_with_equity | paying_margin_call_with_equity
+            deficits = margin_account.voluntary_rebalance(day, taxes, years_remaining, rebalancing)
+            margin_strategy_went_bankrupt = use_emergency_funds_for_deficits_and_maybe_go_bankrupt(
+                deficits, rebalancing, deficits_still_not_paid, emergency_savings,
+                margin_account, margin_strategy_went_bankrupt)
+            # 4. buy some ETF
+            margin_account.buy_ETF_at_fixed_ratio(numpy.where(buying_ETF, 
+                pay_after_interest_and_principal - amount_to_pay_for_voluntary_margin_call, 0.0),
+                day, years_remaining)
+
+            # If we're rebalancing upwards to increase leverage when it's too low, do that.
+            if investor.rebalance_monthly_to_increase_leverage:
+                margin_account.voluntary_rebalance_to_increase_leverage(day, years_remaining)
+
+            # Possibly get laid off or return to work
+            (laid_off, num_times_laid_off) = investor.randomly_update_employment_statuses(
+                laid_off, num_times_laid_off, employment_draws[pay_period_num])
+            pay_period_num += 1
+
+        if is_tax_day:
+            bills_or_refunds = taxes.process_taxes()
+            paying_bills = bills_or_refunds > 0
+            margin_account.margin = numpy.where(paying_bills, margin_account.margin + bills_or_refunds,
+                                                margin_account.margin)
+            deficits = margin_account.voluntary_rebalance(day, taxes, years_remaining, paying_bills)
+            for deficit in deficits[deficits > 0]:
+                print "WARNING: margin account is using %s of emergency funds to pay taxes. This is rare." % \
+                    util.format_as_dollar_string(deficit)
+            margin_strategy_went_bankrupt = use_emergency_funds_for_deficits_and_maybe_go_bankrupt(
+                deficits, paying_bills, deficits_still_not_paid, emergency_savings,
+                margin_account, margin_strategy_went_bankrupt)
+            getting_refunds = bills_or_refunds < 0
+            refunds = -bills_or_refunds
+            gaps = emergency_savings["regular"] - emergency_savings["margin"]
+            restoring_savings_with_all_refund = getting_refunds & (gaps >= refunds)
+            emergency_savings["margin"][restoring_savings_with_all_refund] += refunds[restoring_savings_with_all_refund]
+            restoring_savings_with_some_refund = getting_refunds & ~restoring_savings_with_all_refund
+            emergency_savings["margin"][restoring_savings_with_some_refund] += gaps[restoring_savings_with_some_refund]
+            refunds = numpy.where(restoring_savings_with_some_refund, refunds - gaps, 0.0)
+            margin_account.buy_ETF_at_fixed_ratio(refunds, day, years_remaining) # use the tax refund to buy more shares
+
+        if day == days_from_start_to_donation_date-1:
+            for iter_num in [1,10,100]:
+                if first_iter_num <= iter_num < first_iter_num + num_paths:
+                    print "On day %i, the market returned %f, and investor_unemployed = %s" % \
+                        (day, random_daily_returns[iter_num-first_iter_num], laid_off[iter_num-first_iter_num])
+
+    # Make sure our variables are in order.
+    margin_account = accounts["margin"]
+    assets = margin_account.assets()
+    gaps = emergency_savings["regular"] - emergency_savings["margin"]
+    have_savings_gap_and_no_assets = (assets == 0) & (gaps > 0)
+    for path_index in numpy.flatnonzero((assets == 0) & (gaps == 0)):
+        print "WARNING: You have no assets and no savings gap."
+
+    """Pay off all margin debt, as in one_run"""
+    paying_off_margin = assets > 0
+    deficits = margin_account.pay_off_all_margin(days_from_start_to_donation_date, taxes, paying_off_margin)
+    deficits_still_not_paid[paying_off_margin] = deficits[paying_off_margin]
+    processing_taxes = paying_off_margin & ~(deficits > 0)
+    bills_or_refunds = taxes.process_taxes(processing_taxes)
+    converging = processing_taxes & (bills_or_refunds > THRESHOLD_FOR_TAX_CONVERGENCE)
+    while numpy.any(converging):
+        margin_account.margin = numpy.where(converging, margin_account.margin + bills_or_refunds,
+                                            margin_account.margin)
+        deficits = margin_account.pay_off_all_margin(days_from_start_to_donation_date, taxes, converging)
+        deficits_still_not_paid[converging] = deficits[converging]
+        bills_or_refunds = numpy.where(converging, taxes.process_taxes(converging), bills_or_refunds)
+        converging &= (bills_or_refunds > THRESHOLD_FOR_TAX_CONVERGENCE) & ~(deficits_still_not_paid > 0)
+    margin_account.buy_ETF_without_margin(numpy.where(processing_taxes & ~(deficits_still_not_paid > 0),
+        -bills_or_refunds, 0.0), days_from_start_to_donation_date) # can't use margin anymore because we're done paying off loans
+    margin_strategy_went_bankrupt = use_emergency_funds_for_deficits_and_maybe_go_bankrupt(
+        deficits_still_not_paid, numpy.ones(num_paths, dtype=bool), deficits_still_not_paid,
+        emergency_savings, margin_account, margin_strategy_went_bankrupt)
+
+    for regular_value in accounts["regular"].assets_minus_margin():
+        if regular_value < TINY_NUMBER:
+            print "WARNING: In this simulation round, the regular account ended with only %s." % \
+                util.format_as_dollar_string(regular_value)
+
+    for type in TYPES:
+        assert numpy.all(accounts[type].margin == 0), "We shouldn't have any margin loans left."
+
+    # Possibly save these trajectories of regular vs. margin wealth
+    for path_index in xrange(num_histories_to_keep):
+        if first_iter_num + path_index < num_margin_trajectories_to_save_as_figures:
+            plots.graph_margin_vs_regular_trajectories(historical_regular_wealth[path_index],
+                historical_margin_wealth[path_index], outfilepath, first_iter_num + path_index)
+
+    # Return present values of the account balances
+    present_value_function = schedule.present_value
+    present_values_of_ending_balances = [present_value_function(accounts[type].assets_minus_margin() + 
+        emergency_savings[type]) for type in TYPES]
+    present_values_of_simple_calc_ending_margin_balances = \
+        present_value_function(simple_approx_account_values["margin"] + emergency_savings["margin"])
+    present_values_of_control_variates = numpy.column_stack([present_value_function(
+        control_variate_account_values[type] + control_variate_emergency_savings) for type in TYPES])
+
+    return tuple(present_values_of_ending_balances) + (sum_of_margin_to_assets_ratios,
+        historical_margin_to_assets_ratios, present_value_function(historical_margin_wealth),
+        historical_carried_cap_gains, historical_margin_percent_differences_from_simple_calc,
+        have_savings_gap_and_no_assets, margin_strategy_went_bankrupt,
+        present_values_of_simple_calc_ending_margin_balances, present_values_of_control_variates, )
+
+def leverage_multiples(accounts, years_remaining, investor):
+    """leverage_multiple for each of a BatchedAccounts' accounts"""
+    return util.max_margin_to_assets_ratio_to_N_to_1_leverage( \
+            accounts.personal_max_margin_to_assets_ratios(years_remaining)) if \
+            investor.rebalance_monthly_to_increase_leverage else \
+            util.max_margin_to_assets_ratio_to_N_to_1_leverage( \
+            accounts.margin_to_assets_ratios())
+
+def use_emergency_funds_for_deficits_and_maybe_go_bankrupt(deficits, paths, deficits_still_not_paid,
+    emergency_savings, margin_account, margin_strategy_went_bankrupt):
+    """check_if_margin_strategy_should_use_emergency_funds_and_maybe_go_bankrupt
+    for each of paths, given their deficits. Records the deficits in
+    deficits_still_not_paid and returns margin_strategy_went_bankrupt with the
+    paths' entries set to whether they went bankrupt."""
+    deficits_still_not_paid[paths] = deficits[paths]
+    needing_funds = paths & (deficits > 0)
+    if not numpy.any(needing_funds):
+        return numpy.where(paths, False, margin_strategy_went_bankrupt)
+    paying_from_savings = needing_funds & (deficits <= emergency_savings["margin"])
+    emergency_savings["margin"][paying_from_savings] -= deficits[paying_from_savings]
+    going_bankrupt = needing_funds & ~paying_from_savings
+    for amount_cannot_pay in (deficits - emergency_savings["margin"])[going_bankrupt]:
+        print "Margin strategy is going bankrupt with %s of unpaid debt." % \
+            util.format_as_dollar_string(amount_cannot_pay)
+    emergency_savings["margin"][going_bankrupt] = 0 # pay what we can; the rest of our debt goes away with bankruptcy
+    margin_account.stop_using_margin(going_bankrupt)
+    return numpy.where(paths, going_bankrupt, margin_strategy_went_bankrupt)
+
+def kernel_run_is_supported(investor, verbosity):
+    """Whether kernel_run can stand in for one_run. It doesn't harvest tax
+    losses or print one_run's extra output for verbosity > 1."""
+    return not (investor.do_tax_loss_harvesting and Assets.HARVEST_LOTS_WITH_LOSSES) and verbosity <= 1
+
+def kernel_run(investor, market, verbosity, outfilepath, iter_num,
+               num_margin_trajectories_to_save_as_figures, daily_returns, employment_draws,
+               lot_ordering_randgenerator, schedule=None):
+    """one_run for one path, done by path_kernel.simulate_path. The path's
+    employment comes from employment_draws, one per pay day (see
+    random_streams.employment_draws_for_paths), instead of a generator, and
+    daily_returns and lot_ordering_randgenerator must be given. Returns the
+    same tuple as one_run, with the same numbers up to rounding, and prints
+    the same things, provided kernel_run_is_supported."""
+    assert kernel_run_is_supported(investor, verbosity), "Use one_run for this investor."
+    days_from_start_to_donation_date = int(DAYS_PER_YEAR * investor.years_until_donate)
+    calendar = trading_calendar(days_from_start_to_donation_date)
+    if schedule is None:
+        schedule = horizon_schedule(investor, market)
+    margin_account = BrokerageAccount.BrokerageAccount(0,0,investor.broker_max_margin_to_assets_ratio,\
+        investor.taper_off_leverage_toward_end,\
+        investor.taper_off_leverage_a_lot_toward_end,\
+        investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+    num_pay_days = len(schedule.annual_incomes_before_layoff_penalty)
+    tax_rates = investor.tax_rates
+    max_lots_per_group = path_kernel.max_lots_per_group(num_pay_days, int(numpy.sum(calendar.is_tax_day)))
+    lot_rules = numpy.array([Assets.LONG_TERM_BASIS_BUCKET_WIDTH if Assets.LONG_TERM_BASIS_BUCKET_WIDTH > 0 \
+        else LotGroup.SAME_BASIS_PER_SHARE_TOLERANCE,
+        Assets.lots_can_be_compacted(investor.does_broker_liquidation_sell_tax_favored_first),
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS], dtype=float)
+
+    lot_ordering_draws = numpy.zeros(0)
+    num_lot_ordering_draws_to_add = 16
+    while True:
+        if not investor.does_broker_liquidation_sell_tax_favored_first:
+            """Draw more of the generator's numbers if the kernel ran out last time"""
+            lot_ordering_draws = numpy.concatenate((lot_ordering_draws, [lot_ordering_randgenerator.random()
+                for draw_num in xrange(num_lot_ordering_draws_to_add)]))
+            num_lot_ordering_draws_to_add = len(lot_ordering_draws)
+        histories = numpy.zeros((path_kernel.NUM_HISTORIES, days_from_start_to_donation_date))
+        max_num_events = 4*days_from_start_to_donation_date + 8
+        events = numpy.zeros(max_num_events, dtype=numpy.int64)
+        event_values = numpy.zeros((max_num_events, path_kernel.MAX_EVENT_VALUES))
+        counters = numpy.zeros(3, dtype=numpy.int64)
+        (regular_val, margin_val, matched_401k_val, simple_calc_ending_balance, regular_control_variate,
+         margin_control_variate, matched_401k_control_variate, have_savings_gap_and_no_assets,
+         margin_strategy_went_bankrupt) = path_kernel.simulate_path(
+            numpy.asarray(daily_returns, dtype=float), numpy.asarray(employment_draws, dtype=float),
+            lot_ordering_draws, calendar.is_trading_day, calendar.is_pay_day, calendar.is_tax_day,
+            numpy.array(schedule.years_remaining),
+            numpy.array([margin_account.personal_max_margin_to_assets_ratio(years_remaining)
+                         for years_remaining in xrange(int(investor.years_until_donate)+1)]),
+            numpy.array(schedule.margin_leverage_multiples, dtype=float),
+            numpy.array(schedule.annual_incomes_before_layoff_penalty, dtype=float),
+            numpy.array([Investor.income_penalty_for_past_layoffs(num_times_laid_off)
+                         for num_times_laid_off in xrange(num_pay_days+1)], dtype=float),
+            numpy.array(schedule.principal_repayment_fractions, dtype=float),
+            float(investor.broker_max_margin_to_assets_ratio), investor.rebalance_monthly_to_increase_leverage,
+            investor.does_broker_liquidation_sell_tax_favored_first, float(investor.initial_emergency_savings),
+            float(investor.match_percent_from_401k), float(investor.monthly_probability_of_layoff),
+            float(investor.monthly_probability_find_work_after_laid_off),
+            numpy.array([tax_rates.short_term_cap_gains_rate_plus_state(),
+                         tax_rates.long_term_cap_gains_rate_plus_state(),
+                         tax_rates.income_tax_rate_plus_state()], dtype=float),
+            float(market.annual_margin_interest_rate), float(market.trading_days_per_year),
+            (1+market.annual_margin_interest_rate)**schedule.pay_fraction_of_year - 1, # see compute_interest
+            schedule.pay_fraction_of_year, float(investor.years_until_donate),
+            DIFFERENCE_THRESHOLD_FOR_WARNING_ABOUT_DIFF_FROM_SIMPLE_COMPUTATION_PER_YEAR, TINY_NUMBER,
+            float(THRESHOLD_FOR_TAX_CONVERGENCE), lot_rules, max_lots_per_group, histories, events,
+            event_values, counters)
+        if not counters[path_kernel.RAN_OUT_OF_LOT_ORDERING_DRAWS]:
+            break
+
+    for (event, values) in zip(events[:counters[path_kernel.NUM_EVENTS]], event_values):
+        if event == path_kernel.ACCOUNT_WIPED_OUT:
+            print "Account wiped out with %s still needing to be repaid." % util.format_as_dollar_string(values[0])
+        elif event == path_kernel.GOING_BANKRUPT:
+            print "Margin strategy is going bankrupt with %s of unpaid debt." % \
+                util.format_as_dollar_string(values[0])
+        elif event == path_kernel.ACCOUNT_DEVIATING:
+            warn_about_account_deviating(float(values[0]), float(values[1]), float(values[2]))
+        elif event == path_kernel.USING_EMERGENCY_FUNDS_FOR_TAXES:
+            print "WARNING: %s account is using %s of emergency funds to pay taxes. This is rare." % \
+                ("margin", util.format_as_dollar_string(values[0]))
+        elif event == path_kernel.LAST_DAY and iter_num in [1,10,100]:
+            print "On day %i, the market returned %f, and investor_unemployed = %s" % \
+                (int(values[0]), values[1], bool(values[2]))
+        elif event == path_kernel.NO_ASSETS_AND_NO_SAVINGS_GAP:
+            print "WARNING: You have no assets and no savings gap."
+        elif event == path_kernel.REGULAR_ACCOUNT_ENDED_LOW:
+            print "WARNING: In this simulation round, the regular account ended with only %s." % \
+                util.format_as_dollar_string(values[0])
+
+    if iter_num < num_margin_trajectories_to_save_as_figures:
+        plots.graph_margin_vs_regular_trajectories(histories[path_kernel.HISTORICAL_REGULAR_WEALTH], \
+            histories[path_kernel.HISTORICAL_MARGIN_WEALTH], outfilepath, iter_num)
+
+    present_value_function = schedule.present_value
+    return tuple(map(present_value_function, [regular_val, margin_val, matched_401k_val])) + \
+        (histories[path_kernel.HISTORICAL_MARGIN_TO_ASSETS_RATIOS],
+         present_value_function(histories[path_kernel.HISTORICAL_MARGIN_WEALTH]).tolist(),
+         histories[path_kernel.HISTORICAL_CARRIED_CAP_GAINS],
+         histories[path_kernel.HISTORICAL_MARGIN_PERCENT_DIFFERENCES_FROM_SIMPLE_CALC],
+         have_savings_gap_and_no_assets, margin_strategy_went_bankrupt,
+         present_value_function(simple_calc_ending_balance),
+         map(present_value_function, [regular_control_variate, margin_control_variate,
+                                      matched_401k_control_variate]), )
+
+def compare_kernel_runs_with_one_run(investor, market, num_paths=20,
+                                     scenario_seed=random_streams.DEFAULT_SCENARIO_SEED):
+    """Parity test for kernel_run: run the first num_paths seeded paths of a
+    scenario with both kernel_run and one_run and check that they agree to
+    within KERNEL_PARITY_TOLERANCE. Without numba, kernel_run is slow but
+    still runs, so this checks the kernel's logic either way. Returns the
+    largest relative difference seen."""
+    calendar = trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate))
+    schedule = horizon_schedule(investor, market)
+    max_relative_difference = 0.0
+    for path_index in xrange(num_paths):
+        daily_returns = random_streams.daily_returns_for_paths(market, calendar.trading_days,
+                                                               scenario_seed, path_index, 1)[0]
+        employment_draws = random_streams.employment_draws_for_paths(scenario_seed, path_index, 1,
+            len(schedule.annual_incomes_before_layoff_penalty))[0]
+        kernel_results = kernel_run(investor, market, 0, None, path_index, 0, daily_returns,
+            employment_draws, random_streams.lot_ordering_generator(scenario_seed, path_index), schedule)
+        one_run_results = one_run(investor, market, 0, None, path_index, 0,
+            random_streams.employment_generator(scenario_seed, path_index), daily_returns,
+            random_streams.lot_ordering_generator(scenario_seed, path_index), schedule)
+        max_relative_difference = max(max_relative_difference, relative_difference_from_one_run(
+            kernel_results, one_run_results, path_index, "kernel_run", KERNEL_PARITY_TOLERANCE))
+    return max_relative_difference
+
+def compare_batched_runs_with_one_run(investor, market, num_paths=20,
+                                      scenario_seed=random_streams.DEFAULT_SCENARIO_SEED):
+    """Parity test for batched_runs: run the first num_paths seeded paths of a
+    scenario as one batch and one at a time with one_run, and check that they
+    agree to within BATCHED_PARITY_TOLERANCE. Returns the largest relative
+    difference seen."""
+    calendar = trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate))
+    schedule = horizon_schedule(investor, market)
+    daily_returns = random_streams.daily_returns_for_paths(market, calendar.trading_days, scenario_seed, 0,
+                                                           num_paths)
+    employment_draws = random_streams.employment_draws_for_paths(scenario_seed, 0, num_paths,
+        len(schedule.annual_incomes_before_layoff_penalty))
+    batched_results = batched_runs(investor, market, 0, None, 0, 0, daily_returns, employment_draws, num_paths,
+        [random_streams.lot_ordering_generator(scenario_seed, path_index) for path_index in xrange(num_paths)],
+        schedule)
+    batched_results = batched_results[:3] + batched_results[4:] # without the sum over paths
+    max_relative_difference = 0.0
+    for path_index in xrange(num_paths):
+        one_run_results = one_run(investor, market, 0, None, path_index, 0,
+            random_streams.employment_generator(scenario_seed, path_index), daily_returns[path_index],
+            random_streams.lot_ordering_generator(scenario_seed, path_index), schedule)
+        max_relative_difference = max(max_relative_difference, relative_difference_from_one_run(
+            tuple(values[path_index] for values in batched_results), one_run_results, path_index,
+            "batched_runs", BATCHED_PARITY_TOLERANCE))
+    return max_relative_difference
+
+def relative_difference_from_one_run(results, one_run_results, path_index, run_name, tolerance):
+    """The largest difference between a path's results from another engine
+    and from one_run, relative to the largest of each of one_run's values.
+    Fails if it's above tolerance or if the emergency-savings and bankruptcy
+    flags differ."""
+    assert tuple(results[7:9]) == tuple(one_run_results[7:9]), \
+        "Path %i: %s and one_run disagree about emergency savings or bankruptcy." % (path_index, run_name)
+    max_relative_difference = 0.0
+    for (values, one_run_values) in zip(results[:7] + results[9:], one_run_results[:7] + one_run_results[9:]):
+        (values, one_run_values) = (numpy.array(values, dtype=float).ravel(),
+                                    numpy.array(one_run_values, dtype=float).ravel())
+        assert numpy.array_equal(numpy.isinf(values), numpy.isinf(one_run_values)), \
+            "Path %i: %s and one_run disagree about infinite values." % (path_index, run_name)
+        finite = numpy.isfinite(one_run_values)
+        scale = max(1.0, numpy.max(numpy.abs(one_run_values[finite]))) if numpy.any(finite) else 1.0
+        relative_difference = numpy.max(numpy.abs(values[finite] - one_run_values[finite]) / scale) \
+            if numpy.any(finite) else 0.0
+        assert relative_difference <= tolerance, \
+            "Path %i: %s differs from one_run by %g." % (path_index, run_name, relative_difference)
+        max_relative_difference = max(max_relative_difference, relative_difference)
+    return max_relative_difference
+
+def compare_kernel_runs_with_one_run_for_all_scenarios(num_paths=20):
+    """compare_kernel_runs_with_one_run for every scenario in SCENARIOS
+    that kernel_run supports, printing each one's largest relative
+    difference; it stops at the first that fails. Run "python path_kernel.py"
+    to run it."""
+    for scenario_name in sorted(SCENARIOS.keys()):
+        (investor, market, num_trials, outpath) = args_for_this_scenario(scenario_name, num_paths, "")
+        if kernel_run_is_supported(investor, 0):
+            print "{}: {:g}".format(scenario_name, compare_kernel_runs_with_one_run(investor, market, num_paths))
+        else:
+            print "{}: skipped, since kernel_run doesn't support it".format(scenario_name)
+
+def return_batch_size(num_paths_per_return_batch, use_seed_for_randomness, sampling_mode, num_samples):
+    """How many paths' market returns to draw at once. Seeded runs default to
+    one path at a time (two for antithetic pairs). Unseeded antithetic batches
+    need an even size so that pairs don't straddle batches."""
+    if sampling_mode == util.ANTITHETIC_SAMPLING:
+        assert num_samples % 2 == 0, "Antithetic sampling needs an even number of samples"
+    if use_seed_for_randomness and not num_paths_per_return_batch:
+        num_paths_per_return_batch = 2 if sampling_mode == util.ANTITHETIC_SAMPLING else 1
+    if not use_seed_for_randomness and sampling_mode != util.INDEPENDENT_SAMPLING and \
+        not num_paths_per_return_batch:
+        num_paths_per_return_batch = num_samples
+    if sampling_mode == util.ANTITHETIC_SAMPLING and num_paths_per_return_batch % 2 == 1:
+        num_paths_per_return_batch += 1
+    return num_paths_per_return_batch
+
 def run_samples(investor,market,num_samples,outfilepath,output_queue=None,
                 verbosity=1,num_margin_trajectories_to_save_as_figures=10,
-                use_seed_for_randomness=True):
-    if use_seed_for_randomness:
-        randgenerator = Random("seedy character")
-    else:
-        randgenerator = None
-    account_values = dict()
-    account_types = ["regular", "margin", "matched401k"]
-    NUM_HISTORIES_TO_PLOT = 20
+                use_seed_for_randomness=True, num_paths_per_return_batch=None,
+                scenario_seed=random_streams.DEFAULT_SCENARIO_SEED, path_tape=None,
+                sampling_mode=util.INDEPENDENT_SAMPLING, use_control_variates=False,
+                use_batched_engine=False, use_compiled_kernel=None, num_workers=None,
+                exact_statistics=True, target_ratio_stderr=None, max_num_samples=None):
+    """If use_seed_for_randomness, sample number i draws from its own random
+    streams keyed by (scenario_seed, i), so its results don't depend on
+    the other samples. If num_paths_per_return_batch is set, the daily market
+    returns for that many samples at a time are drawn in one call to 
+    Market.random_daily_returns; this doesn't change seeded results.
+    If path_tape is given, returns and employment draws are read from it
+    instead; see PathTape.
+    sampling_mode chooses how the market return paths are sampled (see
+    Market.random_daily_returns); antithetic and stratified sampling give
+    smaller standard errors for the same num_samples. Only the market returns
+    are paired / stratified; employment draws stay independent.
+    If use_control_variates, the means of the ending balances and the ratio
+    of means sent to output_queue are estimated with control variates (see
+    control_variate_growth_factor), which gives much smaller standard errors
+    for the same num_samples. The results table reports both estimates.
+    If use_batched_engine, the samples are run BATCHED_ENGINE_PATHS_PER_BATCH
+    at a time by batched_runs instead of one at a time by one_run. That's much
+    faster, and the results are the same up to rounding, but it doesn't
+    harvest tax losses, it needs EtfLot.PARTIAL_SALES_REDUCE_BASIS (which is
+    off by default), and each batch's memory grows with the number of
+    purchases unless BatchedAccounts.AGGREGATE_LONG_TERM_LOTS (see there), so
+    it can't stand in for one_run in every scenario.
+    If use_compiled_kernel (by default, USE_COMPILED_KERNEL) and numba is
+    installed, seeded samples run one at a time are run by kernel_run, which
+    compiles one_run's loop, instead of by one_run, as long as
+    kernel_run_is_supported. Otherwise, or without numba, one_run runs them
+    as usual.
+    Seeded samples are split into shards of consecutive samples (see
+    sample_shards) that run on a pool of num_workers processes (one per
+    available core if None), and the shards' results are merged in order, so
+    the files written and the output sent to output_queue are the same
+    however many workers there are.
+    If exact_statistics, every sample's ending values are kept and the
+    statistics are computed from them (see ExactStatistics). Otherwise, they're
+    computed online in constant memory (see StreamingStatistics), which is
+    what runs of millions of samples need; means, standard errors and control
+    variate estimates are then the same up to rounding, and quantiles,
+    histograms and expected utilities are estimates.
+    Seeded results are cached (see run_sharded_samples), so running the same
+    run again loads them, and running it with more samples only runs the
+    samples that the cached run didn't, e.g., asking for 5000 samples after
+    1000 only runs the 4000 new ones.
+    If target_ratio_stderr is given (e.g., .01), num_samples is only the
+    number of samples to start with: the samples run in rounds, doubling
+    the number each round, until the standard errors of the ratio of means
+    and the ratio of E[sqrt(wealth)] sent to output_queue are both at most
+    target_ratio_stderr of the ratios (see ratios_are_precise_enough), or
+    until max_num_samples (by default, MAX_NUM_SAMPLES_PER_STARTING_SAMPLE
+    times num_samples) have run. The number of samples used is printed and
+    written in the results table. This needs seeded samples and isn't
+    supported with stratified sampling, whose strata depend on the number of
+    samples."""
+    if use_compiled_kernel is None:
+        use_compiled_kernel = USE_COMPILED_KERNEL
+    shard_kwargs = {"verbosity": verbosity,
+                    "num_margin_trajectories_to_save_as_figures": num_margin_trajectories_to_save_as_figures,
+                    "use_seed_for_randomness": use_seed_for_randomness,
+                    "num_paths_per_return_batch": num_paths_per_return_batch,
+                    "scenario_seed": scenario_seed, "path_tape": path_tape,
+                    "sampling_mode": sampling_mode, "use_batched_engine": use_batched_engine,
+                    "use_compiled_kernel": use_compiled_kernel, "exact_statistics": exact_statistics}
+    def write_merged_results(run_index, results):
+        write_sample_results(investor, market, outfilepath, results, output_queue,
+                             sampling_mode, use_control_variates, target_ratio_stderr)
+    is_precise_enough = None
+    if target_ratio_stderr is not None:
+        is_precise_enough = lambda run_index, results: ratios_are_precise_enough(
+            investor, market, results, target_ratio_stderr, sampling_mode, use_control_variates)
+        max_num_samples = max_num_samples or MAX_NUM_SAMPLES_PER_STARTING_SAMPLE * num_samples
+    run_sharded_samples([((investor,market,num_samples,outfilepath), shard_kwargs)], num_workers,
+                        write_merged_results, None, is_precise_enough, max_num_samples)
+
+def shard_alignment(num_samples, use_seed_for_randomness=True, num_paths_per_return_batch=None,
+                    sampling_mode=util.INDEPENDENT_SAMPLING, path_tape=None, use_batched_engine=False,
+                    exact_statistics=True, **other_shard_kwargs):
+    """Number of samples that every shard of a run_sample_shard run but the
+    last should be a multiple of, so that batches of samples drawn or run
+    together, and the pairs of samples that util.stderr compares for
+    antithetic and stratified sampling, aren't split. StreamingStatistics
+    keeps those pairs' statistics whatever the sampling mode, and can only
+    merge shards that start at even sample numbers. Unseeded samples draw from this process's random
+    state, which forked workers would all share, so they can't be split at all."""
+    if not use_seed_for_randomness:
+        return num_samples
+    alignment = 1
+    if not path_tape:
+        alignment = return_batch_size(num_paths_per_return_batch, use_seed_for_randomness,
+                                      sampling_mode, num_samples) or 1
+    if (sampling_mode != util.INDEPENDENT_SAMPLING or not exact_statistics) and alignment % 2 == 1:
+        alignment *= 2
+    if use_batched_engine:
+        alignment *= BATCHED_ENGINE_PATHS_PER_BATCH / fractions.gcd(alignment, BATCHED_ENGINE_PATHS_PER_BATCH)
+    return alignment
+
+def sample_shards(num_samples, num_workers, alignment=1, first_sample_to_run=0):
+    """Split the samples first_sample_to_run (a multiple of alignment)
+    through num_samples-1 into (first_sample, end_sample) shards of
+    consecutive samples: at least one per worker if there are enough
+    samples, with at most SAMPLES_PER_SHARD samples each (rounded up to a
+    multiple of alignment)."""
+    num_samples_to_run = num_samples - first_sample_to_run
+    samples_per_shard = min(SAMPLES_PER_SHARD, int(math.ceil(float(num_samples_to_run) / num_workers)))
+    samples_per_shard = max(1, int(math.ceil(float(samples_per_shard) / alignment))) * alignment
+    return [(first_sample, min(first_sample + samples_per_shard, num_samples))
+            for first_sample in xrange(first_sample_to_run, num_samples, samples_per_shard)]
+
+def stored_results_to_top_up(cache, parameters, num_samples, alignment, sampling_mode, outfilepath):
+    """(num_stored_samples, results) of the run in cache with these
+    parameters and the most samples fewer than num_samples that a run of
+    num_samples samples can start from, only running samples
+    num_stored_samples through num_samples-1 and merging their results into
+    these; or (0, None) if there isn't one. Seeded samples draw from their own
+    streams, so this gives the same results as running all num_samples (up
+    to the rounding of running sums and of StreamingStatistics), as long as
+    num_stored_samples is a multiple of alignment (see shard_alignment) and
+    a sample's draws don't depend on the number of samples, as they do with
+    stratified sampling."""
+    if sampling_mode not in SAMPLING_MODES_THAT_CAN_BE_TOPPED_UP:
+        return (0, None)
+    num_samples_stored = [num_stored_samples for num_stored_samples in cache.num_samples_stored(parameters)
+                          if num_stored_samples < num_samples and num_stored_samples % alignment == 0]
+    if not num_samples_stored:
+        return (0, None)
+    num_stored_samples = max(num_samples_stored)
+    print "Topping up {} cached samples to {} for {}".format(num_stored_samples, num_samples, outfilepath)
+    return (num_stored_samples, cache.load(parameters, num_stored_samples, outfilepath))
+
+def run_sharded_samples(runs, num_workers, on_result, checkpoints=None, is_precise_enough=None,
+                        max_num_samples=None):
+    """Split each of runs, given as the (args, shard_kwargs) for
+    run_sample_shard other than the range of samples, into shards, and run
+    all of them on one pool of num_workers processes (one per available core
+    if None). Once all of a run's shards are done, on_result(run_index,
+    results) is called with their merged SampleResults.
+    If checkpoints are given, each seeded shard's results are saved to them
+    as soon as it's done, and shards already saved by an earlier call with
+    the same arguments are loaded instead of run (see shard_checkpoint_key).
+    Once on_result returns for a run, its shards' checkpoints are removed,
+    so on_result should save what's needed to resume without the run (as
+    run_leverage_sweeps does).
+    Unless USE_RESULT_CACHE is False, each seeded run's merged results are
+    also saved to the result_cache, and a run whose results are already
+    there (see sample_run_parameters) isn't run at all; nor are the samples
+    of a run that a cached run of fewer samples already ran (see
+    stored_results_to_top_up).
+    If is_precise_enough is given, the runs' numbers of samples are only the
+    numbers to start with: they run in rounds, and after each round, the
+    runs for which is_precise_enough(run_index, results) is False, and that
+    have fewer than max_num_samples samples, go on to the next round with
+    twice as many samples (but at most max_num_samples), running only the
+    new ones. So each run gets about as many samples as it needs, and the
+    results of a run that stopped at n samples are the same as those of a
+    run of n samples. This needs seeded samples and a sampling mode in
+    SAMPLING_MODES_THAT_CAN_BE_TOPPED_UP."""
+    if num_workers is None:
+        num_workers = worker_pool.num_available_cores()
+    cache = result_cache()
+    runs = list(runs)
+    cache_parameters = [("run_samples",) + sample_run_parameters(*run)
+                        if cache and run[1].get("use_seed_for_randomness", True) else None for run in runs]
+    stored_results_by_run = [(0, None) for run in runs]
+    shard_checkpoint_keys_by_run = [[] for run in runs] # of every round
+    if is_precise_enough:
+        for (run_index, (args, shard_kwargs)) in enumerate(runs):
+            assert shard_kwargs.get("use_seed_for_randomness", True) and \
+                shard_kwargs.get("sampling_mode", util.INDEPENDENT_SAMPLING) in SAMPLING_MODES_THAT_CAN_BE_TOPPED_UP, \
+                "Runs can only be continued with more samples if they're seeded and not stratified"
+            (investor, market, num_samples, outfilepath) = args
+            runs[run_index] = ((investor, market, samples_to_reach(num_samples, shard_kwargs, max_num_samples),
+                                outfilepath), shard_kwargs)
+
+    run_indices_in_round = range(len(runs))
+    while run_indices_in_round:
+        run_indices_in_next_round = []
+        def finish_or_continue_run(run_index, results):
+            (args, shard_kwargs) = runs[run_index]
+            (investor, market, num_samples, outfilepath) = args
+            if is_precise_enough and num_samples < max_num_samples and not is_precise_enough(run_index, results):
+                next_num_samples = samples_to_reach(2*num_samples, shard_kwargs, max_num_samples)
+                if shard_kwargs.get("path_tape"):
+                    shard_kwargs = dict(shard_kwargs,
+                                        path_tape=shard_kwargs["path_tape"].with_at_least(next_num_samples))
+                runs[run_index] = ((investor, market, next_num_samples, outfilepath), shard_kwargs)
+                stored_results_by_run[run_index] = (num_samples, results)
+                run_indices_in_next_round.append(run_index)
+            else:
+                on_result(run_index, results)
+                for key in shard_checkpoint_keys_by_run[run_index]:
+                    checkpoints.remove(key)
+        run_round_of_sharded_samples(runs, run_indices_in_round, stored_results_by_run, num_workers,
+                                     finish_or_continue_run, checkpoints, cache, cache_parameters,
+                                     shard_checkpoint_keys_by_run)
+        if run_indices_in_next_round:
+            print "Running more samples for %i of %i runs" % (len(run_indices_in_next_round),
+                                                             len(run_indices_in_round))
+        run_indices_in_round = run_indices_in_next_round
+
+def samples_to_reach(num_samples, shard_kwargs, max_num_samples):
+    """num_samples rounded up to a multiple of shard_alignment, so that a run
+    can be continued from there, but at most max_num_samples"""
+    alignment = shard_alignment(num_samples, **shard_kwargs)
+    return min(max_num_samples, int(math.ceil(float(num_samples) / alignment)) * alignment)
+
+def run_round_of_sharded_samples(runs, run_indices, stored_results_by_run, num_workers, on_result,
+                                 checkpoints, cache, cache_parameters, shard_checkpoint_keys_by_run=None):
+    """Run the runs at run_indices (see run_sharded_samples), starting from
+    the (num_stored_samples, results) in stored_results_by_run if they have
+    any. The checkpoint keys of each run's shards are added to its list in
+    shard_checkpoint_keys_by_run, if given."""
+    shard_tasks = []
+    run_index_of_shard = []
+    shard_results_by_run = dict((run_index, dict()) for run_index in run_indices)
+    for run_index in run_indices:
+        (args, shard_kwargs) = runs[run_index]
+        (investor, market, num_samples, outfilepath) = args
+        alignment = shard_alignment(num_samples, **shard_kwargs)
+        (num_stored_samples, stored_results) = stored_results_by_run[run_index]
+        if cache_parameters[run_index]:
+            if cache.has(cache_parameters[run_index], num_samples):
+                print "Loading cached results for {}".format(outfilepath)
+                on_result(run_index, cache.load(cache_parameters[run_index], num_samples, outfilepath))
+                continue
+            if not stored_results:
+                (num_stored_samples, stored_results) = stored_results_to_top_up(cache,
+                    cache_parameters[run_index], num_samples, alignment,
+                    shard_kwargs.get("sampling_mode", util.INDEPENDENT_SAMPLING), outfilepath)
+        if stored_results:
+            shard_results_by_run[run_index][-1] = stored_results # merged before the shards
+        for (first_sample, end_sample) in sample_shards(num_samples, num_workers, alignment, num_stored_samples):
+            shard_tasks.append( (args, shard_kwargs, first_sample, end_sample) )
+            run_index_of_shard.append(run_index)
+    num_results_by_run = dict((run_index, run_index_of_shard.count(run_index) + len(shard_results_by_run[run_index]))
+                              for run_index in run_indices)
+
+    def merge_run_once_done(shard_index, shard_results):
+        run_index = run_index_of_shard[shard_index]
+        shard_results_by_run[run_index][shard_index] = shard_results
+        if len(shard_results_by_run[run_index]) == num_results_by_run[run_index]:
+            shard_indices = sorted(shard_results_by_run[run_index].keys())
+            results = shard_results_by_run[run_index][shard_indices[0]]
+            for shard_index in shard_indices[1:]:
+                results.merge(shard_results_by_run[run_index][shard_index])
+            shard_results_by_run[run_index] = None
+            if cache_parameters[run_index]:
+                (investor, market, num_samples, outfilepath) = runs[run_index][0]
+                cache.save(cache_parameters[run_index], num_samples, results, outfilepath,
+                           SAMPLE_PATH_FIGURE_SUFFIX_PATTERN)
+            on_result(run_index, results)
+
+    def is_checkpointed(shard_task):
+        """Unseeded samples draw from this process's random state, so they can't be resumed"""
+        (args, shard_kwargs, first_sample, end_sample) = shard_task
+        return checkpoints is not None and shard_kwargs.get("use_seed_for_randomness", True)
+
+    shard_checkpoint_keys = [shard_checkpoint_key(*shard_task) if is_checkpointed(shard_task) else None
+                             for shard_task in shard_tasks]
+    """Made before any shard runs, since shards run in this process (with one
+    worker) share its objects and could change them"""
+    if shard_checkpoint_keys_by_run is not None:
+        for (shard_index, key) in enumerate(shard_checkpoint_keys):
+            if key:
+                shard_checkpoint_keys_by_run[run_index_of_shard[shard_index]].append(key)
+
+    shard_indices_to_run = []
+    for (shard_index, shard_task) in enumerate(shard_tasks):
+        if shard_checkpoint_keys[shard_index] and checkpoints.has(shard_checkpoint_keys[shard_index]):
+            (scenario_seed, first_sample, end_sample, shard_results) = \
+                checkpoints.load(shard_checkpoint_keys[shard_index])
+            assert (first_sample, end_sample) == tuple(shard_task[2:]), "Checkpoint is for a different shard"
+            merge_run_once_done(shard_index, shard_results)
+        else:
+            shard_indices_to_run.append(shard_index)
+    if len(shard_indices_to_run) < len(shard_tasks):
+        print "Loaded %i of %i shards from checkpoints" % (len(shard_tasks)-len(shard_indices_to_run),
+                                                          len(shard_tasks))
+
+    def save_and_merge(task_index, shard_results):
+        shard_index = shard_indices_to_run[task_index]
+        (args, shard_kwargs, first_sample, end_sample) = shard_tasks[shard_index]
+        if shard_checkpoint_keys[shard_index]:
+            checkpoints.save(shard_checkpoint_keys[shard_index],
+                             (shard_kwargs.get("scenario_seed", random_streams.DEFAULT_SCENARIO_SEED),
+                              first_sample, end_sample, shard_results))
+        merge_run_once_done(shard_index, shard_results)
+
+    tasks_to_run = [shard_tasks[shard_index] for shard_index in shard_indices_to_run]
+    costs = [args[0].years_until_donate * (end_sample - first_sample)
+             for (args, shard_kwargs, first_sample, end_sample) in tasks_to_run]
+    log = progress_log()
+    if log and tasks_to_run:
+        log.scheduled(sum(end_sample - first_sample for (args, shard_kwargs, first_sample, end_sample)
+                          in tasks_to_run), len(tasks_to_run))
+    worker_pool.run_tasks(run_sample_shard_task, tasks_to_run, num_workers, costs, save_and_merge)
+
+def sample_run_parameters(args, shard_kwargs):
+    """Everything the results of a seeded run of run_samples with these
+    (args, shard_kwargs) (see run_sharded_samples) depend on, other than the
+    outfilepath, the number of samples and the code: all the Investor's
+    parameters (including its TaxRates and its leverage) and the Market's,
+    the seed, sampling mode and other settings that change the results, and
+    the module settings_that_change_results. The ones that don't, like the
+    path tape and the number of paths per return batch, are left out."""
+    (investor, market, num_samples, outfilepath) = args
+    return (util.object_parameters(investor), util.object_parameters(market),
+            shard_kwargs.get("scenario_seed", random_streams.DEFAULT_SCENARIO_SEED),
+            shard_kwargs.get("sampling_mode", util.INDEPENDENT_SAMPLING),
+            shard_kwargs.get("use_batched_engine", False), shard_kwargs.get("exact_statistics", True),
+            shard_kwargs.get("num_margin_trajectories_to_save_as_figures", 10),
+            settings_that_change_results())
+
+def settings_that_change_results():
+    """(name, value) of each module setting that changes the results of
+    runs. The code version (see ResultCache.code_version) only covers the
+    values they have in the source files, not values set at run time, e.g.,
+    by a test or a driver script."""
+    return (("EtfLot.PARTIAL_SALES_REDUCE_BASIS", EtfLot.PARTIAL_SALES_REDUCE_BASIS),
+            ("Assets.HARVEST_LOTS_WITH_LOSSES", Assets.HARVEST_LOTS_WITH_LOSSES),
+            ("Assets.LONG_TERM_BASIS_BUCKET_WIDTH", Assets.LONG_TERM_BASIS_BUCKET_WIDTH),
+            ("Assets.COMPACT_LOTS", Assets.COMPACT_LOTS),
+            ("SKIP_DAYS_WITHOUT_EVENTS", SKIP_DAYS_WITHOUT_EVENTS),
+            ("CALENDAR_START_YEAR", CALENDAR_START_YEAR),
+            ("BatchedAccounts.AGGREGATE_LONG_TERM_LOTS", BatchedAccounts.AGGREGATE_LONG_TERM_LOTS))
+
+def shard_checkpoint_key(args, shard_kwargs, first_sample, end_sample):
+    """Checkpoints.key of everything a run_sample_shard shard's results depend
+    on. Samples draw from streams keyed by (scenario_seed, sample number) (see
+    random_streams), so the seed and the range of samples pin down where in
+    them the shard starts and ends."""
+    return Checkpoints.key("shard", args[3], args[2], first_sample, end_sample,
+                           *sample_run_parameters(args, shard_kwargs))
+
+def run_sample_shard_task((args, shard_kwargs, first_sample, end_sample)):
+    return run_sample_shard(*args, first_sample=first_sample, end_sample=end_sample, **shard_kwargs)
+
+def run_sample_shard(investor, market, num_samples, outfilepath, first_sample, end_sample,
+                     verbosity=1, num_margin_trajectories_to_save_as_figures=10,
+                     use_seed_for_randomness=True, num_paths_per_return_batch=None,
+                     scenario_seed=random_streams.DEFAULT_SCENARIO_SEED, path_tape=None,
+                     sampling_mode=util.INDEPENDENT_SAMPLING, use_batched_engine=False,
+                     use_compiled_kernel=False, exact_statistics=True):
+    """Run samples first_sample through end_sample-1 of a run_samples run of
+    num_samples samples, with the same arguments, and return their
+    SampleResults. first_sample should be a multiple of shard_alignment.
+    If verbosity > 0, it prints how far along it is, but in a worker process
+    of a pool only if verbosity > 1, since the prints of all the workers
+    would be interleaved; their progress is in the progress_log."""
+    num_paths_per_return_batch = return_batch_size(num_paths_per_return_batch, use_seed_for_randomness,
+                                                   sampling_mode, num_samples)
+    if path_tape:
+        assert path_tape.num_paths >= num_samples, "Path tape doesn't have enough paths"
+        assert path_tape.sampling_mode == sampling_mode, "Path tape has a different sampling mode"
+        assert path_tape.scenario_seed == scenario_seed, "Path tape has a different seed"
+        if sampling_mode == util.STRATIFIED_SAMPLING:
+            assert path_tape.num_paths == num_samples, "Stratified path tape needs one path per sample"
+        num_paths_per_return_batch = None
+    randgenerator = None
+    lot_ordering_randgenerator = None
+    num_shard_samples = end_sample - first_sample
     PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE = sorted([.01, .1, .25, .5, .9])
-    margin_to_assets_ratio_histories = []
-    wealth_histories = []
-    carried_cap_gains_histories = []
-    margin_percent_differences_from_simple_calc_list = []
-    running_average_margin_to_assets_ratios = None
-    num_times_margin_ended_with_emergency_savings_gap = 0
-    num_times_margin_strategy_went_bankrupt = 0
-    prev_num_times_randgenerator_was_called = -9999 # junk
-    running_sum_simple_calc_ending_balance = 0
-    for type in account_types:
-        account_values[type] = []
+    results = SampleResults.SampleResults(TYPES, exact_statistics, max(0, NUM_HISTORIES_TO_PLOT - first_sample),
+                                          max(0, NUM_PERCENT_DIFFS_TO_PLOT - first_sample))
     num_margin_trajectories_to_save_as_figures = min(num_margin_trajectories_to_save_as_figures, 
                                                      num_samples) # save fewer figures if we don't have enough samples
 
+    days_in_each_batch = trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate)).trading_days
+    schedule = horizon_schedule(investor, market)
+    daily_returns = None
+
+    log = progress_log()
+    shard_progress = log.shard_progress(outfilepath,
+        util.max_margin_to_assets_ratio_to_N_to_1_leverage(investor.broker_max_margin_to_assets_ratio),
+        first_sample, end_sample) if log else None
+    print_progress = verbosity > 1 or (verbosity > 0 and not worker_pool.in_worker())
     start_time = time.time()
-    for sample in xrange(num_samples):
+    first_samples_of_batches = xrange(first_sample, end_sample, BATCHED_ENGINE_PATHS_PER_BATCH) \
+        if use_batched_engine else []
+    samples_to_run_one_at_a_time = [] if use_batched_engine else xrange(first_sample, end_sample)
+    use_kernel_run = use_compiled_kernel and path_kernel.HAVE_NUMBA and use_seed_for_randomness and \
+        kernel_run_is_supported(investor, verbosity)
+    for first_sample_of_batch in first_samples_of_batches:
+        num_paths_in_batch = min(BATCHED_ENGINE_PATHS_PER_BATCH, end_sample-first_sample_of_batch)
+        num_pay_days = len(schedule.annual_incomes_before_layoff_penalty)
+        if path_tape:
+            daily_returns_batch = path_tape.daily_returns_for_paths(first_sample_of_batch, num_paths_in_batch)
+            employment_draws = path_tape.employment_draws(first_sample_of_batch, num_paths_in_batch)
+        elif use_seed_for_randomness:
+            daily_returns_batch = random_streams.daily_returns_for_paths(market, days_in_each_batch,
+                scenario_seed, first_sample_of_batch, num_paths_in_batch, sampling_mode, num_samples)
+            employment_draws = random_streams.employment_draws_for_paths(scenario_seed, first_sample_of_batch,
+                                                                         num_paths_in_batch, num_pay_days)
+        else:
+            daily_returns_batch = market.random_daily_returns(num_paths_in_batch, days_in_each_batch, None,
+                sampling_mode, range(first_sample_of_batch, first_sample_of_batch+num_paths_in_batch), num_samples)
+            employment_draws = numpy.random.random_sample((num_paths_in_batch, num_pay_days))
+        lot_ordering_randgenerators = [random_streams.lot_ordering_generator(scenario_seed, sample)
+            for sample in xrange(first_sample_of_batch, first_sample_of_batch+num_paths_in_batch)] \
+            if use_seed_for_randomness else None
+        (regular_vals, margin_vals, matched_401k_vals, sum_of_margin_to_assets_ratios,
+         margin_to_assets_ratios_list, margin_wealth_list, carried_cap_gains_list,
+         margin_percent_differences_from_simple_calc_batch, margin_account_has_emergency_savings_gap,
+         margin_strategy_went_bankrupt, simple_calc_ending_balances, control_variates) = \
+             batched_runs(investor, market, verbosity, outfilepath, first_sample_of_batch,
+                 num_margin_trajectories_to_save_as_figures, daily_returns_batch, employment_draws,
+                 max(0, max(NUM_HISTORIES_TO_PLOT, num_margin_trajectories_to_save_as_figures) - first_sample_of_batch),
+                 lot_ordering_randgenerators, schedule)
+        results.add_batch((regular_vals, margin_vals, matched_401k_vals), control_variates,
+                          sum_of_margin_to_assets_ratios, margin_to_assets_ratios_list,
+                          margin_wealth_list, carried_cap_gains_list,
+                          margin_percent_differences_from_simple_calc_batch,
+                          margin_account_has_emergency_savings_gap, margin_strategy_went_bankrupt,
+                          simple_calc_ending_balances)
+        if shard_progress:
+            shard_progress.update(first_sample_of_batch+num_paths_in_batch-first_sample)
+        if print_progress:
+            print "%s%% done  " % int(round(100.0 * (first_sample_of_batch+num_paths_in_batch-first_sample)/num_shard_samples,0))
+    for sample in samples_to_run_one_at_a_time:
+        if num_paths_per_return_batch:
+            index_in_batch = sample % num_paths_per_return_batch
+            if index_in_batch == 0:
+                num_paths_in_batch = min(num_paths_per_return_batch, end_sample-sample)
+                if use_seed_for_randomness:
+                    daily_returns_batch = random_streams.daily_returns_for_paths(
+                        market, days_in_each_batch, scenario_seed, sample, num_paths_in_batch,
+                        sampling_mode, num_samples)
+                else:
+                    daily_returns_batch = market.random_daily_returns(num_paths_in_batch, 
+                        days_in_each_batch, None, sampling_mode, 
+                        range(sample, sample+num_paths_in_batch), num_samples)
+            daily_returns = daily_returns_batch[index_in_batch]
+        if path_tape:
+            daily_returns = path_tape.daily_returns(sample)
+            randgenerator = path_tape.employment_randgenerator(sample)
+        elif use_seed_for_randomness:
+            randgenerator = random_streams.employment_generator(scenario_seed, sample)
+        if use_seed_for_randomness:
+            lot_ordering_randgenerator = random_streams.lot_ordering_generator(scenario_seed, sample)
+        if use_kernel_run:
+            employment_draws = path_tape.employment_draws(sample, 1)[0] if path_tape else \
+                random_streams.employment_draws_for_paths(scenario_seed, sample, 1,
+                    len(schedule.annual_incomes_before_layoff_penalty))[0]
+            sample_results = kernel_run(investor, market, verbosity, outfilepath, sample,
+                num_margin_trajectories_to_save_as_figures, daily_returns, employment_draws,
+                lot_ordering_randgenerator, schedule)
+        else:
+            sample_results = one_run(investor,market,verbosity,outfilepath,sample, \
+                num_margin_trajectories_to_save_as_figures,randgenerator,daily_returns,
+                lot_ordering_randgenerator,schedule)
         (regular_val, margin_val, matched_401k_val, margin_to_assets_ratios, 
          margin_wealth, carried_cap_gains, margin_percent_differences_from_simple_calc, 
          margin_account_has_emergency_savings_gap,
-         margin_strategy_went_bankrupt, num_times_randgenerator_was_called,
-         simple_calc_ending_balance) = \
-             one_run(investor,market,verbosity,outfilepath,sample, \
-             num_margin_trajectories_to_save_as_figures,randgenerator)
-        if sample > 0:
-            assert prev_num_times_randgenerator_was_called == num_times_randgenerator_was_called, \
-                "All iterations should call randgenerator equal numbers of times."
-        prev_num_times_randgenerator_was_called = num_times_randgenerator_was_called
+         margin_strategy_went_bankrupt, simple_calc_ending_balance, control_variates) = sample_results
 
         """
         print "simple_calc_ending_balance = %s" % util.format_as_dollar_string(simple_calc_ending_balance)
         print "margin_val = %s" % util.format_as_dollar_string(margin_val)
         """
 
-        account_values["regular"].append(regular_val)
-        account_values["margin"].append(margin_val)
-        account_values["matched401k"].append(matched_401k_val)
-
-        if len(margin_to_assets_ratio_histories) < NUM_HISTORIES_TO_PLOT:
-            margin_to_assets_ratio_histories.append(margin_to_assets_ratios)
-        if len(wealth_histories) < NUM_HISTORIES_TO_PLOT:
-            wealth_histories.append(margin_wealth)
-        if len(carried_cap_gains_histories) < NUM_HISTORIES_TO_PLOT:
-            carried_cap_gains_histories.append(carried_cap_gains)
-        if len(margin_percent_differences_from_simple_calc_list) < NUM_PERCENT_DIFFS_TO_PLOT:
-            margin_percent_differences_from_simple_calc_list.append(margin_percent_differences_from_simple_calc)
-        running_sum_simple_calc_ending_balance += simple_calc_ending_balance
-        if running_average_margin_to_assets_ratios is None:
-            running_average_margin_to_assets_ratios = copy.copy(margin_to_assets_ratios)
-        else:
-            running_average_margin_to_assets_ratios += margin_to_assets_ratios
-        if margin_account_has_emergency_savings_gap:
-            num_times_margin_ended_with_emergency_savings_gap += 1
-        if margin_strategy_went_bankrupt:
-            num_times_margin_strategy_went_bankrupt += 1
+        results.add_sample((regular_val, margin_val, matched_401k_val), control_variates,
+                           margin_to_assets_ratios, margin_wealth, carried_cap_gains,
+                           margin_percent_differences_from_simple_calc,
+                           margin_account_has_emergency_savings_gap, margin_strategy_went_bankrupt,
+                           simple_calc_ending_balance)
+        if shard_progress:
+            shard_progress.update(sample+1-first_sample)
 
-        if verbosity > 0:
+        if print_progress:
             NUM_SAMPLES_FOR_TIMING = 10
-            if sample+1 == NUM_SAMPLES_FOR_TIMING:
+            if sample+1-first_sample == NUM_SAMPLES_FOR_TIMING:
                 stop_time = time.time()
-                samples_remaining_divided_by_samples_so_far = (num_samples-NUM_SAMPLES_FOR_TIMING)/NUM_SAMPLES_FOR_TIMING
+                samples_remaining_divided_by_samples_so_far = (num_shard_samples-NUM_SAMPLES_FOR_TIMING)/NUM_SAMPLES_FOR_TIMING
                 est_hours_to_complete_this_function = (stop_time-start_time)*samples_remaining_divided_by_samples_so_far/(60*60)
                 print "Estimated hours to complete this round = %f" % est_hours_to_complete_this_function
 
             if PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE:
-                iter_threshold_for_next_percent = PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE[0] * num_samples
-                if sample >= iter_threshold_for_next_percent:
-                    print "%s%% done  " % int(round(100.0 * sample/num_samples,0))
-                    while PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE and PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE[0] * num_samples <= sample:
+                iter_threshold_for_next_percent = PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE[0] * num_shard_samples
+                if sample-first_sample >= iter_threshold_for_next_percent:
+                    print "%s%% done  " % int(round(100.0 * (sample-first_sample)/num_shard_samples,0))
+                    while PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE and \
+                        PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE[0] * num_shard_samples <= sample-first_sample:
                         PRINT_PROGRESS_AFTER_THESE_PERCENTS_DONE.pop(0)
-    print ""
-
-    avg_margin_to_assets_ratios = running_average_margin_to_assets_ratios / num_samples
+    if shard_progress:
+        shard_progress.finish()
+    return results
+
+def control_variate_means_and_stderrs_by_type(investor, market, account_statistics,
+                                              sampling_mode=util.INDEPENDENT_SAMPLING):
+    """(mean, stderr) of each account type's ending value, estimated with
+    control variates; see run_samples"""
+    control_variate_means_and_stderrs = dict()
+    for (type, expected_control_variate_value) in zip(TYPES, 
+        expected_control_variate_values(investor, market, horizon_schedule(investor, market))):
+        control_variate_means_and_stderrs[type] = account_statistics[type].control_variate_mean_and_stderr(
+            expected_control_variate_value, sampling_mode)
+    return control_variate_means_and_stderrs
+
+def margin_vs_regular_output(investor, results, sampling_mode=util.INDEPENDENT_SAMPLING,
+                             control_variate_means_and_stderrs=None):
+    """What write_sample_results sends to its output_queue: (N_to_1_leverage,
+    ratio_of_means, ratio_of_means_error, ratio_of_medians, ratio_of_exp_util,
+    ratio_of_exp_util_error) of the margin account vs. the regular one. The
+    ratio of means uses control_variate_means_and_stderrs if given."""
+    regular_statistics = results.account_statistics["regular"]
+    margin_statistics = results.account_statistics["margin"]
+    if control_variate_means_and_stderrs:
+        (ratio_of_means, ratio_of_means_error) = util.ratio_with_error_bars(
+            *(control_variate_means_and_stderrs["margin"] + control_variate_means_and_stderrs["regular"]))
+    else:
+        (ratio_of_means, ratio_of_means_error) = util.ratio_with_error_bars(
+            margin_statistics.mean(), margin_statistics.stderr(sampling_mode),
+            regular_statistics.mean(), regular_statistics.stderr(sampling_mode))
+    ratio_of_medians = margin_statistics.median()/regular_statistics.median()
+    (ratio_of_exp_util, ratio_of_exp_util_error) = util.ratio_with_error_bars(
+        margin_statistics.sqrt_mean(), margin_statistics.sqrt_stderr(sampling_mode),
+        regular_statistics.sqrt_mean(), regular_statistics.sqrt_stderr(sampling_mode))
+    N_to_1_leverage = util.max_margin_to_assets_ratio_to_N_to_1_leverage(investor.broker_max_margin_to_assets_ratio)
+    assert N_to_1_leverage >= 1, "N_to_1_leverage is < 1"
+    return (N_to_1_leverage, ratio_of_means, ratio_of_means_error,
+            ratio_of_medians, ratio_of_exp_util, ratio_of_exp_util_error)
+
+def ratios_are_precise_enough(investor, market, results, target_ratio_stderr,
+                              sampling_mode=util.INDEPENDENT_SAMPLING, use_control_variates=False):
+    """Whether the standard errors of the ratio of means and of the ratio of
+    E[sqrt(wealth)] in margin_vs_regular_output are both at most
+    target_ratio_stderr as a fraction of the ratios"""
+    control_variate_means_and_stderrs = control_variate_means_and_stderrs_by_type(
+        investor, market, results.account_statistics, sampling_mode) if use_control_variates else None
+    (N_to_1_leverage, ratio_of_means, ratio_of_means_error, ratio_of_medians, ratio_of_exp_util,
+     ratio_of_exp_util_error) = margin_vs_regular_output(investor, results, sampling_mode,
+                                                         control_variate_means_and_stderrs)
+    return ratio_of_means_error <= target_ratio_stderr * abs(ratio_of_means) and \
+        ratio_of_exp_util_error <= target_ratio_stderr * abs(ratio_of_exp_util)
+
+def write_sample_results(investor, market, outfilepath, results, output_queue=None,
+                         sampling_mode=util.INDEPENDENT_SAMPLING, use_control_variates=False,
+                         target_ratio_stderr=None):
+    """Write the files for, and send to output_queue the output of, the
+    merged SampleResults of a run_samples run; see run_samples."""
+    num_samples = results.num_samples
+    account_statistics = results.account_statistics
+    account_types = TYPES
+    avg_margin_to_assets_ratios = results.sum_of_margin_to_assets_ratios / num_samples
+
+    regular_statistics = account_statistics["regular"]
+    margin_statistics = account_statistics["margin"]
+    control_variate_means_and_stderrs = None
+    if use_control_variates:
+        control_variate_means_and_stderrs = control_variate_means_and_stderrs_by_type(
+            investor, market, account_statistics, sampling_mode)
 
-    numpy_regular = numpy.array(account_values["regular"])
-    numpy_margin = numpy.array(account_values["margin"])
     if output_queue:
-        (ratio_of_means, ratio_of_means_error) = util.ratio_of_means_with_error_bars(
-            numpy_margin,numpy_regular)
-        ratio_of_medians = numpy.median(numpy_margin)/numpy.median(numpy_regular)
-        (ratio_of_exp_util, ratio_of_exp_util_error) = util.ratio_of_means_with_error_bars(
-            map(math.sqrt, numpy_margin), 
-            map(math.sqrt, numpy_regular))
-        N_to_1_leverage = util.max_margin_to_assets_ratio_to_N_to_1_leverage(investor.broker_max_margin_to_assets_ratio)
-        assert N_to_1_leverage >= 1, "N_to_1_leverage is < 1"
-        output_queue.put( (N_to_1_leverage, ratio_of_means, ratio_of_means_error,
-                           ratio_of_medians, ratio_of_exp_util, ratio_of_exp_util_error) )
+        output_queue.put(margin_vs_regular_output(investor, results, sampling_mode,
+                                                  control_variate_means_and_stderrs))
+    if target_ratio_stderr is not None:
+        print "Ran {:,} samples for {}".format(num_samples, outfilepath)
 
     if outfilepath:
         with open(write_results.results_table_file_name(outfilepath), "w") as outfile:
-            write_results.write_file_table(account_values, account_types, \
-                float(num_times_margin_strategy_went_bankrupt)/num_samples, outfile, \
-                fraction_times_margin_ended_with_emergency_savings_gap=float(num_times_margin_ended_with_emergency_savings_gap)/num_samples, \
-                avg_simple_calc_value=running_sum_simple_calc_ending_balance/num_samples)
+            write_results.write_file_table(account_statistics, account_types, \
+                float(results.num_times_margin_strategy_went_bankrupt)/num_samples, outfile, \
+                fraction_times_margin_ended_with_emergency_savings_gap=float(results.num_times_margin_ended_with_emergency_savings_gap)/num_samples, \
+                avg_simple_calc_value=results.sum_of_simple_calc_ending_balances/num_samples, \
+                sampling_mode=sampling_mode, \
+                control_variate_means_and_stderrs=control_variate_means_and_stderrs)
+            if target_ratio_stderr is not None:
+                write_results.write_num_samples_for_target_stderr(num_samples, target_ratio_stderr,
+                    ratios_are_precise_enough(investor, market, results, target_ratio_stderr,
+                                              sampling_mode, use_control_variates), outfile)
         with open(write_results.other_results_file_name(outfilepath), "w") as outfile:
-            write_results.write_means(account_values, investor.years_until_donate, outfile)
-            write_results.write_percentiles(account_values, outfile)
-            write_results.write_winner_for_each_percentile(account_values, outfile)
+            write_results.write_means(account_statistics, investor.years_until_donate, outfile)
+            write_results.write_percentiles(account_statistics, outfile)
+            write_results.write_winner_for_each_percentile(account_statistics, outfile)
         
-        plots.graph_histograms(account_values, num_samples, outfilepath)
-        plots.graph_expected_utility_vs_alpha(numpy_regular, numpy_margin, outfilepath)
-        plots.graph_expected_utility_vs_wealth_saturation_cutoff(numpy_regular, numpy_margin, outfilepath, 4, 7)
-        plots.graph_historical_margin_to_assets_ratios(margin_to_assets_ratio_histories, 
+        plots.graph_histograms(account_statistics, num_samples, outfilepath)
+        plots.graph_expected_utility_vs_alpha(regular_statistics, margin_statistics, outfilepath)
+        plots.graph_expected_utility_vs_wealth_saturation_cutoff(regular_statistics, margin_statistics, outfilepath, 4, 7)
+        plots.graph_historical_margin_to_assets_ratios(results.margin_to_assets_ratio_histories, 
                                                        avg_margin_to_assets_ratios, outfilepath)
-        plots.graph_historical_wealth_trajectories(wealth_histories, outfilepath)
-        plots.graph_carried_cap_gains_trajectories(carried_cap_gains_histories, outfilepath)
+        plots.graph_historical_wealth_trajectories(results.wealth_histories, outfilepath)
+        plots.graph_carried_cap_gains_trajectories(results.carried_cap_gains_histories, outfilepath)
         plots.graph_percent_differences_from_simple_calc(
-            margin_percent_differences_from_simple_calc_list, outfilepath)
-    
-    print "randgenerator called %i times. Check that this is equal across variants!" % \
-        num_times_randgenerator_was_called
+            results.margin_percent_differences_from_simple_calc_list, outfilepath)
+
     # TODO: return (mean_%_better, median%better)
 
 def args_for_this_scenario(scenario_name, num_trials, outdir_name):
@@ -736,7 +2111,33 @@ def args_for_this_scenario(scenario_name, num_trials, outdir_name):
     else:
         raise Exception(scenario_name + " is not a known scenario type.")
 
-def sweep_scenarios(approx_num_simultaneous_processes, num_trials):
+def use_batched_engine_for(scenario_name):
+    return SCENARIOS[scenario_name] in SCENARIOS_FOR_BATCHED_ENGINE
+
+def run_sample_shard_kwargs(scenario_name, path_tape):
+    return {"path_tape": path_tape, "sampling_mode": SAMPLING_MODE, 
+            "use_batched_engine": use_batched_engine_for(scenario_name),
+            "use_compiled_kernel": USE_COMPILED_KERNEL, "exact_statistics": EXACT_STATISTICS}
+
+def write_sweep_results(run, results, output_queue=None):
+    """write_sample_results for one of the (args, shard_kwargs) runs of a sweep"""
+    (investor, market, num_trials, outpath) = run[0]
+    write_sample_results(investor, market, outpath, results, output_queue,
+                         SAMPLING_MODE, USE_CONTROL_VARIATES, TARGET_RATIO_STDERR)
+
+def run_sweep_samples(runs, num_workers, on_result, checkpoints=None):
+    """run_sharded_samples for the (args, shard_kwargs) runs of a sweep, which
+    run until they reach TARGET_RATIO_STDERR, if it's set, as in run_samples"""
+    is_precise_enough = None
+    max_num_samples = None
+    if TARGET_RATIO_STDERR is not None:
+        is_precise_enough = lambda run_index, results: ratios_are_precise_enough(
+            runs[run_index][0][0], runs[run_index][0][1], results, TARGET_RATIO_STDERR,
+            SAMPLING_MODE, USE_CONTROL_VARIATES)
+        max_num_samples = MAX_NUM_SAMPLES_PER_STARTING_SAMPLE * max([args[2] for (args, shard_kwargs) in runs] or [0])
+    run_sharded_samples(runs, num_workers, on_result, checkpoints, is_precise_enough, max_num_samples)
+
+def sweep_scenarios(num_workers, num_trials):
     """Sweep all the scenarios! (http://knowyourmeme.com/memes/x-all-the-y)"""
     outdir_name = util.create_timestamped_dir("swp") # concise way of writing "sweep scenarios"
 
@@ -744,32 +2145,14 @@ def sweep_scenarios(approx_num_simultaneous_processes, num_trials):
     scenarios_to_run = SCENARIOS.keys()
 
     # Run scenarios
-    processes = []
-    process_num = 1
+    runs = []
     for scenario in scenarios_to_run:
         print "\n\n" + scenario
-        p = Process(target=run_samples,
-                    args=args_for_this_scenario(scenario,num_trials,outdir_name))
-        p.start()
-        if enough_processes_running(process_num,approx_num_simultaneous_processes):
-            p.join()
-        processes.append(p)
-        process_num += 1
-
-    # Wait for all processes to finish
-    for process in processes:
-        process.join()
-
-def enough_processes_running(process_num, approx_num_simultaneous_processes):
-    """This is a hacky method to control the number of processes. The actual
-    number of simultaneous processes can be anywhere from 1 to
-    2 * approx_num_simultaneous_processes - 1. For example, if
-    approx_num_simultaneous_processes == 3, then we run the first
-    3 processes. If the third one finishes last, we wait for it, and while
-    it's running, there's just 1 process. If the third one finishes first,
-    we let another 3 processes go before joining again, so there are 5
-    running at that point."""
-    return process_num % approx_num_simultaneous_processes == 0
+        args = args_for_this_scenario(scenario,num_trials,outdir_name)
+        path_tape = path_tape_for(args[0], args[1], num_trials, os.getcwd())
+        runs.append( (args, run_sample_shard_kwargs(scenario, path_tape)) )
+    run_sweep_samples(runs, num_workers,
+                      lambda run_index, results: write_sweep_results(runs[run_index], results))
 
 def dir_prefix_for_optimal_leverage_specific_scenario(scenario_name):
     # sclev is short for "scenario-specific optimal leverage graph"
@@ -781,27 +2164,45 @@ def file_prefix_for_optimal_leverage_specific_scenario(max_margin_to_assets):
 
 def get_performance_vs_leverage_amount_by_scenario(scenario_name, num_trials, 
                                                    use_timestamped_dirs, cur_working_dir, 
-                                                   approx_num_simultaneous_processes,
+                                                   num_workers=None,
                                                    leverage_amounts_to_try=[1.0,1.5,2.0,2.5,3.0,4.0]):
+    checkpoints = checkpoints_for(cur_working_dir)
+    sweep = leverage_sweep(scenario_name, num_trials, use_timestamped_dirs, cur_working_dir,
+                           leverage_amounts_to_try, checkpoints)
+    run_leverage_sweeps([sweep], num_workers, checkpoints)
+
+def leverage_sweep(scenario_name, num_trials, use_timestamped_dirs, cur_working_dir,
+                   leverage_amounts_to_try=[1.0,1.5,2.0,2.5,3.0,4.0], checkpoints=None):
+    """Make the output directory for a scenario's sweep over leverage amounts
+    and return it along with the (args, shard_kwargs) for
+    run_sharded_samples of a run per leverage amount. If checkpoints are
+    given and have a directory for the same sweep from an earlier call that
+    didn't finish, that directory is used again so that the sweep resumes
+    there."""
     print "\n\n==Getting optimal leverage for scenario = {}==".format(scenario_name)
 
-    output_queue = Queue() # multiprocessing queue
-
     dir_prefix = dir_prefix_for_optimal_leverage_specific_scenario(scenario_name)
     dir = path.join(cur_working_dir, dir_prefix)
-    if use_timestamped_dirs:
+    sweep_key = Checkpoints.key("sweep", scenario_name, num_trials, use_timestamped_dirs, cur_working_dir,
+                                leverage_amounts_to_try)
+    if checkpoints and checkpoints.has(sweep_key) and path.isdir(checkpoints.load(sweep_key)):
+        outdir_name = checkpoints.load(sweep_key)
+        print "Resuming in {}".format(outdir_name)
+    elif use_timestamped_dirs:
         outdir_name = util.create_timestamped_dir(dir)
     else:
         outdir_name = dir
         os.mkdir(outdir_name) # let it fail if already exists
+    if checkpoints:
+        checkpoints.save(sweep_key, outdir_name)
+        checkpoints.save(sweep_dir_checkpoint_key(outdir_name), sweep_key) # to remove it once done
     
     """
     ONLY USE THIS IF CALCULATING WHICH LEVERAGE VALUES TO TRY BASED ON A RANGE AND STEP SIZE:
     assert range_stop >= range_start, "Stopping range value must be at least as big as starting range value."
     num_steps = int((range_stop-range_start)/step_size)+1
     """
-    processes = []
-    process_num = 1
+    runs = []
     #for N_to_1_leverage in numpy.linspace(range_start, range_stop, num_steps):
     for N_to_1_leverage in leverage_amounts_to_try:
         max_margin_to_assets = util.N_to_1_leverage_to_max_margin_to_assets_ratio(N_to_1_leverage)
@@ -814,25 +2215,261 @@ def get_performance_vs_leverage_amount_by_scenario(scenario_name, num_trials,
         market = args[1]
 
         outpath = path.join(outdir_name, file_prefix_for_optimal_leverage_specific_scenario(max_margin_to_assets))
-        p = Process(target=run_samples, 
-                args=(investor,market,num_trials,outpath,output_queue))
-        p.start()
-        if enough_processes_running(process_num,approx_num_simultaneous_processes):
-            p.join()
-        processes.append(p)
-        process_num += 1
-    
-    # Wait for all processes to finish
-    for process in processes:
-        process.join()
-
-    # Once they're done, plot them
-    plots.graph_trends_vs_leverage_amount(output_queue, outdir_name)
+        path_tape = path_tape_for(investor, market, num_trials, cur_working_dir)
+        """Leverage levels (and other scenarios with the same market and horizon)
+        share one tape, so they're compared on exactly the same return paths.
+        It's made here rather than on the workers so that no two of them
+        write the same tape at once."""
+        runs.append( ((investor,market,num_trials,outpath), 
+                      run_sample_shard_kwargs(scenario_name, path_tape)) )
+    return (outdir_name, runs)
+
+def run_checkpoint_key(run):
+    """Checkpoints.key of everything the output that write_sweep_results sends
+    to its output_queue for one of the (args, shard_kwargs) runs of a sweep
+    depends on"""
+    (args, shard_kwargs) = run
+    return Checkpoints.key("run", shard_checkpoint_key(args, shard_kwargs, 0, args[2]),
+                           USE_CONTROL_VARIATES, TARGET_RATIO_STDERR, MAX_NUM_SAMPLES_PER_STARTING_SAMPLE)
+
+def sweep_dir_checkpoint_key(outdir_name):
+    """Checkpoints.key under which leverage_sweep saves the key of the sweep
+    whose output directory is outdir_name"""
+    return Checkpoints.key("sweep dir", outdir_name)
+
+def run_leverage_sweeps(sweeps, num_workers, checkpoints=None):
+    """Run the runs of all the (outdir_name, runs) sweeps from leverage_sweep,
+    split into sample shards, on one pool of workers, so that workers go on
+    to other runs' shards while the last of a run's or a scenario's shards
+    are still running. Each run's results are written as soon as all its
+    shards are done, and each scenario's graphs vs. leverage amount as soon
+    as all its leverage amounts are.
+
+    Each run's output for the graphs vs. leverage amount is kept as a record,
+    which the graphs are made from. If checkpoints are given, the records
+    are saved to them, as are the shards' results (see run_sharded_samples),
+    so that if the sweeps are stopped, running them again with the same
+    arguments skips the runs and shards that already finished. Once all the
+    sweeps are done, their checkpoints are removed, so running them again
+    starts new sweeps rather than resuming these (and, without timestamped
+    directories, fails because their directories already exist)."""
+    runs = []
+    sweep_num_of_run = []
+    run_indices_by_sweep = []
+    for (sweep_num, (outdir_name, sweep_runs)) in enumerate(sweeps):
+        run_indices_by_sweep.append(range(len(runs), len(runs) + len(sweep_runs)))
+        runs.extend(sweep_runs)
+        sweep_num_of_run.extend([sweep_num] * len(sweep_runs))
+    run_keys = [run_checkpoint_key(run) for run in runs] # before any run changes its objects
+    records = dict() # by run_checkpoint_key, if there are no checkpoints to save them to
+    def save_record(run_index, output_tuple):
+        if checkpoints:
+            checkpoints.save(run_keys[run_index], output_tuple)
+        else:
+            records[run_keys[run_index]] = output_tuple
+    def load_record(run_index):
+        return checkpoints.load(run_keys[run_index]) if checkpoints else records[run_keys[run_index]]
+
+    num_runs_left_by_sweep = [len(sweep_runs) for (outdir_name, sweep_runs) in sweeps]
+    def plot_sweep_once_done(run_index):
+        sweep_num = sweep_num_of_run[run_index]
+        num_runs_left_by_sweep[sweep_num] -= 1
+        if num_runs_left_by_sweep[sweep_num] == 0:
+            (outdir_name, sweep_runs) = sweeps[sweep_num]
+            plots.graph_trends_vs_leverage_amount([load_record(run_index_in_sweep) for run_index_in_sweep
+                                                   in run_indices_by_sweep[sweep_num]], outdir_name)
+
+    run_indices_to_run = []
+    for (run_index, run) in enumerate(runs):
+        if checkpoints and checkpoints.has(run_keys[run_index]):
+            print "Already finished {}".format(run[0][3])
+            plot_sweep_once_done(run_index)
+        else:
+            run_indices_to_run.append(run_index)
+
+    def write_results_and_plot_sweep_once_done(index_to_run, results):
+        run_index = run_indices_to_run[index_to_run]
+        output_queue = Queue.Queue()
+        write_sweep_results(runs[run_index], results, output_queue)
+        save_record(run_index, output_queue.get())
+        plot_sweep_once_done(run_index)
+
+    run_sweep_samples([runs[run_index] for run_index in run_indices_to_run], num_workers,
+                      write_results_and_plot_sweep_once_done, checkpoints)
+
+    if checkpoints:
+        for run_key in run_keys:
+            checkpoints.remove(run_key)
+        for (outdir_name, sweep_runs) in sweeps:
+            sweep_dir_key = sweep_dir_checkpoint_key(outdir_name)
+            if checkpoints.has(sweep_dir_key):
+                checkpoints.remove(checkpoints.load(sweep_dir_key))
+                checkpoints.remove(sweep_dir_key)
+
+def sweep_run_output(run, results):
+    """What write_sweep_results sends to its output_queue for one of the
+    (args, shard_kwargs) runs of a sweep"""
+    (investor, market, num_trials, outpath) = run[0]
+    control_variate_means_and_stderrs = control_variate_means_and_stderrs_by_type(
+        investor, market, results.account_statistics, SAMPLING_MODE) if USE_CONTROL_VARIATES else None
+    return margin_vs_regular_output(investor, results, SAMPLING_MODE, control_variate_means_and_stderrs)
+
+def leverage_search_objective(output_tuple, objective):
+    """(value, stderr or None) of objective (EXP_UTIL_OBJECTIVE or
+    MEDIAN_OBJECTIVE) in a margin_vs_regular_output"""
+    (N_to_1_leverage, ratio_of_means, ratio_of_means_error,
+     ratio_of_medians, ratio_of_exp_util, ratio_of_exp_util_error) = output_tuple
+    if objective == MEDIAN_OBJECTIVE:
+        return (ratio_of_medians, None) # medians don't have standard errors
+    assert objective == EXP_UTIL_OBJECTIVE, "Unknown objective %s" % objective
+    return (ratio_of_exp_util, ratio_of_exp_util_error)
+
+def objective_difference_stderr(results, best_results, objective):
+    """Standard error of the difference between objective's values for the
+    results of runs of the same samples at two leverage amounts, or None for
+    MEDIAN_OBJECTIVE. The regular accounts are the same in both runs, so the
+    difference is in the margin accounts' E[sqrt(wealth)], compared path by
+    path if the statistics allow (see sqrt_difference_stderr)."""
+    if objective == MEDIAN_OBJECTIVE:
+        return None
+    return results.account_statistics["margin"].sqrt_difference_stderr(
+        best_results.account_statistics["margin"], SAMPLING_MODE) / \
+        best_results.account_statistics["regular"].sqrt_mean()
+
+def leverage_could_be_optimal(value, best_value, difference_stderr):
+    """Whether a leverage amount's value of the objective isn't significantly
+    (by LEVERAGE_SEARCH_CONFIDENCE_Z standard errors of the difference) below
+    the best one's. Without a standard error, only the best one could be."""
+    if difference_stderr is None:
+        return value >= best_value
+    return value + LEVERAGE_SEARCH_CONFIDENCE_Z * difference_stderr >= best_value
+
+def search_for_optimal_leverage(scenario_name, num_trials, use_timestamped_dirs, cur_working_dir,
+                                num_workers=None, min_leverage=1.0, max_leverage=4.0,
+                                num_leverage_amounts=9, objective=EXP_UTIL_OBJECTIVE,
+                                leverage_amounts_to_keep=()):
+    """Find the N:1 leverage between min_leverage and max_leverage that
+    maximizes objective (EXP_UTIL_OBJECTIVE or MEDIAN_OBJECTIVE) for a
+    scenario, running a fraction of the samples that a leverage_sweep of as
+    many leverage amounts with num_trials samples each would.
+
+    The range is split into num_leverage_amounts evenly spaced leverage
+    amounts, which are narrowed down by successive halving: in each round,
+    the amounts still in the search run twice as many samples as in the
+    round before (only the new ones, as in run_sharded_samples), up to
+    num_trials in the last round, and only the better half go on, less any
+    that are significantly worse than the best (see
+    leverage_could_be_optimal). So most samples go to the leverage amounts
+    that could be the best. Every amount runs the same seeded samples on the
+    same path tape, so they're compared on the same return paths and
+    employment histories (common random numbers), and which is better
+    depends on the leverage rather than on the luck of the draw. Leverage
+    amounts in leverage_amounts_to_keep always go on to the next round, so
+    their results have all num_trials samples, e.g., for a report of the
+    results at the default leverage.
+
+    Each leverage amount's results are written once it leaves the search,
+    the rounds to LEVERAGE_SEARCH_FILE_NAME, and the graphs vs. leverage
+    amount from the last results of each. Returns (the best N_to_1_leverage,
+    (low, high) the range of leverage amounts that weren't significantly
+    worse than the best in the last round they ran in, widened by half the
+    spacing between amounts, the objective's value at the best amount and
+    its standard error or None)."""
+    if num_workers is None:
+        num_workers = worker_pool.num_available_cores()
+    leverage_amounts = list(numpy.linspace(min_leverage, max_leverage, num_leverage_amounts))
+    (outdir_name, runs) = leverage_sweep(scenario_name, num_trials, use_timestamped_dirs, cur_working_dir,
+                                         leverage_amounts)
+    for (args, shard_kwargs) in runs:
+        assert shard_kwargs.get("use_seed_for_randomness", True) and \
+            shard_kwargs.get("sampling_mode", util.INDEPENDENT_SAMPLING) in SAMPLING_MODES_THAT_CAN_BE_TOPPED_UP, \
+            "The search continues runs with more samples, so they have to be seeded and not stratified"
+    cache = result_cache()
+    cache_parameters = [("run_samples",) + sample_run_parameters(*run) if cache else None for run in runs]
+    stored_results_by_run = [(0, None) for run in runs]
+    output_by_run = [None] * len(runs)
+    could_be_optimal_by_run = [True] * len(runs) # vs. the best in the last round each ran in
+    num_samples_run = 0
+
+    num_rounds = int(math.ceil(math.log(num_leverage_amounts, 2)))
+    num_samples = float(num_trials) / 2**num_rounds
+    run_indices_in_search = range(len(runs))
+    with open(path.join(outdir_name, LEVERAGE_SEARCH_FILE_NAME), "w") as outfile:
+        while True:
+            for run_index in run_indices_in_search:
+                ((investor, market, num_samples_in_last_round, outpath), shard_kwargs) = runs[run_index]
+                runs[run_index] = ((investor, market,
+                                    samples_to_reach(max(1, int(num_samples)), shard_kwargs, num_trials), outpath),
+                                   shard_kwargs)
+                num_samples_run += runs[run_index][0][2] - stored_results_by_run[run_index][0]
+            def store_results(run_index, results):
+                stored_results_by_run[run_index] = (runs[run_index][0][2], results)
+                output_by_run[run_index] = sweep_run_output(runs[run_index], results)
+            run_round_of_sharded_samples(runs, run_indices_in_search, stored_results_by_run, num_workers,
+                                         store_results, None, cache, cache_parameters)
+
+            objectives = dict((run_index, leverage_search_objective(output_by_run[run_index], objective))
+                              for run_index in run_indices_in_search)
+            write_results.write_leverage_search_round(runs[run_indices_in_search[0]][0][2], objective,
+                [(leverage_amounts[run_index],) + objectives[run_index] for run_index in run_indices_in_search],
+                outfile)
+            ranked_run_indices = sorted(run_indices_in_search, key=lambda run_index: objectives[run_index][0],
+                                        reverse=True)
+            best_run_index = ranked_run_indices[0]
+            for run_index in run_indices_in_search:
+                could_be_optimal_by_run[run_index] = leverage_could_be_optimal(objectives[run_index][0],
+                    objectives[best_run_index][0], objective_difference_stderr(
+                        stored_results_by_run[run_index][1], stored_results_by_run[best_run_index][1], objective))
+            if runs[best_run_index][0][2] >= num_trials:
+                break
+            run_indices_in_next_round = [run_index for run_index in
+                                         ranked_run_indices[:int(math.ceil(len(ranked_run_indices)/2.0))]
+                                         if objective == MEDIAN_OBJECTIVE or could_be_optimal_by_run[run_index]]
+            run_indices_in_next_round += [run_index for run_index in run_indices_in_search
+                                          if run_index not in run_indices_in_next_round and
+                                          leverage_amounts[run_index] in leverage_amounts_to_keep]
+            for run_index in run_indices_in_search:
+                if run_index not in run_indices_in_next_round:
+                    write_sweep_results(runs[run_index], stored_results_by_run[run_index][1])
+            print "{} of {} leverage amounts go on to the next round".format(len(run_indices_in_next_round),
+                                                                            len(run_indices_in_search))
+            run_indices_in_search = sorted(run_indices_in_next_round)
+            num_samples *= 2
+        for run_index in run_indices_in_search:
+            write_sweep_results(runs[run_index], stored_results_by_run[run_index][1])
+
+        leverage_amounts_that_could_be_optimal = [leverage_amounts[run_index] for run_index in range(len(runs))
+                                                  if could_be_optimal_by_run[run_index]]
+        half_spacing = (max_leverage - min_leverage) / max(1, num_leverage_amounts-1) / 2.0
+        interval = (max(min_leverage, min(leverage_amounts_that_could_be_optimal) - half_spacing),
+                    min(max_leverage, max(leverage_amounts_that_could_be_optimal) + half_spacing))
+        write_results.write_optimal_leverage(leverage_amounts[best_run_index], interval, objective,
+                                             objectives[best_run_index][0], objectives[best_run_index][1],
+                                             num_samples_run, num_leverage_amounts * num_trials, outfile)
+    plots.graph_trends_vs_leverage_amount(output_by_run, outdir_name)
+    return (leverage_amounts[best_run_index], interval) + objectives[best_run_index]
 
 def optimal_leverage_for_all_scenarios(num_trials, use_timestamped_dirs, cur_working_dir,
-                                       approx_num_simultaneous_processes):
+                                       num_workers=None, search=None):
     """Get graphs of optimal leverage over all scenarios. This may take days/weeks to 
-    finish running!"""
+    finish running! The shards of the (scenario, leverage amount) runs all share
+    one pool of num_workers processes (by default, one per available core).
+    Finished shards and runs are checkpointed under cur_working_dir (see
+    run_leverage_sweeps), so if this is stopped, calling it again with the
+    same arguments resumes where it left off. If TARGET_RATIO_STDERR is set,
+    num_trials is only where each (scenario, leverage amount) run starts,
+    and each runs until its ratios are that precise (see run_samples), so
+    runs that converge quickly don't take samples from those that don't.
+    If search (by default, SEARCH_FOR_OPTIMAL_LEVERAGE), the scenarios that
+    would be swept over the grid of leverage amounts are instead searched one
+    after another by search_for_optimal_leverage, over
+    LEVERAGE_SEARCH_NUM_AMOUNTS amounts, which runs far fewer samples. The
+    default leverage is kept to the end, so its results have all num_trials
+    samples, as with the grid. Searches aren't checkpointed, but a stopped
+    one that's run again loads the rounds it finished from the result
+    cache."""
+    if search is None:
+        search = SEARCH_FOR_OPTIMAL_LEVERAGE
     scenarios_not_to_sweep = ["closetotheoryminus%i" % i for i in [2,3,4,5,6]]
     scenarios_not_to_sweep.append("sig0")
     scenarios_not_to_sweep.append("persmaxbrokermax")
@@ -841,21 +2478,31 @@ def optimal_leverage_for_all_scenarios(num_trials, use_timestamped_dirs, cur_wor
     #scenarios_not_to_sweep.append("closetotheoryminus7")# comment out later
     #scenarios_not_to_sweep.append("emergsav1m")# comment out later
     #scenarios_not_to_sweep.append("yrs5")# comment out later
+    checkpoints = checkpoints_for(cur_working_dir)
+    default_investor = Investor.Investor()
+    default_leverage = util.max_margin_to_assets_ratio_to_N_to_1_leverage(default_investor.broker_max_margin_to_assets_ratio)
+    sweeps = []
+    scenarios_to_search = []
     for scenario_name in SCENARIOS.keys():
         if SCENARIOS[scenario_name] in scenarios_not_to_sweep: # skip them to speed up computing
             """In this case, only get results for the default margin-to-assets setting
             because we don't actually care about sensitivity analysis here."""
-            default_investor = Investor.Investor()
-            default_leverage = util.max_margin_to_assets_ratio_to_N_to_1_leverage(default_investor.broker_max_margin_to_assets_ratio)
-            get_performance_vs_leverage_amount_by_scenario(scenario_name,num_trials,
-                                                           use_timestamped_dirs,cur_working_dir,
-                                                           approx_num_simultaneous_processes,
-                                                           leverage_amounts_to_try=[default_leverage])
+            sweeps.append(leverage_sweep(scenario_name,num_trials,
+                                         use_timestamped_dirs,cur_working_dir,
+                                         leverage_amounts_to_try=[default_leverage],
+                                         checkpoints=checkpoints))
+        elif search:
+            scenarios_to_search.append(scenario_name)
         else:
             """Use default range for the param sweep."""
-            get_performance_vs_leverage_amount_by_scenario(scenario_name,num_trials,
-                                                           use_timestamped_dirs,cur_working_dir,
-                                                           approx_num_simultaneous_processes)
+            sweeps.append(leverage_sweep(scenario_name,num_trials,
+                                         use_timestamped_dirs,cur_working_dir,
+                                         checkpoints=checkpoints))
+    run_leverage_sweeps(sweeps, num_workers, checkpoints)
+    for scenario_name in scenarios_to_search:
+        search_for_optimal_leverage(scenario_name, num_trials, use_timestamped_dirs, cur_working_dir,
+                                    num_workers, num_leverage_amounts=LEVERAGE_SEARCH_NUM_AMOUNTS,
+                                    leverage_amounts_to_keep=[default_leverage])
 
 def run_one_variant(num_trials):
     outdir_name = util.create_timestamped_dir("one") # concise way of writing "one variant"
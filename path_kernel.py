@@ -0,0 +1,690 @@
+import numpy
+from BrokerageAccount import EPSILON, FEE_PER_DOLLAR_TRADED, MIN_ADDITIONAL_PURCHASE_AMOUNT
+from EtfLot import DAYS_PER_YEAR
+from LotGroup import SAME_BASIS_PER_SHARE_TOLERANCE
+from Taxes import MAX_CAPITAL_LOSS_DEDUCTION_PER_YEAR
+
+"""margin_leverage.one_run's daily and monthly state machine for one sample
+path, written over plain numpy arrays and scalars so that numba can compile
+it. numba is optional: if it's installed, the functions here are compiled
+with numba.njit the first time they're called, and the machine code is cached
+on disk (in __pycache__ next to this file, or in NUMBA_CACHE_DIR if that's set),
+so later processes, like the workers that sweep scenarios, load it instead of
+compiling again. Without numba, the functions are plain Python, which is much
+slower than one_run, so margin_leverage only uses them if HAVE_NUMBA.
+
+The margin account's lots are kept the same way Assets keeps them: a price
+index, running totals of shares and cost basis, and short- and long-term
+groups of lots sorted by basis per share that sell and merge lots like
+LotGroup does.
+So sales pick the same lots in the same order as one_run, and results agree
+with one_run's up to rounding; see margin_leverage.compare_kernel_runs_with_one_run.
+The regular and matched 401k accounts never sell, so only their totals are kept.
+
+Things that print in one_run are recorded as events instead, which
+margin_leverage.kernel_run prints afterward in the same order."""
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+def jit(function):
+    if HAVE_NUMBA:
+        return numba.njit(cache=True)(function)
+    return function
+
+REGULAR = 0
+MARGIN = 1
+MATCHED_401K = 2
+"""Indices of the account types, in the order of margin_leverage.TYPES"""
+
+SHORT_TERM = 0
+LONG_TERM = 1
+"""Indices of the lot groups in lots and of the capital gains in cap_gains"""
+
+NEGATIVE_BASIS_PER_SHARE = 0
+PURCHASE_PRICE = 1
+SHARES = 2
+PURCHASE_DAY = 3
+"""lots[field, group, i] is field of lot i in group, like LotGroup's arrays.
+Purchase days are stored as floats, which hold them exactly."""
+
+LONG_TERM_BASIS_PER_SHARE_TOLERANCE = 0
+COMPACT_LOTS = 1
+PARTIAL_SALES_REDUCE_BASIS = 2
+"""Indices in lot_rules, which says how the margin account keeps its lots:
+the long-term group's basis_per_share_tolerance (see Assets), and 1.0 or 0.0
+for whether it compacts lots (Assets.lots_can_be_compacted) and for
+EtfLot.PARTIAL_SALES_REDUCE_BASIS"""
+
+PRICE_INDEX = 0
+TOTAL_SHARES = 1
+TOTAL_PURCHASE_PRICE = 2
+"""Indices in a margin account's totals, like Assets' attributes"""
+
+NUM_EVENTS = 0
+NUM_LOT_ORDERING_DRAWS_USED = 1
+RAN_OUT_OF_LOT_ORDERING_DRAWS = 2
+"""Indices in counters"""
+
+ACCOUNT_WIPED_OUT = 0
+GOING_BANKRUPT = 1
+ACCOUNT_DEVIATING = 2
+USING_EMERGENCY_FUNDS_FOR_TAXES = 3
+LAST_DAY = 4
+NO_ASSETS_AND_NO_SAVINGS_GAP = 5
+REGULAR_ACCOUNT_ENDED_LOW = 6
+"""Event codes. Each event has up to 3 values; see simulate_path."""
+MAX_EVENT_VALUES = 3
+
+HISTORICAL_MARGIN_TO_ASSETS_RATIOS = 0
+HISTORICAL_REGULAR_WEALTH = 1
+HISTORICAL_MARGIN_WEALTH = 2
+HISTORICAL_CARRIED_CAP_GAINS = 3
+HISTORICAL_MARGIN_PERCENT_DIFFERENCES_FROM_SIMPLE_CALC = 4
+NUM_HISTORIES = 5
+"""Rows of histories"""
+
+def max_lots_per_group(num_pay_days, num_tax_days):
+    """Most lots a group can hold: two purchases each pay day (pay and
+    rebalancing to increase leverage), one each tax day, and one at the end"""
+    return 2*num_pay_days + num_tax_days + 2
+
+@jit
+def record_event(events, event_values, counters, code, value0, value1, value2):
+    event_num = counters[NUM_EVENTS]
+    events[event_num] = code
+    event_values[event_num, 0] = value0
+    event_values[event_num, 1] = value1
+    event_values[event_num, 2] = value2
+    counters[NUM_EVENTS] = event_num + 1
+
+@jit
+def can_merge(lots, num_lots, group, lot_index, negative_basis_per_share, purchase_day,
+              lot_rules):
+    """LotGroup.__can_merge"""
+    if lot_rules[COMPACT_LOTS] == 0 or lot_index < 0 or lot_index >= num_lots[group]:
+        return False
+    difference = abs(lots[NEGATIVE_BASIS_PER_SHARE, group, lot_index] - negative_basis_per_share)
+    same_basis_per_share = difference <= -negative_basis_per_share * SAME_BASIS_PER_SHARE_TOLERANCE
+    if lots[PURCHASE_DAY, group, lot_index] == purchase_day and same_basis_per_share:
+        return True
+    return group == LONG_TERM and \
+        difference <= -negative_basis_per_share * lot_rules[LONG_TERM_BASIS_PER_SHARE_TOLERANCE]
+
+@jit
+def insert_lot(lots, num_lots, group, purchase_price, purchase_day, shares, basis_per_share,
+               lot_rules):
+    """LotGroup.insert"""
+    negative_basis_per_share = -basis_per_share
+    position = 0 # like numpy.searchsorted with side="right"
+    while position < num_lots[group] and \
+        lots[NEGATIVE_BASIS_PER_SHARE, group, position] <= negative_basis_per_share:
+        position += 1
+    for neighbor in (position-1, position):
+        if can_merge(lots, num_lots, group, neighbor, negative_basis_per_share, purchase_day,
+                     lot_rules):
+            lots[PURCHASE_PRICE, group, neighbor] += purchase_price
+            lots[SHARES, group, neighbor] += shares
+            lots[PURCHASE_DAY, group, neighbor] = min(lots[PURCHASE_DAY, group, neighbor], purchase_day)
+            lots[NEGATIVE_BASIS_PER_SHARE, group, neighbor] = \
+                -lots[PURCHASE_PRICE, group, neighbor] / lots[SHARES, group, neighbor]
+            return
+    for lot_index in range(num_lots[group], position, -1):
+        lots[:, group, lot_index] = lots[:, group, lot_index-1]
+    lots[NEGATIVE_BASIS_PER_SHARE, group, position] = negative_basis_per_share
+    lots[PURCHASE_PRICE, group, position] = purchase_price
+    lots[SHARES, group, position] = shares
+    lots[PURCHASE_DAY, group, position] = purchase_day
+    num_lots[group] += 1
+
+@jit
+def remove_lots(lots, num_lots, group, first_lot_index, num_lots_to_remove):
+    """LotGroup.remove and remove_first"""
+    if num_lots_to_remove == 0:
+        return
+    for lot_index in range(first_lot_index, num_lots[group] - num_lots_to_remove):
+        lots[:, group, lot_index] = lots[:, group, lot_index+num_lots_to_remove]
+    num_lots[group] -= num_lots_to_remove
+
+@jit
+def buy_new_lot(lots, num_lots, totals, purchase_amount, day, lot_rules):
+    """Assets.buy_new_lot"""
+    purchase_price = purchase_amount * (1-FEE_PER_DOLLAR_TRADED)
+    shares = purchase_price / totals[PRICE_INDEX]
+    insert_lot(lots, num_lots, SHORT_TERM, purchase_price, float(day), shares, totals[PRICE_INDEX],
+               lot_rules)
+    totals[TOTAL_SHARES] += shares
+    totals[TOTAL_PURCHASE_PRICE] += purchase_price
+
+@jit
+def remove_all_lots(num_lots, totals):
+    num_lots[SHORT_TERM] = 0
+    num_lots[LONG_TERM] = 0
+    totals[PRICE_INDEX] = 1.0
+    totals[TOTAL_SHARES] = 0.0
+    totals[TOTAL_PURCHASE_PRICE] = 0.0
+
+@jit
+def update_price(current_price, rate_of_return):
+    """util.update_price"""
+    current_price *= (1.0+rate_of_return)
+    if current_price < 0:
+        return (0.0, True)
+    return (current_price, False)
+
+@jit
+def move_lots_that_became_long_term(lots, num_lots, day, lot_rules):
+    """Assets.__move_lots_that_became_long_term"""
+    lot_index = 0
+    while lot_index < num_lots[SHORT_TERM]:
+        if lots[PURCHASE_DAY, SHORT_TERM, lot_index] <= day - DAYS_PER_YEAR:
+            purchase_price = lots[PURCHASE_PRICE, SHORT_TERM, lot_index]
+            purchase_day = lots[PURCHASE_DAY, SHORT_TERM, lot_index]
+            shares = lots[SHARES, SHORT_TERM, lot_index]
+            basis_per_share = -lots[NEGATIVE_BASIS_PER_SHARE, SHORT_TERM, lot_index]
+            remove_lots(lots, num_lots, SHORT_TERM, lot_index, 1)
+            insert_lot(lots, num_lots, LONG_TERM, purchase_price, purchase_day, shares, basis_per_share,
+                       lot_rules)
+        else:
+            lot_index += 1
+
+@jit
+def tax_rate_of_lot(lots, totals, group, lot_index, tax_rates):
+    """Assets.__tax_rate"""
+    current_price = lots[SHARES, group, lot_index] * totals[PRICE_INDEX]
+    return (current_price - lots[PURCHASE_PRICE, group, lot_index]) * tax_rates[group] / current_price
+
+@jit
+def sell_from_lot(lots, totals, cap_gains, group, lot_index, cash_still_need_to_get, lot_rules):
+    """Assets.__sell_from_lot"""
+    purchase_price = lots[PURCHASE_PRICE, group, lot_index]
+    shares = lots[SHARES, group, lot_index]
+    current_price = shares * totals[PRICE_INDEX]
+    after_fee_value_of_lot = current_price * (1-FEE_PER_DOLLAR_TRADED)
+    if after_fee_value_of_lot > cash_still_need_to_get:
+        amount_to_sell = cash_still_need_to_get / (1-FEE_PER_DOLLAR_TRADED)
+        if lot_rules[PARTIAL_SALES_REDUCE_BASIS] != 0:
+            fraction_sold = amount_to_sell / current_price
+            cap_gains[group] += (current_price - purchase_price) * fraction_sold
+            totals[TOTAL_SHARES] -= shares * fraction_sold
+            totals[TOTAL_PURCHASE_PRICE] -= purchase_price * fraction_sold
+            lots[PURCHASE_PRICE, group, lot_index] *= (1-fraction_sold)
+            lots[SHARES, group, lot_index] *= (1-fraction_sold)
+            return (0.0, shares * fraction_sold, False)
+        shares_to_sell = amount_to_sell / totals[PRICE_INDEX]
+        cap_gains[group] += (current_price - amount_to_sell - purchase_price) * amount_to_sell / current_price
+        totals[TOTAL_SHARES] -= shares_to_sell
+        return (0.0, shares_to_sell, False)
+    cap_gains[group] += current_price - purchase_price
+    totals[TOTAL_SHARES] -= shares
+    totals[TOTAL_PURCHASE_PRICE] -= purchase_price
+    return (cash_still_need_to_get - after_fee_value_of_lot, shares, True)
+
+@jit
+def sell_shares(lots, num_lots, group, lot_index, shares_to_sell, lot_rules):
+    """LotGroup.sell_shares"""
+    purchase_price = lots[PURCHASE_PRICE, group, lot_index]
+    purchase_day = lots[PURCHASE_DAY, group, lot_index]
+    shares = lots[SHARES, group, lot_index]
+    remove_lots(lots, num_lots, group, lot_index, 1)
+    insert_lot(lots, num_lots, group, purchase_price, purchase_day, shares - shares_to_sell,
+               purchase_price / (shares - shares_to_sell), lot_rules)
+
+@jit
+def sell(lots, num_lots, totals, cap_gains, amount_of_net_cash_to_get_back, day,
+         sell_best_for_taxes_first, tax_rates, lot_ordering_draws, lot_rules,
+         events, event_values, counters):
+    """Assets.sell. Lots are sold in random order with the draws in
+    lot_ordering_draws, which are the path's lot-ordering generator's
+    random() values (Random.randrange(n) is int(random() * n))."""
+    move_lots_that_became_long_term(lots, num_lots, day, lot_rules)
+    cash_still_need_to_get = amount_of_net_cash_to_get_back
+    if sell_best_for_taxes_first:
+        num_lots_emptied = numpy.zeros(2, dtype=numpy.int64)
+        partly_sold_group = -1
+        partly_sold_shares = 0.0
+        while cash_still_need_to_get > 0:
+            have_long_term_lot = num_lots_emptied[LONG_TERM] < num_lots[LONG_TERM]
+            have_short_term_lot = num_lots_emptied[SHORT_TERM] < num_lots[SHORT_TERM]
+            if not (have_long_term_lot or have_short_term_lot):
+                break
+            group = SHORT_TERM
+            if have_long_term_lot and (not have_short_term_lot or \
+                tax_rate_of_lot(lots, totals, LONG_TERM, num_lots_emptied[LONG_TERM], tax_rates) <= \
+                tax_rate_of_lot(lots, totals, SHORT_TERM, num_lots_emptied[SHORT_TERM], tax_rates)):
+                group = LONG_TERM
+            (cash_still_need_to_get, shares_sold, lot_emptied) = sell_from_lot(lots, totals, cap_gains,
+                group, num_lots_emptied[group], cash_still_need_to_get, lot_rules)
+            if lot_emptied:
+                num_lots_emptied[group] += 1
+            else:
+                (partly_sold_group, partly_sold_shares) = (group, shares_sold)
+        remove_lots(lots, num_lots, LONG_TERM, 0, num_lots_emptied[LONG_TERM])
+        remove_lots(lots, num_lots, SHORT_TERM, 0, num_lots_emptied[SHORT_TERM])
+        if partly_sold_group >= 0 and lot_rules[PARTIAL_SALES_REDUCE_BASIS] == 0:
+            sell_shares(lots, num_lots, partly_sold_group, 0, partly_sold_shares, lot_rules)
+    else:
+        while cash_still_need_to_get > 0 and num_lots[SHORT_TERM] + num_lots[LONG_TERM] > 0:
+            lot_number = 0
+            draw_num = counters[NUM_LOT_ORDERING_DRAWS_USED]
+            if draw_num < len(lot_ordering_draws):
+                lot_number = int(lot_ordering_draws[draw_num] * (num_lots[SHORT_TERM] + num_lots[LONG_TERM]))
+                counters[NUM_LOT_ORDERING_DRAWS_USED] = draw_num + 1
+            else:
+                counters[RAN_OUT_OF_LOT_ORDERING_DRAWS] = 1 # the caller reruns the path with more draws
+            (group, lot_index) = (LONG_TERM, lot_number)
+            if lot_number >= num_lots[LONG_TERM]:
+                (group, lot_index) = (SHORT_TERM, lot_number - num_lots[LONG_TERM])
+            (cash_still_need_to_get, shares_sold, lot_emptied) = sell_from_lot(lots, totals, cap_gains,
+                group, lot_index, cash_still_need_to_get, lot_rules)
+            if lot_emptied:
+                remove_lots(lots, num_lots, group, lot_index, 1)
+            elif lot_rules[PARTIAL_SALES_REDUCE_BASIS] == 0:
+                sell_shares(lots, num_lots, group, lot_index, shares_sold, lot_rules)
+
+    if cash_still_need_to_get > 0:
+        record_event(events, event_values, counters, ACCOUNT_WIPED_OUT, cash_still_need_to_get, 0.0, 0.0)
+        remove_all_lots(num_lots, totals)
+    cap_gains[LONG_TERM] += cash_still_need_to_get/2
+    return cash_still_need_to_get
+
+@jit
+def margin_to_assets(margin, assets):
+    """BrokerageAccount.margin_to_assets"""
+    if assets == 0:
+        if margin == 0:
+            return 0.0
+        return numpy.inf
+    if abs(margin-0) < EPSILON:
+        return 0.0
+    return margin/assets
+
+@jit
+def fractional_difference(num1, num2):
+    """util.fractional_difference"""
+    if num1 == 0 and num2 == 0:
+        return 0.0
+    elif num1 == 0 or num2 == 0:
+        return numpy.inf
+    return (num1 - num2)/num2
+
+@jit
+def growth_factor(leverage_multiple, daily_return, annual_margin_interest_rate, trading_days_per_year):
+    """The factor one_run multiplies simple approximations and control variates by"""
+    return 1+leverage_multiple*daily_return \
+        - (leverage_multiple-1.0)*annual_margin_interest_rate/trading_days_per_year
+
+@jit
+def rebalance(lots, num_lots, totals, cap_gains, margin, max_margin_to_assets_ratio, day,
+              sell_best_for_taxes_first, tax_rates, lot_ordering_draws,
+              lot_rules, events, event_values, counters):
+    """BrokerageAccount.rebalance. Returns (margin, deficit_still_not_paid),
+    with a deficit of 0 where rebalance returns None."""
+    assets = totals[TOTAL_SHARES] * totals[PRICE_INDEX]
+    if margin_to_assets(margin, assets) > (1+EPSILON) * max_margin_to_assets_ratio:
+        amount_of_cash_needed = (margin - assets * max_margin_to_assets_ratio) / \
+            (1 - max_margin_to_assets_ratio - FEE_PER_DOLLAR_TRADED * max_margin_to_assets_ratio)
+        deficit_still_not_paid = sell(lots, num_lots, totals, cap_gains, amount_of_cash_needed, day,
+            sell_best_for_taxes_first, tax_rates, lot_ordering_draws, lot_rules,
+            events, event_values, counters)
+        if deficit_still_not_paid > 0:
+            return (0.0, deficit_still_not_paid)
+        return (margin - amount_of_cash_needed, 0.0)
+    return (margin, 0.0)
+
+@jit
+def buy_ETF_at_fixed_ratio(lots, num_lots, totals, margin, money_on_hand, day,
+                           personal_max_margin_to_assets_ratio, lot_rules):
+    """BrokerageAccount.buy_ETF_at_fixed_ratio. Returns the new margin."""
+    if money_on_hand > 0:
+        loan = money_on_hand * personal_max_margin_to_assets_ratio / (1.0 - personal_max_margin_to_assets_ratio)
+        margin += loan
+        buy_new_lot(lots, num_lots, totals, money_on_hand + loan, day, lot_rules)
+    return margin
+
+@jit
+def process_taxes(cap_gains, tax_rates):
+    """Taxes.process_taxes for short- and long-term gains cap_gains, which are
+    replaced by the carryover losses. tax_rates are the short-term, long-term
+    and income tax rates plus state."""
+    short_term_gain = cap_gains[SHORT_TERM]
+    long_term_gain = cap_gains[LONG_TERM]
+    total_gain_or_loss = short_term_gain + long_term_gain
+    bill_or_refund = 0.0
+    short_term_carryover_loss = 0.0
+    long_term_carryover_loss = 0.0
+    if total_gain_or_loss > 0:
+        if short_term_gain >= 0 and long_term_gain >= 0:
+            bill_or_refund = tax_rates[SHORT_TERM] * short_term_gain + tax_rates[LONG_TERM] * long_term_gain
+        elif short_term_gain >= 0:
+            bill_or_refund = tax_rates[SHORT_TERM] * total_gain_or_loss
+        else:
+            bill_or_refund = tax_rates[LONG_TERM] * total_gain_or_loss
+    elif total_gain_or_loss < 0:
+        amount_to_deduct = max(total_gain_or_loss, float(MAX_CAPITAL_LOSS_DEDUCTION_PER_YEAR))
+        bill_or_refund = tax_rates[2] * amount_to_deduct
+        if short_term_gain < amount_to_deduct and long_term_gain < 0:
+            (short_term_carryover_loss, long_term_carryover_loss) = (short_term_gain - amount_to_deduct, long_term_gain)
+        elif short_term_gain < amount_to_deduct:
+            short_term_carryover_loss = min(0.0, short_term_gain + long_term_gain - amount_to_deduct)
+        elif long_term_gain < 0:
+            long_term_carryover_loss = min(0.0, short_term_gain + long_term_gain - amount_to_deduct)
+    cap_gains[SHORT_TERM] = short_term_carryover_loss
+    cap_gains[LONG_TERM] = long_term_carryover_loss
+    return bill_or_refund
+
+@jit
+def use_emergency_funds_and_maybe_go_bankrupt(deficit_still_not_paid, emergency_savings,
+                                              num_lots, totals, events, event_values, counters):
+    """margin_leverage.check_if_margin_strategy_should_use_emergency_funds_and_maybe_go_bankrupt.
+    Returns whether the margin strategy went bankrupt; it's up to the caller to
+    stop using margin if it did."""
+    if deficit_still_not_paid > 0:
+        if deficit_still_not_paid <= emergency_savings[MARGIN]:
+            emergency_savings[MARGIN] -= deficit_still_not_paid
+        else:
+            amount_cannot_pay = deficit_still_not_paid - emergency_savings[MARGIN]
+            emergency_savings[MARGIN] = 0.0
+            record_event(events, event_values, counters, GOING_BANKRUPT, amount_cannot_pay, 0.0, 0.0)
+            remove_all_lots(num_lots, totals) # a new, empty account
+            return True
+    return False
+
+@jit
+def simulate_path(daily_returns, employment_draws, lot_ordering_draws, is_trading_day, is_pay_day,
+                  is_tax_day, years_remaining_by_day, personal_max_margin_to_assets_ratios,
+                  scheduled_leverage, annual_incomes_before_layoff_penalty, income_multipliers,
+                  principal_repayment_fractions, broker_max_margin_to_assets_ratio,
+                  rebalance_monthly_to_increase_leverage, sell_tax_favored_first_in_liquidation,
+                  initial_emergency_savings, match_percent_from_401k, monthly_probability_of_layoff,
+                  monthly_probability_find_work_after_laid_off, tax_rates, annual_margin_interest_rate,
+                  trading_days_per_year, interest_per_dollar_of_margin, pay_fraction_of_year,
+                  years_until_donate, warning_threshold_per_year, tiny_number,
+                  threshold_for_tax_convergence, lot_rules, lot_capacity,
+                  histories, events, event_values, counters):
+    """one_run for one path, with the market return of each trading day in
+    daily_returns, the employment draw of each pay day in employment_draws, and
+    the lot-ordering generator's draws in lot_ordering_draws. The days' flags and
+    the HorizonSchedule's lists come in as arrays; income_multipliers[n] is
+    Investor.income_penalty_for_past_layoffs(n), personal_max_margin_to_assets_ratios
+    is the margin account's by years_remaining, tax_rates are the short-term,
+    long-term and income tax rates plus state, and lot_rules is as above.
+
+    Fills in histories, records the events that one_run would print (see
+    margin_leverage.kernel_run), and returns the ending balances (not present
+    values) of the accounts plus emergency savings, the simple calc's ending
+    margin balance plus emergency savings, the control variates (ditto),
+    have_savings_gap_and_no_assets and margin_strategy_went_bankrupt."""
+    num_days = len(is_trading_day)
+    lots = numpy.zeros((4, 2, lot_capacity))
+    num_lots = numpy.zeros(2, dtype=numpy.int64)
+    totals = numpy.array([1.0, 0.0, 0.0])
+    cap_gains = numpy.zeros(2)
+    margin = 0.0
+    margin_account_is_bankrupt = False # if so, it's an account without margin, like regular's
+    price_indices = numpy.ones(3) # for the regular and matched 401k accounts
+    total_shares = numpy.zeros(3)
+    emergency_savings = numpy.ones(3) * initial_emergency_savings
+    simple_approx_account_values = numpy.zeros(3)
+    control_variate_account_values = numpy.zeros(3)
+    control_variate_emergency_savings = initial_emergency_savings
+    laid_off = False
+    num_times_laid_off = 0
+    margin_strategy_went_bankrupt = False
+    already_gave_warning_about_account_deviating = False
+    deficit_still_not_paid = 0.0
+    trading_day_num = 0
+    pay_period_num = 0
+    random_daily_return = 0.0
+    lot_ordering = sell_tax_favored_first_in_liquidation
+
+    for day in range(num_days):
+        years_remaining = years_remaining_by_day[day]
+        personal_max_ratio = 0.0 if margin_account_is_bankrupt else personal_max_margin_to_assets_ratios[years_remaining]
+        broker_max_ratio = 0.0 if margin_account_is_bankrupt else broker_max_margin_to_assets_ratio
+
+        # Record historical info
+        margin_assets = totals[TOTAL_SHARES] * totals[PRICE_INDEX]
+        histories[HISTORICAL_MARGIN_TO_ASSETS_RATIOS, day] = margin_to_assets(margin, margin_assets)
+        histories[HISTORICAL_REGULAR_WEALTH, day] = total_shares[REGULAR] * price_indices[REGULAR] + \
+            emergency_savings[REGULAR]
+        histories[HISTORICAL_MARGIN_WEALTH, day] = margin_assets - margin + emergency_savings[MARGIN]
+        histories[HISTORICAL_CARRIED_CAP_GAINS, day] = cap_gains[SHORT_TERM] + cap_gains[LONG_TERM]
+
+        # Check deviations from simple approximate estimates of account values
+        for type in (REGULAR, MATCHED_401K):
+            difference = fractional_difference(total_shares[type] * price_indices[type],
+                                               simple_approx_account_values[type])
+            assert abs(difference) < tiny_number, "Non-margin simple calculations should match the real things."
+        difference = fractional_difference(margin_assets - margin, simple_approx_account_values[MARGIN])
+        histories[HISTORICAL_MARGIN_PERCENT_DIFFERENCES_FROM_SIMPLE_CALC, day] = 100*difference
+        if abs(difference) > warning_threshold_per_year * years_until_donate and \
+            not already_gave_warning_about_account_deviating:
+            record_event(events, event_values, counters, ACCOUNT_DEVIATING, margin_assets - margin,
+                         difference, simple_approx_account_values[MARGIN])
+            already_gave_warning_about_account_deviating = True
+
+        if is_trading_day[day]:
+            random_daily_return = daily_returns[trading_day_num]
+            trading_day_num += 1
+
+            if rebalance_monthly_to_increase_leverage:
+                margin_leverage_multiple = 1/(1-personal_max_ratio)
+            else:
+                margin_leverage_multiple = 1/(1-margin_to_assets(margin, totals[TOTAL_SHARES] * totals[PRICE_INDEX]))
+            for type in range(3):
+                (emergency_savings[type], price_went_to_zero) = update_price(emergency_savings[type],
+                                                                             random_daily_return)
+                cur_leverage_multiple = margin_leverage_multiple if type == MARGIN else 1.0
+                if margin_strategy_went_bankrupt:
+                    cur_leverage_multiple = 1.0
+                simple_approx_account_values[type] *= growth_factor(cur_leverage_multiple,
+                    random_daily_return, annual_margin_interest_rate, trading_days_per_year)
+                if simple_approx_account_values[type] < 0:
+                    simple_approx_account_values[type] = 0.0
+
+            # Update control variates
+            control_variate_emergency_savings *= (1+random_daily_return)
+            for type in range(3):
+                control_variate_account_values[type] *= growth_factor(
+                    scheduled_leverage[years_remaining] if type == MARGIN else 1.0,
+                    random_daily_return, annual_margin_interest_rate, trading_days_per_year)
+
+            for type in (REGULAR, MATCHED_401K):
+                (price_indices[type], price_went_to_zero) = update_price(price_indices[type], random_daily_return)
+                if price_went_to_zero:
+                    price_indices[type] = 1.0
+                    total_shares[type] = 0.0
+
+            # Update margin account, unless the margin strategy is using emergency savings
+            if not emergency_savings[MARGIN] < emergency_savings[REGULAR]:
+                (totals[PRICE_INDEX], price_went_to_zero) = update_price(totals[PRICE_INDEX], random_daily_return)
+                if price_went_to_zero:
+                    remove_all_lots(num_lots, totals)
+                (margin, deficit_still_not_paid) = rebalance(lots, num_lots, totals, cap_gains, margin,
+                    broker_max_ratio, day, lot_ordering, tax_rates, lot_ordering_draws,
+                    lot_rules, events, event_values, counters)
+                margin_strategy_went_bankrupt = use_emergency_funds_and_maybe_go_bankrupt(
+                    deficit_still_not_paid, emergency_savings, num_lots, totals, events, event_values, counters)
+                if margin_strategy_went_bankrupt:
+                    (margin, margin_account_is_bankrupt) = (0.0, True)
+                    (personal_max_ratio, broker_max_ratio) = (0.0, 0.0)
+
+        if is_pay_day[day]:
+            pay = annual_incomes_before_layoff_penalty[pay_period_num] * \
+                (0.0 if laid_off else income_multipliers[num_times_laid_off]) * pay_fraction_of_year
+
+            # regular account just buys ETF
+            if pay > 0:
+                total_shares[REGULAR] += pay * (1-FEE_PER_DOLLAR_TRADED) / price_indices[REGULAR]
+            simple_approx_account_values[REGULAR] += pay * (1-FEE_PER_DOLLAR_TRADED)
+
+            # matched 401k account buys ETF with employee and employer funds
+            matched_pay_amount = pay * (1+match_percent_from_401k/100.0)
+            if matched_pay_amount > 0:
+                total_shares[MATCHED_401K] += matched_pay_amount * (1-FEE_PER_DOLLAR_TRADED) / \
+                    price_indices[MATCHED_401K]
+            simple_approx_account_values[MATCHED_401K] += matched_pay_amount * (1-FEE_PER_DOLLAR_TRADED)
+
+            if rebalance_monthly_to_increase_leverage:
+                margin_leverage_multiple = 1/(1-personal_max_ratio)
+            else:
+                margin_leverage_multiple = 1/(1-margin_to_assets(margin, totals[TOTAL_SHARES] * totals[PRICE_INDEX]))
+            simple_approx_account_values[MARGIN] += pay * (1-margin_leverage_multiple * FEE_PER_DOLLAR_TRADED)
+            for type in range(3):
+                if type == MATCHED_401K:
+                    control_variate_account_values[type] += pay * (1+match_percent_from_401k/100.0) * \
+                        (1-FEE_PER_DOLLAR_TRADED)
+                else:
+                    control_variate_account_values[type] += pay * (1-(scheduled_leverage[years_remaining] \
+                        if type == MARGIN else 1.0)*FEE_PER_DOLLAR_TRADED)
+
+            if emergency_savings[REGULAR] - emergency_savings[MARGIN] > pay:
+                # restore emergency savings with pay
+                emergency_savings[MARGIN] += pay
+            else:
+                # 0. restore any needed emergency savings
+                if emergency_savings[REGULAR] - emergency_savings[MARGIN] > 0:
+                    pay -= emergency_savings[REGULAR] - emergency_savings[MARGIN]
+                    emergency_savings[MARGIN] += emergency_savings[REGULAR] - emergency_savings[MARGIN]
+
+                # 1. pay interest
+                interest = margin * interest_per_dollar_of_margin
+                pay_after_interest = pay - interest
+                use_equity = False
+                if pay_after_interest <= 0:
+                    margin += (interest - pay)
+                    use_equity = True
+                else:
+                    # 2. pay some principal
+                    amount_of_principal_to_repay = margin * principal_repayment_fractions[pay_period_num]
+                    if amount_of_principal_to_repay > pay_after_interest:
+                        margin -= pay_after_interest
+                        use_equity = True
+                    else:
+                        margin -= amount_of_principal_to_repay
+                        pay_after_interest_and_principal = pay_after_interest - amount_of_principal_to_repay
+                        # 3. pay down margin if it's over limit
+                        cur_margin_to_assets = margin_to_assets(margin, totals[TOTAL_SHARES] * totals[PRICE_INDEX])
+                        if cur_margin_to_assets <= (1+EPSILON) * personal_max_ratio:
+                            amount_to_pay_for_voluntary_margin_call = 0.0
+                        elif cur_margin_to_assets == numpy.inf:
+                            amount_to_pay_for_voluntary_margin_call = margin
+                        else:
+                            amount_to_pay_for_voluntary_margin_call = margin - \
+                                totals[TOTAL_SHARES] * totals[PRICE_INDEX] * personal_max_ratio
+                        if amount_to_pay_for_voluntary_margin_call > pay_after_interest_and_principal:
+                            margin -= pay_after_interest_and_principal
+                            use_equity = True
+                        else:
+                            margin -= amount_to_pay_for_voluntary_margin_call
+                            # 4. buy some ETF
+                            margin = buy_ETF_at_fixed_ratio(lots, num_lots, totals, margin,
+                                pay_after_interest_and_principal - amount_to_pay_for_voluntary_margin_call,
+                                day, personal_max_ratio, lot_rules)
+                if use_equity:
+                    (margin, deficit_still_not_paid) = rebalance(lots, num_lots, totals, cap_gains, margin,
+                        personal_max_ratio, day, True, tax_rates, lot_ordering_draws,
+                        lot_rules, events, event_values, counters)
+                    margin_strategy_went_bankrupt = use_emergency_funds_and_maybe_go_bankrupt(
+                        deficit_still_not_paid, emergency_savings, num_lots, totals, events, event_values, counters)
+                    if margin_strategy_went_bankrupt:
+                        (margin, margin_account_is_bankrupt) = (0.0, True)
+                        (personal_max_ratio, broker_max_ratio) = (0.0, 0.0)
+
+            # If we're rebalancing upwards to increase leverage when it's too low, do that.
+            assets = totals[TOTAL_SHARES] * totals[PRICE_INDEX]
+            if rebalance_monthly_to_increase_leverage and assets > 0 and \
+                margin_to_assets(margin, assets) < (1-EPSILON) * personal_max_ratio:
+                additional_debt = (assets * personal_max_ratio - margin) / (1-personal_max_ratio)
+                if additional_debt >= MIN_ADDITIONAL_PURCHASE_AMOUNT:
+                    margin += additional_debt
+                    buy_new_lot(lots, num_lots, totals, additional_debt, day, lot_rules)
+
+            # Possibly get laid off or return to work
+            if not laid_off:
+                if employment_draws[pay_period_num] < monthly_probability_of_layoff:
+                    laid_off = True
+                    num_times_laid_off += 1
+            elif employment_draws[pay_period_num] < monthly_probability_find_work_after_laid_off:
+                laid_off = False
+            pay_period_num += 1
+
+        if is_tax_day[day]:
+            # The regular account never sells, so it never owes taxes.
+            bill_or_refund = process_taxes(cap_gains, tax_rates)
+            if bill_or_refund > 0:
+                margin += bill_or_refund
+                (margin, deficit_still_not_paid) = rebalance(lots, num_lots, totals, cap_gains, margin,
+                    personal_max_ratio, day, True, tax_rates, lot_ordering_draws,
+                    lot_rules, events, event_values, counters)
+                if deficit_still_not_paid > 0:
+                    record_event(events, event_values, counters, USING_EMERGENCY_FUNDS_FOR_TAXES,
+                                 deficit_still_not_paid, 0.0, 0.0)
+                margin_strategy_went_bankrupt = use_emergency_funds_and_maybe_go_bankrupt(
+                    deficit_still_not_paid, emergency_savings, num_lots, totals, events, event_values, counters)
+                if margin_strategy_went_bankrupt:
+                    (margin, margin_account_is_bankrupt) = (0.0, True)
+                    (personal_max_ratio, broker_max_ratio) = (0.0, 0.0)
+            elif bill_or_refund < 0:
+                refund_as_positive_number = -bill_or_refund
+                if emergency_savings[REGULAR] - emergency_savings[MARGIN] >= refund_as_positive_number:
+                    emergency_savings[MARGIN] += refund_as_positive_number
+                    refund_as_positive_number = 0.0
+                else:
+                    refund_as_positive_number -= emergency_savings[REGULAR] - emergency_savings[MARGIN]
+                    emergency_savings[MARGIN] += emergency_savings[REGULAR] - emergency_savings[MARGIN]
+                if refund_as_positive_number > 0:
+                    margin = buy_ETF_at_fixed_ratio(lots, num_lots, totals, margin, refund_as_positive_number,
+                        day, personal_max_ratio, lot_rules)
+
+        if day == num_days-1:
+            record_event(events, event_values, counters, LAST_DAY, float(day), random_daily_return,
+                         1.0 if laid_off else 0.0)
+
+    margin_assets = totals[TOTAL_SHARES] * totals[PRICE_INDEX]
+    savings_gap = emergency_savings[REGULAR] - emergency_savings[MARGIN]
+    have_savings_gap_and_no_assets = margin_assets == 0 and savings_gap > 0
+    if margin_assets == 0 and savings_gap == 0:
+        record_event(events, event_values, counters, NO_ASSETS_AND_NO_SAVINGS_GAP, 0.0, 0.0, 0.0)
+
+    if margin_assets > 0:
+        # Pay off all margin debt, repeating until the taxes on the sales converge
+        deficit_still_not_paid = sell(lots, num_lots, totals, cap_gains, margin, num_days, True, tax_rates,
+            lot_ordering_draws, lot_rules, events, event_values, counters)
+        margin = 0.0
+        if not (deficit_still_not_paid > 0):
+            bill_or_refund = process_taxes(cap_gains, tax_rates)
+            while bill_or_refund > threshold_for_tax_convergence and not (deficit_still_not_paid > 0):
+                deficit_still_not_paid = sell(lots, num_lots, totals, cap_gains, margin + bill_or_refund,
+                    num_days, True, tax_rates, lot_ordering_draws, lot_rules,
+                    events, event_values, counters)
+                bill_or_refund = process_taxes(cap_gains, tax_rates)
+            if bill_or_refund < 0 and not (deficit_still_not_paid > 0):
+                buy_new_lot(lots, num_lots, totals, -bill_or_refund, num_days, lot_rules)
+    margin_strategy_went_bankrupt = use_emergency_funds_and_maybe_go_bankrupt(
+        deficit_still_not_paid, emergency_savings, num_lots, totals, events, event_values, counters)
+    if margin_strategy_went_bankrupt:
+        margin = 0.0
+
+    regular_value = total_shares[REGULAR] * price_indices[REGULAR]
+    if regular_value < tiny_number:
+        record_event(events, event_values, counters, REGULAR_ACCOUNT_ENDED_LOW, regular_value, 0.0, 0.0)
+
+    return (regular_value + emergency_savings[REGULAR],
+            totals[TOTAL_SHARES] * totals[PRICE_INDEX] - margin + emergency_savings[MARGIN],
+            total_shares[MATCHED_401K] * price_indices[MATCHED_401K] + emergency_savings[MATCHED_401K],
+            simple_approx_account_values[MARGIN] + emergency_savings[MARGIN],
+            control_variate_account_values[REGULAR] + control_variate_emergency_savings,
+            control_variate_account_values[MARGIN] + control_variate_emergency_savings,
+            control_variate_account_values[MATCHED_401K] + control_variate_emergency_savings,
+            have_savings_gap_and_no_assets, margin_strategy_went_bankrupt)
+
+if __name__ == "__main__":
+    """Parity test: python path_kernel.py [number of paths per scenario]"""
+    import sys
+    import margin_leverage
+    margin_leverage.compare_kernel_runs_with_one_run_for_all_scenarios(*map(int, sys.argv[1:]))
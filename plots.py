@@ -10,24 +10,25 @@ OPTIMAL_LEVERAGE_GRAPH_PREFIX = "aaa_opt_lev" # add "aaa_" to put it first alpha
 EXPECTED_UTILITY_GRAPH_PREFIX = "exp_util"
 EXPECTED_SATURATION_UTILITY_GRAPH_PREFIX = "exp_sat_util"
 
-def graph_histograms(account_values, num_samples, outfilepath):
+def graph_histograms(account_statistics, num_samples, outfilepath):
     alpha_for_pyplot = .5
     num_bins = max(10, num_samples/10)
 
     # Plot each histogram separately
     for type in ["regular", "margin", "matched401k"]:
-        median_value = util.percentile(account_values[type], .5)
-        numpy_array = numpy.array(account_values[type])
-        bin_min = min(numpy_array)
-        bin_max = min(max(numpy_array), 10 * median_value) # the "25 * median_value" part avoids having a distorted graph due to far-right skewed values
+        statistics = account_statistics[type]
+        median_value = statistics.percentile(.5)
+        bin_min = statistics.min()
+        bin_max = min(statistics.max(), 10 * median_value) # the "25 * median_value" part avoids having a distorted graph due to far-right skewed values
         graph_bins = numpy.linspace(bin_min, bin_max, num_bins)
+        (values, weights) = statistics.histogram_data(graph_bins)
         if type is "regular":
-            regular_array = numpy_array
+            (regular_values, regular_weights) = (values, weights)
             regular_bins = graph_bins
         elif type is "margin":
-            margin_array = numpy_array
+            (margin_values, margin_weights) = (values, weights)
             margin_bins = graph_bins
-        pyplot.hist(numpy_array, bins=graph_bins, alpha=alpha_for_pyplot)
+        pyplot.hist(values, bins=graph_bins, weights=weights, alpha=alpha_for_pyplot)
         pyplot.title("Distribution of results for " + type + " investing")
         pyplot.xlabel("Present value of donated $")
         pyplot.ylabel("Frequency out of " + str(num_samples) + " runs")
@@ -35,8 +36,8 @@ def graph_histograms(account_values, num_samples, outfilepath):
         pyplot.close()
 
     # Plot regular and margin together
-    pyplot.hist(regular_array, bins=regular_bins, alpha=alpha_for_pyplot, label="regular")
-    pyplot.hist(margin_array, bins=margin_bins, alpha=alpha_for_pyplot, label="margin")
+    pyplot.hist(regular_values, bins=regular_bins, weights=regular_weights, alpha=alpha_for_pyplot, label="regular")
+    pyplot.hist(margin_values, bins=margin_bins, weights=margin_weights, alpha=alpha_for_pyplot, label="margin")
     pyplot.title("Distribution of results: regular vs. margin")
     pyplot.xlabel("Present value of donated $")
     pyplot.ylabel("Frequency out of " + str(num_samples) + " runs")
@@ -44,16 +45,17 @@ def graph_histograms(account_values, num_samples, outfilepath):
     pyplot.savefig(outfilepath + "_bothhist")
     pyplot.close()
 
-def graph_expected_utility_vs_alpha(numpy_regular, numpy_margin, outdir_name):
-    """alpha is as in utility(wealth) = wealth^alpha"""
+def graph_expected_utility_vs_alpha(regular_statistics, margin_statistics, outdir_name):
+    """alpha is as in utility(wealth) = wealth^alpha. The statistics are
+    ExactStatistics or StreamingStatistics of the ending values."""
 
     MIN_ALPHA = 0
     MAX_ALPHA = 1
     NUM_POINTS = 1000
     alpha_values = numpy.linspace(MIN_ALPHA,MAX_ALPHA,NUM_POINTS)
     ratio_of_expected_utilities = map(lambda alpha: \
-        numpy.mean(map(lambda wealth: util.utility(wealth, alpha), numpy_margin)) / \
-        numpy.mean(map(lambda wealth: util.utility(wealth, alpha), numpy_regular)),
+        margin_statistics.expected_value_of(lambda wealth: util.utility(wealth, alpha)) / \
+        regular_statistics.expected_value_of(lambda wealth: util.utility(wealth, alpha)),
                                       alpha_values)
 
     pyplot.plot(alpha_values,ratio_of_expected_utilities)
@@ -63,13 +65,13 @@ def graph_expected_utility_vs_alpha(numpy_regular, numpy_margin, outdir_name):
     pyplot.savefig("%s_%s" % (outdir_name, EXPECTED_UTILITY_GRAPH_PREFIX))
     pyplot.close()
 
-def graph_expected_utility_vs_wealth_saturation_cutoff(numpy_regular, numpy_margin, \
+def graph_expected_utility_vs_wealth_saturation_cutoff(regular_statistics, margin_statistics, \
     outdir_name, min_log10_saturation, max_log10_saturation):
     NUM_POINTS = 1000
     saturation_values = numpy.logspace(min_log10_saturation,max_log10_saturation,NUM_POINTS)
     ratio_of_expected_utilities = map(lambda saturation: \
-        numpy.mean(map(lambda wealth: util.saturation_utility(wealth, saturation), numpy_margin)) / \
-        numpy.mean(map(lambda wealth: util.saturation_utility(wealth, saturation), numpy_regular)),
+        margin_statistics.expected_value_of(lambda wealth: util.saturation_utility(wealth, saturation)) / \
+        regular_statistics.expected_value_of(lambda wealth: util.saturation_utility(wealth, saturation)),
                                       saturation_values)
     fig = pyplot.figure()
     ax = fig.add_subplot(2,1,1) # see http://stackoverflow.com/a/1183415
@@ -146,14 +148,13 @@ def graph_percent_differences_from_simple_calc(percent_differences_from_simple_c
     pyplot.savefig(outfilepath + "_percdiff")
     pyplot.close()
 
-def graph_trends_vs_leverage_amount(output_queue, outdir_name):
-    """Graph to show optimal leverage."""
+def graph_trends_vs_leverage_amount(output_tuples, outdir_name):
+    """Graph to show optimal leverage, from the records that
+    margin_leverage.write_sample_results sends to its output_queue, one per
+    leverage amount."""
 
-    # Sort the queue by the N leverage value
-    output_tuples = []
-    while not output_queue.empty():
-        output_tuples.append(output_queue.get())
-    output_tuples.sort(key=operator.itemgetter(0))
+    # Sort the records by the N leverage value
+    output_tuples = sorted(output_tuples, key=operator.itemgetter(0))
 
     # Get the axes
     attributes = dict()
@@ -0,0 +1,71 @@
+import hashlib
+import struct
+import numpy
+from random import Random
+import util
+
+"""Every sample path gets its own random streams, keyed by (scenario seed,
+path index, stream name). A path's draws therefore don't depend on which
+other paths were run before it or in which process, so any subset of paths
+can be computed anywhere with identical results.
+
+Ideally this would use numpy's SeedSequence and a counter-based generator
+like Philox, but those need numpy >= 1.17, which doesn't support Python 2.
+Instead, the key is hashed with SHA-256 and the digest seeds an ordinary
+generator. Hashing the key serves the same purpose as a counter-based
+generator's key: nearby path indices give unrelated streams."""
+
+DEFAULT_SCENARIO_SEED = "seedy character"
+RETURNS_STREAM = "returns"
+EMPLOYMENT_STREAM = "employment"
+LOT_ORDERING_STREAM = "lot ordering"
+
+def stream_key(scenario_seed, path_index, stream_name):
+    """32-bit words for seeding a generator."""
+    digest = hashlib.sha256("%s|%i|%s" % (scenario_seed, path_index, stream_name)).digest()
+    return list(struct.unpack("<8I", digest))
+
+def python_generator(scenario_seed, path_index, stream_name):
+    return Random(sum(word << (32*i) for (i, word) in
+        enumerate(stream_key(scenario_seed, path_index, stream_name))))
+
+def returns_generator(scenario_seed, path_index):
+    """numpy.random.RandomState for a path's daily market returns."""
+    return numpy.random.RandomState(stream_key(scenario_seed, path_index, RETURNS_STREAM))
+
+def employment_generator(scenario_seed, path_index):
+    """random.Random for a path's monthly layoff / rehiring draws."""
+    return python_generator(scenario_seed, path_index, EMPLOYMENT_STREAM)
+
+def lot_ordering_generator(scenario_seed, path_index):
+    """random.Random for the order in which lots are sold when not selling
+    in tax-favored order. This is separate from the employment stream because
+    how often lots get sold differs across variants (e.g., leverage amounts),
+    and that shouldn't change the employment history of a path."""
+    return python_generator(scenario_seed, path_index, LOT_ORDERING_STREAM)
+
+def daily_returns_for_paths(market, trading_days, scenario_seed, first_path_index, num_paths,
+                            sampling_mode=util.INDEPENDENT_SAMPLING, num_strata=None):
+    """Rows of Market.random_daily_returns for paths first_path_index, 
+    first_path_index+1, ..., each drawn from its own returns stream. With
+    antithetic sampling, paths 2k and 2k+1 are a pair, whichever batch
+    they're generated in. With stratified sampling, path i is in stratum
+    i % num_strata."""
+    if sampling_mode == util.ANTITHETIC_SAMPLING and first_path_index % 2 == 1:
+        """Start from the partner of the first path so that the pairs line up."""
+        return daily_returns_for_paths(market, trading_days, scenario_seed, first_path_index-1,
+                                       num_paths+1, sampling_mode, num_strata)[1:]
+    path_indices = range(first_path_index, first_path_index + num_paths)
+    strata = [path_index % num_strata for path_index in path_indices] if num_strata else None
+    return market.random_daily_returns(num_paths, trading_days, 
+        [returns_generator(scenario_seed, path_index) for path_index in path_indices],
+        sampling_mode, strata, num_strata)
+
+def employment_draws_for_paths(scenario_seed, first_path_index, num_paths, num_pay_days):
+    """Array whose row i has the first num_pay_days draws of path
+    first_path_index+i's employment generator, one per pay day."""
+    draws = numpy.zeros((num_paths, num_pay_days))
+    for path_index in xrange(first_path_index, first_path_index+num_paths):
+        randgenerator = employment_generator(scenario_seed, path_index)
+        draws[path_index-first_path_index] = [randgenerator.random() for pay_day in xrange(num_pay_days)]
+    return draws
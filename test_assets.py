@@ -0,0 +1,266 @@
+import operator
+import random
+import unittest
+import numpy
+import Assets
+import EtfLot
+import TaxRates
+from BrokerageAccount import FEE_PER_DOLLAR_TRADED
+
+class CapitalGains(object):
+    """Stands in for Taxes, adding up the short- and long-term capital gains
+    that Assets records"""
+
+    def __init__(self):
+        self.tax_rates = TaxRates.TaxRates()
+        self.short_term = 0.0
+        self.long_term = 0.0
+
+    def add_short_term_cap_gains(self, amount_to_add):
+        self.short_term += amount_to_add
+
+    def add_long_term_cap_gains(self, amount_to_add):
+        self.long_term += amount_to_add
+
+class EtfLotAssets(object):
+    """The list of EtfLots that Assets replaced, selling in tax-favored order,
+    to check Assets against"""
+
+    def __init__(self):
+        self.__lots_list = []
+
+    def buy_new_lot(self, purchase_amount, fee_per_dollar_traded, day):
+        self.__lots_list.append(EtfLot.EtfLot(purchase_amount, fee_per_dollar_traded, day))
+
+    def total_assets(self):
+        return sum(lot.current_price for lot in self.__lots_list)
+
+    def total_cost_basis(self):
+        return sum(lot.purchase_price for lot in self.__lots_list)
+
+    def update_prices(self, rate_of_return):
+        for lot in self.__lots_list:
+            lot.update_price(rate_of_return)
+
+    def sell(self, amount_of_net_cash_to_get_back, fee_per_dollar_traded, day, taxes):
+        """Sort by (tax rate, "longterm" or "shortterm"), which is stable, and
+        sell from the front"""
+        list_to_sort = [(lot.capital_gains_tax_rate(day, taxes.tax_rates), lot) for lot in self.__lots_list]
+        list_to_sort.sort(key=operator.itemgetter(0))
+        self.__lots_list = [lot for (tax, lot) in list_to_sort]
+        cash_still_need_to_get = amount_of_net_cash_to_get_back
+        while cash_still_need_to_get > 0 and self.__lots_list:
+            (cash_still_need_to_get, lot_emptied) = self.__lots_list[0].sell(
+                cash_still_need_to_get, fee_per_dollar_traded, day, taxes)
+            if lot_emptied:
+                self.__lots_list.pop(0)
+        return cash_still_need_to_get
+
+class AssetsTest(unittest.TestCase):
+    def setUp(self):
+        self.__settings = (Assets.HARVEST_LOTS_WITH_LOSSES, EtfLot.PARTIAL_SALES_REDUCE_BASIS)
+
+    def tearDown(self):
+        (Assets.HARVEST_LOTS_WITH_LOSSES, EtfLot.PARTIAL_SALES_REDUCE_BASIS) = self.__settings
+
+    def test_harvesting_sells_the_lots_with_losses(self):
+        Assets.HARVEST_LOTS_WITH_LOSSES = True
+        (assets, gains) = (Assets.Assets(), CapitalGains())
+        assets.buy_new_lot(100.0, 0, 0)
+        assets.update_prices(1.0)
+        assets.buy_new_lot(100.0, 0, 10) # at twice the first lot's share price
+        assets.update_prices(-.25)
+        self.assertEqual(assets.tax_loss_harvest(.01, 20, gains), 75.0 * .99)
+        self.assertEqual((gains.short_term, gains.long_term), (-25.0, 0))
+        self.assertEqual((assets.num_lots, assets.total_assets(), assets.total_cost_basis()), (1, 150.0, 100.0))
+        Assets.HARVEST_LOTS_WITH_LOSSES = False
+        assets.update_prices(-.5)
+        self.assertEqual(assets.tax_loss_harvest(.01, 30, gains), 0)
+        self.assertEqual(assets.num_lots, 1)
+
+    def test_random_order_sales(self):
+        """Lots are picked with the account's generator, and whichever are
+        sold, the gains are the value sold minus the basis sold (which, for a
+        partly sold lot, needs PARTIAL_SALES_REDUCE_BASIS)"""
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = True
+        def account_after_sale(seed):
+            (assets, gains) = (Assets.Assets(random.Random(seed)), CapitalGains())
+            randgenerator = numpy.random.RandomState(0)
+            for day in xrange(40): # more lots than the arrays start with room for
+                assets.buy_new_lot(100.0, FEE_PER_DOLLAR_TRADED, day * 10)
+                assets.update_prices(float(randgenerator.normal(0, .05)))
+            (total_assets, total_cost_basis) = (assets.total_assets(), assets.total_cost_basis())
+            cash_needed = 1234.5
+            self.assertEqual(assets.sell(cash_needed, FEE_PER_DOLLAR_TRADED, 400, gains, False), 0)
+            self.assertAlmostEqual(total_assets - assets.total_assets(),
+                                   cash_needed / (1-FEE_PER_DOLLAR_TRADED), places=9)
+            self.assertAlmostEqual(gains.short_term + gains.long_term, total_assets - assets.total_assets() -
+                                   (total_cost_basis - assets.total_cost_basis()), places=9)
+            return (assets.total_cost_basis(), gains.short_term, gains.long_term)
+        self.assertEqual(account_after_sale(1), account_after_sale(1))
+        self.assertNotEqual(account_after_sale(1), account_after_sale(2))
+
+    def test_price_falling_to_zero_wipes_out_the_lots(self):
+        assets = Assets.Assets()
+        assets.buy_new_lot(100.0, 0, 0)
+        assets.buy_new_lot(50.0, 0, 1)
+        assets.update_prices(-1.5)
+        self.assertEqual((assets.num_lots, assets.total_assets(), assets.total_cost_basis()), (0, 0, 0))
+
+class EtfLotLedgerTest(unittest.TestCase):
+    """Assets keeps lots as shares against a price index, sorted by basis per
+    share, but should sell the same lots for the same gains as the list of
+    EtfLots did, with either way of taxing partial sales"""
+
+    def setUp(self):
+        self.__partial_sales_reduce_basis = EtfLot.PARTIAL_SALES_REDUCE_BASIS
+
+    def tearDown(self):
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = self.__partial_sales_reduce_basis
+
+    def check_ledgers_agree(self, days, fee_per_dollar_traded, tax_rates, relative_tolerance):
+        """days is a list of (day, rate of return or None, [purchase amounts],
+        cash to get from a sale or None)."""
+        for partial_sales_reduce_basis in [False, True]:
+            EtfLot.PARTIAL_SALES_REDUCE_BASIS = partial_sales_reduce_basis
+            (assets, etf_lots) = (Assets.Assets(), EtfLotAssets())
+            (assets_gains, etf_lot_gains) = (CapitalGains(), CapitalGains())
+            assets_gains.tax_rates = etf_lot_gains.tax_rates = tax_rates
+            for (day, rate_of_return, purchase_amounts, cash_needed) in days:
+                if rate_of_return is not None:
+                    assets.update_prices(rate_of_return)
+                    etf_lots.update_prices(rate_of_return)
+                for purchase_amount in purchase_amounts:
+                    assets.buy_new_lot(purchase_amount, fee_per_dollar_traded, day)
+                    etf_lots.buy_new_lot(purchase_amount, fee_per_dollar_traded, day)
+                if cash_needed:
+                    self.assertEqual(assets.sell(cash_needed, fee_per_dollar_traded, day, assets_gains, True), 0)
+                    self.assertEqual(etf_lots.sell(cash_needed, fee_per_dollar_traded, day, etf_lot_gains), 0)
+                for (assets_value, etf_lots_value) in [
+                        (assets.total_assets(), etf_lots.total_assets()),
+                        (assets.total_cost_basis(), etf_lots.total_cost_basis()),
+                        (assets_gains.short_term, etf_lot_gains.short_term),
+                        (assets_gains.long_term, etf_lot_gains.long_term)]:
+                    self.assertLessEqual(abs(assets_value - etf_lots_value),
+                                         relative_tolerance * max(1.0, abs(etf_lots_value)),
+                                         "Day %i: %r != %r" % (day, assets_value, etf_lots_value))
+
+    def test_lots_bought_at_the_same_price_are_sold_in_the_order_bought(self):
+        """Prices that are powers of 2 and tax rates with few bits, without
+        fees, give exact arithmetic, so lots bought the same day tie exactly,
+        and the EtfLots are sold in the order they were bought. Which one is
+        partly sold changes the gains unless PARTIAL_SALES_REDUCE_BASIS."""
+        days = [(0, None, [1.0, 3.0], None),
+                (1, 1.0, [], None),
+                (10, None, [2.0], None),
+                (11, 1.0, [], None),
+                (20, None, [], 14.0), # all of day 10's lot and the smaller day-0 lot, and half the bigger one
+                (30, None, [4.0, 4.0, 8.0], None),
+                (400, None, [], 6.0), # day 0's, now long term, then day 30's in order
+                (401, -.5, [], None),
+                (410, None, [], 1.0)]
+        self.check_ledgers_agree(days, 0, TaxRates.TaxRates(.25, .125, 0), 0)
+
+    def test_random_purchases_and_sales(self):
+        """Without ties, the only differences are rounding errors."""
+        randgenerator = numpy.random.RandomState(0)
+        days = []
+        for day in xrange(3 * EtfLot.DAYS_PER_YEAR):
+            purchase_amounts = [float(randgenerator.uniform(100, 1000))] if day % 7 == 0 else []
+            cash_needed = float(randgenerator.uniform(100, 2000)) if day % 30 == 29 else None
+            days.append((day, float(randgenerator.normal(.0003, .015)), purchase_amounts, cash_needed))
+        self.check_ledgers_agree(days, FEE_PER_DOLLAR_TRADED, TaxRates.TaxRates(), 1e-9)
+
+class LotCompactionTest(unittest.TestCase):
+    """Merging lots is only done where it can't change any results, so an
+    account that compacts its lots should record exactly the same gains and
+    keep exactly the same cost basis as one that doesn't. The prices here are
+    powers of 2 and the sales fractions with few bits, so that there's no
+    rounding error either way and any difference would be a real one."""
+
+    def setUp(self):
+        self.__partial_sales_reduce_basis = EtfLot.PARTIAL_SALES_REDUCE_BASIS
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = True
+
+    def tearDown(self):
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = self.__partial_sales_reduce_basis
+
+    def test_compacting_lots_leaves_gains_and_basis_unchanged(self):
+        accounts = [Assets.Assets(compact_lots=True), Assets.Assets(compact_lots=False)]
+        gains = [CapitalGains(), CapitalGains()]
+
+        def check_accounts_agree():
+            self.assertEqual(accounts[0].total_assets(), accounts[1].total_assets())
+            self.assertEqual(accounts[0].total_cost_basis(), accounts[1].total_cost_basis())
+            self.assertEqual(gains[0].short_term, gains[1].short_term)
+            self.assertEqual(gains[0].long_term, gains[1].long_term)
+
+        def for_both(function):
+            for (account, account_gains) in zip(accounts, gains):
+                function(account, account_gains)
+            check_accounts_agree()
+
+        for_both(lambda account, account_gains: account.buy_new_lot(1.0, 0, 0))
+        for_both(lambda account, account_gains: account.buy_new_lot(1.0, 0, 0)) # same day
+        for_both(lambda account, account_gains: account.update_prices(1.0))
+        for_both(lambda account, account_gains: account.buy_new_lot(4.0, 0, 5)) # higher basis per share
+        for_both(lambda account, account_gains: account.update_prices(-.5))
+        for_both(lambda account, account_gains: account.buy_new_lot(2.0, 0, 20)) # same basis as day 0's
+        for_both(lambda account, account_gains: account.update_prices(1.0))
+        for_both(lambda account, account_gains: account.buy_new_lot(2.0, 0, 390))
+        for_both(lambda account, account_gains: account.buy_new_lot(2.0, 0, 390))
+        self.assertEqual((accounts[0].num_lots, accounts[1].num_lots), (4, 6))
+        self.assertEqual(accounts[0].num_lots_without_compaction, accounts[1].num_lots)
+        for_both(lambda account, account_gains: account.update_prices(1.0))
+
+        # All of the day-5 lot and part of the three lots with basis 1 per share, merged into one
+        for_both(lambda account, account_gains: self.assertEqual(
+            account.sell(14.0, 0, 400, account_gains, True), 0))
+        self.assertEqual(accounts[0].num_lots, 2)
+        self.assertGreater(gains[0].long_term, 0)
+
+        for_both(lambda account, account_gains: account.update_prices(-.5))
+        for_both(lambda account, account_gains: self.assertEqual(
+            account.sell(account.total_assets(), 0, 800, account_gains, True), 0))
+        self.assertEqual(accounts[1].num_lots, 0)
+
+    def test_lots_are_only_compacted_when_that_cant_change_results(self):
+        self.assertTrue(Assets.lots_can_be_compacted(True))
+        self.assertFalse(Assets.lots_can_be_compacted(False)) # random order depends on the number of lots
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = False
+        self.assertFalse(Assets.lots_can_be_compacted(True))
+
+class RunningTotalsTest(unittest.TestCase):
+    """With CHECK_RUNNING_TOTALS, Assets checks its running totals of shares
+    and cost basis against sums over the lots after every change"""
+
+    def setUp(self):
+        self.__settings = (Assets.CHECK_RUNNING_TOTALS, Assets.HARVEST_LOTS_WITH_LOSSES,
+                           EtfLot.PARTIAL_SALES_REDUCE_BASIS)
+        Assets.CHECK_RUNNING_TOTALS = True
+        Assets.HARVEST_LOTS_WITH_LOSSES = True
+
+    def tearDown(self):
+        (Assets.CHECK_RUNNING_TOTALS, Assets.HARVEST_LOTS_WITH_LOSSES,
+         EtfLot.PARTIAL_SALES_REDUCE_BASIS) = self.__settings
+
+    def test_running_totals_match_the_lots(self):
+        for partial_sales_reduce_basis in [False, True]:
+            EtfLot.PARTIAL_SALES_REDUCE_BASIS = partial_sales_reduce_basis
+            for sell_best_for_taxes_first in [False, True]:
+                randgenerator = numpy.random.RandomState(0)
+                (assets, gains) = (Assets.Assets(random.Random(0), compact_lots=Assets.lots_can_be_compacted(
+                    sell_best_for_taxes_first)), CapitalGains())
+                for day in xrange(2 * EtfLot.DAYS_PER_YEAR):
+                    assets.update_prices(float(randgenerator.normal(0, .02)))
+                    if day % 5 == 0:
+                        assets.buy_new_lot(float(randgenerator.uniform(100, 1000)), FEE_PER_DOLLAR_TRADED, day)
+                    if day % 17 == 16:
+                        assets.sell(float(randgenerator.uniform(100, 1000)), FEE_PER_DOLLAR_TRADED, day, gains,
+                                    sell_best_for_taxes_first)
+                    if day % 90 == 89:
+                        assets.tax_loss_harvest(FEE_PER_DOLLAR_TRADED, day, gains)
+                self.assertGreater(assets.num_lots, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import StringIO
+import sys
+import unittest
+import numpy
+import BatchedAccounts
+import BatchedTaxes
+import EtfLot
+import Investor
+import Market
+import TaxRates
+import margin_leverage
+import random_streams
+
+NUM_PATHS = 3 # per scenario
+
+class BatchedParityTest(unittest.TestCase):
+    """batched_runs redoes one_run's accounting for many paths at once, so
+    on the same paths it should agree with one_run to within
+    BATCHED_PARITY_TOLERANCE on every scenario it supports"""
+
+    def setUp(self):
+        self.__partial_sales_reduce_basis = EtfLot.PARTIAL_SALES_REDUCE_BASIS
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = True # batched_runs needs it
+
+    def tearDown(self):
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = self.__partial_sales_reduce_basis
+
+    def test_batched_runs_agree_with_one_run(self):
+        num_scenarios_compared = 0
+        for scenario_name in sorted(margin_leverage.SCENARIOS.keys()):
+            (investor, market, num_trials, outpath) = margin_leverage.args_for_this_scenario(scenario_name,
+                                                                                             NUM_PATHS, "")
+            if margin_leverage.kernel_run_is_supported(investor, 0): # batched_runs doesn't harvest either
+                max_relative_difference = margin_leverage.compare_batched_runs_with_one_run(investor, market,
+                                                                                            NUM_PATHS)
+                self.assertLessEqual(max_relative_difference, margin_leverage.BATCHED_PARITY_TOLERANCE,
+                                     scenario_name)
+                num_scenarios_compared += 1
+        self.assertGreater(num_scenarios_compared, 0)
+
+class AggregatedLongTermLotsTest(unittest.TestCase):
+    """With AGGREGATE_LONG_TERM_LOTS, an account should only keep a column for
+    each of the past year's purchases, and otherwise hold and sell what it
+    would without it"""
+
+    def setUp(self):
+        self.__settings = (EtfLot.PARTIAL_SALES_REDUCE_BASIS, BatchedAccounts.AGGREGATE_LONG_TERM_LOTS)
+        EtfLot.PARTIAL_SALES_REDUCE_BASIS = True
+
+    def tearDown(self):
+        (EtfLot.PARTIAL_SALES_REDUCE_BASIS, BatchedAccounts.AGGREGATE_LONG_TERM_LOTS) = self.__settings
+
+    def accounts_after_three_years(self, aggregate_long_term_lots):
+        BatchedAccounts.AGGREGATE_LONG_TERM_LOTS = aggregate_long_term_lots
+        accounts = BatchedAccounts.BatchedAccounts(2, .5, False, False, 1.0)
+        randgenerator = numpy.random.RandomState(0)
+        for day in xrange(0, 3*EtfLot.DAYS_PER_YEAR, 30):
+            accounts.buy_ETF_at_fixed_ratio(numpy.array([1000.0, 500.0]), day, 10)
+            accounts.update_asset_prices(1 + randgenerator.normal(.01, .05, 2))
+        return accounts
+
+    def test_only_the_past_years_lots_have_columns(self):
+        (accounts, aggregated_accounts) = [self.accounts_after_three_years(aggregate_long_term_lots)
+                                           for aggregate_long_term_lots in [False, True]]
+        self.assertEqual(accounts.num_lot_columns, 37)
+        self.assertEqual(aggregated_accounts.num_lot_columns, 1 + 13)
+        numpy.testing.assert_allclose(aggregated_accounts.assets(), accounts.assets(), rtol=1e-12)
+
+        tax_rates = TaxRates.TaxRates()
+        (taxes, aggregated_taxes) = (BatchedTaxes.BatchedTaxes(tax_rates, 2), BatchedTaxes.BatchedTaxes(tax_rates, 2))
+        paths = numpy.array([True, True])
+        day = 3*EtfLot.DAYS_PER_YEAR
+        self.assertEqual(accounts.pay_off_all_margin(day, taxes, paths).tolist(), [0, 0])
+        self.assertEqual(aggregated_accounts.pay_off_all_margin(day, aggregated_taxes, paths).tolist(), [0, 0])
+        numpy.testing.assert_allclose(aggregated_accounts.assets(), accounts.assets(), rtol=1e-12)
+
+    def test_batched_runs_approximate_one_run(self):
+        investor = Investor.Investor(years_until_donate=3, does_broker_liquidation_sell_tax_favored_first=True)
+        market = Market.Market()
+        calendar = margin_leverage.trading_calendar(int(EtfLot.DAYS_PER_YEAR * investor.years_until_donate))
+        schedule = margin_leverage.horizon_schedule(investor, market)
+        num_paths = 10
+        daily_returns = random_streams.daily_returns_for_paths(market, calendar.trading_days,
+            random_streams.DEFAULT_SCENARIO_SEED, 0, num_paths)
+        employment_draws = random_streams.employment_draws_for_paths(random_streams.DEFAULT_SCENARIO_SEED, 0,
+            num_paths, len(schedule.annual_incomes_before_layoff_penalty))
+        ending_balances = []
+        for aggregate_long_term_lots in [False, True]:
+            BatchedAccounts.AGGREGATE_LONG_TERM_LOTS = aggregate_long_term_lots
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO() # warnings about the simple approximation
+            try:
+                results = margin_leverage.batched_runs(investor, market, 0, None, 0, 0, daily_returns,
+                                                       employment_draws, 0, None, schedule)
+            finally:
+                sys.stdout = stdout
+            ending_balances.append(numpy.array(results[:3]))
+        # the regular and 401k accounts don't keep lots
+        numpy.testing.assert_array_equal(ending_balances[1][[0,2]], ending_balances[0][[0,2]])
+        numpy.testing.assert_allclose(ending_balances[1][1], ending_balances[0][1], rtol=.01)
+        self.assertFalse(numpy.array_equal(ending_balances[1][1], ending_balances[0][1]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+from os import path
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import Checkpoints
+import Investor
+import Market
+import margin_leverage
+
+class Crash(Exception):
+    pass
+
+class ShardCheckpointTest(unittest.TestCase):
+    """A run of run_sharded_samples in this process (one worker) that's
+    stopped partway through should, when run again, load the shards that
+    finished instead of running them, even though the shards that ran
+    changed the Investor they share (e.g., laid_off)"""
+
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.SAMPLES_PER_SHARD, margin_leverage.run_sample_shard_task)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = False
+        margin_leverage.USE_PROGRESS_LOG = False
+        margin_leverage.SAMPLES_PER_SHARD = 2
+        self.__num_shards_run = 0
+        self.__num_shards_before_crash = None
+        run_sample_shard_task = margin_leverage.run_sample_shard_task
+        def crashing_run_sample_shard_task(shard_task):
+            if self.__num_shards_run == self.__num_shards_before_crash:
+                raise Crash()
+            self.__num_shards_run += 1
+            return run_sample_shard_task(shard_task)
+        margin_leverage.run_sample_shard_task = crashing_run_sample_shard_task
+        self.investor = Investor.Investor(years_until_donate=1, monthly_probability_of_layoff=.5,
+                                          monthly_probability_find_work_after_laid_off=0)
+        self.market = Market.Market()
+        self.checkpoints = Checkpoints.Checkpoints(path.join(self.__temp_dir, "checkpoints"))
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.SAMPLES_PER_SHARD, margin_leverage.run_sample_shard_task) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def run_sharded_samples(self, num_samples, num_shards_before_crash=None):
+        """(number of shards run, merged results or None if it crashed, what
+        run_sharded_samples printed)"""
+        self.__num_shards_run = 0
+        self.__num_shards_before_crash = num_shards_before_crash
+        results_by_run = dict()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            margin_leverage.run_sharded_samples([((self.investor, self.market, num_samples, ""),
+                                                  {"verbosity": 0})], 1, results_by_run.__setitem__,
+                                                self.checkpoints)
+        except Crash:
+            pass
+        finally:
+            printed = sys.stdout.getvalue()
+            sys.stdout = stdout
+        return (self.__num_shards_run, results_by_run.get(0), printed)
+
+    def test_resume_loads_finished_shards(self):
+        (num_shards_run, results, printed) = self.run_sharded_samples(12, num_shards_before_crash=3)
+        self.assertEqual(num_shards_run, 3)
+        self.assertIsNone(results)
+        self.assertTrue(self.investor.laid_off) # so the shards that ran did change the investor
+        (num_shards_run, results, printed) = self.run_sharded_samples(12)
+        self.assertEqual(num_shards_run, 3)
+        self.assertIn("Loaded 3 of 6 shards from checkpoints", printed)
+        self.assertEqual(results.num_samples, 12)
+
+    def test_finished_run_removes_its_shard_checkpoints(self):
+        (num_shards_run, results, printed) = self.run_sharded_samples(12)
+        self.assertEqual(num_shards_run, 6)
+        self.assertEqual(os.listdir(path.join(self.__temp_dir, "checkpoints")), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import itertools
+import math
+import StringIO
+import sys
+import unittest
+import numpy
+import Investor
+import Market
+import margin_leverage
+import random_streams
+import util
+from EtfLot import DAYS_PER_YEAR
+
+class FixedDraws(object):
+    """Employment generator whose draws are given"""
+
+    def __init__(self, draws):
+        self.__draws = iter(draws)
+
+    def random(self):
+        return next(self.__draws)
+
+class ExpectedAnnualIncomesTest(unittest.TestCase):
+    def test_expected_incomes_average_over_every_employment_history(self):
+        """Each month either changes employment (a draw of 0) or doesn't (a
+        draw just under 1). The layoffs are frequent enough that the income
+        penalty stops growing."""
+        investor = Investor.Investor(monthly_probability_of_layoff=.4,
+                                     monthly_probability_find_work_after_laid_off=.7)
+        pay_days = range(0, 13*30, 30) # into the second year
+        inflation_rate = .03
+        expected_incomes = numpy.zeros(len(pay_days))
+        for changes in itertools.product([True, False], repeat=len(pay_days)):
+            investor.reset_employment_for_next_round()
+            randgenerator = FixedDraws([0.0 if change else .999 for change in changes])
+            (probability, incomes) = (1.0, [])
+            for (day, change) in zip(pay_days, changes):
+                incomes.append(investor.current_annual_income(day/DAYS_PER_YEAR, day, inflation_rate))
+                probability_of_change = investor.monthly_probability_find_work_after_laid_off \
+                    if investor.laid_off else investor.monthly_probability_of_layoff
+                probability *= probability_of_change if change else 1-probability_of_change
+                investor.randomly_update_employment_status_this_month(randgenerator)
+            expected_incomes += probability * numpy.array(incomes)
+        numpy.testing.assert_allclose(investor.expected_annual_incomes(pay_days, DAYS_PER_YEAR, inflation_rate),
+                                      expected_incomes, rtol=1e-12)
+
+    def test_only_paid_in_first_month(self):
+        investor = Investor.Investor(only_paid_in_first_month_of_sim=True)
+        expected_incomes = investor.expected_annual_incomes([0, 30, 60], DAYS_PER_YEAR, .03)
+        self.assertEqual(expected_incomes, [investor.initial_annual_income_for_investing, 0, 0])
+
+class ControlVariatesTest(unittest.TestCase):
+    def one_run_control_variates(self, investor, market, path_index):
+        calendar = margin_leverage.trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate))
+        daily_returns = random_streams.daily_returns_for_paths(market, calendar.trading_days,
+            random_streams.DEFAULT_SCENARIO_SEED, path_index, 1)[0]
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            return margin_leverage.one_run(investor, market, 0, None, path_index, 0,
+                random_streams.employment_generator(random_streams.DEFAULT_SCENARIO_SEED, path_index),
+                daily_returns, random_streams.lot_ordering_generator(random_streams.DEFAULT_SCENARIO_SEED,
+                                                                     path_index))[-1]
+        finally:
+            sys.stdout = stdout
+
+    def test_control_variates_without_randomness_equal_their_expectations(self):
+        investor = Investor.Investor(years_until_donate=2, monthly_probability_of_layoff=0)
+        market = Market.Market(annual_sigma=0, medium_black_swan_prob=0, large_black_swan_prob=0)
+        numpy.testing.assert_allclose(self.one_run_control_variates(investor, market, 0),
+                                      margin_leverage.expected_control_variate_values(investor, market),
+                                      rtol=1e-12)
+
+    def test_control_variates_average_to_their_expectations(self):
+        num_paths = 60
+        investor = Investor.Investor(years_until_donate=1, monthly_probability_of_layoff=.1)
+        market = Market.Market(medium_black_swan_prob=.05)
+        control_variates = numpy.array([self.one_run_control_variates(investor, market, path_index)
+                                        for path_index in xrange(num_paths)])
+        for (type_num, expected_value) in enumerate(margin_leverage.expected_control_variate_values(investor,
+                                                                                                    market)):
+            self.assertLess(abs(numpy.mean(control_variates[:,type_num]) - expected_value),
+                            4 * util.stderr(control_variates[:,type_num]), margin_leverage.TYPES[type_num])
+
+    def test_estimate_with_a_perfect_control_is_exact(self):
+        control_values = numpy.array([1.0, 4.0, 2.0, 7.0])
+        (mean, stderr) = util.control_variate_mean_and_stderr(3 * control_values + 5, control_values, 2.5)
+        self.assertAlmostEqual(mean, 3 * 2.5 + 5, places=12)
+        self.assertAlmostEqual(stderr, 0, places=12)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import StringIO
+import sys
+import unittest
+import numpy
+import Assets
+import margin_leverage
+import random_streams
+from EtfLot import DAYS_PER_YEAR
+
+NUM_PATHS = 3 # per scenario
+
+class DaysWithoutEventsTest(unittest.TestCase):
+    """simulate_days_without_events compounds the days between events in one
+    step, in the same order as one_run's daily loop, so one_run should give
+    exactly the same results whether or not SKIP_DAYS_WITHOUT_EVENTS"""
+
+    def setUp(self):
+        self.__skip_days_without_events = margin_leverage.SKIP_DAYS_WITHOUT_EVENTS
+
+    def tearDown(self):
+        margin_leverage.SKIP_DAYS_WITHOUT_EVENTS = self.__skip_days_without_events
+
+    def one_run_results(self, scenario_name, path_index, skip_days_without_events):
+        margin_leverage.SKIP_DAYS_WITHOUT_EVENTS = skip_days_without_events
+        (investor, market, num_trials, outpath) = margin_leverage.args_for_this_scenario(scenario_name,
+                                                                                         NUM_PATHS, "")
+        calendar = margin_leverage.trading_calendar(int(DAYS_PER_YEAR * investor.years_until_donate))
+        daily_returns = random_streams.daily_returns_for_paths(market, calendar.trading_days,
+            random_streams.DEFAULT_SCENARIO_SEED, path_index, 1)[0]
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO() # warnings about margin calls and the like
+        try:
+            return margin_leverage.one_run(investor, market, 0, None, path_index, 0,
+                random_streams.employment_generator(random_streams.DEFAULT_SCENARIO_SEED, path_index),
+                daily_returns, random_streams.lot_ordering_generator(random_streams.DEFAULT_SCENARIO_SEED,
+                                                                     path_index))
+        finally:
+            sys.stdout = stdout
+
+    def check_skipping_days_changes_nothing(self, scenario_name):
+        for path_index in xrange(NUM_PATHS):
+            for (skipped_values, daily_values) in zip(self.one_run_results(scenario_name, path_index, True),
+                                                      self.one_run_results(scenario_name, path_index, False)):
+                self.assertTrue(numpy.array_equal(numpy.array(skipped_values, dtype=float),
+                                                  numpy.array(daily_values, dtype=float)),
+                                "%s, path %i" % (scenario_name, path_index))
+
+    def test_vix(self):
+        self.check_skipping_days_changes_nothing("Use VIX data")
+
+    def test_unemployment(self):
+        self.check_skipping_days_changes_nothing("Unemployment lasts a long time")
+
+    def test_margin_calls_selling_in_random_order_with_high_volatility(self):
+        self.check_skipping_days_changes_nothing("Annual sigma = .4")
+
+    def test_tax_loss_harvest_days(self):
+        """Harvest days are event days, for investors that do tax-loss
+        harvesting, like the default one, and those that don't. Assets only
+        harvests lots if HARVEST_LOTS_WITH_LOSSES, which one_run can't run
+        with: its regular account would then pay fees and taxes, which
+        one_run asserts it never does. So no lots are actually harvested."""
+        self.assertFalse(Assets.HARVEST_LOTS_WITH_LOSSES)
+        self.check_skipping_days_changes_nothing("Default")
+        self.check_skipping_days_changes_nothing(
+            "No unemployment or inflation or taxes or black swans, no emergency savings")
+
+class EventDaysTest(unittest.TestCase):
+    """What simulate_days_without_events relies on: no event day is skipped,
+    and compounding prices over days gives the same values as daily updates"""
+
+    def test_next_event_days(self):
+        (investor, market, num_trials, outpath) = margin_leverage.args_for_this_scenario("Default", 1, "")
+        num_days = int(DAYS_PER_YEAR * investor.years_until_donate)
+        calendar = margin_leverage.trading_calendar(num_days)
+        schedule = margin_leverage.horizon_schedule(investor, market)
+        is_event_day = [calendar.is_pay_day[day] or calendar.is_tax_day[day] or
+                        calendar.is_tax_loss_harvest_day[day] or day == num_days-1 or
+                        (day > 0 and schedule.years_remaining[day] != schedule.years_remaining[day-1])
+                        for day in xrange(num_days)]
+        for day in xrange(num_days):
+            next_event_day = schedule.next_event_days[day]
+            self.assertTrue(is_event_day[next_event_day])
+            self.assertFalse(any(is_event_day[day:next_event_day]))
+
+    def test_price_updates_over_days_match_daily_ones(self):
+        randgenerator = numpy.random.RandomState(0)
+        (daily_assets, skipping_assets) = (Assets.Assets(), Assets.Assets())
+        for assets in [daily_assets, skipping_assets]:
+            assets.buy_new_lot(1000.0, 0, 0)
+        growth_factors = 1 + randgenerator.normal(0, .02, 30)
+        for growth_factor in growth_factors:
+            daily_assets.update_prices(growth_factor - 1)
+        self.assertEqual(skipping_assets.total_assets_after_price_updates(growth_factors)[-1],
+                         daily_assets.total_assets())
+        skipping_assets.update_prices_over_days(growth_factors)
+        self.assertEqual(skipping_assets.total_assets(), daily_assets.total_assets())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import BrokerageAccount
+import Investor
+import Market
+import margin_leverage
+import util
+from margin_leverage import DAYS_PER_YEAR, INTEREST_AND_SALARY_EVERY_NUM_DAYS
+
+class HorizonScheduleTest(unittest.TestCase):
+    """HorizonSchedule's tables should hold what one_run used to compute
+    from the investor and market each day or pay day"""
+
+    def setUp(self):
+        self.investor = Investor.Investor(years_until_donate=3, taper_off_leverage_a_lot_toward_end=True,
+                                          rebalance_monthly_to_increase_leverage=False,
+                                          pay_principal_throughout=True)
+        self.market = Market.Market()
+        self.num_days = int(DAYS_PER_YEAR * self.investor.years_until_donate)
+        self.calendar = margin_leverage.trading_calendar(self.num_days)
+        self.schedule = margin_leverage.horizon_schedule(self.investor, self.market)
+
+    def test_years(self):
+        for day in xrange(self.num_days):
+            self.assertEqual(self.schedule.years_elapsed[day], day/DAYS_PER_YEAR)
+            self.assertEqual(self.schedule.years_remaining[day], (self.num_days-day)/DAYS_PER_YEAR)
+
+    def test_pay_and_principal_repayments(self):
+        self.investor.reset_employment_for_next_round()
+        for (pay_period, day) in enumerate(self.calendar.pay_days):
+            self.assertAlmostEqual(
+                self.schedule.annual_incomes_before_layoff_penalty[pay_period] * self.schedule.pay_fraction_of_year,
+                self.investor.current_annual_income(day/DAYS_PER_YEAR, day, self.market.inflation_rate) *
+                (float(INTEREST_AND_SALARY_EVERY_NUM_DAYS) / DAYS_PER_YEAR), places=9)
+            self.assertAlmostEqual(self.schedule.principal_repayment_fractions[pay_period] * 10000.0,
+                util.per_period_annuity_payment_of_principal(10000.0,
+                    (self.num_days - day) / INTEREST_AND_SALARY_EVERY_NUM_DAYS,
+                    self.market.annual_margin_interest_rate, True), places=9)
+        self.assertAlmostEqual(self.schedule.present_value(12345.0),
+                               self.market.present_value(12345.0, self.investor.years_until_donate), places=9)
+
+    def test_leverage_tapers_toward_the_end(self):
+        account = BrokerageAccount.BrokerageAccount(0, 0, self.investor.broker_max_margin_to_assets_ratio,
+            True, True, self.investor.initial_personal_max_margin_to_assets_relative_to_broker_max)
+        leverage_multiples = self.schedule.margin_leverage_multiples
+        self.assertEqual(leverage_multiples, [util.max_margin_to_assets_ratio_to_N_to_1_leverage(
+            account.personal_max_margin_to_assets_ratio(years_remaining)) for years_remaining in xrange(4)])
+        self.assertLess(leverage_multiples[0], leverage_multiples[-1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import margin_leverage
+from margin_leverage import EXP_UTIL_OBJECTIVE, MEDIAN_OBJECTIVE
+
+SCENARIO_NAME = "Donate after 5 years" # short, so quick to search
+
+class LeverageSearchObjectiveTest(unittest.TestCase):
+    def test_objectives_are_read_from_the_output(self):
+        output_tuple = (2.0, 1.1, .01, 1.2, 1.05, .02)
+        self.assertEqual(margin_leverage.leverage_search_objective(output_tuple, EXP_UTIL_OBJECTIVE), (1.05, .02))
+        self.assertEqual(margin_leverage.leverage_search_objective(output_tuple, MEDIAN_OBJECTIVE), (1.2, None))
+        self.assertRaises(AssertionError, margin_leverage.leverage_search_objective, output_tuple, "mean")
+
+    def test_only_significantly_worse_amounts_are_dropped(self):
+        z = margin_leverage.LEVERAGE_SEARCH_CONFIDENCE_Z
+        self.assertTrue(margin_leverage.leverage_could_be_optimal(1.0, 1.0 + .99 * z * .01, .01))
+        self.assertFalse(margin_leverage.leverage_could_be_optimal(1.0, 1.0 + 1.01 * z * .01, .01))
+        self.assertTrue(margin_leverage.leverage_could_be_optimal(1.0, 1.0, None))
+        self.assertFalse(margin_leverage.leverage_could_be_optimal(.999, 1.0, None))
+
+class SearchForOptimalLeverageTest(unittest.TestCase):
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.SCENARIOS)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = False
+        margin_leverage.USE_PROGRESS_LOG = False
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.SCENARIOS) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def search(self, dir_name, search_function=margin_leverage.search_for_optimal_leverage, **kwargs):
+        """(what search_function returned, the rounds it wrote)"""
+        cur_working_dir = os.path.join(self.__temp_dir, dir_name)
+        os.mkdir(cur_working_dir)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            result = search_function(SCENARIO_NAME, 8, False, cur_working_dir, num_workers=1, **kwargs)
+        finally:
+            sys.stdout = stdout
+        with open(os.path.join(self.scenario_dir(dir_name), margin_leverage.LEVERAGE_SEARCH_FILE_NAME)) as search_file:
+            return (result, search_file.read())
+
+    def scenario_dir(self, dir_name):
+        return os.path.join(self.__temp_dir, dir_name,
+                            margin_leverage.dir_prefix_for_optimal_leverage_specific_scenario(SCENARIO_NAME))
+
+    def test_search_halves_the_leverage_amounts_each_round(self):
+        ((best_leverage, (low, high), value, stderr), rounds) = self.search("search", num_leverage_amounts=3)
+        self.assertEqual([line.split(":")[0] for line in rounds.splitlines() if line.endswith("samples:")],
+                         ["2 samples", "4 samples", "8 samples"])
+        self.assertEqual(rounds.count("leverage: "), 3 + 2 + 1)
+        self.assertIn("Ran 14 samples, vs. 24", rounds)
+        self.assertTrue(low <= best_leverage <= high)
+
+        # The best leverage amount's samples, run in rounds, give the same
+        # results as running them all at once
+        ((one_leverage, interval, one_value, one_stderr), one_round) = self.search(
+            "one", min_leverage=best_leverage, max_leverage=best_leverage, num_leverage_amounts=1)
+        self.assertEqual((one_leverage, one_value, one_stderr), (best_leverage, value, stderr))
+
+    def test_leverage_amounts_to_keep_run_all_the_samples(self):
+        (result, rounds) = self.search("search", num_leverage_amounts=3, leverage_amounts_to_keep=[4.0])
+        last_round = rounds[rounds.index("8 samples:"):rounds.index("Optimal leverage")]
+        self.assertIn("4.000:1 leverage", last_round) # which is dropped without being kept
+
+    def test_all_scenarios_can_be_searched_instead_of_swept(self):
+        margin_leverage.SCENARIOS = {SCENARIO_NAME: margin_leverage.SCENARIOS[SCENARIO_NAME]}
+        (result, rounds) = self.search("all", lambda scenario_name, *args, **kwargs:
+            margin_leverage.optimal_leverage_for_all_scenarios(*args, search=True, **kwargs))
+        last_round = rounds[rounds.index("8 samples:"):rounds.index("Optimal leverage")]
+        self.assertIn("2.000:1 leverage", last_round) # the default, which write_essay reports
+        self.assertTrue(os.path.exists(os.path.join(self.scenario_dir("all"),
+            margin_leverage.file_prefix_for_optimal_leverage_specific_scenario(.5) + "_table.txt")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import numpy
+from LotGroup import LotGroup
+
+class LotGroupTest(unittest.TestCase):
+    """Lots should stay sorted by basis per share, highest first, with ties in
+    the order they were inserted, whatever is inserted, removed or sold"""
+
+    def check_lots(self, lots, expected_lots):
+        """expected_lots is a list of (purchase price, purchase day, shares)"""
+        self.assertEqual(lots.num_lots, len(expected_lots))
+        self.assertEqual(zip(lots.purchase_prices.tolist(), lots.purchase_days.tolist(), lots.shares.tolist()),
+                         expected_lots)
+
+    def test_lots_are_sorted_by_basis_per_share_with_ties_in_insertion_order(self):
+        lots = LotGroup()
+        randgenerator = numpy.random.RandomState(0)
+        expected_lots = []
+        for day in xrange(50): # more lots than the arrays start with room for
+            basis_per_share = float(randgenerator.choice([.5, 1.0, 2.0, 4.0]))
+            shares = float(randgenerator.randint(1, 10))
+            lots.insert(basis_per_share * shares, day, shares)
+            expected_lots.append((basis_per_share * shares, day, shares))
+        expected_lots.sort(key=lambda (purchase_price, day, shares): -purchase_price / shares) # stable
+        self.check_lots(lots, expected_lots)
+
+        lots.remove(3)
+        lots.remove_first(2)
+        del expected_lots[3]
+        del expected_lots[:2]
+        self.check_lots(lots, expected_lots)
+        self.assertEqual(lots.num_purchases, 47)
+
+    def test_lots_with_losses_are_a_prefix(self):
+        lots = LotGroup()
+        for (day, basis_per_share) in enumerate([1.0, 3.0, 2.0, 2.0, 1.5]):
+            lots.insert(basis_per_share, day, 1.0)
+        self.assertEqual([lots.num_lots_with_basis_per_share_above(share_price) for share_price in
+                          [.5, 1.0, 1.75, 2.0, 2.5, 3.0]], [5, 4, 3, 1, 1, 0])
+
+    def test_partial_sales(self):
+        lots = LotGroup()
+        for (day, purchase_price) in enumerate([3.0, 2.0, 1.0]):
+            lots.insert(purchase_price, day, 1.0)
+        lots.sell_fraction(0, .25) # keeps its basis per share
+        self.check_lots(lots, [(2.25, 0, .75), (2.0, 1, 1.0), (1.0, 2, 1.0)])
+        lots.sell_shares(2, .75) # keeps its purchase price, so its basis per share goes up to 4
+        self.check_lots(lots, [(1.0, 2, .25), (2.25, 0, .75), (2.0, 1, 1.0)])
+
+    def test_purchases_on_or_before(self):
+        lots = LotGroup()
+        for (day, purchase_price) in [(5, 1.0), (1, 3.0), (3, 2.0)]:
+            lots.insert(purchase_price, day, 1.0)
+        self.assertEqual(lots.indices_of_lots_purchased_on_or_before(3).tolist(), [0, 1])
+
+if __name__ == "__main__":
+    unittest.main()
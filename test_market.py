@@ -0,0 +1,103 @@
+import math
+import os
+from os import path
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy
+import Market
+
+TRADING_DAYS = [0, 1, 2, 5, 6, 7, 8, 9, 12, 3000]
+
+class RandomDailyReturnsTest(unittest.TestCase):
+    """Market.random_daily_returns should apply random_daily_return's formula
+    and black-swan mixture to each of its draws: first one uniform per path
+    and day, which picks the black swans, then one normal shock"""
+
+    def draws(self, num_paths, seed=0):
+        randgenerator = numpy.random.RandomState(seed)
+        return (randgenerator.random_sample((num_paths, len(TRADING_DAYS))),
+                randgenerator.standard_normal((num_paths, len(TRADING_DAYS))))
+
+    def test_returns_without_black_swans(self):
+        market = Market.Market(annual_mu=.07, annual_sigma=.3, medium_black_swan_prob=0,
+                               large_black_swan_prob=0)
+        returns = market.random_daily_returns(3, TRADING_DAYS, numpy.random.RandomState(0))
+        (rand_floats, randgauss) = self.draws(3)
+        self.assertEqual(returns.shape, (3, len(TRADING_DAYS)))
+        numpy.testing.assert_allclose(returns, .3 * randgauss * math.sqrt(1/252.0) + .07/252, rtol=1e-14)
+
+    def test_black_swans_have_their_own_sigma_and_no_drift(self):
+        (medium_black_swan_prob, large_black_swan_prob) = (.3, .2)
+        market = Market.Market(annual_mu=.07, annual_sigma=.3, medium_black_swan_prob=medium_black_swan_prob,
+                               large_black_swan_prob=large_black_swan_prob)
+        returns = market.random_daily_returns(50, TRADING_DAYS, numpy.random.RandomState(0))
+        (rand_floats, randgauss) = self.draws(50)
+        large_black_swans = rand_floats < large_black_swan_prob
+        medium_black_swans = (rand_floats >= large_black_swan_prob) & \
+            (rand_floats < large_black_swan_prob + medium_black_swan_prob)
+        self.assertTrue(large_black_swans.any() and medium_black_swans.any())
+        expected_returns = .3 * randgauss * math.sqrt(1/252.0) + .07/252
+        expected_returns[medium_black_swans] = market.annual_sigma_for_medium_black_swan * \
+            randgauss[medium_black_swans] * math.sqrt(1/252.0)
+        expected_returns[large_black_swans] = market.annual_sigma_for_large_black_swan * \
+            randgauss[large_black_swans] * math.sqrt(1/252.0)
+        numpy.testing.assert_allclose(returns, expected_returns, rtol=1e-14)
+
+    def test_VIX_sigmas_are_looked_up_by_day(self):
+        market = Market.Market(annual_mu=.07, use_VIX_data_for_volatility=True, medium_black_swan_prob=0,
+                               large_black_swan_prob=0)
+        vix_sigmas = Market.load_volatility_series()
+        returns = market.random_daily_returns(2, TRADING_DAYS, numpy.random.RandomState(0))
+        (rand_floats, randgauss) = self.draws(2)
+        sigmas = vix_sigmas[numpy.array(TRADING_DAYS) % len(vix_sigmas)] # day 3000 wraps around
+        numpy.testing.assert_allclose(returns, sigmas * randgauss * math.sqrt(1/252.0) + .07/252, rtol=1e-14)
+
+class VolatilitySeriesTest(unittest.TestCase):
+    """load_volatility_series parses a series once, then maps its .npy copy"""
+
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        self.text_file_name = path.join(self.__temp_dir, "sigmas.txt")
+        self.write_series(["18.22", "20.5", "", "31.0"])
+
+    def tearDown(self):
+        Market.VOLATILITY_SERIES_BY_FILE.pop(self.text_file_name, None)
+        shutil.rmtree(self.__temp_dir)
+
+    def write_series(self, lines):
+        with open(self.text_file_name, "w") as text_file:
+            text_file.write("\n".join(lines) + "\n")
+
+    def test_series_is_parsed_once_and_shared(self):
+        sigmas = Market.load_volatility_series(self.text_file_name)
+        numpy.testing.assert_allclose(sigmas, [.1822, .205, .31], rtol=1e-15)
+        self.assertTrue(path.exists(Market.volatility_series_cache_file_name(self.text_file_name)))
+        self.assertIsInstance(sigmas, numpy.memmap)
+        self.assertFalse(sigmas.flags.writeable)
+        self.assertIs(Market.load_volatility_series(self.text_file_name), sigmas)
+
+    def test_cache_is_rebuilt_when_the_text_is_newer(self):
+        Market.load_volatility_series(self.text_file_name)
+        del Market.VOLATILITY_SERIES_BY_FILE[self.text_file_name]
+        self.write_series(["10", "40"])
+        cache_file_name = Market.volatility_series_cache_file_name(self.text_file_name)
+        os.utime(cache_file_name, (0, 0))
+        numpy.testing.assert_allclose(Market.load_volatility_series(self.text_file_name), [.1, .4], rtol=1e-15)
+
+    def test_pickled_market_maps_the_series_again(self):
+        market = Market.Market(use_VIX_data_for_volatility=True, volatility_data_file=self.text_file_name)
+        pickled_market = pickle.dumps(market, pickle.HIGHEST_PROTOCOL)
+        self.assertNotIn(numpy.asarray(Market.load_volatility_series(self.text_file_name)).tostring(),
+                         pickled_market)
+        unpickled_market = pickle.loads(pickled_market)
+        self.assertIsNotNone(market.volatility_data_hash)
+        self.assertEqual(unpickled_market.volatility_data_hash, market.volatility_data_hash)
+        trading_days = range(5)
+        numpy.testing.assert_array_equal(
+            unpickled_market.random_daily_returns(2, trading_days, numpy.random.RandomState(0)),
+            market.random_daily_returns(2, trading_days, numpy.random.RandomState(0)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+import margin_leverage
+
+NUM_PATHS = 2 # per scenario; kernel_run is slow without numba
+
+class KernelParityTest(unittest.TestCase):
+    """path_kernel.simulate_path redoes one_run's accounting, so kernel_run
+    should agree with one_run on every scenario it supports"""
+
+    def test_kernel_run_agrees_with_one_run(self):
+        num_scenarios_compared = 0
+        for scenario_name in sorted(margin_leverage.SCENARIOS.keys()):
+            (investor, market, num_trials, outpath) = margin_leverage.args_for_this_scenario(scenario_name,
+                                                                                             NUM_PATHS, "")
+            if margin_leverage.kernel_run_is_supported(investor, 0):
+                max_relative_difference = margin_leverage.compare_kernel_runs_with_one_run(investor, market,
+                                                                                           NUM_PATHS)
+                self.assertLessEqual(max_relative_difference, margin_leverage.KERNEL_PARITY_TOLERANCE,
+                                     scenario_name)
+                num_scenarios_compared += 1
+        self.assertGreater(num_scenarios_compared, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import Queue
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import numpy
+import Investor
+import Market
+import PathTape
+import margin_leverage
+import random_streams
+
+SEED = random_streams.DEFAULT_SCENARIO_SEED
+
+class PathTapeTest(unittest.TestCase):
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.USE_COMPILED_KERNEL)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = False
+        margin_leverage.USE_PROGRESS_LOG = False
+        margin_leverage.USE_COMPILED_KERNEL = False
+        self.investor = Investor.Investor(years_until_donate=2)
+        self.market = Market.Market()
+        self.calendar = margin_leverage.trading_calendar(int(margin_leverage.DAYS_PER_YEAR *
+                                                             self.investor.years_until_donate))
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.USE_COMPILED_KERNEL) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def tape(self, num_paths, scenario_seed=SEED):
+        return PathTape.PathTape(self.__temp_dir, self.market, self.calendar, num_paths, scenario_seed)
+
+    def check_tape_has_the_streams_draws(self, tape, num_paths):
+        numpy.testing.assert_array_equal(tape.daily_returns_for_paths(0, num_paths),
+            random_streams.daily_returns_for_paths(self.market, self.calendar.trading_days, SEED, 0, num_paths))
+        num_pay_days = len(self.calendar.pay_days)
+        for path_index in xrange(num_paths):
+            employment_generator = random_streams.employment_generator(SEED, path_index)
+            recorded_draws = tape.employment_randgenerator(path_index)
+            for pay_day in xrange(num_pay_days):
+                self.assertEqual(recorded_draws.random(), employment_generator.random())
+
+    def test_tape_has_each_paths_draws(self):
+        self.check_tape_has_the_streams_draws(self.tape(3), 3)
+
+    def test_tapes_are_reused_and_extended(self):
+        tape = self.tape(3)
+        self.assertIs(tape.with_at_least(2), tape)
+        extended_tape = tape.with_at_least(5)
+        self.assertEqual(extended_tape.num_paths, 5)
+        self.check_tape_has_the_streams_draws(extended_tape, 5)
+        self.assertEqual(self.tape(4).num_paths, 5) # the longer tape is reused as is
+        self.assertEqual(self.tape(2, "other seed").num_paths, 2)
+
+    def run_samples(self, num_samples, path_tape=None):
+        output_queue = Queue.Queue()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            margin_leverage.run_samples(self.investor, self.market, num_samples, "", output_queue,
+                                        verbosity=0, num_margin_trajectories_to_save_as_figures=0,
+                                        num_workers=1, path_tape=path_tape)
+        finally:
+            sys.stdout = stdout
+        return output_queue.get()
+
+    def test_runs_from_a_tape_match_runs_without_one(self):
+        self.assertEqual(self.run_samples(4, self.tape(4)), self.run_samples(4))
+
+    def test_tape_must_have_the_runs_seed(self):
+        self.assertRaises(AssertionError, self.run_samples, 2, self.tape(2, "other seed"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import Investor
+import Market
+import ProgressLog
+import margin_leverage
+
+def event(event_name, time, pid, run="run", first_sample=0, end_sample=10, samples_done=0, eta_seconds=None):
+    return {"event": event_name, "time": time, "pid": pid, "run": run, "leverage": 2.0,
+            "first_sample": first_sample, "end_sample": end_sample, "samples_done": samples_done,
+            "eta_seconds": eta_seconds}
+
+class ProgressLogTest(unittest.TestCase):
+    def setUp(self):
+        self.__event_interval_seconds = ProgressLog.EVENT_INTERVAL_SECONDS
+        self.__temp_dir = tempfile.mkdtemp()
+        self.log = ProgressLog.ProgressLog(os.path.join(self.__temp_dir, "progress_log.jsonl"))
+
+    def tearDown(self):
+        ProgressLog.EVENT_INTERVAL_SECONDS = self.__event_interval_seconds
+        shutil.rmtree(self.__temp_dir)
+
+    def test_events_are_read_back_less_a_partly_written_last_line(self):
+        self.assertEqual(self.log.events(), [])
+        self.log.scheduled(20, 2)
+        self.log.write("done", run="run")
+        with open(self.log.file_name, "a") as outfile:
+            outfile.write('{"event": "pro')
+        events = self.log.events()
+        self.assertEqual([(event["event"], event["pid"]) for event in events],
+                         [("scheduled", os.getpid()), ("done", os.getpid())])
+        self.assertEqual((events[0]["num_samples"], events[0]["num_shards"]), (20, 2))
+
+    def test_shards_write_progress_at_most_every_interval(self):
+        ProgressLog.EVENT_INTERVAL_SECONDS = 1000
+        shard_progress = self.log.shard_progress("run", 2.0, 10, 20)
+        shard_progress.update(3)
+        ProgressLog.EVENT_INTERVAL_SECONDS = 0
+        shard_progress.update(4)
+        shard_progress.finish()
+        events = self.log.events()
+        self.assertEqual([(event["event"], event["samples_done"]) for event in events],
+                         [("start", 0), ("progress", 4), ("done", 10)])
+        self.assertEqual((events[1]["first_sample"], events[1]["end_sample"], events[1]["leverage"]), (10, 20, 2.0))
+        self.assertIsNone(events[0]["eta_seconds"])
+        self.assertEqual(events[2]["eta_seconds"], 0)
+
+    def test_summary_is_of_the_shards_since_the_last_scheduled_event(self):
+        self.assertEqual(ProgressLog.summary([]), ["No progress events"])
+        events = [event("done", 0.0, 1),
+                  {"event": "scheduled", "time": 100.0, "pid": 1, "num_samples": 30, "num_shards": 3},
+                  event("start", 100.0, 2),
+                  event("start", 100.0, 3, first_sample=10, end_sample=20),
+                  event("done", 110.0, 2, samples_done=10),
+                  event("progress", 110.0, 3, first_sample=10, end_sample=20, samples_done=5, eta_seconds=10)]
+        self.assertEqual(ProgressLog.summary(events, now=115.0), [
+            "15 of 30 samples (50%) and 1 of 3 shards done in 00:00:15, 1.00 samples/second, about 00:00:15 left",
+            "Worker 2: 10 samples in 1 shards, 1.00 samples/second",
+            "Worker 3: 5 samples in 1 shards, 0.50 samples/second; on run at 2.00:1 leverage, samples 10-19: "
+            "5 done, about 00:00:10 left"])
+
+class RunSamplesProgressLogTest(unittest.TestCase):
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.SAMPLES_PER_SHARD)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = False
+        margin_leverage.USE_PROGRESS_LOG = True
+        margin_leverage.SAMPLES_PER_SHARD = 2
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.SAMPLES_PER_SHARD) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def run_samples(self, num_workers):
+        """What run_samples printed"""
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            margin_leverage.run_samples(Investor.Investor(years_until_donate=1), Market.Market(), 4, "run",
+                                        verbosity=1, num_margin_trajectories_to_save_as_figures=0,
+                                        num_workers=num_workers)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_workers_log_each_shard(self):
+        self.assertNotIn("% done", self.run_samples(2)) # that's left to the log
+        events = ProgressLog.ProgressLog(margin_leverage.PROGRESS_LOG_FILE_NAME).events()
+        self.assertEqual((events[0]["event"], events[0]["num_samples"], events[0]["num_shards"]),
+                         ("scheduled", 4, 2))
+        self.assertEqual(sorted((event["first_sample"], event["end_sample"], event["samples_done"])
+                                for event in events if event["event"] == "done"), [(0, 2, 2), (2, 4, 2)])
+        self.assertNotIn(os.getpid(), [event["pid"] for event in events[1:]])
+        self.assertTrue(ProgressLog.summary(events)[0].startswith("4 of 4 samples (100%) and 2 of 2 shards done"))
+
+    def test_shards_run_in_this_process_print_their_progress(self):
+        self.assertIn("% done", self.run_samples(1))
+
+if __name__ == "__main__":
+    unittest.main()
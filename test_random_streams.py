@@ -0,0 +1,81 @@
+import math
+import unittest
+import numpy
+from scipy.stats import norm
+import Market
+import random_streams
+import util
+
+SEED = random_streams.DEFAULT_SCENARIO_SEED
+TRADING_DAYS = range(40)
+
+class RandomStreamsTest(unittest.TestCase):
+    """Each path's streams depend only on (scenario seed, path index, stream
+    name), so a path's draws are the same whichever paths are drawn with it"""
+
+    def setUp(self):
+        self.market = Market.Market()
+
+    def test_streams_are_reproducible_and_distinct(self):
+        self.assertEqual(random_streams.employment_generator(SEED, 3).random(),
+                         random_streams.employment_generator(SEED, 3).random())
+        draws = [random_streams.employment_generator(SEED, 3).random(),
+                 random_streams.employment_generator(SEED, 4).random(),
+                 random_streams.employment_generator("other seed", 3).random(),
+                 random_streams.lot_ordering_generator(SEED, 3).random()]
+        self.assertEqual(len(set(draws)), len(draws))
+
+    def test_paths_are_the_same_in_any_batch(self):
+        all_paths = random_streams.daily_returns_for_paths(self.market, TRADING_DAYS, SEED, 0, 7)
+        batches = [random_streams.daily_returns_for_paths(self.market, TRADING_DAYS, SEED, first, end-first)
+                   for (first, end) in [(0, 2), (2, 5), (5, 7)]]
+        numpy.testing.assert_array_equal(numpy.concatenate(batches), all_paths)
+        path_4_alone = self.market.random_daily_returns(1, TRADING_DAYS, random_streams.returns_generator(SEED, 4))
+        numpy.testing.assert_array_equal(all_paths[4], path_4_alone[0])
+        self.assertFalse(numpy.array_equal(all_paths[0], all_paths[1]))
+
+class SamplingModesTest(unittest.TestCase):
+    """Without black swans, and with a constant sigma, each day's return
+    gives back its normal shock"""
+
+    def setUp(self):
+        self.market = Market.Market(annual_mu=.07, annual_sigma=.3, medium_black_swan_prob=0,
+                                    large_black_swan_prob=0)
+
+    def shocks(self, first_path_index, num_paths, sampling_mode, num_strata=None):
+        returns = random_streams.daily_returns_for_paths(self.market, TRADING_DAYS, SEED, first_path_index,
+                                                         num_paths, sampling_mode, num_strata)
+        return (returns - .07/252) / (.3 * math.sqrt(1/252.0))
+
+    def test_antithetic_pairs_line_up_at_odd_shard_starts(self):
+        all_paths = self.shocks(0, 8, util.ANTITHETIC_SAMPLING)
+        numpy.testing.assert_allclose(all_paths[1::2], -all_paths[0::2], rtol=1e-12)
+        batches = [self.shocks(first, end-first, util.ANTITHETIC_SAMPLING)
+                   for (first, end) in [(0, 3), (3, 4), (4, 7), (7, 8)]]
+        numpy.testing.assert_array_equal(numpy.concatenate(batches), all_paths)
+
+    def test_antithetic_pairs_share_black_swans(self):
+        """A pair's returns add up to twice the day's drift, which is 0 on
+        black-swan days"""
+        market = Market.Market(medium_black_swan_prob=.2, large_black_swan_prob=.1)
+        returns = random_streams.daily_returns_for_paths(market, TRADING_DAYS, SEED, 1, 4,
+                                                         util.ANTITHETIC_SAMPLING)
+        pair_sums = returns[1] + returns[2] # paths 2 and 3
+        is_black_swan = numpy.abs(pair_sums) < 1e-12
+        self.assertTrue(is_black_swan.any() and not is_black_swan.all())
+        numpy.testing.assert_allclose(pair_sums[~is_black_swan], 2 * market.annual_mu / 252, rtol=1e-9)
+
+    def test_stratified_paths_total_shocks_are_in_their_strata(self):
+        num_strata = 6
+        shocks = self.shocks(0, num_strata, util.STRATIFIED_SAMPLING, num_strata)
+        total_shock_quantiles = norm.cdf(shocks.sum(axis=1) / math.sqrt(len(TRADING_DAYS)))
+        numpy.testing.assert_array_equal(numpy.floor(total_shock_quantiles * num_strata), range(num_strata))
+
+    def test_stderrs(self):
+        values = [1.0, 3.0, 2.0, 6.0]
+        self.assertAlmostEqual(util.stderr(values), numpy.std(values) / 2, places=14)
+        self.assertAlmostEqual(util.stderr(values, util.ANTITHETIC_SAMPLING), 1.0 / math.sqrt(2), places=14)
+        self.assertAlmostEqual(util.stderr(values, util.STRATIFIED_SAMPLING), math.sqrt(4 + 16) / 4, places=14)
+
+if __name__ == "__main__":
+    unittest.main()
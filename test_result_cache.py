@@ -0,0 +1,95 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import Investor
+import Market
+import margin_leverage
+import ResultCache
+import util
+
+class ResultCacheTest(unittest.TestCase):
+    """Runs of run_samples in this process (one worker) with the same Investor
+    object, which one_run's samples change (e.g., laid_off), should still be
+    found in the result cache"""
+
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.SAMPLES_PER_SHARD, margin_leverage.USE_COMPILED_KERNEL,
+                           margin_leverage.run_sample_shard_task)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = True
+        margin_leverage.USE_PROGRESS_LOG = False
+        margin_leverage.SAMPLES_PER_SHARD = 2
+        margin_leverage.USE_COMPILED_KERNEL = False # kernel_run doesn't change the Investor
+        self.__num_samples_run = 0
+        run_sample_shard_task = margin_leverage.run_sample_shard_task
+        def counting_run_sample_shard_task(shard_task):
+            (args, shard_kwargs, first_sample, end_sample) = shard_task
+            self.__num_samples_run += end_sample - first_sample
+            return run_sample_shard_task(shard_task)
+        margin_leverage.run_sample_shard_task = counting_run_sample_shard_task
+        self.investor = Investor.Investor(years_until_donate=1, monthly_probability_of_layoff=.5,
+                                          monthly_probability_find_work_after_laid_off=0)
+        self.market = Market.Market()
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.SAMPLES_PER_SHARD, margin_leverage.USE_COMPILED_KERNEL,
+         margin_leverage.run_sample_shard_task) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def run_samples(self, num_samples):
+        """(number of samples run, what run_samples printed)"""
+        self.__num_samples_run = 0
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            margin_leverage.run_samples(self.investor, self.market, num_samples, "", verbosity=0,
+                                        num_workers=1)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return (self.__num_samples_run, printed)
+
+    def test_key_is_unchanged_by_a_run(self):
+        parameters = util.object_parameters(self.investor)
+        (num_samples_run, printed) = self.run_samples(7)
+        self.assertEqual(num_samples_run, 7)
+        self.assertTrue(self.investor.laid_off) # so the run did change the investor
+        self.assertEqual(util.object_parameters(self.investor), parameters)
+        (num_samples_run, printed) = self.run_samples(7)
+        self.assertEqual(num_samples_run, 0)
+        self.assertIn("Loading cached results", printed)
+
+    def test_top_up_only_runs_new_samples(self):
+        self.run_samples(6)
+        (num_samples_run, printed) = self.run_samples(12)
+        self.assertEqual(num_samples_run, 6)
+        self.assertIn("Topping up 6 cached samples to 12", printed)
+
+    def test_module_settings_changed_at_run_time_are_part_of_the_key(self):
+        skip_days_without_events = margin_leverage.SKIP_DAYS_WITHOUT_EVENTS
+        self.run_samples(4)
+        try:
+            margin_leverage.SKIP_DAYS_WITHOUT_EVENTS = not skip_days_without_events
+            self.assertEqual(self.run_samples(4)[0], 4)
+        finally:
+            margin_leverage.SKIP_DAYS_WITHOUT_EVENTS = skip_days_without_events
+        self.assertEqual(self.run_samples(4)[0], 0)
+
+class CodeVersionTest(unittest.TestCase):
+    def test_only_modules_that_runs_use_change_the_code_version(self):
+        for module_file_name in ["margin_leverage.py", "Assets.py", "path_kernel.py"]:
+            self.assertTrue(ResultCache.can_change_results(module_file_name))
+        for module_file_name in ["write_essay.py", "write_results.py", "test_result_cache.py",
+                                 "oldversion_leveraged_etf_returns.py"]:
+            self.assertFalse(ResultCache.can_change_results(module_file_name))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import math
+import os
+from os import path
+import Queue
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import Investor
+import Market
+import leveraged_etf_returns
+import margin_leverage
+import util
+import write_results
+
+NUM_SAMPLES = 7
+UNEVEN_SHARDS = [(0, 2), (2, 6), (6, 7)] # pairs of samples aren't split, as StreamingStatistics needs
+STREAMING_RELATIVE_TOLERANCE = 1e-12 # StreamingStatistics' merged moments differ in rounding
+
+class SampleShardTest(unittest.TestCase):
+    """Seeded samples draw from their own streams and shards' results are
+    merged in order, so a run split into shards of different sizes should
+    write the same files and send the same output as a run of one shard"""
+
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.USE_COMPILED_KERNEL, margin_leverage.sample_shards)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = False
+        margin_leverage.USE_PROGRESS_LOG = False
+        margin_leverage.USE_COMPILED_KERNEL = False
+        self.__shards = None
+        sample_shards = margin_leverage.sample_shards
+        def sample_shards_of_test(num_samples, num_workers, alignment=1, first_sample_to_run=0):
+            shards = sample_shards(num_samples, num_workers, alignment, first_sample_to_run)
+            return shards if self.__shards is None else self.__shards
+        margin_leverage.sample_shards = sample_shards_of_test
+        self.investor = Investor.Investor(years_until_donate=2)
+        self.market = Market.Market()
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.USE_COMPILED_KERNEL, margin_leverage.sample_shards) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def run_in_shards(self, shards, run):
+        """The text files that run(outfilepath) wrote, by name, and what it
+        sent to an output queue, with the samples split into shards"""
+        self.__shards = shards
+        outdir = tempfile.mkdtemp(dir=self.__temp_dir)
+        output_queue = Queue.Queue()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            run(path.join(outdir, "run"), output_queue)
+        finally:
+            sys.stdout = stdout
+        files = dict()
+        for file_name in os.listdir(outdir):
+            if file_name.endswith(".txt"):
+                with open(path.join(outdir, file_name)) as infile:
+                    files[file_name] = infile.read()
+        outputs = []
+        while not output_queue.empty():
+            outputs.append(output_queue.get())
+        return (files, outputs)
+
+    def check_shards_agree(self, run, exact_statistics):
+        (one_shard_files, one_shard_outputs) = self.run_in_shards([(0, NUM_SAMPLES)], run)
+        (files, outputs) = self.run_in_shards(UNEVEN_SHARDS, run)
+        self.assertIn(write_results.results_table_file_name("run"), files)
+        self.assertEqual(files, one_shard_files)
+        self.assertEqual(len(outputs), len(one_shard_outputs))
+        for (output, one_shard_output) in zip(outputs, one_shard_outputs):
+            if exact_statistics:
+                self.assertEqual(output, one_shard_output)
+            else:
+                for (value, one_shard_value) in zip(output, one_shard_output):
+                    self.assertLessEqual(abs(value - one_shard_value),
+                                         STREAMING_RELATIVE_TOLERANCE * abs(one_shard_value))
+
+    def test_run_samples(self):
+        for exact_statistics in [True, False]:
+            self.check_shards_agree(lambda outfilepath, output_queue: margin_leverage.run_samples(
+                self.investor, self.market, NUM_SAMPLES, outfilepath, output_queue, verbosity=0,
+                num_margin_trajectories_to_save_as_figures=0, num_workers=1,
+                exact_statistics=exact_statistics), exact_statistics)
+
+    def test_many_runs(self):
+        for exact_statistics in [True, False]:
+            self.check_shards_agree(lambda outfilepath, output_queue: leveraged_etf_returns.many_runs(
+                leveraged_etf_returns.FUNDS_AND_EXPENSE_RATIOS, 0, 2.0, NUM_SAMPLES, self.investor,
+                self.market, outfilepath, 0, num_workers=1, exact_statistics=exact_statistics),
+                exact_statistics)
+
+    def test_shards_cover_the_samples_in_aligned_pieces(self):
+        for (num_samples, num_workers, alignment, first_sample_to_run) in [
+                (7, 3, 1, 0), (7, 3, 2, 0), (1000, 4, 1, 0), (1000, 3, 16, 0), (10, 20, 2, 4), (250, 1, 4, 100)]:
+            shards = margin_leverage.sample_shards(num_samples, num_workers, alignment, first_sample_to_run)
+            self.assertEqual(shards[0][0], first_sample_to_run)
+            self.assertEqual(shards[-1][1], num_samples)
+            for ((first_sample, end_sample), (next_first_sample, next_end_sample)) in zip(shards, shards[1:]):
+                self.assertEqual(end_sample, next_first_sample)
+            for (first_sample, end_sample) in shards:
+                self.assertEqual(first_sample % alignment, 0)
+                self.assertLess(first_sample, end_sample)
+                self.assertLessEqual(end_sample - first_sample,
+                                     int(math.ceil(float(margin_leverage.SAMPLES_PER_SHARD) / alignment)) * alignment)
+            if alignment == 1:
+                self.assertGreaterEqual(len(shards), min(num_workers, num_samples - first_sample_to_run))
+
+    def test_pairs_of_antithetic_samples_are_not_split(self):
+        self.assertEqual(margin_leverage.shard_alignment(8, sampling_mode=util.ANTITHETIC_SAMPLING), 2)
+        self.assertEqual(margin_leverage.shard_alignment(8, sampling_mode=util.STRATIFIED_SAMPLING), 2)
+        self.assertEqual(margin_leverage.shard_alignment(NUM_SAMPLES, use_seed_for_randomness=False), NUM_SAMPLES)
+
+    def test_streaming_statistics_shards_start_at_even_samples(self):
+        self.assertEqual(margin_leverage.shard_alignment(NUM_SAMPLES), 1)
+        self.assertEqual(margin_leverage.shard_alignment(NUM_SAMPLES, exact_statistics=False), 2)
+
+if __name__ == "__main__":
+    unittest.main()
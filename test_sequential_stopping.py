@@ -0,0 +1,104 @@
+import os
+import Queue
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import Investor
+import Market
+import margin_leverage
+import util
+
+class SequentialStoppingTest(unittest.TestCase):
+    """Runs with a target_ratio_stderr should stop once their ratios are
+    precise enough or they reach max_num_samples, and give the same output as
+    a run of the number of samples they stopped at"""
+
+    def setUp(self):
+        self.__settings = (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+                           margin_leverage.SAMPLES_PER_SHARD, margin_leverage.USE_COMPILED_KERNEL,
+                           margin_leverage.run_sample_shard_task)
+        self.__cur_working_dir = os.getcwd()
+        self.__temp_dir = tempfile.mkdtemp()
+        os.chdir(self.__temp_dir)
+        margin_leverage.USE_RESULT_CACHE = False
+        margin_leverage.USE_PROGRESS_LOG = False
+        margin_leverage.SAMPLES_PER_SHARD = 2
+        margin_leverage.USE_COMPILED_KERNEL = False
+        self.__num_samples_run = 0
+        run_sample_shard_task = margin_leverage.run_sample_shard_task
+        def counting_run_sample_shard_task(shard_task):
+            (args, shard_kwargs, first_sample, end_sample) = shard_task
+            self.__num_samples_run += end_sample - first_sample
+            return run_sample_shard_task(shard_task)
+        margin_leverage.run_sample_shard_task = counting_run_sample_shard_task
+        self.investor = Investor.Investor(years_until_donate=1)
+        self.market = Market.Market()
+
+    def tearDown(self):
+        (margin_leverage.USE_RESULT_CACHE, margin_leverage.USE_PROGRESS_LOG,
+         margin_leverage.SAMPLES_PER_SHARD, margin_leverage.USE_COMPILED_KERNEL,
+         margin_leverage.run_sample_shard_task) = self.__settings
+        os.chdir(self.__cur_working_dir)
+        shutil.rmtree(self.__temp_dir)
+
+    def run_samples(self, num_samples, **kwargs):
+        """(output sent to the output_queue, number of samples run, what
+        run_samples printed)"""
+        self.__num_samples_run = 0
+        output_queue = Queue.Queue()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            margin_leverage.run_samples(self.investor, self.market, num_samples, "", output_queue,
+                                        verbosity=0, num_margin_trajectories_to_save_as_figures=0,
+                                        num_workers=1, **kwargs)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return (output_queue.get(), self.__num_samples_run, printed)
+
+    def test_precise_runs_stop_at_the_starting_number_of_samples(self):
+        (output, num_samples_run, printed) = self.run_samples(4, target_ratio_stderr=100.0)
+        self.assertEqual(num_samples_run, 4)
+        self.assertIn("Ran 4 samples", printed)
+        self.assertEqual(output, self.run_samples(4)[0])
+
+    def test_imprecise_runs_double_until_max_num_samples(self):
+        (output, num_samples_run, printed) = self.run_samples(4, target_ratio_stderr=1e-12,
+                                                              max_num_samples=16)
+        self.assertEqual(num_samples_run, 16) # 4, then 4 more, then 8 more
+        self.assertIn("Ran 16 samples", printed)
+        self.assertEqual(output, self.run_samples(16)[0])
+
+    def test_max_num_samples_defaults_to_a_multiple_of_the_starting_number(self):
+        (output, num_samples_run, printed) = self.run_samples(2, target_ratio_stderr=1e-12)
+        self.assertEqual(num_samples_run, 2 * margin_leverage.MAX_NUM_SAMPLES_PER_STARTING_SAMPLE)
+
+    def test_stratified_runs_cant_be_continued(self):
+        self.assertRaises(AssertionError, self.run_samples, 4, target_ratio_stderr=.01,
+                          sampling_mode=util.STRATIFIED_SAMPLING)
+
+    def test_precision_is_relative_to_the_ratios(self):
+        results = []
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            margin_leverage.run_sharded_samples(
+                [((self.investor, self.market, 8, ""), {"verbosity": 0,
+                                                         "num_margin_trajectories_to_save_as_figures": 0})],
+                1, lambda run_index, run_results: results.append(run_results))
+        finally:
+            sys.stdout = stdout
+        (N_to_1_leverage, ratio_of_means, ratio_of_means_error, ratio_of_medians, ratio_of_exp_util,
+         ratio_of_exp_util_error) = margin_leverage.margin_vs_regular_output(self.investor, results[0])
+        largest_relative_error = max(ratio_of_means_error / abs(ratio_of_means),
+                                     ratio_of_exp_util_error / abs(ratio_of_exp_util))
+        self.assertTrue(margin_leverage.ratios_are_precise_enough(self.investor, self.market, results[0],
+                                                                  largest_relative_error * 1.001))
+        self.assertFalse(margin_leverage.ratios_are_precise_enough(self.investor, self.market, results[0],
+                                                                   largest_relative_error * .999))
+
+if __name__ == "__main__":
+    unittest.main()
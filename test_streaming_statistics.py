@@ -0,0 +1,141 @@
+import math
+import unittest
+import numpy
+import ExactStatistics
+import StreamingStatistics
+import TDigest
+import util
+
+RELATIVE_TOLERANCE = 1e-12 # merged moments differ from added ones in rounding
+MOMENTS_RELATIVE_TOLERANCE = 1e-9 # moments differ from sums over all the values in rounding
+RANK_TOLERANCE = .002 # fraction of the values that a digest's quantile may be off by
+
+class StreamingStatisticsMergeTest(unittest.TestCase):
+    """StreamingStatistics of consecutive pieces of the samples, merged in
+    order, should equal those of all the samples added to one object, as long
+    as each piece but the last has an even number of samples"""
+
+    def setUp(self):
+        randgenerator = numpy.random.RandomState(0)
+        self.values = randgenerator.lognormal(12, 1, 11)
+        self.control_values = self.values * randgenerator.uniform(.8, 1.2, 11)
+
+    def statistics_of(self, first, end, add_one_at_a_time=False):
+        statistics = StreamingStatistics.StreamingStatistics()
+        if add_one_at_a_time:
+            for (value, control_value) in zip(self.values[first:end], self.control_values[first:end]):
+                statistics.add(value, control_value)
+        else:
+            statistics.add_values(self.values[first:end], self.control_values[first:end])
+        return statistics
+
+    def summary(self, statistics, sampling_modes):
+        summary = [statistics.num_values, statistics.mean(), statistics.sqrt_mean(), statistics.log_std(),
+                   statistics.min(), statistics.max()]
+        for sampling_mode in sampling_modes:
+            summary += [statistics.stderr(sampling_mode), statistics.sqrt_stderr(sampling_mode)]
+            summary += list(statistics.control_variate_mean_and_stderr(numpy.mean(self.control_values),
+                                                                       sampling_mode))
+        return summary
+
+    def check_merged_pieces_agree(self, piece_ends, sampling_modes):
+        merged_statistics = StreamingStatistics.StreamingStatistics()
+        first = 0
+        for (piece_num, end) in enumerate(piece_ends):
+            merged_statistics.merge(self.statistics_of(first, end, add_one_at_a_time=(piece_num % 2 == 1)))
+            first = end
+        for (merged_value, value) in zip(self.summary(merged_statistics, sampling_modes),
+                                         self.summary(self.statistics_of(0, piece_ends[-1]), sampling_modes)):
+            self.assertLessEqual(abs(merged_value - value), RELATIVE_TOLERANCE * abs(value),
+                                 "%r != %r" % (merged_value, value))
+
+    def test_merging_pieces_of_even_length(self):
+        self.check_merged_pieces_agree([4, 6, 10], [util.INDEPENDENT_SAMPLING, util.ANTITHETIC_SAMPLING,
+                                                    util.STRATIFIED_SAMPLING])
+
+    def test_last_piece_can_have_odd_length(self):
+        self.check_merged_pieces_agree([2, 8, 11], [util.INDEPENDENT_SAMPLING, util.STRATIFIED_SAMPLING])
+
+    def test_merging_empty_pieces(self):
+        self.check_merged_pieces_agree([0, 3, 3], [util.INDEPENDENT_SAMPLING, util.STRATIFIED_SAMPLING])
+
+    def test_merging_after_odd_number_of_samples_fails(self):
+        statistics = self.statistics_of(0, 3)
+        self.assertRaises(AssertionError, statistics.merge, self.statistics_of(3, 5))
+
+class StreamingVsExactStatisticsTest(unittest.TestCase):
+    """StreamingStatistics should give what ExactStatistics does: the same
+    statistics from moments, up to rounding, and nearly the same quantiles"""
+
+    NUM_VALUES = 20000
+
+    def setUp(self):
+        randgenerator = numpy.random.RandomState(0)
+        self.values = randgenerator.lognormal(12, 1, self.NUM_VALUES)
+        self.control_values = self.values * randgenerator.uniform(.8, 1.2, self.NUM_VALUES)
+        self.exact_statistics = ExactStatistics.ExactStatistics()
+        self.exact_statistics.add_values(self.values, self.control_values)
+        self.streaming_statistics = StreamingStatistics.StreamingStatistics()
+        for first in xrange(0, self.NUM_VALUES, 3000):
+            self.streaming_statistics.add_values(self.values[first:first+3000],
+                                                 self.control_values[first:first+3000])
+
+    def test_statistics_from_moments(self):
+        statistics = [lambda statistics: statistics.mean(), lambda statistics: statistics.sqrt_mean(),
+                      lambda statistics: statistics.log_std(), lambda statistics: statistics.min(),
+                      lambda statistics: statistics.max()]
+        for mode in [util.INDEPENDENT_SAMPLING, util.ANTITHETIC_SAMPLING, util.STRATIFIED_SAMPLING]:
+            statistics += [lambda statistics, mode=mode: statistics.stderr(mode),
+                           lambda statistics, mode=mode: statistics.sqrt_stderr(mode),
+                           lambda statistics, mode=mode: statistics.control_variate_mean_and_stderr(160000.0, mode)[0],
+                           lambda statistics, mode=mode: statistics.control_variate_mean_and_stderr(160000.0, mode)[1]]
+        for statistic in statistics:
+            (exact_value, streaming_value) = (statistic(self.exact_statistics), statistic(self.streaming_statistics))
+            self.assertLessEqual(abs(streaming_value - exact_value), MOMENTS_RELATIVE_TOLERANCE * abs(exact_value),
+                                 "%r != %r" % (streaming_value, exact_value))
+
+    def test_quantiles(self):
+        sorted_values = numpy.sort(self.values)
+        for (percentile_as_fraction, exact_value, streaming_value) in [
+                (.5, self.exact_statistics.median(), self.streaming_statistics.median())] + \
+                [(fraction, self.exact_statistics.percentile(fraction), self.streaming_statistics.percentile(fraction))
+                 for fraction in [.001, .1, .9, .999]]:
+            fraction_below = numpy.searchsorted(sorted_values, streaming_value) / float(self.NUM_VALUES)
+            self.assertLessEqual(abs(fraction_below - percentile_as_fraction), RANK_TOLERANCE,
+                                 "%g: %r vs. %r" % (percentile_as_fraction, streaming_value, exact_value))
+        self.assertAlmostEqual(self.streaming_statistics.expected_value_of(math.sqrt),
+                               self.exact_statistics.expected_value_of(math.sqrt),
+                               delta=1e-3 * self.exact_statistics.expected_value_of(math.sqrt))
+
+    def test_fraction_greater_than(self):
+        (exact_statistics, streaming_statistics) = (ExactStatistics.ExactStatistics(),
+                                                    StreamingStatistics.StreamingStatistics())
+        other_values = self.values[::-1] * numpy.linspace(.8, 1.3, self.NUM_VALUES)
+        exact_statistics.add_values(other_values)
+        streaming_statistics.add_values(other_values)
+        self.assertAlmostEqual(streaming_statistics.fraction_greater_than(self.streaming_statistics),
+                               exact_statistics.fraction_greater_than(self.exact_statistics), delta=.01)
+
+class TDigestTest(unittest.TestCase):
+    def test_merged_digests_keep_quantiles_and_stay_small(self):
+        randgenerator = numpy.random.RandomState(1)
+        values = randgenerator.standard_normal(50000)
+        digest = TDigest.TDigest()
+        for first in xrange(0, len(values), 7000):
+            piece_digest = TDigest.TDigest()
+            for value in values[first:first+7000]:
+                piece_digest.add(value)
+            digest.merge(piece_digest)
+        (means, weights) = digest.centroids()
+        self.assertEqual(digest.num_values, len(values))
+        self.assertLessEqual(len(means), 1000)
+        self.assertEqual((digest.min, digest.max), (numpy.min(values), numpy.max(values)))
+        sorted_values = numpy.sort(values)
+        for fraction in [.0001, .01, .25, .5, .75, .99, .9999]:
+            estimate = digest.values_at_ranks(fraction * len(values))
+            fraction_below = numpy.searchsorted(sorted_values, estimate) / float(len(values))
+            self.assertLessEqual(abs(fraction_below - fraction), RANK_TOLERANCE)
+            self.assertAlmostEqual(float(digest.fractions_below([estimate])[0]), fraction, delta=RANK_TOLERANCE)
+
+if __name__ == "__main__":
+    unittest.main()
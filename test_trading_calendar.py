@@ -0,0 +1,70 @@
+from datetime import date
+import unittest
+import numpy
+import TradingCalendar
+import util
+
+class TradingHolidaysTest(unittest.TestCase):
+    def test_2015_holidays(self):
+        self.assertEqual(util.trading_holidays(2015), util.TRADING_HOLIDAYS)
+
+    def test_holidays_that_fall_on_weekends(self):
+        """In 2016, Christmas is on a Sunday; in 2021, July 4 is on a Sunday;
+        in 2022, New Year's Day is on a Saturday (and not observed) and
+        Juneteenth, first observed that year, is on a Sunday"""
+        self.assertEqual(util.trading_holidays(2016),
+                         [date(2016,1,1), date(2016,1,18), date(2016,2,15), date(2016,3,25), date(2016,5,30),
+                          date(2016,7,4), date(2016,9,5), date(2016,11,24), date(2016,12,26)])
+        self.assertEqual(util.trading_holidays(2021),
+                         [date(2021,1,1), date(2021,1,18), date(2021,2,15), date(2021,4,2), date(2021,5,31),
+                          date(2021,7,5), date(2021,9,6), date(2021,11,25), date(2021,12,24)])
+        self.assertEqual(util.trading_holidays(2022),
+                         [date(2022,1,17), date(2022,2,21), date(2022,4,15), date(2022,5,30), date(2022,6,20),
+                          date(2022,7,4), date(2022,9,5), date(2022,11,24), date(2022,12,26)])
+
+class TradingCalendarTest(unittest.TestCase):
+    NUM_DAYS = 3 * 365 + 10
+    (DAYS_PER_YEAR, PAY_EVERY_NUM_DAYS, TAX_DAY, TAX_LOSS_HARVEST_DAY) = (365, 14, 103, 364)
+
+    def calendar(self, start_year=None):
+        return TradingCalendar.TradingCalendar(self.NUM_DAYS, self.DAYS_PER_YEAR, self.PAY_EVERY_NUM_DAYS,
+                                               self.TAX_DAY, self.TAX_LOSS_HARVEST_DAY, start_year)
+
+    def test_every_year_is_2015_without_a_start_year(self):
+        """Matches the day-by-day checks that one_run used to make"""
+        calendar = self.calendar()
+        expected_trading_days = [day for day in xrange(self.NUM_DAYS)
+                                 if not util.day_is_weekend(day % self.DAYS_PER_YEAR)
+                                 and not util.day_is_holiday(day % self.DAYS_PER_YEAR)]
+        self.assertEqual(list(calendar.trading_days), expected_trading_days)
+        self.assertEqual(calendar.num_trading_days, len(expected_trading_days))
+        self.assertEqual(list(calendar.pay_days), range(0, self.NUM_DAYS, self.PAY_EVERY_NUM_DAYS))
+        self.assertEqual(list(calendar.tax_days), [103, 468, 833])
+        self.assertEqual(list(calendar.tax_loss_harvest_days), [364, 729, 1094])
+
+    def test_start_year_gives_each_year_its_own_days(self):
+        """2016 is a leap year, so day 366 is Jan 1, 2017, a Sunday, observed
+        on Monday, Jan 2"""
+        calendar = self.calendar(2016)
+        self.assertEqual([calendar.is_trading_day[day] for day in [0, 3, 365, 366, 367, 368]],
+                         [False, True, False, False, False, True])
+        self.assertEqual(numpy.sum(calendar.is_trading_day[:366]), 252) # NYSE trading days in 2016
+
+    def test_num_trading_days_before(self):
+        calendar = self.calendar(2016)
+        num_trading_days_before = calendar.num_trading_days_before
+        self.assertEqual(len(num_trading_days_before), self.NUM_DAYS + 1)
+        self.assertEqual(num_trading_days_before[-1], calendar.num_trading_days)
+        for day in xrange(self.NUM_DAYS):
+            self.assertEqual(num_trading_days_before[day], numpy.sum(calendar.trading_days < day))
+
+    def test_event_days(self):
+        calendar = self.calendar()
+        for (day, is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day) in calendar.event_days():
+            self.assertEqual((is_trading_day, is_pay_day, is_tax_day, is_tax_loss_harvest_day),
+                             (calendar.is_trading_day[day], calendar.is_pay_day[day],
+                              calendar.is_tax_day[day], calendar.is_tax_loss_harvest_day[day]))
+            self.assertIs(type(is_trading_day), bool)
+
+if __name__ == "__main__":
+    unittest.main()
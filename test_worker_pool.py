@@ -0,0 +1,55 @@
+import os
+import unittest
+import worker_pool
+
+def square(number):
+    return number * number
+
+def process_id(task):
+    return os.getpid()
+
+def in_worker(task):
+    return worker_pool.in_worker()
+
+def fail_on_three(number):
+    if number == 3:
+        raise ValueError("task 3 failed")
+    return number
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_results_are_in_the_order_of_the_tasks(self):
+        tasks = range(10)
+        costs = [task % 3 for task in tasks]
+        for num_workers in [1, 3]:
+            self.assertEqual(worker_pool.run_tasks(square, tasks, num_workers, costs),
+                             [task * task for task in tasks])
+
+    def test_on_result_gets_each_result_once(self):
+        for num_workers in [1, 3]:
+            results = dict()
+            def record(task_index, result):
+                self.assertNotIn(task_index, results)
+                results[task_index] = result
+            self.assertEqual(worker_pool.run_tasks(square, range(7), num_workers, on_result=record), [None] * 7)
+            self.assertEqual(results, dict((task, task * task) for task in range(7)))
+
+    def test_costliest_tasks_start_first(self):
+        started = []
+        worker_pool.run_tasks(square, [1, 2, 3, 4], 1, costs=[1, 5, 2, 5],
+                              on_result=lambda task_index, result: started.append(task_index))
+        self.assertEqual(started, [1, 3, 2, 0])
+
+    def test_one_worker_runs_tasks_in_this_process(self):
+        self.assertEqual(worker_pool.run_tasks(process_id, range(3), 1), [os.getpid()] * 3)
+        self.assertNotIn(os.getpid(), worker_pool.run_tasks(process_id, range(3), 2))
+
+    def test_workers_know_they_are_workers(self):
+        self.assertEqual(worker_pool.run_tasks(in_worker, range(3), 1), [False] * 3)
+        self.assertEqual(worker_pool.run_tasks(in_worker, range(3), 2), [True] * 3)
+        self.assertFalse(worker_pool.in_worker())
+
+    def test_errors_in_workers_are_raised(self):
+        self.assertRaises(ValueError, worker_pool.run_tasks, fail_on_three, range(6), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,6 +24,59 @@ def day_is_holiday(day_number_in_the_year):
             return True
     return False
 
+MONDAY = 0
+THURSDAY = 3
+FRIDAY = 4
+YEAR_NYSE_STARTED_OBSERVING_JUNETEENTH = 2022
+
+def nth_weekday_of_month(year, month, weekday, n):
+    """n=1 gives the first such weekday of the month, n=-1 the last."""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % DAYS_PER_WEEK + DAYS_PER_WEEK*(n-1))
+    else:
+        last = date(year, month+1, 1) - timedelta(days=1) if month < 12 else date(year, 12, 31)
+        return last - timedelta(days=(last.weekday() - weekday) % DAYS_PER_WEEK)
+
+def easter_sunday(year):
+    """Anonymous Gregorian algorithm: https://en.wikipedia.org/wiki/Computus#Anonymous_Gregorian_algorithm"""
+    a = year % 19
+    b = year // 100
+    c = year % 100
+    d = (19*a + b - b//4 - (b - (b+8)//25 + 1)//3 + 15) % 30
+    e = (32 + 2*(b % 4) + 2*(c//4) - d - (c % 4)) % 7
+    f = d + e - 7*((a + 11*d + 22*e) // 451) + 114
+    return date(year, f // 31, f % 31 + 1)
+
+def observed_holiday(holiday):
+    """Holidays on Saturday are observed the Friday before; holidays on 
+    Sunday are observed the Monday after."""
+    if holiday.weekday() == SATURDAY:
+        return holiday - timedelta(days=1)
+    elif holiday.weekday() == SUNDAY:
+        return holiday + timedelta(days=1)
+    return holiday
+
+def trading_holidays(year):
+    """NYSE holiday rules (https://www.nyse.com/markets/hours-calendars) applied
+    to any year. For 2015 this gives TRADING_HOLIDAYS. New Year's Day falling on a
+    Saturday isn't observed because the NYSE doesn't close on Dec 31 for it."""
+    holidays = []
+    new_years = date(year,1,1)
+    if new_years.weekday() != SATURDAY:
+        holidays.append(observed_holiday(new_years))
+    holidays.append(nth_weekday_of_month(year, 1, MONDAY, 3)) # Martin Luther King, Jr. Day
+    holidays.append(nth_weekday_of_month(year, 2, MONDAY, 3)) # Washington's Birthday
+    holidays.append(easter_sunday(year) - timedelta(days=2)) # Good Friday
+    holidays.append(nth_weekday_of_month(year, 5, MONDAY, -1)) # Memorial Day
+    if year >= YEAR_NYSE_STARTED_OBSERVING_JUNETEENTH:
+        holidays.append(observed_holiday(date(year,6,19)))
+    holidays.append(observed_holiday(date(year,7,4)))
+    holidays.append(nth_weekday_of_month(year, 9, MONDAY, 1)) # Labor Day
+    holidays.append(nth_weekday_of_month(year, 11, THURSDAY, 4)) # Thanksgiving
+    holidays.append(observed_holiday(date(year,12,25)))
+    return holidays
+
 def update_price(current_price, rate_of_return):
     """Let R dt be the rate of return for this small time step. dS = S R dt. 
     Then to update S, we set S = S + dS = S + S R dt = S (1 + R dt),
@@ -69,6 +122,22 @@ def create_timestamped_dir(prefix):
     os.mkdir(outdir_name) # let it fail if dir already exists
     return outdir_name
 
+def object_parameters(obj):
+    """Sorted (name, value) pairs for all of obj's properties, other than
+    those its class lists in STATE_PROPERTIES (state that changes while it's
+    used, like Investor.laid_off). Values that themselves have properties
+    (like an Investor's TaxRates) are expanded the same way. Useful for
+    telling whether two configurations are the same."""
+    parameters = []
+    for name in sorted(dir(type(obj))):
+        if isinstance(getattr(type(obj), name), property) and \
+            name not in getattr(type(obj), "STATE_PROPERTIES", []):
+            value = getattr(obj, name)
+            if any(isinstance(getattr(type(value), attr, None), property) for attr in dir(type(value))):
+                value = object_parameters(value)
+            parameters.append((name, value))
+    return parameters
+
 def N_to_1_leverage_to_max_margin_to_assets_ratio(N_to_1_leverage):
     """
     Record our leverage amount in N:1 terms. 2:1 leverage means up to half
@@ -85,16 +154,61 @@ def max_margin_to_assets_ratio_to_N_to_1_leverage(max_margin_to_assets_ratio):
     """
     return 1/(1-max_margin_to_assets_ratio)
 
-def stderr(numpy_array):
-    return numpy.std(numpy_array) / math.sqrt(len(numpy_array))
+INDEPENDENT_SAMPLING = "independent"
+ANTITHETIC_SAMPLING = "antithetic"
+STRATIFIED_SAMPLING = "stratified"
 
-def ratio_of_means_with_error_bars(numpy_array1, numpy_array2):
+def stderr(numpy_array, sampling_mode=INDEPENDENT_SAMPLING):
+    """Standard error of the mean of values from sample paths 0, 1, ..., in
+    order, generated with the given sampling mode (see Market.random_daily_returns).
+    - Antithetic: the pair means are independent, so use their spread.
+    - Stratified (one path per stratum): there's no within-stratum spread to
+      measure, so collapse neighboring strata into pairs. This slightly
+      overstates the error, which is the safe direction."""
+    numpy_array = numpy.asarray(numpy_array, dtype=float)
+    num_values = len(numpy_array)
+    if sampling_mode == ANTITHETIC_SAMPLING:
+        assert num_values % 2 == 0, "Antithetic samples come in pairs"
+        pair_means = (numpy_array[0::2] + numpy_array[1::2]) / 2
+        return numpy.std(pair_means) / math.sqrt(len(pair_means))
+    elif sampling_mode == STRATIFIED_SAMPLING:
+        num_pairs = num_values / 2
+        differences = numpy_array[0:2*num_pairs:2] - numpy_array[1:2*num_pairs:2]
+        sum_of_variances = numpy.sum(differences**2) * num_values / (2.0*num_pairs)
+        return math.sqrt(sum_of_variances) / num_values
+    else:
+        assert sampling_mode == INDEPENDENT_SAMPLING, "Unknown sampling mode %s" % sampling_mode
+        return numpy.std(numpy_array) / math.sqrt(num_values)
+
+def control_variate_mean_and_stderr(numpy_array, control_values, expected_control_value,
+                                    sampling_mode=INDEPENDENT_SAMPLING):
+    """Estimate the mean of numpy_array using a control variate: control_values
+    are computed on the same sample paths, and their expectation is known to be
+    expected_control_value. Subtracting b * (control - expected) from each value
+    doesn't change the expectation but removes the part of the variance that
+    the control explains, when b is the regression coefficient of the values
+    on the controls. Estimating b from the same sample adds a bias of order
+    1/len(numpy_array), which is negligible next to the standard error.
+    Returns (mean, stderr)."""
+    numpy_array = numpy.asarray(numpy_array, dtype=float)
+    control_values = numpy.asarray(control_values, dtype=float)
+    control_variance = numpy.var(control_values)
+    if control_variance > 0:
+        coefficient = numpy.mean((numpy_array - numpy.mean(numpy_array)) * 
+                                 (control_values - numpy.mean(control_values))) / control_variance
+    else:
+        coefficient = 0
+    adjusted_values = numpy_array - coefficient * (control_values - expected_control_value)
+    return (numpy.mean(adjusted_values), stderr(adjusted_values, sampling_mode))
+
+def ratio_of_means_with_error_bars(numpy_array1, numpy_array2, sampling_mode=INDEPENDENT_SAMPLING):
     """Take two arrays and compute (mean of first)/(mean of second)
     as well as the appropriate error bars for this ratio."""
-    mean1 = numpy.mean(numpy_array1)
-    mean2 = numpy.mean(numpy_array2)
-    stderr1 = stderr(numpy_array1)
-    stderr2 = stderr(numpy_array2)
+    return ratio_with_error_bars(numpy.mean(numpy_array1), stderr(numpy_array1, sampling_mode),
+                                 numpy.mean(numpy_array2), stderr(numpy_array2, sampling_mode))
+
+def ratio_with_error_bars(mean1, stderr1, mean2, stderr2):
+    """mean1/mean2 and its error bars, given the two means' standard errors."""
     """
     "Uncertainties and Error Propagation - Part I of a manual on 
     Uncertainties, Graphing, and the Vernier Caliper" by Vern Lindberg
@@ -128,6 +242,19 @@ def fractional_difference(num1, num2):
     else:
         return (float(num1) - num2)/num2
 
+def fractional_differences(nums1, nums2):
+    """fractional_difference for each pair of elements of two numpy arrays"""
+    differences = (nums1 - nums2) / numpy.where(nums2 == 0, 1.0, nums2)
+    differences[(nums1 == 0) | (nums2 == 0)] = float("inf")
+    differences[(nums1 == 0) & (nums2 == 0)] = 0
+    return differences
+
+def running_products(initial_value, factors):
+    """[initial_value, initial_value*factors[0], initial_value*factors[0]*factors[1], ...]
+    as a numpy array. numpy.cumprod multiplies in order, one factor at a time,
+    so the results are exactly the same as updating a value with *= each day."""
+    return numpy.cumprod(numpy.concatenate(([initial_value], factors)))
+
 def round_decimal_to_given_num_of_sig_figs(decimal_less_than_1, sig_figs):
     """Inspired by http://stackoverflow.com/questions/3410976/how-to-round-a-number-to-significant-figures-in-python/3413529#3413529"""
     assert decimal_less_than_1 < 1.0, "This function is only built for decimals less than 1.0"
@@ -187,11 +314,18 @@ def per_period_annuity_payment_of_principal(principal, num_payment_periods,
     This is the formula for an annuity-due (a-with-umlauts N|R):
     https://en.wikipedia.org/wiki/Annuity_(finance_theory)#Annuity-due
     """
+    return principal * per_period_annuity_fraction_of_principal(num_payment_periods, 
+        loan_interest_rate, pay_principal_throughout)
+
+def per_period_annuity_fraction_of_principal(num_payment_periods, loan_interest_rate,
+                                             pay_principal_throughout):
+    """A/P from per_period_annuity_payment_of_principal. It doesn't depend on
+    the principal, so it can be computed ahead of time for each pay period."""
     if pay_principal_throughout:
         if num_payment_periods == 0:
-            return principal # pay off the whole remaining balance if we're at the last pay period
+            return 1.0 # pay off the whole remaining balance if we're at the last pay period
         else:
             inverse_interest = 1/(1+loan_interest_rate)
-            return principal * (1-inverse_interest) / (1-inverse_interest**num_payment_periods)
+            return (1-inverse_interest) / (1-inverse_interest**num_payment_periods)
     else:
         return 0 # not paying principal now; just pay at the end
\ No newline at end of file
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+
+WAIT_SECONDS_BETWEEN_CHECKS = 1
+"""How long to wait for the next result before checking again. Waiting with a
+timeout lets Ctrl-C through in Python 2, which ignores it during a plain wait."""
+IN_WORKER = False # set in run_tasks's worker processes; see in_worker
+
+def num_available_cores():
+    """Cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # not in Python 2
+        return multiprocessing.cpu_count()
+
+def run_tasks(function, tasks, num_workers=None, costs=None, on_result=None):
+    """Run function(task) for each of tasks on a pool of num_workers processes
+    (by default, one per available core). Each worker takes the next task off
+    the queue as soon as it finishes one, so all of them stay busy until the
+    queue runs out, however long the individual tasks take. If costs are
+    given (e.g., estimated run times, one per task), the costliest tasks are
+    started first so that no long task is left running alone at the end.
+
+    function must be a module-level function so that it can be sent to the
+    workers, and tasks and results must be picklable. on_result(task_index,
+    result) is called in this process as each task finishes, in the order
+    they finish, and then the result isn't kept; otherwise, the results are
+    returned in the order of tasks. With one worker, the tasks run in this
+    process instead, which is easier to debug."""
+    if num_workers is None:
+        num_workers = num_available_cores()
+    num_workers = max(1, min(num_workers, len(tasks)))
+    task_indices = range(len(tasks))
+    if costs is not None:
+        task_indices.sort(key=lambda task_index: -costs[task_index])
+    results = [None] * len(tasks)
+
+    def record(task_index, result):
+        if on_result:
+            on_result(task_index, result)
+        else:
+            results[task_index] = result
+
+    if num_workers == 1:
+        for task_index in task_indices:
+            record(task_index, function(tasks[task_index]))
+        return results
+
+    pool = multiprocessing.Pool(num_workers, initializer=mark_as_worker)
+    try:
+        finished_tasks = pool.imap_unordered(run_indexed_task,
+            [(function, task_index, tasks[task_index]) for task_index in task_indices], chunksize=1)
+        for num_finished in xrange(len(tasks)):
+            while True:
+                try:
+                    (task_index, result) = finished_tasks.next(timeout=WAIT_SECONDS_BETWEEN_CHECKS)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+            record(task_index, result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def mark_as_worker():
+    global IN_WORKER
+    IN_WORKER = True
+
+def in_worker():
+    """Whether this is one of run_tasks's worker processes rather than the
+    process that called it (as with one worker)"""
+    return IN_WORKER
+
+def run_indexed_task((function, task_index, task)):
+    return (task_index, function(task))
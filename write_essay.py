@@ -35,8 +35,8 @@ QUICK_M_T_OPTIMIZATION = False
 NUM_LEV_ETF_TRAJECTORIES_TO_SAVE_AS_FIGURES = 10
 
 def write_essay(skeleton, outfile, cur_working_dir, num_trials, 
-                use_local_image_file_paths, approx_num_simultaneous_processes,
-                data_already_exists, timestamp):
+                use_local_image_file_paths, num_workers,
+                data_already_exists, timestamp, search_for_optimal_leverage=False):
     """The following are the markers in the text that indicate
     where to replace with output numbers."""
 
@@ -52,10 +52,11 @@ def write_essay(skeleton, outfile, cur_working_dir, num_trials,
         leveraged_etf_returns.sweep_variations(leveraged_etf_returns.FUNDS_AND_EXPENSE_RATIOS, 
                                                LEV_ETF_LEVERAGE_RATIO, LEV_ETF_NUM_SAMPLES,
                                                NUM_LEV_ETF_TRAJECTORIES_TO_SAVE_AS_FIGURES, 
-                                               cur_working_dir)
+                                               cur_working_dir, num_workers=num_workers)
         # run margin sim
         margin_leverage.optimal_leverage_for_all_scenarios(num_trials, False, cur_working_dir, 
-                                                           approx_num_simultaneous_processes=approx_num_simultaneous_processes)
+                                                           num_workers=num_workers,
+                                                           search=search_for_optimal_leverage)
 
     """Read and parse the results for leveraged ETFs."""
     starting_balance_for_leveraged_ETF_sim = default_investor.initial_annual_income_for_investing * \
@@ -902,10 +903,11 @@ or else the params filled in to the output HTMl file will be wrong!
 ============
 """
             NUM_TRIALS = 1000
-            APPROX_NUM_SIMULTANEOUS_PROCESSES = 1
-            #APPROX_NUM_SIMULTANEOUS_PROCESSES = 3
+            NUM_WORKERS = None # one per available core
+            #NUM_WORKERS = 3
+            SEARCH_FOR_OPTIMAL_LEVERAGE = False # True to search each scenario's leverage amounts instead of running them all
             write_essay(skeleton, outfile, cur_folder, NUM_TRIALS, LOCAL_FILE_PATHS_IN_HTML, 
-                        APPROX_NUM_SIMULTANEOUS_PROCESSES, data_already_exists, timestamp)
+                        NUM_WORKERS, data_already_exists, timestamp, SEARCH_FOR_OPTIMAL_LEVERAGE)
 
         """Once this is finished, you should have a timestamped folder with an essay HTML file and
         a bunch of figures. Just bulk upload the figures to WordPress and copy-paste
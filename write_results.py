@@ -1,6 +1,4 @@
-import numpy
 import util
-import math
 
 def results_table_file_name(outfilepath):
     return outfilepath + "_table.txt"
@@ -8,41 +6,49 @@ def results_table_file_name(outfilepath):
 def other_results_file_name(outfilepath):
     return outfilepath + "_other.txt"
 
-def write_means(account_values, years_until_donation_date, outfile):
-    regular_mean = util.mean(account_values["regular"])
-    margin_mean = util.mean(account_values["margin"])
-    matched_401k_mean = util.mean(account_values["matched401k"])
+def write_means(account_statistics, years_until_donation_date, outfile):
+    """account_statistics maps account types to their ExactStatistics or
+    StreamingStatistics, as in the functions below."""
+    regular_mean = account_statistics["regular"].mean()
+    margin_mean = account_statistics["margin"].mean()
+    matched_401k_mean = account_statistics["matched401k"].mean()
     outfile.write("\n")
     outfile.write("Mean regular = ${:,}\n".format(int(round(regular_mean,0))))
     outfile.write("Mean margin = ${:,}\n".format(int(round(margin_mean,0))))
     outfile.write("Mean matched 401k = ${:,}\n".format(int(round(matched_401k_mean,0))))
     outfile.write("Mean value per year of margin over regular = ${:,}\n".format(int(round( (margin_mean-regular_mean)/years_until_donation_date, 0))))
 
-def write_percentiles(account_values, outfile):
+def write_percentiles(account_statistics, outfile):
     for percentile in [0, 10, 25, 50, 75, 90, 100]:
         fractional_percentile = percentile/100.0
         outfile.write("\n")
         for type in ["regular", "margin", "matched401k"]:
-            outfile.write( str(percentile) + "th percentile " + type + " = ${:,}\n".format(int(round(util.percentile(account_values[type], fractional_percentile),0))) )
+            outfile.write( str(percentile) + "th percentile " + type + " = ${:,}\n".format(int(round(account_statistics[type].percentile(fractional_percentile),0))) )
 
-def write_winner_for_each_percentile(account_values, outfile):
+def write_winner_for_each_percentile(account_statistics, outfile):
     index = 0
-    sorted_regular_list = sorted(account_values["regular"])
-    sorted_margin_list = sorted(account_values["margin"])
-    assert len(sorted_regular_list) == len(sorted_margin_list), "Regular and margin lists not the same length"
-    upper_index = len(sorted_regular_list) - 1
+    regular_statistics = account_statistics["regular"]
+    margin_statistics = account_statistics["margin"]
+    assert regular_statistics.num_values == margin_statistics.num_values, "Regular and margin lists not the same length"
+    upper_index = regular_statistics.num_values - 1
     outfile.write("\n")
     outfile.write("Margin vs. regular % at percentiles 0 to 100:\n")
     for percentile in xrange(100):
         index = int((percentile/100.0)*upper_index)
-        if sorted_regular_list[index] > 0: # prevent divide-by-zero errors
-            outfile.write( "{}% ".format(int(round( (100.0 * sorted_margin_list[index]) / sorted_regular_list[index], 0 ))) )
+        regular_value = regular_statistics.value_at_sorted_index(index)
+        if regular_value > 0: # prevent divide-by-zero errors
+            outfile.write( "{}% ".format(int(round( (100.0 * margin_statistics.value_at_sorted_index(index)) / regular_value, 0 ))) )
 
-def write_file_table(account_values, account_types, 
+def write_file_table(account_statistics, account_types, 
                      fraction_times_margin_strategy_went_bankrupt, outfile,
                      fraction_times_margin_ended_with_emergency_savings_gap=None,
                      avg_percent_diff_from_simple_calc=None,
-                     avg_simple_calc_value=None):
+                     avg_simple_calc_value=None,
+                     sampling_mode=util.INDEPENDENT_SAMPLING,
+                     control_variate_means_and_stderrs=None):
+    """control_variate_means_and_stderrs, if given, maps account types to
+    (mean, stderr) estimated with control variates; these are reported after
+    the table, next to the raw means in it."""
     REGULAR_INDEX = 0
     LEVERAGE_INDEX = 1
     assert account_types[REGULAR_INDEX] == "regular", "Regular account has to go in the 0th index"
@@ -50,17 +56,15 @@ def write_file_table(account_values, account_types,
     outfile.write("<table>\n")
     outfile.write("""<tr><td><i>Type</i></td> <td><i>Mean &plusmn; stderr</i></td> <td><i>Median</i></td> <td><i>Min</i></td> <td><i>Max</i></td> <td><i>E[&radic;<span style="text-decoration: overline">wealth</span>] &plusmn; stderr</i></td> <td><i>&sigma;<sub>ln(wealth)</sub></i></td> </tr>\n""");
     for type in account_types:
-        numpy_values = numpy.array(account_values[type])
-        log_values = map(math.log, numpy_values+1) # The +1 here is so that the log() value will be at least 0
-        sqrt_values = map(math.sqrt, numpy_values)
+        statistics = account_statistics[type]
         outfile.write("<tr><td><i>{}</i></td> <td>${:,} &plusmn; ${:,}</td> <td>${:,}</td> <td>${:,}</td> <td>${:,}</td> <td>{:,} &plusmn; {:,}</td> <td>{:.2f}</td></tr>\n".format( 
             return_pretty_name_for_type(type), 
-            int(round(numpy.mean(numpy_values),0)) , int(round(util.stderr(numpy_values),0)), 
-            int(round(numpy.median(numpy_values),0)) , 
-            int(round(util.percentile(account_values[type], 0),0)) , 
-            int(round(util.percentile(account_values[type], 1),0)) ,
-            int(round(numpy.mean(sqrt_values),0)), int(round(util.stderr(sqrt_values),0)), 
-            numpy.std(log_values) ))
+            int(round(statistics.mean(),0)) , int(round(statistics.stderr(sampling_mode),0)), 
+            int(round(statistics.median(),0)) , 
+            int(round(statistics.percentile(0),0)) , 
+            int(round(statistics.percentile(1),0)) ,
+            int(round(statistics.sqrt_mean(),0)), int(round(statistics.sqrt_stderr(sampling_mode),0)), 
+            statistics.log_std() ))
     outfile.write("</table>")
     emergency_savings_gap = ""
     if fraction_times_margin_ended_with_emergency_savings_gap is not None:
@@ -69,12 +73,41 @@ def write_file_table(account_values, account_types,
     if avg_simple_calc_value is not None:
         avg_simple_calc_string = " Average simple-calculation margin ending balance was {}.".format(util.format_as_dollar_string(avg_simple_calc_value))
     outfile.write("\nLeverage is better than regular {}% of the time.{} Leveraged account went fully bankrupt {}% of the time.{}".format(
-        int(round(100 * util.probability_x_better_than_y(
-            account_values[account_types[LEVERAGE_INDEX]],
-            account_values[account_types[REGULAR_INDEX]]),1)), 
+        int(round(100 * account_statistics[account_types[LEVERAGE_INDEX]].fraction_greater_than(
+            account_statistics[account_types[REGULAR_INDEX]]),1)), 
         emergency_savings_gap,
         round(100 * fraction_times_margin_strategy_went_bankrupt,1),
         avg_simple_calc_string))
+    if control_variate_means_and_stderrs is not None:
+        outfile.write("\nMeans &plusmn; stderr using control variates: {}.".format("; ".join(
+            "{} ${:,} &plusmn; ${:,}".format(return_pretty_name_for_type(type),
+                int(round(control_variate_means_and_stderrs[type][0],0)),
+                int(round(control_variate_means_and_stderrs[type][1],0)))
+            for type in account_types)))
+
+def write_num_samples_for_target_stderr(num_samples, target_ratio_stderr, target_reached, outfile):
+    """For runs that ran until the standard errors of the margin-vs.-regular
+    ratios reached target_ratio_stderr (see margin_leverage.run_samples)"""
+    outfile.write("\nRan {:,} samples {} standard errors of the ratios of means and of E[&radic;<span style=\"text-decoration: overline\">wealth</span>] of at most {}%.".format(
+        num_samples, "to reach" if target_reached else "(the most allowed) without reaching",
+        100 * target_ratio_stderr))
+
+def write_leverage_search_round(num_samples, objective_name, objectives, outfile):
+    """For a round of margin_leverage.search_for_optimal_leverage: objectives
+    has the (N_to_1_leverage, objective, stderr or None) of each leverage
+    amount still in the search"""
+    outfile.write("\n{:,} samples:\n".format(num_samples))
+    for (N_to_1_leverage, objective, stderr) in objectives:
+        outfile.write("{:.3f}:1 leverage: {} = {:.4f}{}\n".format(N_to_1_leverage, objective_name, objective,
+            "" if stderr is None else " +/- {:.4f}".format(stderr)))
+
+def write_optimal_leverage(N_to_1_leverage, interval, objective_name, objective, stderr,
+                           num_samples_run, num_samples_for_grid, outfile):
+    outfile.write("\nOptimal leverage = {:.3f}:1 (between {:.3f}:1 and {:.3f}:1), with {} = {:.4f}{}\n".format(
+        N_to_1_leverage, interval[0], interval[1], objective_name, objective,
+        "" if stderr is None else " +/- {:.4f}".format(stderr)))
+    outfile.write("Ran {:,} samples, vs. {:,} to run every leverage amount with all the samples\n".format(
+        num_samples_run, num_samples_for_grid))
 
 def return_pretty_name_for_type(type):
     if type == "regular":